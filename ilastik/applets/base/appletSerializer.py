@@ -29,6 +29,7 @@ from ilastik.utility.maybe import maybe
 import os
 import re
 import tempfile
+import threading
 import h5py
 import numpy
 import warnings
@@ -343,7 +344,22 @@ class SerialListSlot(SerialSlot):
         self.dirty = False
 
 class SerialBlockSlot(SerialSlot):
-    """A slot which only saves nonzero blocks."""
+    """
+    A slot which only saves nonzero blocks.
+
+    After the first save, subsequent saves are incremental: the regions of
+    the slot that became dirty since the last save are recorded, and only
+    the stored blocks that intersect them are rewritten (or deleted, if the
+    block no longer contains any data).  The rest of the stored blocks are
+    left untouched, so saving is fast even if the project contains many
+    blocks.  If the stored blocks don't match the slot (e.g. lanes were
+    added or removed), the whole group is rewritten.
+    """
+
+    # If more dirty regions than this accumulate for one lane between saves,
+    #  the lane is rewritten entirely instead.
+    MAX_DIRTY_ROIS = 1000
+
     def __init__(self, slot, inslot, blockslot, name=None, subname=None,
                  default=None, depends=None, selfdepends=True, shrink_to_bb=False):
         """
@@ -360,6 +376,52 @@ class SerialBlockSlot(SerialSlot):
         self._bind(slot)
         self._shrink_to_bb = shrink_to_bb
 
+        # Dirty regions since the last save, for each lane (keyed by subslot).
+        # None means the whole lane must be rewritten.
+        self._dirtyRoisLock = threading.Lock()
+        self._dirtyRois = {}
+        self._rewriteAll = False
+        self._bindDirtyRois()
+
+    def _bindDirtyRois(self):
+        """
+        Record the dirty regions of each lane, so the next save only needs to update those regions.
+        """
+        def handleDirtyRoi(subslot, roi, **kwargs):
+            self._addDirtyRoi( subslot, roi.start, roi.stop )
+
+        def handleLaneValueChanged(subslot, *args, **kwargs):
+            self._addDirtyRoi( subslot, None, None )
+
+        def bindLane(slot, index, *args):
+            slot[index].notifyDirty( handleDirtyRoi )
+            slot[index].notifyValueChanged( handleLaneValueChanged )
+
+        def handleLanesChanged(*args):
+            # Lanes are stored by index, so all of them must be rewritten.
+            if not self.ignoreDirty:
+                with self._dirtyRoisLock:
+                    self._rewriteAll = True
+
+        for index in range( len(self.slot) ):
+            bindLane( self.slot, index )
+        self.slot.notifyInserted( bindLane )
+        self.slot.notifyInserted( handleLanesChanged )
+        self.slot.notifyRemoved( handleLanesChanged )
+
+    def _addDirtyRoi(self, subslot, start, stop):
+        if self.ignoreDirty:
+            return
+        with self._dirtyRoisLock:
+            if subslot in self._dirtyRois and self._dirtyRois[subslot] is None:
+                return
+            rois = self._dirtyRois.setdefault( subslot, [] )
+            if start is None or len(rois) >= self.MAX_DIRTY_ROIS:
+                self._dirtyRois[subslot] = None
+            else:
+                rois.append( (tuple(start), tuple(stop)) )
+        self.dirty = True
+
     def shouldSerialize(self, group):
         # Should this be a docstring?
         #
@@ -396,22 +458,162 @@ class SerialBlockSlot(SerialSlot):
             else:
                 logger.debug("Found \"" + subname + "\" from \"" + repr(mygroup) + "\" belonging to BlockSlot \"" + self.name + "\".")
 
+            # Blocks are not necessarily numbered consecutively (cleared blocks are deleted),
+            #  so we just check that every nonzero block has been stored.
             subgroup = mygroup[subname]
-
-            nonZeroBlocks = self.blockslot[index].value
-            for blockIndex in xrange(len(nonZeroBlocks)):
-                blockName = 'block{:04d}'.format(blockIndex)
-
-                if blockName not in subgroup:
-                    logger.debug("Missing \"" + blockName + "\" from \"" + repr(subgroup) + "\". Should serialize.")
-                    return True
-                else:
-                    logger.debug("Found \"" + blockName + "\" from \"" + repr(subgroup) + "\" belonging to BlockSlot \"" + self.name + "\".")
+            numStored = self._countStoredBlocks(subgroup)
+            numNonZero = len(self.blockslot[index].value)
+            if numStored != numNonZero:
+                logger.debug("Found {} of {} blocks in \"".format( numStored, numNonZero ) + repr(subgroup) + "\". Should serialize.")
+                return True
 
         logger.debug("Everything belonging to BlockSlot \"" + self.name + "\" appears to be in order. Should not serialize.")
 
         return False
 
+    @staticmethod
+    def _isStoredBlock(item):
+        # Masked blocks are stored as a group with separate datasets for data and mask
+        return isinstance(item, h5py.Dataset) or 'data' in item
+
+    def _countStoredBlocks(self, subgroup):
+        return sum( 1 for item in subgroup.values() if self._isStoredBlock(item) )
+
+    def serialize(self, group):
+        """
+        Write the blocks that changed since the last save, or all blocks if
+        this slot's group is missing or doesn't match the slot.
+        """
+        if not self.shouldSerialize(group):
+            return
+
+        # Take the dirty regions now, so regions that become dirty while we save are kept for the next save.
+        with self._dirtyRoisLock:
+            dirtyRois, self._dirtyRois = self._dirtyRois, {}
+            rewriteAll, self._rewriteAll = self._rewriteAll, False
+
+        try:
+            if self.slot.ready() and not rewriteAll and self._canUpdate(group):
+                self._update(group[self.name], dirtyRois)
+            else:
+                deleteIfPresent(group, self.name)
+                if self.slot.ready():
+                    self._serialize(group, self.name, self.slot)
+        except:
+            # We don't know which blocks were written, so rewrite everything next time.
+            with self._dirtyRoisLock:
+                self._rewriteAll = True
+            raise
+        self.dirty = False
+
+    def deserialize(self, group):
+        super(SerialBlockSlot, self).deserialize(group)
+        # The stored blocks match the slot now.
+        with self._dirtyRoisLock:
+            self._dirtyRois = {}
+            self._rewriteAll = False
+
+    def _canUpdate(self, group):
+        """
+        Return True if this slot's group can be updated in place, i.e. it has a subgroup for each lane.
+        """
+        if self.name not in group:
+            return False
+        mygroup = group[self.name]
+        if len(mygroup) != len(self.blockslot):
+            return False
+        for index in range(len(self.blockslot)):
+            if self.subname.format(index) not in mygroup:
+                return False
+            if mygroup.attrs.get("meta.has_mask") and not self.slot[index].meta.has_mask:
+                return False
+        return True
+
+    @timeLogged(logger, logging.DEBUG)
+    def _update(self, mygroup, dirtyRois):
+        logger.debug("Updating BlockSlot: {}".format( self.name ))
+        for index in range(len(self.blockslot)):
+            subname = self.subname.format(index)
+            rois = dirtyRois.get( self.slot[index], [] )
+            if rois:
+                self._updateLane(mygroup, mygroup[subname], index, rois)
+
+            # If the stored blocks are out of sync for any other reason
+            #  (or the whole lane is dirty), rewrite the lane.
+            if rois is None or self._countStoredBlocks(mygroup[subname]) != len(self.blockslot[index].value):
+                del mygroup[subname]
+                self._serializeLane(mygroup, subname, index)
+
+    def _updateLane(self, mygroup, subgroup, index, dirtyRois):
+        """
+        Rewrite the stored blocks that intersect the given dirty regions.
+        Stored blocks that no longer contain any data are deleted.
+        """
+        shape = self.slot[index].meta.shape
+        dirty_starts, dirty_stops = map( numpy.array, zip(*dirtyRois) )
+
+        # Nonzero blocks that intersect a dirty region must be rewritten.
+        nonzeroBlockRois = [ self._blockRoi(slicing, shape) for slicing in self.blockslot[index].value ]
+        changedBlockRois = []
+        if nonzeroBlockRois:
+            block_starts, block_stops = map( numpy.array, zip(*nonzeroBlockRois) )
+            changed = self._intersecting( block_starts, block_stops, dirty_starts, dirty_stops )
+            changedBlockRois = [ roi for roi, c in zip(nonzeroBlockRois, changed) if c ]
+
+        # Delete the old version of those blocks, and all stored blocks in the dirty regions
+        #  (which includes the blocks that were cleared).
+        storedRois = self._storedBlockRois(subgroup)
+        if storedRois:
+            names = storedRois.keys()
+            stored_starts, stored_stops = map( numpy.array, zip(*[storedRois[name] for name in names]) )
+            obsolete = self._intersecting( stored_starts, stored_stops, dirty_starts, dirty_stops )
+            if changedBlockRois:
+                changed_starts, changed_stops = map( numpy.array, zip(*changedBlockRois) )
+                obsolete |= self._intersecting( stored_starts, stored_stops, changed_starts, changed_stops )
+            for name, o in zip(names, obsolete):
+                if o:
+                    del subgroup[name]
+
+        blockIndex = self._nextBlockIndex(subgroup)
+        for block_start, block_stop in changedBlockRois:
+            self._writeBlock( mygroup, subgroup, 'block{:04d}'.format(blockIndex), index,
+                              roiToSlice(block_start, block_stop) )
+            blockIndex += 1
+
+        logger.debug( "Updated {} of {} blocks in BlockSlot \"{}\" ({} dirty regions)"
+                      .format( len(changedBlockRois), len(nonzeroBlockRois), self.name, len(dirtyRois) ) )
+
+    @staticmethod
+    def _blockRoi(slicing, shape):
+        if isinstance(slicing[0], slice):
+            return tuple(map( tuple, sliceToRoi(slicing, shape) ))
+        return tuple(map( tuple, slicing ))
+
+    @staticmethod
+    def _intersecting(starts, stops, other_starts, other_stops):
+        """
+        For each roi (row) in starts/stops, return True if it intersects any of the other rois.
+        """
+        overlaps = ( starts[:, None, :] < other_stops[None, :, :] ) & ( other_starts[None, :, :] < stops[:, None, :] )
+        return overlaps.all(axis=2).any(axis=1)
+
+    def _storedBlockRois(self, subgroup):
+        """
+        Return a dict of block name -> (start, stop) for the blocks stored in the given lane subgroup.
+        """
+        storedRois = {}
+        for name, item in subgroup.items():
+            if 'blockSlice' in item.attrs:
+                slicing = stringToSlicing(item.attrs['blockSlice'])
+                storedRois[name] = tuple(map( tuple, sliceToRoi(slicing, (0,)*len(slicing)) ))
+        return storedRois
+
+    @staticmethod
+    def _nextBlockIndex(subgroup):
+        indexes = [ int(name[len('block'):]) for name in subgroup.keys()
+                    if name.startswith('block') and name[len('block'):].isdigit() ]
+        return max(indexes) + 1 if indexes else 0
+
     @timeLogged(logger, logging.DEBUG)
     def _serialize(self, group, name, slot):
         logger.debug("Serializing BlockSlot: {}".format( self.name ))
@@ -419,48 +621,54 @@ class SerialBlockSlot(SerialSlot):
         num = len(self.blockslot)
         for index in range(num):
             subname = self.subname.format(index)
-            subgroup = mygroup.create_group(subname)
-            nonZeroBlocks = self.blockslot[index].value
-            for blockIndex, slicing in enumerate(nonZeroBlocks):
-                if not isinstance(slicing[0], slice):
-                    slicing = roiToSlice(*slicing)
-
-                block = self.slot[index][slicing].wait()
-                blockName = 'block{:04d}'.format(blockIndex)
-
-                if self._shrink_to_bb:
-                    nonzero_coords = numpy.nonzero(block)
-                    if len(nonzero_coords[0]) > 0:
-                        block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
-                        block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
-                        block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
-                        block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
-                        bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
-                        bounding_box_roi += block_start
-                        
-                        # Overwrite the vars that are written to the file
-                        slicing = roiToSlice(*bounding_box_roi)
-                        block = block[block_slicing]
-
-                # If we have a masked array, convert it to a structured array so that h5py can handle it.
-                if slot[index].meta.has_mask:
-                    mygroup.attrs["meta.has_mask"] = True
-
-                    block_group = subgroup.create_group(blockName)
-
-                    block_group.create_dataset("data", data=block.data)
-                    block_group.create_dataset(
-                        "mask",
-                        data=block.mask,
-                        compression="gzip",
-                        compression_opts=2
-                    )
-                    block_group.create_dataset("fill_value", data=block.fill_value)
-
-                    block_group.attrs['blockSlice'] = slicingToString(slicing)
-                else:
-                    subgroup.create_dataset(blockName, data=block)
-                    subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
+            self._serializeLane(mygroup, subname, index)
+
+    def _serializeLane(self, mygroup, subname, index):
+        subgroup = mygroup.create_group(subname)
+        nonZeroBlocks = self.blockslot[index].value
+        for blockIndex, slicing in enumerate(nonZeroBlocks):
+            self._writeBlock( mygroup, subgroup, 'block{:04d}'.format(blockIndex), index, slicing )
+
+    def _writeBlock(self, mygroup, subgroup, blockName, index, slicing):
+        if not isinstance(slicing[0], slice):
+            slicing = roiToSlice(*slicing)
+
+        block = self.slot[index][slicing].wait()
+
+        if self._shrink_to_bb:
+            nonzero_coords = numpy.nonzero(block)
+            if len(nonzero_coords[0]) > 0:
+                block_start = sliceToRoi( slicing, (0,)*len(slicing) )[0]
+                block_bounding_box_start = numpy.array( map( numpy.min, nonzero_coords ) )
+                block_bounding_box_stop = 1 + numpy.array( map( numpy.max, nonzero_coords ) )
+                block_slicing = roiToSlice( block_bounding_box_start, block_bounding_box_stop )
+                bounding_box_roi = numpy.array([block_bounding_box_start, block_bounding_box_stop])
+                bounding_box_roi += block_start
+                
+                # Overwrite the vars that are written to the file
+                slicing = roiToSlice(*bounding_box_roi)
+                block = block[block_slicing]
+
+        # If we have a masked array, convert it to a structured array so that h5py can handle it.
+        if self.slot[index].meta.has_mask:
+            mygroup.attrs["meta.has_mask"] = True
+
+            block_group = subgroup.create_group(blockName)
+
+            block_group.create_dataset("data", data=block.data, compression="gzip", compression_opts=1)
+            block_group.create_dataset(
+                "mask",
+                data=block.mask,
+                compression="gzip",
+                compression_opts=2
+            )
+            block_group.create_dataset("fill_value", data=block.fill_value)
+
+            block_group.attrs['blockSlice'] = slicingToString(slicing)
+        else:
+            # Label blocks are mostly empty, so they compress well (and fast, at the lowest gzip level).
+            subgroup.create_dataset(blockName, data=block, compression="gzip", compression_opts=1)
+            subgroup[blockName].attrs['blockSlice'] = slicingToString(slicing)
 
     @timeLogged(logger, logging.DEBUG)
     def _deserialize(self, mygroup, slot):
@@ -503,6 +711,10 @@ class SerialBlockSlot(SerialSlot):
 
 class SerialHdf5BlockSlot(SerialBlockSlot):
 
+    def serialize(self, group):
+        # The blocks are written by the upstream operator, so they can't be updated individually.
+        SerialSlot.serialize(self, group)
+
     def _serialize(self, group, name, slot):
         mygroup = group.create_group(name)
         num = len(self.blockslot)
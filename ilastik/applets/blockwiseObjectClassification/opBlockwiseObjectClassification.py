@@ -19,6 +19,11 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 # Built-in
+import os
+import shutil
+import tempfile
+import collections
+import functools
 import logging
 
 # Third-party
@@ -26,14 +31,15 @@ import numpy
 
 # lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.request import RequestLock, RequestPool
+from lazyflow.request import Request, RequestLock, RequestPool
 from lazyflow.roi import getIntersectingBlocks, getBlockBounds, getIntersection, roiToSlice, TinyVector
 from lazyflow.operators import OpSubRegion, OpMultiArrayStacker, OpArrayCache
 from lazyflow.stype import Opaque
 from lazyflow.rtype import List
 
 # ilastik
-from ilastik.utility import bind
+import ilastik.config
+from ilastik.utility import bind, log_exception
 from ilastik.applets.objectExtraction.opObjectExtraction import OpObjectExtraction
 from ilastik.applets.objectClassification.opObjectClassification import OpObjectPredict, OpRelabelSegmentation, OpMaxLabel, OpMultiRelabelSegmentation
 from ilastik.applets.base.applet import DatasetConstraintError
@@ -224,6 +230,18 @@ class OpSingleBlockObjectPrediction( Operator ):
 class OpBlockwiseObjectClassification( Operator ):
     """
     Handles prediction ONLY.  Training must be provided externally and loaded via the serializer.
+
+    Each block is processed by its own OpSingleBlockObjectPrediction pipeline, which holds the block's
+    labels, region features and predictions.  If MaxBlockPipelines is nonzero, at most that many pipelines
+    are kept alive (plus any that are currently in use), and the least recently used ones are deleted.
+    If an EvictedPredictionDirectory is given, the prediction image of an evicted block is saved there first,
+    so later PredictionImage requests for that block are served from disk instead of being recomputed.
+    Eviction and recompute counts are available via getStatistics().
+
+    If PrefetchBlocks is nonzero, each PredictionImage (or ProbabilityChannelImage) request also starts
+    computing the predictions of the next few blocks in the background.  Blocks are prefetched in raster order,
+    forwards or backwards depending on the direction of the previous requests (e.g. a blockwise export),
+    so the next request usually finds its pipelines ready.
     """
     RawImage = InputSlot()
     BinaryImage = InputSlot()
@@ -232,6 +250,9 @@ class OpBlockwiseObjectClassification( Operator ):
     SelectedFeatures = InputSlot(rtype=List, stype=Opaque)
     BlockShape3dDict = InputSlot( value={'x' : 512, 'y' : 512, 'z' : 512} ) # A dict of SPATIAL block dims
     HaloPadding3dDict = InputSlot( value={'x' : 64, 'y' : 64, 'z' : 64} ) # A dict of spatial block dims
+    MaxBlockPipelines = InputSlot( value=0 ) # 0 means unlimited
+    EvictedPredictionDirectory = InputSlot( optional=True ) # Predictions of evicted blocks are stored in a temporary subdirectory of this directory.
+    PrefetchBlocks = InputSlot( value=0 ) # Number of blocks to compute ahead of the requested ones (0 means no prefetching)
 
     PredictionImage = OutputSlot()
     ProbabilityChannelImage = OutputSlot()
@@ -239,8 +260,26 @@ class OpBlockwiseObjectClassification( Operator ):
     
     def __init__(self, *args, **kwargs):
         super( self.__class__, self ).__init__(*args, **kwargs)
-        self._blockPipelines = {} # indexed by blockstart
+        self._blockPipelines = collections.OrderedDict() # indexed by blockstart, least recently used first
+        self._pipelineUsers = collections.Counter() # blockstart -> number of requests using the pipeline
+        self._predictedBlocks = set() # live pipelines whose PredictionImage has been computed
+        self._evictedBlocks = set() # blocks whose pipeline was deleted (and whose predictions weren't stored)
+        self._storedPredictions = {} # blockstart -> path of the stored PredictionImage of an evicted block
+        self._storeDir = None
+        self._storeBaseDir = None # The EvictedPredictionDirectory that _storeDir was created in
+        self._stats = collections.Counter()
+        self._prefetching = set() # blocks that are being prefetched
+        self._lastRequestedBlockIndex = None # raster index of the first block of the previous request
         self._lock = RequestLock()
+
+        section = 'blockwise object classification'
+        cfg = ilastik.config.cfg
+        max_pipelines = cfg.getint( section, 'max_block_pipelines' )
+        if max_pipelines:
+            self.MaxBlockPipelines.setValue( max_pipelines )
+        prediction_dir = cfg.get( section, 'evicted_prediction_directory' )
+        if prediction_dir:
+            self.EvictedPredictionDirectory.setValue( prediction_dir )
         
     def setupOutputs(self):
         # Check for preconditions.
@@ -257,6 +296,18 @@ class OpBlockwiseObjectClassification( Operator ):
         self._block_shape_dict = self.BlockShape3dDict.value
         self._halo_padding_dict = self.HaloPadding3dDict.value
 
+        store_base_dir = self.EvictedPredictionDirectory.value if self.EvictedPredictionDirectory.ready() else None
+        if store_base_dir != self._storeBaseDir:
+            # Stored predictions in the old directory are discarded, so their blocks will be recomputed.
+            with self._lock:
+                self._evictedBlocks.update( self._storedPredictions.keys() )
+            self._setupStore( store_base_dir )
+
+        # Apply a lower limit immediately
+        with self._lock:
+            evicted = self._selectEvictions()
+        self._evict( evicted )
+
         self.PredictionImage.meta.assignFrom( self.RawImage.meta )
         self.PredictionImage.meta.dtype = numpy.uint8 # Ultimately determined by meta.mapping_dtype from OpRelabelSegmentation
         prediction_tagged_shape = self.RawImage.meta.getTaggedShape()
@@ -299,11 +350,26 @@ class OpBlockwiseObjectClassification( Operator ):
         block_shape = self._getFullShape( self.BlockShape3dDict.value )
         block_starts = getIntersectingBlocks( block_shape, roi_one_channel )
         block_starts = map( tuple, block_starts )
+        self._prefetch( block_starts )
+
+        # Blocks whose predictions were stored when their pipeline was evicted are read from disk
+        if slot == self.PredictionImage:
+            block_starts = filter( lambda block_start: not self._readStoredPrediction( block_start, roi_one_channel, destination ),
+                                   block_starts )
 
         # Ensure that block pipelines exist (create first if necessary)
+        # They can't be evicted until we release them.
         for block_start in block_starts:
-            self._ensurePipelineExists(block_start)
+            self._acquirePipeline(block_start)
+        try:
+            self._requestBlocks( slot, roi, roi_one_channel, block_starts, destination )
+        finally:
+            for block_start in block_starts:
+                self._releasePipeline(block_start)
+
+        return destination
 
+    def _requestBlocks(self, slot, roi, roi_one_channel, block_starts, destination):
         # Retrieve result from each block, and write into the appropriate region of the destination
         pool = RequestPool()
         for block_start in block_starts:
@@ -312,6 +378,9 @@ class OpBlockwiseObjectClassification( Operator ):
             block_intersection = getIntersection( block_roi, roi_one_channel )
             block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
             destination_relative_intersection = numpy.subtract(block_intersection, roi_one_channel[0])
+            if slot == self.PredictionImage:
+                # (The pipeline caches its entire prediction image, so it can be stored cheaply on eviction)
+                self._predictedBlocks.add( block_start )
 
             block_slot = opBlockPipeline.PredictionImage            
             if slot == self.ProbabilityChannelImage:
@@ -329,7 +398,31 @@ class OpBlockwiseObjectClassification( Operator ):
             pool.add( req )
         pool.wait()
 
-        return destination
+    def _readStoredPrediction(self, block_start, roi_one_channel, destination):
+        """
+        If the prediction image of the given (evicted) block was stored, copy the part of it
+        that intersects roi_one_channel into the destination and return True.
+        """
+        path = self._storedPredictions.get( block_start )
+        if path is None:
+            return False
+        try:
+            npz = numpy.load( path )
+            try:
+                block_data = npz['data']
+            finally:
+                npz.close()
+        except (IOError, KeyError):
+            # The stored prediction was invalidated in the meantime
+            return False
+
+        block_roi = self.get_block_roi( block_start )
+        block_intersection = getIntersection( block_roi, roi_one_channel )
+        block_relative_intersection = numpy.subtract(block_intersection, block_roi[0])
+        destination_relative_intersection = numpy.subtract(block_intersection, roi_one_channel[0])
+        destination[ roiToSlice( *destination_relative_intersection ) ] = block_data[ roiToSlice( *block_relative_intersection ) ]
+        self._stats['stored_prediction_reads'] += 1
+        return True
 
     def _executeBlockwiseRegionFeatures(self, roi, destination):
         """
@@ -348,9 +441,10 @@ class OpBlockwiseObjectClassification( Operator ):
         block_starts = getIntersectingBlocks( block_shape, pixel_roi )
         block_starts = map( tuple, block_starts )
         
-        # TODO: Parallelize this?
+        pool = RequestPool()
         for block_start in block_starts:
-            assert block_start in self._blockPipelines, "Not allowed to request region features for blocks that haven't yet been processed." # See note above
+            assert block_start in self._blockPipelines or block_start in self._evictedBlocks or block_start in self._storedPredictions, \
+                "Not allowed to request region features for blocks that haven't yet been processed." # See note above
 
             # Discard spatial axes to get (t,c) index for region slot roi
             tagged_block_start = zip( axiskeys, block_start )
@@ -362,23 +456,181 @@ class OpBlockwiseObjectClassification( Operator ):
             destination_start = numpy.array(block_start) / block_shape - roi.start
             destination_stop = destination_start + numpy.array( [1]*len(axiskeys) )
 
-            opBlockPipeline = self._blockPipelines[block_start]
-            req = opBlockPipeline.BlockwiseRegionFeatures( *block_roi_t )
             destination_without_channel = destination[ roiToSlice( destination_start, destination_stop ) ]
             destination_with_channel = destination_without_channel[ ...,block_roi_tc[0][-1] : block_roi_tc[1][-1] ]
-            req.writeInto( destination_with_channel )
-            req.wait()
-        
+            pool.add( Request( functools.partial( self._readBlockRegionFeatures, block_start, block_roi_t, destination_with_channel ) ) )
+        pool.wait()
+
         return destination
 
-    def _ensurePipelineExists(self, block_start):
-        if block_start in self._blockPipelines:
+    def _readBlockRegionFeatures(self, block_start, block_roi_t, destination):
+        # (If the block's pipeline was evicted, it is recreated and the features are recomputed.)
+        opBlockPipeline = self._acquirePipeline(block_start)
+        try:
+            opBlockPipeline.BlockwiseRegionFeatures( *block_roi_t ).writeInto( destination ).wait()
+        finally:
+            self._releasePipeline(block_start)
+
+    def _prefetch(self, block_starts):
+        """
+        Start computing the predictions of the PrefetchBlocks blocks that follow the given (requested) blocks
+        in raster order, in the background.  If the requested blocks precede those of the previous request,
+        the blocks before them are prefetched instead.
+        """
+        num_blocks = self.PrefetchBlocks.value
+        if not num_blocks or not block_starts:
+            return
+        max_pipelines = self.MaxBlockPipelines.value
+        if max_pipelines:
+            # Don't prefetch so much that the prefetched pipelines evict each other (or the requested ones).
+            num_blocks = min( num_blocks, max_pipelines - len(block_starts) )
+            if num_blocks <= 0:
+                return
+
+        block_shape = numpy.array( self._getFullShape( self._block_shape_dict ) )
+        grid_shape = ( numpy.array( self.PredictionImage.meta.shape ) + block_shape - 1 ) / block_shape
+        indexes = [ numpy.ravel_multi_index( tuple( numpy.array(block_start) / block_shape ), grid_shape )
+                    for block_start in block_starts ]
+
+        with self._lock:
+            previous_index = self._lastRequestedBlockIndex
+            self._lastRequestedBlockIndex = min(indexes)
+        if previous_index is not None and min(indexes) < previous_index:
+            candidates = min(indexes) - numpy.arange( 1, num_blocks+1 )
+        else:
+            candidates = max(indexes) + numpy.arange( 1, num_blocks+1 )
+        candidates = candidates[ (candidates >= 0) & (candidates < numpy.prod(grid_shape)) ]
+
+        for index in candidates:
+            block_start = tuple( int(x) for x in numpy.array( numpy.unravel_index( index, grid_shape ) ) * block_shape )
+            with self._lock:
+                if ( block_start in self._prefetching
+                     or block_start in self._predictedBlocks
+                     or block_start in self._storedPredictions ):
+                    continue
+                self._prefetching.add( block_start )
+            Request( functools.partial( self._prefetchBlock, block_start ) ).submit()
+
+    def _prefetchBlock(self, block_start):
+        try:
+            opBlockPipeline = self._acquirePipeline( block_start )
+            try:
+                opBlockPipeline.PredictionImage[:].wait()
+                self._predictedBlocks.add( block_start )
+            finally:
+                self._releasePipeline( block_start )
+            with self._lock:
+                self._stats['prefetched_blocks'] += 1
+        except Exception:
+            # Nobody waits for this request, so report the error here.
+            # (The block will be computed again when it is requested.)
+            log_exception( logger, "Failed to prefetch block {}".format( block_start ) )
+        finally:
+            with self._lock:
+                self._prefetching.discard( block_start )
+
+    def getStatistics(self):
+        """
+        Return a dict with the number of 'live_pipelines', 'created_pipelines', 'evictions',
+        'recomputes' (pipelines created again for evicted blocks), 'stored_predictions' (evicted blocks
+        whose predictions were saved), 'stored_prediction_reads' and 'prefetched_blocks'.
+        """
+        with self._lock:
+            stats = dict( self._stats )
+            stats['live_pipelines'] = len( self._blockPipelines )
+        for key in ['created_pipelines', 'evictions', 'recomputes', 'stored_predictions', 'stored_prediction_reads', 'prefetched_blocks']:
+            stats.setdefault( key, 0 )
+        return stats
+
+    def _acquirePipeline(self, block_start):
+        """
+        Return the pipeline for the given block (creating it if necessary), and mark it as in use
+        so it won't be evicted.  Must be followed by a call to _releasePipeline().
+        """
+        self._ensurePipelineExists( block_start, acquire=True )
+        return self._blockPipelines[block_start]
+
+    def _releasePipeline(self, block_start):
+        with self._lock:
+            self._pipelineUsers[block_start] -= 1
+            if self._pipelineUsers[block_start] <= 0:
+                del self._pipelineUsers[block_start]
+            evicted = self._selectEvictions()
+        self._evict( evicted )
+
+    def _selectEvictions(self):
+        """
+        Remove the least recently used pipelines that aren't in use until no more than MaxBlockPipelines are left.
+        Must be called with the lock held.  Returns the removed (block_start, pipeline, was_predicted) tuples.
+        """
+        max_pipelines = self.MaxBlockPipelines.value
+        evicted = []
+        if not max_pipelines:
+            return evicted
+        for block_start in list( self._blockPipelines.keys() ):
+            if len( self._blockPipelines ) <= max_pipelines:
+                break
+            if self._pipelineUsers[block_start] > 0:
+                continue
+            opBlockPipeline = self._blockPipelines.pop( block_start )
+            was_predicted = block_start in self._predictedBlocks
+            self._predictedBlocks.discard( block_start )
+            evicted.append( (block_start, opBlockPipeline, was_predicted) )
+            self._stats['evictions'] += 1
+        return evicted
+
+    def _evict(self, evicted):
+        """
+        Delete the given pipelines (see _selectEvictions), storing their predictions first, if possible.
+        """
+        for block_start, opBlockPipeline, was_predicted in evicted:
+            logger.debug( "Evicting pipeline for block: {}".format( block_start ) )
+            stored = False
+            if was_predicted and self._storeDir is not None:
+                stored = self._storePrediction( block_start, opBlockPipeline )
+            with self._lock:
+                if not stored:
+                    self._evictedBlocks.add( block_start )
+            opBlockPipeline.cleanUp()
+
+    def _storePrediction(self, block_start, opBlockPipeline):
+        with self._lock:
+            store_dir = self._storeDir
+        path = os.path.join( store_dir, "block_{}.npz".format( "_".join( map(str, block_start) ) ) )
+        try:
+            data = opBlockPipeline.PredictionImage[:].wait()
+            with open( path, 'wb' ) as f:
+                numpy.savez_compressed( f, data=data )
+        except Exception as ex:
+            logger.warn( "Failed to store the predictions of block {}: {}".format( block_start, ex ) )
+            return False
+        with self._lock:
+            if self._storeDir != store_dir:
+                # The store was removed in the meantime
+                return False
+            self._storedPredictions[block_start] = path
+            self._stats['stored_predictions'] += 1
+        return True
+
+    def _ensurePipelineExists(self, block_start, acquire=False):
+        if not acquire and block_start in self._blockPipelines:
             return
         with self._lock:
             if block_start in self._blockPipelines:
+                if acquire:
+                    # Mark as recently used
+                    self._blockPipelines[block_start] = self._blockPipelines.pop( block_start )
+                    self._pipelineUsers[block_start] += 1
                 return
 
             logger.debug( "Creating pipeline for block: {}".format( block_start ) )
+            self._stats['created_pipelines'] += 1
+            if block_start in self._evictedBlocks:
+                self._evictedBlocks.remove( block_start )
+                self._stats['recomputes'] += 1
+            elif block_start in self._storedPredictions:
+                # Only the PredictionImage is stored.  Other outputs must be recomputed.
+                self._stats['recomputes'] += 1
 
             block_shape = self._getFullShape( self._block_shape_dict )
             halo_padding = self._getFullShape( self._halo_padding_dict )
@@ -399,6 +651,10 @@ class OpBlockwiseObjectClassification( Operator ):
             opBlockPipeline.PredictionImage.notifyDirty( bind(self._handleDirtyBlock, block_start ) )
             
             self._blockPipelines[block_start] = opBlockPipeline
+            if acquire:
+                self._pipelineUsers[block_start] += 1
+            evicted = self._selectEvictions()
+        self._evict( evicted )
 
     def get_blockshape(self):
         return self._getFullShape(self.BlockShape3dDict.value)
@@ -439,16 +695,101 @@ class OpBlockwiseObjectClassification( Operator ):
     def _deleteAllPipelines(self):
         logger.debug("Deleting all pipelines.")
         oldBlockPipelines = self._blockPipelines
-        self._blockPipelines = {}
+        self._blockPipelines = collections.OrderedDict()
         with self._lock:
+            self._pipelineUsers.clear()
+            self._predictedBlocks.clear()
+            self._evictedBlocks.clear()
+            self._lastRequestedBlockIndex = None
             for opBlockPipeline in oldBlockPipelines.values():
                 opBlockPipeline.cleanUp()
-    
-    
+        self._removeStoredPredictions()
+
+    def _setupStore(self, base_dir):
+        """
+        Create a fresh directory for the predictions of evicted blocks in the given directory
+        (or stop storing predictions, if base_dir is None).
+        """
+        self._removeStore()
+        if base_dir is not None:
+            store_parent = os.path.expanduser( base_dir )
+            if not os.path.exists( store_parent ):
+                os.makedirs( store_parent )
+            store_dir = tempfile.mkdtemp( prefix='ilastik-blockwise-predictions-', dir=store_parent )
+            logger.debug( "Storing the predictions of evicted blocks in {}".format( store_dir ) )
+        with self._lock:
+            self._storeDir = store_dir if base_dir is not None else None
+            self._storeBaseDir = base_dir
+
+    def _removeStore(self):
+        self._removeStoredPredictions()
+        with self._lock:
+            store_dir = self._storeDir
+            self._storeDir = None
+            self._storeBaseDir = None
+        if store_dir is not None:
+            shutil.rmtree( store_dir, ignore_errors=True )
+
+    def _removeStoredPredictions(self, block_starts=None):
+        """
+        Forget the stored predictions of the given blocks (all blocks if block_starts is None).
+        """
+        with self._lock:
+            if block_starts is None:
+                block_starts = self._storedPredictions.keys()
+            paths = [ self._storedPredictions.pop( block_start ) for block_start in block_starts
+                      if block_start in self._storedPredictions ]
+        for path in paths:
+            try:
+                os.remove( path )
+            except OSError:
+                pass
+
+    def _invalidateStoredPredictions(self, roi=None):
+        """
+        Discard the stored predictions of evicted blocks whose (halo) region intersects the given roi
+        (or all of them, if no roi is given), and mark those blocks dirty.
+        (Live pipelines propagate their own dirty notifications.)
+        """
+        with self._lock:
+            stored_blocks = self._storedPredictions.keys()
+        if not stored_blocks:
+            return
+        tagged_shape = self.RawImage.meta.getTaggedShape()
+        halo_padding = self._getFullShape( self._halo_padding_dict )
+        dirty_blocks = []
+        for block_start in stored_blocks:
+            block_roi = self.get_block_roi( block_start )
+            if roi is not None:
+                halo_roi = OpSingleBlockObjectPrediction.computeHaloRoi( tagged_shape, halo_padding, block_roi )
+                dirty_roi = numpy.array( (roi.start, roi.stop) )
+                dirty_roi[:, -1] = (0, 1)
+                halo_roi = numpy.array( halo_roi )
+                halo_roi[:, -1] = (0, 1)
+                if getIntersection( halo_roi, dirty_roi, assertIntersect=False ) is None:
+                    continue
+            dirty_blocks.append( block_start )
+        self._removeStoredPredictions( dirty_blocks )
+        for block_start in dirty_blocks:
+            self.PredictionImage.setDirty( *self.get_block_roi( block_start ) )
+
     def propagateDirty(self, slot, subindex, roi):
         if slot == self.BlockShape3dDict or slot == self.HaloPadding3dDict:
             self._deleteAllPipelines()
             self.PredictionImage.setDirty( slice(None) )
+        elif slot == self.RawImage or slot == self.BinaryImage:
+            self._invalidateStoredPredictions( roi )
+        elif slot == self.MaxBlockPipelines or slot == self.EvictedPredictionDirectory or slot == self.PrefetchBlocks:
+            # Takes effect in setupOutputs()
+            pass
+        else:
+            # Classifier, LabelsCount or SelectedFeatures
+            self._invalidateStoredPredictions()
+
+    def cleanUp(self):
+        logger.debug( "Blockwise object classification statistics: {}".format( self.getStatistics() ) )
+        self._removeStore()
+        super( OpBlockwiseObjectClassification, self ).cleanUp()
     
     
     def _handleDirtyBlock(self, block_start, slot, roi):
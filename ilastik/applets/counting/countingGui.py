@@ -48,6 +48,7 @@ from ilastik.shell.gui.iconMgr import ilastikIcons
 from ilastik.applets.labeling.labelingGui import LabelingGui
 from ilastik.applets.base.applet import ShellRequest
 from lazyflow.operators.opReorderAxes import OpReorderAxes
+from ilastik.applets.counting.opCounting import OpBoxStatistics
 from ilastik.applets.counting.countingGuiDotsInterface import DotCrosshairController,DotInterpreter
 from ilastik.applets.base.appletSerializer import SerialListSlot
 from PyQt4 import QtGui
@@ -259,7 +260,9 @@ class CountingGui(LabelingGui):
         self.density5d=OpReorderAxes(graph=self.op.graph, parent=self.op.parent) #
 
         self.density5d.Input.connect(self.op.Density)
-        self.boxController=BoxController(mainwin.editor,self.density5d.Output,self.labelingDrawerUi.boxListModel)
+        self.boxStatistics=OpBoxStatistics(graph=self.op.graph, parent=self.op.parent)
+        self.boxStatistics.Input.connect(self.density5d.Output)
+        self.boxController=BoxController(mainwin.editor,self.boxStatistics,self.labelingDrawerUi.boxListModel)
         self.boxInterpreter=BoxInterpreter(mainwin.editor.navInterpret,mainwin.editor.posModel,self.boxController,mainwin.centralWidget())
 
         self.navigationInterpreterDefault=self.editor.navInterpret
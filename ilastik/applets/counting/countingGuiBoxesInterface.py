@@ -531,7 +531,7 @@ class RedRubberBand(QRubberBand):
 #===============================================================================
 
 class CoupledRectangleElement(object):
-    def __init__(self,x,y,h,w,inputSlot,editor = None, scene=None,parent=None,qcolor=QColor(0,0,255)):
+    def __init__(self,x,y,h,w,inputSlot,editor = None, scene=None,parent=None,qcolor=QColor(0,0,255),boxStatistics=None):
         '''
         Couples the functionality of the lazyflow operator OpSubRegion which gets a subregion of interest
         and the functionality of the resizable rectangle Item.
@@ -543,6 +543,8 @@ class CoupledRectangleElement(object):
         :param h: initial height
         :param w: initial width
         :param inputSlot: Should be the output slot of another operator from which you would like monitor a subregion
+        :param boxStatistics: an OpBoxStatistics operator (whose Output should be the inputSlot) used to compute the
+                              count in the box. If None, the count is the sum of the subregion.
         :param scene: the scene where to put the graphics item
         :param parent: the parent object if any
         :param qcolor: initial color of the rectangle
@@ -554,6 +556,7 @@ class CoupledRectangleElement(object):
         #self.opsum = OpSumAll(graph=inputSlot.operator.graph)
         self._graph=inputSlot.operator.graph
         self._inputSlot=inputSlot #input slot which connect to the sub array
+        self._boxStatistics=boxStatistics
 
 
         self.boxLabel=None #a reference to the label in the labellist model
@@ -589,12 +592,16 @@ class CoupledRectangleElement(object):
         #FIXME: Workaround: when the array is resized over the border of the image scene the
         # region get a wrong size
         try:
-            subarray=self.getSubRegion()
+            if self._boxStatistics is not None:
+                counts,_,_=self._boxStatistics.getBoxStatistics([(self.getStart(),self.getStop())])
+                value=counts[0]
+            else:
+                subarray=self.getSubRegion()
 
-            #self.current_sum= self.opsum.outputs["Output"][:].wait()[0]
-            value=0
-            if subarray!=None:
-                value=np.sum(subarray)
+                #self.current_sum= self.opsum.outputs["Output"][:].wait()[0]
+                value=0
+                if subarray!=None:
+                    value=np.sum(subarray)
 
             #print "Resetting to a new value ",value,self.boxLabel
 
@@ -887,12 +894,13 @@ class BoxController(QObject):
     viewBoxesChanged = pyqtSignal(dict)
 
 
-    def __init__(self,editor,connectionInput,boxListModel):
+    def __init__(self,editor,boxStatistics,boxListModel):
         '''
         Class which controls all boxes on the scene
 
         :param scene:
-        :param connectionInput: The imput slot to which connect all the new boxes
+        :param boxStatistics: The OpBoxStatistics operator which computes the box counts.
+                              All new boxes are connected to its Output.
         :param boxListModel:
 
         '''
@@ -903,7 +911,8 @@ class BoxController(QObject):
         QObject.__init__(self,parent=scene.parent())
         self._setUpRandomColors()
         self.scene=scene
-        self.connectionInput=connectionInput
+        self.boxStatistics=boxStatistics
+        self.connectionInput=boxStatistics.Output
         self._currentBoxesList=[]
         #self._currentActiveItem=[]
         #self.counter=1000
@@ -956,7 +965,8 @@ class BoxController(QObject):
         w=stop[0]-start[0]
         if h*w<9: return #too small
 
-        rect=CoupledRectangleElement(start[0],start[1],h,w,self.connectionInput,editor = self._editor, scene=self.scene,parent=self.scene.parent())
+        rect=CoupledRectangleElement(start[0],start[1],h,w,self.connectionInput,editor = self._editor, scene=self.scene,parent=self.scene.parent(),
+                                     boxStatistics=self.boxStatistics)
         rect.setZValue(len(self._currentBoxesList))
         rect.setColor(self.currentColor)
         #self.counter-=1
@@ -1083,14 +1093,15 @@ class BoxController(QObject):
 
                 fh.write(" , ".join(header) +"\n")
 
+                # All boxes at once, from the summed-area tables
+                rois=[(box.getStart(),box.getStop()) for box in self._currentBoxesList]
+                counts,means,stds=self.boxStatistics.getBoxStatistics(rois)
 
                 for k,box in enumerate(self._currentBoxesList):
-                    start=box.getStart()
-                    stop=box.getStop()
-                    region = box.getSubRegion()
-                    count = np.sum(region)
-                    averagedens = np.mean(region)
-                    stddensity = np.std(region)
+                    start,stop=rois[k]
+                    count = counts[k]
+                    averagedens = means[k]
+                    stddensity = stds[k]
 
 
                     line=["%5.5d"%k, "%5.5d"%start[1], "%5.5d"%start[2], "%5.5d"%stop[1],\
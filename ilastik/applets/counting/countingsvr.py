@@ -21,6 +21,7 @@
 import numpy as np
 import vigra
 import itertools
+from functools import partial
 try:
     import gurobipy as gu
 except:
@@ -29,6 +30,8 @@ except:
 import h5py, cPickle
 import sys
 
+from lazyflow.request import Request, RequestPool
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -606,25 +609,39 @@ class SVR(object):
         
 
 
+    # Number of pixels that predict() normalizes and predicts at once
+    PREDICTION_BATCH_SIZE = 65536
+
     def predict(self, oldImage):
+        """
+        Predict the density for each pixel of oldImage (features in the last axis).
+        Returns an array of shape oldImage.shape[:-1] + (number of regressors,).
+
+        The pixels are normalized and predicted in batches of PREDICTION_BATCH_SIZE, which are
+        written straight into the result, so the only full-size array is the result itself.
+        Batches are processed in parallel on the lazyflow request pool.
+        """
         oldShape = oldImage.shape
-        resShape = oldShape[:-1]
-        image = np.copy(oldImage.reshape((-1, oldImage.shape[-1])))
-        image = self.normalize(image)
-
-        reslist = []
-        for r in self._regressor:
-            if r is None:
-                reslist.append(np.zeros(oldImage.shape[:-1]))
-            else:
-                reslist.append(r.predict(image))
-            res = np.dstack(reslist)
-            resShape = oldShape[:-1] + (len(self._regressor),)
-        
-        #res = np.zeros(oldShape[:-1])
-        res = res.view(np.ndarray)
-        res[res < 0] = 0
-        return res.reshape(resShape)
+        image = oldImage.reshape((-1, oldShape[-1]))
+        numPixels = image.shape[0]
+        res = np.zeros((numPixels, len(self._regressor)), dtype=np.float64)
+
+        def predictBatch(start, stop):
+            # normalize() works in-place, so it gets a copy
+            batch = self.normalize(np.array(image[start:stop]))
+            for i, r in enumerate(self._regressor):
+                if r is not None:
+                    res[start:stop, i] = r.predict(batch)
+            resBatch = res[start:stop]
+            resBatch[resBatch < 0] = 0
+
+        pool = RequestPool()
+        for start in range(0, numPixels, self.PREDICTION_BATCH_SIZE):
+            stop = min(start + self.PREDICTION_BATCH_SIZE, numPixels)
+            pool.add(Request(partial(predictBatch, start, stop)))
+        pool.wait()
+
+        return res.reshape(oldShape[:-1] + (len(self._regressor),))
 
     def writeHDF5(self, cachePath, targetname):
         f = h5py.File(cachePath)
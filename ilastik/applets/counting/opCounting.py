@@ -156,6 +156,233 @@ class OpMean(Operator):
         key = roi.toSlice()
         self.Output.setDirty( key[:-1] )
 
+class OpBoxStatistics(Operator):
+    """
+    Computes the count (sum), mean and standard deviation of a 2D density image within rectangular boxes,
+    using summed-area tables (integral images) of the density and of its square.
+
+    The tables are kept per block (BlockShape pixels along x and y), computed when a box first touches
+    the block and discarded when the block becomes dirty.  Once the tables of all blocks are known,
+    coarse summed-area tables of the block totals are built, too.  Then a box query costs one coarse
+    lookup for the blocks that the box covers completely, plus four table lookups for each block on the
+    box border (i.e. it grows with the box perimeter, not with its area).  Until then, the totals of the
+    covered blocks are added one by one.  Many boxes can be queried at once with getBoxStatistics().
+
+    Output is the unchanged Input.  Connect dirty notifications to Output (not Input),
+    so the tables have been invalidated when the notification arrives.
+    """
+    name = "OpBoxStatistics"
+    description = "Box sums, means and standard deviations via summed-area tables"
+    Input = InputSlot()
+    BlockShape = InputSlot(value=128) # Block size along x and y
+
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super( OpBoxStatistics, self ).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._tables = {} # (block x index, block y index) -> (sum table, squared sum table)
+        self._coarseTables = None # (sum table, squared sum table) of the block totals, if all blocks are known
+        self._generation = 0 # Incremented whenever tables are invalidated
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom(self.Input.meta)
+        taggedShape = self.Input.meta.getTaggedShape()
+        for key, size in taggedShape.items():
+            assert key in 'xy' or size == 1, "OpBoxStatistics needs a 2D single-channel image, got shape {}".format( taggedShape )
+        self._xIndex = taggedShape.keys().index('x')
+        self._yIndex = taggedShape.keys().index('y')
+        self._shape = ( taggedShape['x'], taggedShape['y'] )
+        self._blockSize = self.BlockShape.value
+        self._numBlocks = ( ( self._shape[0] + self._blockSize - 1 ) // self._blockSize,
+                            ( self._shape[1] + self._blockSize - 1 ) // self._blockSize )
+        with self._lock:
+            self._tables.clear()
+            self._coarseTables = None
+            self._generation += 1
+
+    def execute(self, slot, subindex, roi, result):
+        self.Input(roi.start, roi.stop).writeInto(result).wait()
+        return result
+
+    def getBoxStatistics(self, rois):
+        """
+        Return the sum, mean and standard deviation of the Input within each box, as three arrays.
+
+        :param rois: A list of boxes, each given as (start, stop) in Input coordinates.
+                     Only the x and y entries are used.  Boxes are clipped to the image.
+                     Empty boxes get zeros.
+        """
+        boxes = []
+        for start, stop in rois:
+            x0, x1 = sorted( ( start[self._xIndex], stop[self._xIndex] ) )
+            y0, y1 = sorted( ( start[self._yIndex], stop[self._yIndex] ) )
+            boxes.append( ( max(0, int(x0)), min(self._shape[0], int(x1)),
+                            max(0, int(y0)), min(self._shape[1], int(y1)) ) )
+
+        # Compute all missing tables at once.
+        # (With the coarse tables, only the blocks on the box borders are needed.)
+        coarseTables = self._getCoarseTables()
+        blockIndexes = set()
+        for box in boxes:
+            if coarseTables is None:
+                blockIndexes.update( self._blocksOfBox( box ) )
+            else:
+                blockIndexes.update( self._borderBlocksOfBox( box ) )
+        tables = self._getTables( blockIndexes )
+        if coarseTables is None:
+            coarseTables = self._getCoarseTables()
+
+        sums = numpy.zeros( (len(boxes),), dtype=numpy.float64 )
+        squaredSums = numpy.zeros( (len(boxes),), dtype=numpy.float64 )
+        areas = numpy.zeros( (len(boxes),), dtype=numpy.float64 )
+        b = self._blockSize
+        for i, (x0, x1, y0, y1) in enumerate(boxes):
+            areas[i] = max(0, x1 - x0) * max(0, y1 - y0)
+            if coarseTables is None:
+                blocks = self._blocksOfBox( (x0, x1, y0, y1) )
+            else:
+                blocks = self._borderBlocksOfBox( (x0, x1, y0, y1) )
+                interior = self._interiorBlocksOfBox( (x0, x1, y0, y1) )
+                if interior is not None:
+                    bx0, bx1, by0, by1 = interior
+                    sumTable, squaredTable = coarseTables
+                    sums[i] += sumTable[bx1, by1] - sumTable[bx0, by1] - sumTable[bx1, by0] + sumTable[bx0, by0]
+                    squaredSums[i] += squaredTable[bx1, by1] - squaredTable[bx0, by1] - squaredTable[bx1, by0] + squaredTable[bx0, by0]
+            for bx, by in blocks:
+                sumTable, squaredTable = tables[(bx, by)]
+                # Box corners in block coordinates
+                u0, u1 = max(x0 - bx*b, 0), min(x1 - bx*b, b)
+                v0, v1 = max(y0 - by*b, 0), min(y1 - by*b, b)
+                sums[i] += sumTable[u1, v1] - sumTable[u0, v1] - sumTable[u1, v0] + sumTable[u0, v0]
+                squaredSums[i] += squaredTable[u1, v1] - squaredTable[u0, v1] - squaredTable[u1, v0] + squaredTable[u0, v0]
+
+        nonempty = areas > 0
+        safeAreas = numpy.where( nonempty, areas, 1 )
+        means = numpy.where( nonempty, sums / safeAreas, 0 )
+        variances = numpy.where( nonempty, squaredSums / safeAreas - means*means, 0 )
+        stds = numpy.sqrt( numpy.maximum( variances, 0 ) )
+        return sums, means, stds
+
+    def _blocksOfBox(self, box):
+        x0, x1, y0, y1 = box
+        if x1 <= x0 or y1 <= y0:
+            return []
+        b = self._blockSize
+        return list( itertools.product( range( x0 // b, (x1 - 1) // b + 1 ),
+                                        range( y0 // b, (y1 - 1) // b + 1 ) ) )
+
+    def _interiorBlocksOfBox(self, box):
+        """
+        Return the range of blocks (bx0, bx1, by0, by1) that the box covers completely, or None.
+        (The last blocks may be smaller than BlockShape, if the image size isn't a multiple of it.)
+        """
+        x0, x1, y0, y1 = box
+        b = self._blockSize
+        bx0, by0 = -(-x0 // b), -(-y0 // b)
+        bx1 = self._numBlocks[0] if x1 >= self._shape[0] else x1 // b
+        by1 = self._numBlocks[1] if y1 >= self._shape[1] else y1 // b
+        if bx0 >= bx1 or by0 >= by1:
+            return None
+        return bx0, bx1, by0, by1
+
+    def _borderBlocksOfBox(self, box):
+        """
+        Return the blocks that the box touches, but doesn't cover completely.
+        """
+        x0, x1, y0, y1 = box
+        if x1 <= x0 or y1 <= y0:
+            return []
+        interior = self._interiorBlocksOfBox( box )
+        if interior is None:
+            return self._blocksOfBox( box )
+        ix0, ix1, iy0, iy1 = interior
+        b = self._blockSize
+        xBlocks = range( x0 // b, (x1 - 1) // b + 1 )
+        yBlocks = range( y0 // b, (y1 - 1) // b + 1 )
+        yBorder = [ by for by in yBlocks if not iy0 <= by < iy1 ]
+        blocks = []
+        for bx in xBlocks:
+            if ix0 <= bx < ix1:
+                blocks += [ (bx, by) for by in yBorder ]
+            else:
+                blocks += [ (bx, by) for by in yBlocks ]
+        return blocks
+
+    def _getCoarseTables(self):
+        """
+        Return the summed-area tables of the block totals (sum and squared sum),
+        or None if the tables of some blocks are not known.
+        """
+        with self._lock:
+            if self._coarseTables is None and len(self._tables) == self._numBlocks[0] * self._numBlocks[1]:
+                totals = numpy.zeros( self._numBlocks, dtype=numpy.float64 )
+                squaredTotals = numpy.zeros( self._numBlocks, dtype=numpy.float64 )
+                for (bx, by), (sumTable, squaredTable) in self._tables.items():
+                    totals[bx, by] = sumTable[-1, -1]
+                    squaredTotals[bx, by] = squaredTable[-1, -1]
+                self._coarseTables = ( self._summedAreaTable( totals ), self._summedAreaTable( squaredTotals ) )
+            return self._coarseTables
+
+    def _getTables(self, blockIndexes):
+        """
+        Return a dict of the tables for the given blocks, computing the missing ones in parallel.
+        """
+        with self._lock:
+            tables = dict( (index, self._tables[index]) for index in blockIndexes if index in self._tables )
+            generation = self._generation
+        missing = [ index for index in blockIndexes if index not in tables ]
+        if not missing:
+            return tables
+
+        computed = {}
+        def computeTables( index ):
+            bx, by = index
+            b = self._blockSize
+            start = [0] * len(self.Input.meta.shape)
+            stop = [1] * len(self.Input.meta.shape)
+            start[self._xIndex], stop[self._xIndex] = bx*b, min( (bx+1)*b, self._shape[0] )
+            start[self._yIndex], stop[self._yIndex] = by*b, min( (by+1)*b, self._shape[1] )
+            data = self.Input(start, stop).wait()
+            data = data.reshape( ( stop[self._xIndex] - start[self._xIndex], stop[self._yIndex] - start[self._yIndex] ) )
+            computed[index] = ( self._summedAreaTable( data ), self._summedAreaTable( data * data ) )
+
+        pool = RequestPool()
+        for index in missing:
+            pool.add( Request( partial( computeTables, index ) ) )
+        pool.wait()
+
+        with self._lock:
+            # Don't keep the tables if the Input became dirty while we were computing them
+            if generation == self._generation:
+                self._tables.update( computed )
+        tables.update( computed )
+        return tables
+
+    @classmethod
+    def _summedAreaTable(cls, data):
+        """
+        Return the table S of shape (data.shape[0]+1, data.shape[1]+1), where S[i,j] = data[:i, :j].sum().
+        """
+        table = numpy.zeros( ( data.shape[0]+1, data.shape[1]+1 ), dtype=numpy.float64 )
+        table[1:, 1:] = data.astype(numpy.float64).cumsum(axis=0).cumsum(axis=1)
+        return table
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input:
+            b = self._blockSize
+            x0, x1 = roi.start[self._xIndex], roi.stop[self._xIndex]
+            y0, y1 = roi.start[self._yIndex], roi.stop[self._yIndex]
+            with self._lock:
+                for index in self._blocksOfBox( (x0, x1, y0, y1) ):
+                    self._tables.pop( index, None )
+                self._coarseTables = None
+                self._generation += 1
+            self.Output.setDirty( roi.start, roi.stop )
+        else:
+            # BlockShape: the tables are discarded in setupOutputs()
+            pass
+
 class OpBoxViewer( Operator ):
     name = "OpBoxViewer"
     description = "DummyOperator to serialize view-boxes"
@@ -23,6 +23,7 @@ import argparse
 from ilastik.applets.base.applet import Applet
 from opDataExport import OpDataExport
 from dataExportSerializer import DataExportSerializer
+from laneExportScheduler import LaneExportScheduler
 from ilastik.utility import OpMultiLaneWrapper
 
 class DataExportApplet( Applet ):
@@ -52,6 +53,9 @@ class DataExportApplet( Applet ):
 
         # This flag is set by the gui and checked by the workflow        
         self.busy = False
+
+        # Number of lanes to export simultaneously in headless mode (see run_headless_export())
+        self.lane_concurrency = 1
         
     @property
     def dataSerializers(self):
@@ -67,6 +71,18 @@ class DataExportApplet( Applet ):
             self._gui = DataExportGui( self, self.topLevelOperator )
         return self._gui
 
+    def run_headless_export(self, result_description="Result"):
+        """
+        Helper function for headless workflows.
+        Exports every lane of the top-level operator, running up to ``self.lane_concurrency``
+        lanes at once (as configured via ``--export_lane_concurrency``).
+        See :py:class:`LaneExportScheduler` for details.
+        """
+        scheduler = LaneExportScheduler( self.topLevelOperator,
+                                         lane_concurrency=self.lane_concurrency,
+                                         result_description=result_description )
+        return scheduler.run()
+
     @classmethod
     def make_cmdline_parser(cls, starting_parser=None):
         arg_parser = starting_parser or argparse.ArgumentParser()
@@ -85,6 +101,10 @@ class DataExportApplet( Applet ):
         arg_parser.add_argument( '--output_internal_path', help='Specifies dataset name within an hdf5 dataset (applies to hdf5 output only), e.g. /volume/data', required=False )
 
         arg_parser.add_argument( '--export_source', help='The data to export.  See the dropdown list on the Data Export page for choices.', required=False )
+        arg_parser.add_argument( '--export_sources', help='Several outputs to export in a single pass through the pipeline, e.g. --export_sources Probabilities "Simple Segmentation".  '
+                                                          'Use {result_type} in --output_filename_format or --output_internal_path to give each output its own file or dataset.',
+                                 nargs='+', required=False )
+        arg_parser.add_argument( '--export_lane_concurrency', help='Number of datasets to export simultaneously (headless mode only).  Also limited by the lazyflow RAM budget.', type=int, default=1, required=False )
 
         return arg_parser
 
@@ -162,6 +182,15 @@ class DataExportApplet( Applet ):
                 raise Exception( "Invalid axes specified output_axis_order: {}".format( parsed_args.output_axis_order ) )
             parsed_args.output_axis_order = output_axis_order
 
+        if getattr(parsed_args, 'export_sources', None):
+            if parsed_args.export_source is not None:
+                raise Exception( "Specify either --export_source or --export_sources, not both." )
+            if len( set( map(str.lower, parsed_args.export_sources) ) ) != len( parsed_args.export_sources ):
+                raise Exception( "--export_sources contains duplicates: {}".format( parsed_args.export_sources ) )
+
+        if getattr(parsed_args, 'export_lane_concurrency', 1) < 1:
+            raise Exception( "Invalid export_lane_concurrency: {}".format( parsed_args.export_lane_concurrency ) )
+
         return parsed_args, unused_args
 
     
@@ -175,6 +204,7 @@ class DataExportApplet( Applet ):
         """
         opDataExport = self.topLevelOperator
         self._configure_operator_with_parsed_args(parsed_args, opDataExport)
+        self.lane_concurrency = getattr(parsed_args, 'export_lane_concurrency', None) or 1
 
     @classmethod
     def _configure_operator_with_parsed_args(cls, parsed_args, opDataExport):
@@ -192,17 +222,23 @@ class DataExportApplet( Applet ):
         #  settings from triggering many calls to setupOutputs.
         opDataExport.TransactionSlot.disconnect()
 
+        export_sources = getattr(parsed_args, 'export_sources', None) or []
         if parsed_args.export_source is not None:
+            export_sources = [parsed_args.export_source]
+        if export_sources:
             source_choices = opDataExport.SelectionNames.value
             source_choices = map(str.lower, source_choices)
-            export_source = parsed_args.export_source.lower()
-            try:
-                source_index = source_choices.index(export_source)
-            except ValueError:
-                raise Exception("Invalid option for --export_source: '{}'\n"
-                                "Valid options are: {}".format( parsed_args.export_source, source_choices ))
-            else:
-                opDataExport.InputSelection.setValue( source_index )
+            source_indexes = []
+            for export_source in export_sources:
+                try:
+                    source_indexes.append( source_choices.index(export_source.lower()) )
+                except ValueError:
+                    raise Exception("Invalid option for --export_source: '{}'\n"
+                                    "Valid options are: {}".format( export_source, source_choices ))
+            opDataExport.InputSelection.setValue( source_indexes[0] )
+            if len(source_indexes) > 1:
+                # The remaining outputs are exported in the same pass (see OpDataExport.run_export())
+                opDataExport.AdditionalInputSelections.setValue( source_indexes[1:] )
 
         if parsed_args.cutout_subregion:
             opDataExport.RegionStart.setValue( parsed_args.cutout_subregion[0] )
@@ -0,0 +1,196 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import sys
+import time
+import threading
+import collections
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy
+
+import lazyflow
+from ilastik.utility import log_exception
+
+LaneExportResult = collections.namedtuple( 'LaneExportResult', 'lane_index export_path seconds exception' )
+
+class LaneExportScheduler(object):
+    """
+    Runs ``run_export()`` for several lanes of a multi-lane data export operator at the same time.
+
+    Headless workflows used to export their lanes one after another, which leaves most of the
+    machine idle when each individual dataset is small.  This scheduler keeps up to ``lane_concurrency``
+    lane exports in flight, but never admits a new lane if the estimated RAM usage of all running lanes
+    would exceed the lazyflow RAM budget.  (A single lane is always admitted, regardless of its estimate.)
+
+    Lanes that fail are logged and skipped.  After all lanes have been processed, a summary is written
+    and an exception is raised if any lane failed.
+
+    Usage:
+
+    >>> opBatchDataExport = self.batchResultsApplet.topLevelOperator
+    >>> LaneExportScheduler( opBatchDataExport, lane_concurrency=8 ).run()
+    """
+
+    # Per-lane progress is only printed when it advances by at least this many percent.
+    PROGRESS_STEP = 10
+
+    def __init__(self, opDataExport, lane_concurrency=1, ram_budget_mb=None, result_description="Result", stream=None):
+        """
+        :param opDataExport: A multi-lane export operator (e.g. ``DataExportApplet.topLevelOperator``).
+                             Iterating over it must yield per-lane operators with ``run_export()``,
+                             ``progressSignal`` and ``ExportPath``.
+        :param lane_concurrency: The maximum number of lanes to export simultaneously.
+        :param ram_budget_mb: RAM available to all concurrent lane exports.
+                              If not provided, ``lazyflow.AVAILABLE_RAM_MB`` is used (if it was configured).
+        :param result_description: Used in progress messages, e.g. "Exporting <result_description> 3/10"
+        :param stream: Where progress messages are written (default: sys.stdout)
+        """
+        assert lane_concurrency >= 1, "lane_concurrency must be at least 1"
+        self._opDataExport = opDataExport
+        self._lane_concurrency = lane_concurrency
+        if ram_budget_mb is None:
+            ram_budget_mb = getattr( lazyflow, 'AVAILABLE_RAM_MB', None ) or None
+        self._ram_budget_mb = ram_budget_mb
+        self._result_description = result_description
+        self._stream = stream or sys.stdout
+
+        self._condition = threading.Condition()
+        self._stream_lock = threading.Lock()
+        self._running_ram_mb = 0.0
+        self._running_count = 0
+        self._results = []
+
+    @classmethod
+    def estimate_lane_ram_mb(cls, opLane):
+        """
+        Estimate the RAM needed to export one lane, based on the export image's metadata.
+        Returns 0 if the upstream operators don't provide enough information for an estimate.
+        """
+        slot = opLane.ImageToExport
+        if not slot.ready():
+            return 0.0
+        ram_per_pixel = slot.meta.ram_usage_per_requested_pixel
+        if not ram_per_pixel:
+            return 0.0
+
+        shape = slot.meta.shape
+        blockshape = slot.meta.ideal_blockshape
+        if blockshape is None or len(blockshape) != len(shape):
+            blockshape = shape
+        # In ideal_blockshape, 0 means "no preference", i.e. the full extent of that axis.
+        blockshape = [ b or s for (b,s) in zip(blockshape, shape) ]
+        return ram_per_pixel * numpy.prod( blockshape ) / 1e6
+
+    def run(self):
+        """
+        Export all lanes and return a list of ``LaneExportResult`` tuples (in lane order).
+        """
+        lanes = list(enumerate(self._opDataExport))
+        num_lanes = len(lanes)
+        if num_lanes == 0:
+            return []
+
+        logger.info( "Exporting {} lanes with up to {} concurrent lane(s) (RAM budget: {} MB)"
+                     .format( num_lanes, self._lane_concurrency, self._ram_budget_mb or "unlimited" ) )
+
+        start_time = time.time()
+        threads = []
+        for lane_index, opLane in lanes:
+            ram_mb = self.estimate_lane_ram_mb( opLane )
+            self._admit( ram_mb )
+            th = threading.Thread( target=self._export_lane,
+                                   args=(lane_index, num_lanes, opLane, ram_mb),
+                                   name="LaneExport-{}".format( lane_index ) )
+            th.daemon = True
+            threads.append( th )
+            th.start()
+
+        for th in threads:
+            th.join()
+
+        results = sorted( self._results, key=lambda r: r.lane_index )
+        self._write_summary( results, time.time() - start_time )
+
+        failed = filter( lambda r: r.exception is not None, results )
+        if failed:
+            raise Exception( "Export failed for {} of {} lanes: {}"
+                             .format( len(failed), num_lanes, [r.lane_index for r in failed] ) )
+        return results
+
+    def _admit(self, ram_mb):
+        """
+        Block until there is room for a new lane with the given RAM estimate.
+        """
+        with self._condition:
+            while self._running_count > 0 and \
+                  ( self._running_count >= self._lane_concurrency or \
+                    ( self._ram_budget_mb and self._running_ram_mb + ram_mb > self._ram_budget_mb ) ):
+                self._condition.wait()
+            self._running_count += 1
+            self._running_ram_mb += ram_mb
+
+    def _release(self, ram_mb, result):
+        with self._condition:
+            self._results.append( result )
+            self._running_count -= 1
+            self._running_ram_mb -= ram_mb
+            self._condition.notify_all()
+
+    def _write(self, msg):
+        with self._stream_lock:
+            self._stream.write( msg + "\n" )
+            self._stream.flush()
+
+    def _export_lane(self, lane_index, num_lanes, opLane, ram_mb):
+        export_path = None
+        exception = None
+        last_reported = [-self.PROGRESS_STEP]
+        def print_progress( progress ):
+            if progress - last_reported[0] >= self.PROGRESS_STEP or (progress >= 100 and last_reported[0] < 100):
+                last_reported[0] = progress
+                self._write( "{} {}/{} Progress: {:.1f}".format( self._result_description, lane_index, num_lanes, progress ) )
+
+        start_time = time.time()
+        try:
+            export_path = opLane.ExportPath.value
+            logger.info( "Exporting {} {} to {}".format( self._result_description.lower(), lane_index, export_path ) )
+
+            # If the operator provides a progress signal, use it.
+            opLane.progressSignal.subscribe( print_progress )
+            try:
+                opLane.run_export()
+            finally:
+                opLane.progressSignal.unsubscribe( print_progress )
+        except Exception as ex:
+            exception = ex
+            log_exception( logger, "Failed to export {} {}".format( self._result_description.lower(), lane_index ) )
+        finally:
+            self._release( ram_mb, LaneExportResult( lane_index, export_path, time.time() - start_time, exception ) )
+
+    def _write_summary(self, results, total_seconds):
+        num_failed = len( filter( lambda r: r.exception is not None, results ) )
+        lane_seconds = sum( r.seconds for r in results )
+        self._write( "Exported {} of {} lanes in {:.1f} seconds ({:.1f} lane-seconds, {} failed)"
+                     .format( len(results) - num_failed, len(results), total_seconds, lane_seconds, num_failed ) )
+        for r in results:
+            if r.exception is not None:
+                self._write( "  FAILED {} {} ({}): {}".format( self._result_description.lower(), r.lane_index, r.export_path, r.exception ) )
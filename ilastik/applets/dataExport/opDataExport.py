@@ -28,6 +28,8 @@ from lazyflow.operators.ioOperators import OpInputDataReader, OpFormattedDataExp
 from lazyflow.operators.generic import OpSubRegion
 from lazyflow.operators.valueProviders import OpMetadataInjector
 
+from singlePassExporter import SinglePassExporter
+
 class OpDataExport(Operator):
     """
     Top-level operator for the export applet.
@@ -45,6 +47,7 @@ class OpDataExport(Operator):
     
     Inputs = InputSlot(level=1) # The exportable slots (should all be of the same shape, except for channel)
     InputSelection = InputSlot(value=0)
+    AdditionalInputSelections = InputSlot(value=[]) # More selections to export in the same pass as InputSelection (see run_export())
     SelectionNames = InputSlot() # A list of names corresponding to the exportable inputs
 
     # Subregion params
@@ -107,21 +110,9 @@ class OpDataExport(Operator):
     def __init__(self, *args, **kwargs):
         super( OpDataExport, self ).__init__(*args, **kwargs)
         
-        self._opFormattedExport = OpFormattedDataExport( parent=self )
+        self._opFormattedExport = self._createFormattedExport()
         opFormattedExport = self._opFormattedExport
 
-        # Forward almost all inputs to the 'real' exporter
-        opFormattedExport.TransactionSlot.connect( self.TransactionSlot )
-        opFormattedExport.RegionStart.connect( self.RegionStart )
-        opFormattedExport.RegionStop.connect( self.RegionStop )
-        opFormattedExport.InputMin.connect( self.InputMin )
-        opFormattedExport.InputMax.connect( self.InputMax )
-        opFormattedExport.ExportMin.connect( self.ExportMin )
-        opFormattedExport.ExportMax.connect( self.ExportMax )
-        opFormattedExport.ExportDtype.connect( self.ExportDtype )
-        opFormattedExport.OutputAxisOrder.connect( self.OutputAxisOrder )
-        opFormattedExport.OutputFormat.connect( self.OutputFormat )
-        
         self.ConvertedImage.connect( opFormattedExport.ConvertedImage )
         self.ImageToExport.connect( opFormattedExport.ImageToExport )
         self.ExportPath.connect( opFormattedExport.ExportPath )
@@ -132,6 +123,9 @@ class OpDataExport(Operator):
 
         self._opImageOnDiskProvider = None
 
+        # One exporter for each of the AdditionalInputSelections
+        self._opAdditionalExports = []
+
         # We don't export the raw data, but we connect it to it's own op 
         #  so it can be displayed alongside the data to export in the same viewer.  
         # This keeps axis order, shape, etc. in sync with the displayed export data.
@@ -157,6 +151,22 @@ class OpDataExport(Operator):
         self._opFormatRaw = opFormatRaw
         self.FormattedRawData.connect( opFormatRaw.ImageToExport )
 
+    def _createFormattedExport(self):
+        opFormattedExport = OpFormattedDataExport( parent=self )
+
+        # Forward almost all inputs to the 'real' exporter
+        opFormattedExport.TransactionSlot.connect( self.TransactionSlot )
+        opFormattedExport.RegionStart.connect( self.RegionStart )
+        opFormattedExport.RegionStop.connect( self.RegionStop )
+        opFormattedExport.InputMin.connect( self.InputMin )
+        opFormattedExport.InputMax.connect( self.InputMax )
+        opFormattedExport.ExportMin.connect( self.ExportMin )
+        opFormattedExport.ExportMax.connect( self.ExportMax )
+        opFormattedExport.ExportDtype.connect( self.ExportDtype )
+        opFormattedExport.OutputAxisOrder.connect( self.OutputAxisOrder )
+        opFormattedExport.OutputFormat.connect( self.OutputFormat )
+        return opFormattedExport
+
     def cleanupOnDiskView(self):
         if self._opImageOnDiskProvider is not None:
             self.ImageOnDisk.disconnect()
@@ -221,9 +231,20 @@ class OpDataExport(Operator):
             self._opImageOnDiskProvider.TransactionSlot.disconnect()
         self._opFormattedExport.TransactionSlot.disconnect()
 
+        self._configureExportPaths( self._opFormattedExport, known_keys )
+
+        # Re-connect to finish the 'transaction'
+        self._opFormattedExport.TransactionSlot.connect( self.TransactionSlot )
+        if self._opImageOnDiskProvider is not None:
+            self._opImageOnDiskProvider.TransactionSlot.connect( self.TransactionSlot )
+        
+        self.setupOnDiskView()
+        self._setupAdditionalExports( known_keys )
+
+    def _configureExportPaths(self, opFormattedExport, known_keys):
         # Blank the internal path while we manipulate the external path
         #  to avoid invalid intermediate states of ExportPath
-        self._opFormattedExport.OutputInternalPath.setValue( "" )
+        opFormattedExport.OutputInternalPath.setValue( "" )
 
         # use partial formatting to fill in non-coordinate name fields
         name_format = self.OutputFilenameFormat.value
@@ -231,19 +252,35 @@ class OpDataExport(Operator):
         
         # Convert to absolute path before configuring the internal op
         abs_path, _ = getPathVariants( partially_formatted_name, self.WorkingDirectory.value )
-        self._opFormattedExport.OutputFilenameFormat.setValue( abs_path )
+        opFormattedExport.OutputFilenameFormat.setValue( abs_path )
 
         # use partial formatting on the internal dataset name, too
         internal_dataset_format = self.OutputInternalPath.value 
         partially_formatted_dataset_name = format_known_keys( internal_dataset_format, known_keys )
-        self._opFormattedExport.OutputInternalPath.setValue( partially_formatted_dataset_name )
+        opFormattedExport.OutputInternalPath.setValue( partially_formatted_dataset_name )
 
-        # Re-connect to finish the 'transaction'
-        self._opFormattedExport.TransactionSlot.connect( self.TransactionSlot )
-        if self._opImageOnDiskProvider is not None:
-            self._opImageOnDiskProvider.TransactionSlot.connect( self.TransactionSlot )
-        
-        self.setupOnDiskView()
+    def _setupAdditionalExports(self, known_keys):
+        """
+        Create an exporter for each of the AdditionalInputSelections.
+        They share all settings with the main exporter, except for the {result_type}.
+        """
+        for op in self._opAdditionalExports:
+            op.cleanUp()
+        self._opAdditionalExports = []
+
+        result_types = self.SelectionNames.value
+        for selection_index in self.AdditionalInputSelections.value:
+            if selection_index == self.InputSelection.value:
+                continue
+            opFormattedExport = self._createFormattedExport()
+            opFormattedExport.Input.connect( self.Inputs[selection_index] )
+
+            selection_keys = dict( known_keys )
+            selection_keys['result_type'] = result_types[selection_index]
+            opFormattedExport.TransactionSlot.disconnect()
+            self._configureExportPaths( opFormattedExport, selection_keys )
+            opFormattedExport.TransactionSlot.connect( self.TransactionSlot )
+            self._opAdditionalExports.append( opFormattedExport )
 
     def execute(self, slot, subindex, roi, result):
         assert False, "Shouldn't get here"
@@ -258,11 +295,32 @@ class OpDataExport(Operator):
         # If we're not dirty, we don't have to do anything.
         if self.Dirty.value:
             self.cleanupOnDiskView()
-            self._opFormattedExport.run_export()
+            if self._opAdditionalExports:
+                self._run_multi_output_export()
+            else:
+                self._opFormattedExport.run_export()
             self.Dirty.setValue( False )
             self.setupOnDiskView()
             self._opImageOnDiskProvider.Dirty.setValue( False )
 
+    def _run_multi_output_export(self):
+        """
+        Export the InputSelection and all AdditionalInputSelections.
+        For hdf5 output, all of them are written in a single blockwise pass, so upstream computations
+        that are shared among the selections (e.g. the pixel classifier's predictions) run only once per block.
+        Other formats are written by their own exporters, one after another.
+        """
+        exportOps = [self._opFormattedExport] + self._opAdditionalExports
+        for op in exportOps:
+            if not op.ImageToExport.ready():
+                raise Exception( "Can't export: not all of the selected outputs are ready." )
+
+        if self.OutputFormat.value == 'hdf5':
+            SinglePassExporter( exportOps, self.progressSignal ).run()
+        else:
+            for op in exportOps:
+                op.run_export()
+
 class OpRawSubRegionHelper(Operator):
     """
     We display the raw data underneath the export data.
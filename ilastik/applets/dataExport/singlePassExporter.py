@@ -0,0 +1,186 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import threading
+import functools
+import collections
+import logging
+logger = logging.getLogger(__name__)
+
+import numpy
+import h5py
+
+import lazyflow
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, determineBlockShape, roiToSlice
+from lazyflow.request import Request, RequestPool
+from lazyflow.utility import PathComponents
+
+class SinglePassExporter(object):
+    """
+    Writes the ``ImageToExport`` of several export operators (e.g. probabilities, segmentation and
+    uncertainty of the same dataset) to hdf5 in a single blockwise pass.
+
+    Each block is requested from all outputs within the same request, one after the other.
+    If the outputs share an upstream computation that buffers its results (e.g. OpFusedPredictionProducts),
+    the pipeline is executed only once per block, no matter how many outputs are written.
+
+    All outputs must have the same axes and the same shape (except for the number of channels).
+    Each output is written to the dataset named by its operator's ``ExportPath``.
+    Several outputs may be written to different datasets within the same file.
+
+    Usage:
+
+    >>> SinglePassExporter( [opExportProbabilities, opExportSegmentation] ).run()
+    """
+
+    # Spatial block volume if no RAM estimate is available
+    DEFAULT_BLOCK_VOLUME = 128**3
+
+    def __init__(self, exportOps, progressSignal=None):
+        """
+        :param exportOps: A list of OpFormattedDataExport operators (or anything with
+                          ``ImageToExport`` and ``ExportPath`` slots).
+        :param progressSignal: Called with the overall progress (0-100), if provided.
+        """
+        assert len(exportOps) > 0
+        self._slots = [op.ImageToExport for op in exportOps]
+        self._export_paths = [op.ExportPath.value for op in exportOps]
+        self._progressSignal = progressSignal or (lambda progress: None)
+
+        if len( set(self._export_paths) ) != len( self._export_paths ):
+            raise Exception( "Can't export several outputs to the same dataset: {}\n"
+                             "Use {{result_type}} in the output filename or internal path."
+                             .format( self._export_paths ) )
+
+        self._axiskeys = self._slots[0].meta.getAxisKeys()
+        self._c_index = self._axiskeys.index('c') if 'c' in self._axiskeys else None
+        self._spatial_shape = self._spatialShape( self._slots[0] )
+        for slot, path in zip( self._slots, self._export_paths ):
+            if slot.meta.getAxisKeys() != self._axiskeys or self._spatialShape( slot ) != self._spatial_shape:
+                raise Exception( "Can't export {} in the same pass as {}: axes or shape don't match ({} vs. {})"
+                                 .format( path, self._export_paths[0],
+                                          slot.meta.shape, self._slots[0].meta.shape ) )
+
+    def _spatialShape(self, slot):
+        """
+        The slot's shape, with a channel axis of size 1.
+        """
+        shape = list( slot.meta.shape )
+        if self._c_index is not None:
+            shape[self._c_index] = 1
+        return tuple(shape)
+
+    def _slotRoi(self, slot, block_start, block_stop):
+        """
+        Convert a block (with a singleton channel axis) into a roi for the given slot (with all channels).
+        """
+        start, stop = list(block_start), list(block_stop)
+        if self._c_index is not None:
+            start[self._c_index] = 0
+            stop[self._c_index] = slot.meta.shape[self._c_index]
+        return tuple(start), tuple(stop)
+
+    def _determineBlockShape(self):
+        ideal_blockshape = self._slots[0].meta.ideal_blockshape
+        if ideal_blockshape is not None and len(ideal_blockshape) == len(self._spatial_shape) and any(ideal_blockshape):
+            # In ideal_blockshape, 0 means "no preference", i.e. the full extent of that axis.
+            blockshape = [ b or s for b,s in zip( ideal_blockshape, self._spatial_shape ) ]
+            if self._c_index is not None:
+                blockshape[self._c_index] = 1
+            return tuple( numpy.minimum( blockshape, self._spatial_shape ) )
+
+        # RAM needed per spatial pixel to produce all outputs
+        ram_per_pixel = 0
+        for slot in self._slots:
+            num_channels = slot.meta.shape[self._c_index] if self._c_index is not None else 1
+            ram_per_pixel += (slot.meta.ram_usage_per_requested_pixel or 0) * num_channels
+
+        block_volume = self.DEFAULT_BLOCK_VOLUME
+        available_ram_mb = getattr( lazyflow, 'AVAILABLE_RAM_MB', 0 )
+        if ram_per_pixel and available_ram_mb:
+            num_threads = max( 1, getattr( Request.global_thread_pool, 'num_workers', 1 ) )
+            block_volume = available_ram_mb * 1e6 / num_threads / ram_per_pixel
+        block_volume = max( 1, int(block_volume) )
+        return determineBlockShape( self._spatial_shape, block_volume )
+
+    def run(self):
+        blockshape = self._determineBlockShape()
+        block_starts = getIntersectingBlocks( blockshape, ( (0,)*len(self._spatial_shape), self._spatial_shape ) )
+        num_blocks = len(block_starts)
+        logger.info( "Exporting {} outputs in {} blocks of shape {}".format( len(self._slots), num_blocks, blockshape ) )
+
+        files, datasets = self._createDatasets()
+        try:
+            lock = threading.Lock()
+            progress = collections.Counter()
+            self._progressSignal(0)
+
+            def exportBlock(block_start):
+                block_roi = getBlockBounds( self._spatial_shape, blockshape, block_start )
+                for slot, dataset in zip( self._slots, datasets ):
+                    start, stop = self._slotRoi( slot, *block_roi )
+                    data = slot( start, stop ).wait()
+                    with lock:
+                        dataset[roiToSlice(start, stop)] = data
+                with lock:
+                    progress['blocks'] += 1
+                    self._progressSignal( 100.0 * progress['blocks'] / num_blocks )
+
+            pool = RequestPool()
+            for block_start in block_starts:
+                pool.add( Request( functools.partial( exportBlock, block_start ) ) )
+            pool.wait()
+        finally:
+            for f in files:
+                f.close()
+        self._progressSignal(100)
+
+    def _createDatasets(self):
+        """
+        Create (or overwrite) the output files and create an empty dataset for each output.
+        Like the single-output hdf5 export, each output file is replaced entirely.
+        """
+        files = collections.OrderedDict()
+        datasets = []
+        try:
+            for slot, export_path in zip( self._slots, self._export_paths ):
+                components = PathComponents( export_path )
+                external_path = components.externalPath
+                if external_path not in files:
+                    export_dir = os.path.dirname( external_path )
+                    if export_dir and not os.path.exists( export_dir ):
+                        os.makedirs( export_dir )
+                    files[external_path] = h5py.File( external_path, 'w' )
+                f = files[external_path]
+                dataset = f.create_dataset( components.internalPath,
+                                            shape=slot.meta.shape,
+                                            dtype=slot.meta.dtype,
+                                            chunks=True )
+                if slot.meta.axistags is not None:
+                    dataset.attrs['axistags'] = slot.meta.axistags.toJSON()
+                if slot.meta.drange is not None:
+                    dataset.attrs['drange'] = slot.meta.drange
+                datasets.append( dataset )
+        except:
+            for f in files.values():
+                f.close()
+            raise
+        return files.values(), datasets
@@ -27,10 +27,13 @@ from lazyflow.utility.jsonConfig import RoiTuple
 from lazyflow.operators.ioOperators import OpStreamingHdf5Reader, OpInputDataReader
 from lazyflow.operators.valueProviders import OpMetadataInjector
 from ilastik.applets.base.applet import DatasetConstraintError
+import ilastik.config
 
 from ilastik.utility import OpMultiLaneWrapper
 from lazyflow.operators.opReorderAxes import OpReorderAxes
 
+from opRawBlockCache import OpRawBlockCache
+
 class DatasetInfo(object):
     """
     Struct-like class for describing dataset info.
@@ -130,6 +133,11 @@ class OpDataSelection(Operator):
         super(OpDataSelection, self).__init__(*args, **kwargs)
         self.force5d = force5d
         self._opReaders = []
+        self._opRawCache = None
+
+        # Optionally, raw data is cached in blocks between the reader and our outputs (see OpRawBlockCache)
+        self.rawCacheSizeMB = ilastik.config.cfg.getint( 'raw data cache', 'size_mb' ) # 0 means no cache
+        self.rawCacheReadAheadBlocks = ilastik.config.cfg.getint( 'raw data cache', 'read_ahead_blocks' )
 
         # If the gui calls disconnect() on an input slot without replacing it with something else,
         #  we still need to clean up the internal operator that was providing our data.
@@ -145,6 +153,16 @@ class OpDataSelection(Operator):
             for reader in reversed(self._opReaders):
                 reader.cleanUp()
             self._opReaders = []
+            self._opRawCache = None
+
+    def getRawCacheStatistics(self):
+        """
+        Return the statistics of the raw data cache (see OpRawBlockCache.getStatistics()),
+        or None if the data isn't cached.
+        """
+        if self._opRawCache is None:
+            return None
+        return self._opRawCache.getStatistics()
     
     def setupOutputs(self):
         self.internalCleanup()
@@ -174,6 +192,16 @@ class OpDataSelection(Operator):
                 opReader.FilePath.setValue(datasetInfo.filePath)
                 providerSlot = opReader.Output
                 self._opReaders.append(opReader)
+
+            # Cache the raw data in blocks that are aligned to the file's chunks
+            if self.rawCacheSizeMB:
+                opRawCache = OpRawBlockCache( parent=self )
+                opRawCache.MaxSizeMB.setValue( self.rawCacheSizeMB )
+                opRawCache.ReadAheadBlocks.setValue( self.rawCacheReadAheadBlocks )
+                opRawCache.Input.connect( providerSlot )
+                providerSlot = opRawCache.Output
+                self._opReaders.append( opRawCache )
+                self._opRawCache = opRawCache
             
             # Inject metadata if the dataset info specified any.
             # Also, inject if if dtype is uint8, which we can reasonably assume has drange (0,255)
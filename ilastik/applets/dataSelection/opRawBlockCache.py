@@ -0,0 +1,277 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import threading
+import collections
+import functools
+import logging
+
+import numpy
+
+import lazyflow
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
+from lazyflow.request import Request, RequestPool
+
+logger = logging.getLogger(__name__)
+
+def rawCacheBlockShape( meta, target_block_bytes ):
+    """
+    Choose the block shape for caching an image that is read from a file.
+
+    Blocks are aligned to the file's native chunks (``meta.ideal_blockshape``, if the reader provides it):
+    Each block is a whole number of chunks, grown along the last axes first (which are contiguous in the file)
+    until it holds about ``target_block_bytes``.  Blocks always include all channels.
+    """
+    shape = meta.shape
+    chunks = meta.ideal_blockshape
+    if chunks is None or len(chunks) != len(shape):
+        chunks = (1,) * len(shape)
+    # In ideal_blockshape, 0 means "no preference", i.e. the full extent of that axis.
+    block = [ min( c or s, s ) for c, s in zip( chunks, shape ) ]
+    axiskeys = meta.getAxisKeys()
+    if 'c' in axiskeys:
+        c_index = axiskeys.index('c')
+        block[c_index] = shape[c_index]
+
+    itemsize = numpy.dtype( meta.dtype ).itemsize
+    for i in reversed( range( len(shape) ) ):
+        factor = int( target_block_bytes // ( numpy.prod( block ) * itemsize ) )
+        if factor <= 1:
+            break
+        block[i] = min( block[i] * factor, shape[i] )
+    return tuple( block )
+
+class OpRawBlockCache(Operator):
+    """
+    An in-memory block cache for raw data that is read from a file (e.g. by OpInputDataReader).
+
+    Downstream filters request their roi plus a halo, so neighbouring requests overlap, and without
+    a cache every request goes back to the file (which is slow for compressed HDF5, tiff sequences
+    or network drives).  This cache reads whole blocks that are aligned to the file's chunks
+    (see rawCacheBlockShape()) and keeps the least recently used blocks within MaxSizeMB.
+    The size is further limited to RAM_FRACTION of the lazyflow RAM budget (lazyflow.AVAILABLE_RAM_MB).
+
+    If ReadAheadBlocks is nonzero, sequential access (in C-order of the block grid, as in a blockwise
+    export) reads the next blocks in the background.
+
+    The number of bytes read from the file and served to downstream operators, and the
+    hit/miss/read-ahead counts are available via getStatistics().
+    """
+    Input = InputSlot()
+    MaxSizeMB = InputSlot(value=500)
+    ReadAheadBlocks = InputSlot(value=0)
+
+    Output = OutputSlot()
+
+    # Approximate size of each cached block
+    TARGET_BLOCK_BYTES = 4e6
+    # Fraction of the lazyflow RAM budget that the cache may use at most
+    RAM_FRACTION = 0.25
+
+    def __init__(self, *args, **kwargs):
+        super( OpRawBlockCache, self ).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._blocks = collections.OrderedDict() # block start -> data, least recently used first
+        self._pending = {} # block start -> Request, for blocks that are being read
+        self._cached_bytes = 0
+        self._generation = 0 # Incremented whenever cached data becomes invalid
+        self._last_block_index = None # For detecting sequential access
+        self._store_key = None
+        self._blockShape = None
+        self._stats = collections.Counter()
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom( self.Input.meta )
+
+        store_key = ( self.Input.meta.shape, self.Input.meta.dtype )
+        if store_key != self._store_key:
+            self._clear()
+            self._blockShape = rawCacheBlockShape( self.Input.meta, self.TARGET_BLOCK_BYTES )
+            self._store_key = store_key
+            logger.debug( "Caching raw data in blocks of shape {}".format( self._blockShape ) )
+
+        with self._lock:
+            self._evict()
+
+    def getStatistics(self):
+        """
+        Return a dict with the number of 'bytes_read' (from the Input) and 'bytes_served' (to the Output),
+        the number of block 'hits', 'misses' and 'read_ahead' blocks, 'evictions', and the current 'cached_bytes'.
+        """
+        with self._lock:
+            stats = dict( self._stats )
+            stats['cached_bytes'] = self._cached_bytes
+        for key in ['bytes_read', 'bytes_served', 'hits', 'misses', 'read_ahead', 'evictions']:
+            stats.setdefault( key, 0 )
+        return stats
+
+    def execute(self, slot, subindex, roi, result):
+        shape = self.Input.meta.shape
+        block_starts = map( tuple, getIntersectingBlocks( self._blockShape, (roi.start, roi.stop) ) )
+
+        def copyBlock( block_start ):
+            data = self._getBlock( block_start )
+            bounds_start, bounds_stop = getBlockBounds( shape, self._blockShape, block_start )
+            start = numpy.maximum( bounds_start, roi.start )
+            stop = numpy.minimum( bounds_stop, roi.stop )
+            result[ roiToSlice( start - roi.start, stop - roi.start ) ] = data[ roiToSlice( start - bounds_start, stop - bounds_start ) ]
+
+        if len(block_starts) == 1:
+            copyBlock( block_starts[0] )
+        else:
+            pool = RequestPool()
+            for block_start in block_starts:
+                pool.add( Request( functools.partial( copyBlock, block_start ) ) )
+            pool.wait()
+
+        with self._lock:
+            self._stats['bytes_served'] += result.nbytes
+        self._readAhead( block_starts )
+        return result
+
+    def _getBlock(self, block_start):
+        with self._lock:
+            data = self._blocks.get( block_start )
+            if data is not None:
+                # Mark as recently used
+                self._blocks[block_start] = self._blocks.pop( block_start )
+                self._stats['hits'] += 1
+                return data
+            request = self._pending.get( block_start )
+            if request is None:
+                request = self._readRequest( block_start )
+                self._stats['misses'] += 1
+            else:
+                # Already being read (by another request, or ahead)
+                self._stats['hits'] += 1
+        # (If nobody submitted the request yet, this reads the block in the current thread.)
+        return request.wait()
+
+    def _readRequest(self, block_start):
+        """
+        Create a request that reads a block into the cache.  Must be called with the lock held.
+        (Requests are submitted or waited for after the lock was released.)
+        """
+        request = Request( functools.partial( self._readBlock, block_start, self._generation ) )
+        self._pending[block_start] = request
+        return request
+
+    def _readBlock(self, block_start, generation):
+        start, stop = getBlockBounds( self.Input.meta.shape, self._blockShape, block_start )
+        try:
+            data = self.Input( start, stop ).wait()
+        except:
+            with self._lock:
+                if generation == self._generation:
+                    self._pending.pop( block_start, None )
+            raise
+        with self._lock:
+            self._stats['bytes_read'] += data.nbytes
+            # Don't keep blocks that were invalidated while we were reading them
+            if generation == self._generation:
+                self._pending.pop( block_start, None )
+                self._blocks[block_start] = data
+                self._cached_bytes += data.nbytes
+                self._evict()
+        return data
+
+    def _readAhead(self, block_starts):
+        """
+        If the blocks of the last request follow the blocks of the previous one (in C-order of the block grid),
+        start reading the next ReadAheadBlocks blocks.
+        """
+        num_blocks = self.ReadAheadBlocks.value
+        grid_shape = [ (s + b - 1) // b for s, b in zip( self.Input.meta.shape, self._blockShape ) ]
+        indexes = [ numpy.ravel_multi_index( tuple( s // b for s, b in zip( start, self._blockShape ) ), grid_shape )
+                    for start in block_starts ]
+        first, last = min( indexes ), max( indexes )
+        requests = []
+        with self._lock:
+            previous = self._last_block_index
+            self._last_block_index = max( last, previous ) if previous is not None else last
+            if not num_blocks or previous is None or not ( previous <= first <= previous + num_blocks + 1 ):
+                return
+            num_grid_blocks = numpy.prod( grid_shape )
+            for index in range( last + 1, min( last + 1 + num_blocks, num_grid_blocks ) ):
+                block_index = numpy.unravel_index( index, grid_shape )
+                block_start = tuple( i * b for i, b in zip( block_index, self._blockShape ) )
+                if block_start not in self._blocks and block_start not in self._pending:
+                    requests.append( self._readRequest( block_start ) )
+                    self._stats['read_ahead'] += 1
+        for request in requests:
+            request.submit()
+
+    def _maxBytes(self):
+        max_bytes = self.MaxSizeMB.value * 1e6
+        ram_mb = getattr( lazyflow, 'AVAILABLE_RAM_MB', 0 )
+        if ram_mb:
+            max_bytes = min( max_bytes, ram_mb * self.RAM_FRACTION * 1e6 )
+        return max_bytes
+
+    def _evict(self):
+        """
+        Discard the least recently used blocks until the cache fits within its size limit.
+        Must be called with the lock held.
+        """
+        max_bytes = self._maxBytes()
+        while self._blocks and self._cached_bytes > max_bytes:
+            _, data = self._blocks.popitem( last=False )
+            self._cached_bytes -= data.nbytes
+            self._stats['evictions'] += 1
+
+    def _invalidate(self, start, stop):
+        """
+        Forget all blocks that intersect the given region.
+        (Blocks that are currently being read won't be cached.)
+        """
+        shape = self.Input.meta.shape
+        with self._lock:
+            self._generation += 1
+            self._pending.clear()
+            for block_start in self._blocks.keys():
+                bounds_start, bounds_stop = getBlockBounds( shape, self._blockShape, block_start )
+                if all( bs < e and s < be for bs, be, s, e in zip( bounds_start, bounds_stop, start, stop ) ):
+                    self._cached_bytes -= self._blocks.pop( block_start ).nbytes
+
+    def _clear(self):
+        with self._lock:
+            self._generation += 1
+            self._pending.clear()
+            self._blocks.clear()
+            self._cached_bytes = 0
+            self._last_block_index = None
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input:
+            self._invalidate( roi.start, roi.stop )
+            self.Output.setDirty( roi.start, roi.stop )
+        else:
+            # MaxSizeMB takes effect in setupOutputs(), ReadAheadBlocks with the next request
+            pass
+
+    def cleanUp(self):
+        stats = self.getStatistics()
+        if stats['bytes_served']:
+            logger.info( "Raw cache: read {:.1f} MB from the file, served {:.1f} MB ({} hits, {} misses, {} blocks read ahead)"
+                          .format( stats['bytes_read']/1e6, stats['bytes_served']/1e6,
+                                   stats['hits'], stats['misses'], stats['read_ahead'] ) )
+        self._clear()
+        super( OpRawBlockCache, self ).cleanUp()
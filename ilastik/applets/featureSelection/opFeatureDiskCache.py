@@ -0,0 +1,299 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import glob
+import hashlib
+import threading
+import functools
+import logging
+
+import numpy
+import h5py
+
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.roi import roiToSlice, getIntersectingBlocks, getBlockBounds
+from lazyflow.request import Request, RequestPool, RequestLock
+from lazyflow.utility import PathComponents
+
+logger = logging.getLogger(__name__)
+
+def makeDatasetIdentity( datasetInfo ):
+    """
+    Create a string that identifies the data described by the given ``DatasetInfo``.
+    The string changes if the data file is modified.
+    """
+    from ilastik.applets.dataSelection.opDataSelection import DatasetInfo
+    if datasetInfo.location == DatasetInfo.Location.ProjectInternal:
+        identity = "project:" + datasetInfo.datasetId
+    else:
+        identity = "file:" + datasetInfo.filePath
+        externalPath = PathComponents( datasetInfo.filePath.split( os.path.pathsep )[0] ).externalPath
+        if os.path.exists( externalPath ):
+            identity += ":{}".format( os.path.getmtime( externalPath ) )
+    identity += ":{}".format( datasetInfo.subvolume_roi )
+    return identity
+
+class _CacheEntry(object):
+    """
+    An open cache entry file.  Operators that use the same entry share one instance.
+    """
+    def __init__(self, path, h5file):
+        self.path = path
+        self.file = h5file
+        self.lock = RequestLock()
+        self.pending_blocks = {} # block_start -> Request
+        self.refcount = 0
+
+class OpFeatureDiskCache(Operator):
+    """
+    A persistent, chunked on-disk cache for computed features.
+
+    Each cache entry is an hdf5 file in ``CacheDirectory``, named after a hash of the ``DatasetIdentity``
+    and a hash of the ``FeatureSettings``.  Entries survive between sessions, so repeated batch runs,
+    retraining and re-opened projects can reuse features that were already computed.
+
+    - Blocks are computed on demand (in parallel) and marked as stored in a per-block status table.
+    - When the feature settings for a dataset change, the old entries for that dataset are deleted.
+    - If ``MaxSizeMB`` is nonzero, the least recently used entries are deleted until the cache fits.
+      (Checked when an entry is opened and after new blocks were stored.)
+    - If ``CacheDirectory`` is empty, the cache is disabled, and requests are forwarded to ``Input``.
+    - Dirty notifications from upstream invalidate the affected blocks.
+
+    Note: The cache directory must not be shared by several processes that compute features concurrently.
+    """
+    Input = InputSlot()
+    CacheDirectory = InputSlot(stype='filestring') # Empty means disabled
+    DatasetIdentity = InputSlot(stype='string') # Identifies the input data (see makeDatasetIdentity())
+    FeatureSettings = InputSlot(stype='string') # Identifies the feature computation (selections, scales, etc.)
+    MaxSizeMB = InputSlot(value=0) # 0 means unlimited
+
+    Output = OutputSlot()
+
+    # Spatial block size of the stored features (all channels are stored together)
+    BLOCK_SIDE = 64
+
+    # All entries that are currently open in this process, by path.  (Open entries are never evicted.)
+    _open_entries = {}
+    _open_entries_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super( OpFeatureDiskCache, self ).__init__(*args, **kwargs)
+        self._entry = None
+        self._blockshape = None
+
+    @classmethod
+    def _hash(cls, s):
+        return hashlib.sha1( s ).hexdigest()[:16]
+
+    def setupOutputs(self):
+        self._closeEntry()
+        self.Output.meta.assignFrom( self.Input.meta )
+
+        shape = self.Input.meta.shape
+        blockshape = []
+        for tag, size in zip( self.Input.meta.getAxisKeys(), shape ):
+            if tag == 't':
+                blockshape.append( 1 )
+            elif tag == 'c':
+                blockshape.append( size )
+            else:
+                blockshape.append( min( size, self.BLOCK_SIDE ) )
+        self._blockshape = tuple(blockshape)
+        self.Output.meta.ideal_blockshape = self._blockshape
+
+        cache_dir = self.CacheDirectory.value
+        if not cache_dir:
+            # Disabled
+            return
+        if not os.path.exists( cache_dir ):
+            os.makedirs( cache_dir )
+        dataset_hash = self._hash( self.DatasetIdentity.value )
+        settings_hash = self._hash( self.FeatureSettings.value )
+        entry_path = os.path.join( cache_dir, "features_{}_{}.h5".format( dataset_hash, settings_hash ) )
+
+        # Features for this dataset with any other settings are now obsolete.
+        for path in glob.glob( os.path.join( cache_dir, "features_{}_*.h5".format( dataset_hash ) ) ):
+            if path != entry_path:
+                self._deleteEntry( path )
+
+        self._openEntry( entry_path )
+        self._evict( self._entry )
+
+    def _openEntry(self, entry_path):
+        with OpFeatureDiskCache._open_entries_lock:
+            entry = OpFeatureDiskCache._open_entries.get( entry_path )
+            if entry is None:
+                entry = _CacheEntry( entry_path, self._openFile( entry_path ) )
+                OpFeatureDiskCache._open_entries[entry_path] = entry
+            entry.refcount += 1
+        # Mark this entry as recently used
+        os.utime( entry_path, None )
+        self._entry = entry
+
+    def _openFile(self, entry_path):
+        shape = self.Input.meta.shape
+        dtype = self.Input.meta.dtype
+        num_blocks = tuple( (numpy.array(shape) + self._blockshape - 1) // self._blockshape )
+
+        f = None
+        if os.path.exists( entry_path ):
+            try:
+                f = h5py.File( entry_path, 'a' )
+                if f['features'].shape != shape or \
+                   f['features'].dtype != dtype or \
+                   tuple(f['features'].chunks) != self._blockshape:
+                    logger.info( "Discarding incompatible feature cache entry: {}".format( entry_path ) )
+                    f.close()
+                    f = None
+                    os.remove( entry_path )
+            except Exception as ex:
+                logger.warn( "Discarding unreadable feature cache entry {}: {}".format( entry_path, ex ) )
+                if f is not None:
+                    f.close()
+                f = None
+                os.remove( entry_path )
+
+        if f is None:
+            f = h5py.File( entry_path, 'w' )
+            f.create_dataset( 'features', shape=shape, dtype=dtype, chunks=self._blockshape )
+            f.create_dataset( 'block_status', shape=num_blocks, dtype=numpy.uint8 )
+            f.attrs['dataset_identity'] = self.DatasetIdentity.value
+            f.attrs['feature_settings'] = self.FeatureSettings.value
+        return f
+
+    def _closeEntry(self):
+        entry = self._entry
+        self._entry = None
+        if entry is None:
+            return
+        with OpFeatureDiskCache._open_entries_lock:
+            entry.refcount -= 1
+            if entry.refcount == 0:
+                del OpFeatureDiskCache._open_entries[entry.path]
+                with entry.lock:
+                    entry.file.close()
+
+    def _deleteEntry(self, path):
+        with OpFeatureDiskCache._open_entries_lock:
+            if path in OpFeatureDiskCache._open_entries:
+                return
+        logger.info( "Deleting feature cache entry: {}".format( path ) )
+        try:
+            os.remove( path )
+        except OSError:
+            pass
+
+    def _evict(self, entry):
+        """
+        Delete the least recently used entries (except for the given open entry) until the cache fits within MaxSizeMB.
+        """
+        max_size_mb = self.MaxSizeMB.value
+        if not max_size_mb:
+            return
+        # Make sure the size of our own entry is up-to-date on disk
+        with entry.lock:
+            entry.file.flush()
+        entries = []
+        for path in glob.glob( os.path.join( self.CacheDirectory.value, "features_*.h5" ) ):
+            try:
+                entries.append( ( os.path.getmtime(path), os.path.getsize(path), path ) )
+            except OSError:
+                pass
+        total_mb = sum( e[1] for e in entries ) / 1e6
+        for _, size, path in sorted( entries ):
+            if total_mb <= max_size_mb:
+                break
+            if path != entry.path:
+                self._deleteEntry( path )
+                total_mb -= size / 1e6
+
+    def _blockIndex(self, block_start):
+        return tuple( numpy.array(block_start) // self._blockshape )
+
+    def execute(self, slot, subindex, roi, result):
+        entry = self._entry
+        if entry is None:
+            # Disabled
+            self.Input( roi.start, roi.stop ).writeInto( result ).wait()
+            return result
+
+        block_starts = getIntersectingBlocks( self._blockshape, (roi.start, roi.stop) )
+        block_starts = map( tuple, block_starts )
+
+        new_requests = []
+        waiting_requests = []
+        with entry.lock:
+            block_status = entry.file['block_status']
+            for block_start in block_starts:
+                if block_status[self._blockIndex(block_start)]:
+                    continue
+                req = entry.pending_blocks.get( block_start )
+                if req is None:
+                    req = Request( functools.partial( self._computeBlock, entry, block_start ) )
+                    entry.pending_blocks[block_start] = req
+                    new_requests.append( req )
+                waiting_requests.append( req )
+
+        if new_requests:
+            pool = RequestPool()
+            for req in new_requests:
+                pool.add( req )
+            pool.submit()
+        for req in waiting_requests:
+            req.wait()
+        if new_requests:
+            # The stored blocks may have pushed the cache over its limit
+            self._evict( entry )
+
+        with entry.lock:
+            result[...] = entry.file['features'][roiToSlice( roi.start, roi.stop )]
+        return result
+
+    def _computeBlock(self, entry, block_start):
+        try:
+            block_roi = getBlockBounds( self.Input.meta.shape, self._blockshape, block_start )
+            data = self.Input( *block_roi ).wait()
+            with entry.lock:
+                entry.file['features'][roiToSlice( *block_roi )] = data
+                entry.file['block_status'][self._blockIndex(block_start)] = 1
+        finally:
+            with entry.lock:
+                entry.pending_blocks.pop( block_start, None )
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input:
+            # Forget the affected blocks
+            entry = self._entry
+            if entry is not None:
+                with entry.lock:
+                    block_status = entry.file['block_status']
+                    for block_start in getIntersectingBlocks( self._blockshape, (roi.start, roi.stop) ):
+                        block_status[self._blockIndex(block_start)] = 0
+            self.Output.setDirty( roi.start, roi.stop )
+        elif slot == self.MaxSizeMB:
+            pass
+        else:
+            # Other settings: setupOutputs() will select a new cache entry
+            self.Output.setDirty( slice(None) )
+
+    def cleanUp(self):
+        self._closeEntry()
+        super( OpFeatureDiskCache, self ).cleanUp()
@@ -24,11 +24,9 @@ import logging
 
 #SciPy
 import numpy
-import h5py
 
 #lazyflow
 from lazyflow.graph import Operator, InputSlot, OutputSlot
-from lazyflow.roi import roiToSlice
 from lazyflow.operators import OpSlicedBlockedArrayCache, OpMultiArraySlicer2
 from lazyflow.operators import OpPixelFeaturesPresmoothed as OpPixelFeaturesPresmoothed_Original
 from lazyflow.operators import OpPixelFeaturesInterpPresmoothed as OpPixelFeaturesPresmoothed_Interpolated
@@ -36,6 +34,9 @@ from lazyflow.operators.imgFilterOperators import OpPixelFeaturesPresmoothed as
 from lazyflow.operators import OpReorderAxes, OperatorWrapper
 
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.utility.slicedBlockShapes import configuredSlicedBlockShapes
+from opFeatureDiskCache import OpFeatureDiskCache, makeDatasetIdentity
+from precomputedFeatures import PrecomputedFeatureFiles, readFeatureListFile
 
 logger = logging.getLogger(__name__)
 
@@ -58,6 +59,11 @@ class OpFeatureSelectionNoCache(Operator):
                          # The matrix columns correspond to the scales provided in the Scales input,
                          #  which requires that the number of matrix columns must match len(Scales.value)
     FeatureListFilename = InputSlot(stype="str", optional=True)
+
+    # Optional persistent feature cache (see OpFeatureDiskCache)
+    FeatureCacheDirectory = InputSlot(stype='filestring', optional=True) # If not provided (or empty), features are not stored on disk
+    FeatureCacheSizeMB = InputSlot(value=0) # Total size limit of the cache directory (0 means unlimited)
+    DatasetIdentity = InputSlot(optional=True) # A DatasetInfo (or an identifying string) for the input image
     
     # Features are presented in the channels of the output image
     # Output can be optionally accessed via an internal cache.
@@ -98,6 +104,15 @@ class OpFeatureSelectionNoCache(Operator):
                                                broadcastingSlotNames=["AxisOrder"])
         self.opReorderLayers.Input.connect(self.opPixelFeatures.Features)
 
+        self._filter_implementation = filter_implementation
+        self.opDiskCache = OpFeatureDiskCache(parent=self)
+        self.opDiskCache.Input.connect( self.opReorderOut.Output )
+        self.opDiskCache.CacheDirectory.connect( self.FeatureCacheDirectory )
+        self.opDiskCache.MaxSizeMB.connect( self.FeatureCacheSizeMB )
+
+        # Handles for precomputed feature files (if FeatureListFilename is used)
+        self._featureFiles = None
+
         # We don't connect SelectionMatrix here because we want to 
         #  check it for errors (See setupOutputs)
         # self.opPixelFeatures.SelectionMatrix.connect( self.SelectionMatrix )
@@ -114,38 +129,42 @@ class OpFeatureSelectionNoCache(Operator):
         self.opReorderIn.AxisOrder.setValue(newAxes)
         self.opReorderOut.AxisOrder.setValue(oldAxes)
         self.opReorderLayers.AxisOrder.setValue(oldAxes)
-        if self.FeatureListFilename.ready() and len(self.FeatureListFilename.value) > 0:
-            f = open(self.FeatureListFilename.value, 'r')
-            self._files = []
-            for line in f:
-                line = line.strip()
-                if len(line) > 0:
-                    self._files.append(line)
-            f.close()
+
+        # Open the new feature files (if any) before closing the old ones,
+        #  so files that are still in use keep their pooled handles.
+        oldFeatureFiles = self._featureFiles
+        self._featureFiles = None
+        try:
+            if self.FeatureListFilename.ready() and len(self.FeatureListFilename.value) > 0:
+                paths = readFeatureListFile( self.FeatureListFilename.value )
+                self._featureFiles = PrecomputedFeatureFiles( paths,
+                                                              "".join( self.InputImage.meta.getAxisKeys() ),
+                                                              self.InputImage.meta.shape )
+        finally:
+            if oldFeatureFiles is not None:
+                oldFeatureFiles.close()
+
+        if self._featureFiles is not None:
+            # Read precomputed features from the listed files instead of computing them
+            paths = self._featureFiles.paths
             
             self.OutputImage.disconnect()
             self.FeatureLayers.disconnect()
             
             axistags = self.InputImage.meta.axistags
             
-            self.FeatureLayers.resize(len(self._files))
-            for i in range(len(self._files)):
-                f = h5py.File(self._files[i], 'r')
-                shape = f["data"].shape
-                assert len(shape) == 3
-                dtype = f["data"].dtype.type
-                f.close()
-                self.FeatureLayers[i].meta.shape    = shape+(1,)
-                self.FeatureLayers[i].meta.dtype    = dtype
+            self.FeatureLayers.resize(len(paths))
+            for i in range(len(paths)):
+                self.FeatureLayers[i].meta.shape    = self._featureFiles.layerShape(i)
+                self.FeatureLayers[i].meta.dtype    = self._featureFiles.layerDtype(i)
                 self.FeatureLayers[i].meta.axistags = axistags 
-                self.FeatureLayers[i].meta.description = os.path.basename(self._files[i]) 
+                self.FeatureLayers[i].meta.description = os.path.basename(paths[i]) 
             
-            self.OutputImage.meta.shape    = (shape) + (len(self._files),)
-            self.OutputImage.meta.dtype    = dtype 
+            self.OutputImage.meta.shape    = self._featureFiles.shape
+            self.OutputImage.meta.dtype    = self._featureFiles.dtype
             self.OutputImage.meta.axistags = axistags 
-            
-            self.CachedOutputImage.meta.shape    = (shape) + (len(self._files),)
-            self.CachedOutputImage.meta.axistags = axistags 
+            # Downstream requests are most efficient if they align with the hdf5 chunks
+            self.OutputImage.meta.ideal_blockshape = self._featureFiles.ideal_blockshape()
         else:
             # Set the new selection matrix and check if it creates an error.
             selections = self.SelectionMatrix.value
@@ -158,42 +177,57 @@ class OpFeatureSelectionNoCache(Operator):
                 raise DatasetConstraintError( "Feature Selection", msg )
             
             # Connect our external outputs to our internal operators
-            self.OutputImage.connect( self.opReorderOut.Output )
+            if self._isDiskCacheEnabled():
+                self.opDiskCache.DatasetIdentity.setValue( self._getDatasetIdentity() )
+                self.opDiskCache.FeatureSettings.setValue( self._getFeatureSettingsString() )
+                self.OutputImage.connect( self.opDiskCache.Output )
+            else:
+                self.OutputImage.connect( self.opReorderOut.Output )
             self.FeatureLayers.connect( self.opReorderLayers.Output )
 
+    def _isDiskCacheEnabled(self):
+        return self.FeatureCacheDirectory.ready() and \
+               self.FeatureCacheDirectory.value and \
+               self.DatasetIdentity.ready()
+
+    def _getDatasetIdentity(self):
+        identity = self.DatasetIdentity.value
+        if not isinstance( identity, str ):
+            identity = makeDatasetIdentity( identity )
+        # Include the metadata, in case the same file is interpreted differently (e.g. axistags)
+        meta = self.InputImage.meta
+        return "{}:{}:{}:{}".format( identity, meta.shape, meta.dtype, meta.getAxisKeys() )
+
+    def _getFeatureSettingsString(self):
+        """
+        A string that changes whenever the computed features would change.
+        """
+        return "{}:{}:{}:{}:{}".format( self._filter_implementation,
+                                        list(self.FeatureIds.value),
+                                        list(self.Scales.value),
+                                        numpy.asarray(self.SelectionMatrix.value).tolist(),
+                                        self.opReorderIn.AxisOrder.value )
+
     def propagateDirty(self, slot, subindex, roi):
         # Output slots are directly connected to internal operators
         pass
     
     def execute(self, slot, subindex, rroi, result):
-        if len(self.FeatureListFilename.value) == 0:
-            return
-       
-        assert result.dtype == numpy.float32
-        
-        key = roiToSlice(rroi.start, rroi.stop)
-            
+        # Our outputs are only unconnected when the features are read from files
+        assert self._featureFiles is not None, "No feature files are open"
         if slot == self.FeatureLayers:
-            index = subindex[0]
-            f = h5py.File(self._files[index], 'r')
-            result[...,0] = f["data"][key[0:3]]
-            return result
+            return self._featureFiles.readLayer( subindex[0], rroi.start, rroi.stop, result )
         elif slot == self.OutputImage:
-            assert result.ndim == 4
-            assert result.shape[-1] == len(self._files), "result.shape = %r" % result.shape 
-            assert rroi.start == 0, "rroi = %r" % (rroi,)
-            assert rroi.stop  == len(self._files), "rroi = %r" % (rroi,)
-            
-            j = 0
-            for i in range(key[3].start, key[3].stop):
-                f = h5py.File(self._files[i], 'r')
-                r = f["data"][key[0:3]]
-                assert r.dtype == numpy.float32
-                assert r.ndim == 3
-                f.close()
-                result[:,:,:,j] = r 
-                j += 1
-            return result  
+            return self._featureFiles.readFeatures( rroi.start, rroi.stop, result )
+
+    def _closeFeatureFiles(self):
+        if self._featureFiles is not None:
+            self._featureFiles.close()
+            self._featureFiles = None
+
+    def cleanUp(self):
+        self._closeFeatureFiles()
+        super( OpFeatureSelectionNoCache, self ).cleanUp()
 
 class OpFeatureSelection( OpFeatureSelectionNoCache ):
     """
@@ -222,41 +256,22 @@ class OpFeatureSelection( OpFeatureSelectionNoCache ):
             self.CachedOutputImage.meta.assignFrom(self.OutputImage.meta)
         
         else:
-            # We choose block shapes that have only 1 channel because the channels may be 
-            #  coming from different features (e.g different filters) and probably shouldn't be cached together.
-            blockDimsX = { 't' : (1,1),
-                           'z' : (256,256),
-                           'y' : (256,256),
-                           'x' : (32,32),
-                           'c' : (1000,1000) }  # Overestimate number of feature channels: 
-                                                # Cache block dimensions will be clipped to the size of the actual feature image
-    
-            blockDimsY = { 't' : (1,1),
-                           'z' : (256,256),
-                           'y' : (32,32),
-                           'x' : (256,256),
-                           'c' : (1000,1000) }
-    
-            blockDimsZ = { 't' : (1,1),
-                           'z' : (32,32),
-                           'y' : (256,256),
-                           'x' : (256,256),
-                           'c' : (1000,1000) }
-            
-            axisOrder = [ tag.key for tag in self.InputImage.meta.axistags ]
-            innerBlockShapeX = tuple( blockDimsX[k][0] for k in axisOrder )
-            outerBlockShapeX = tuple( blockDimsX[k][1] for k in axisOrder )
-    
-            innerBlockShapeY = tuple( blockDimsY[k][0] for k in axisOrder )
-            outerBlockShapeY = tuple( blockDimsY[k][1] for k in axisOrder )
-    
-            innerBlockShapeZ = tuple( blockDimsZ[k][0] for k in axisOrder )
-            outerBlockShapeZ = tuple( blockDimsZ[k][1] for k in axisOrder )
-    
+            # The block shapes are derived from the feature image's shape, dtype, chunking and resolution,
+            #  so that each block holds about the same number of bytes (see [cache block shapes] in the config file).
+            # Each block includes all feature channels.
+            featureMeta = self.OutputImage.meta if self.OutputImage.ready() else self.InputImage.meta
+            blockShapes = configuredSlicedBlockShapes( featureMeta, 'feature' )
+
             # Configure the cache        
-            self.opPixelFeatureCache.innerBlockShape.setValue( (innerBlockShapeX, innerBlockShapeY, innerBlockShapeZ) )
-            self.opPixelFeatureCache.outerBlockShape.setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
+            self.opPixelFeatureCache.innerBlockShape.setValue( blockShapes )
+            self.opPixelFeatureCache.outerBlockShape.setValue( blockShapes )
 
             # Connect external output to internal output
             self.CachedOutputImage.connect( self.opPixelFeatureCache.Output )
 
+    def execute(self, slot, subindex, rroi, result):
+        if slot == self.CachedOutputImage:
+            # Precomputed features are read directly from their (pooled) files
+            return self._featureFiles.readFeatures( rroi.start, rroi.stop, result )
+        return super( OpFeatureSelection, self ).execute( slot, subindex, rroi, result )
+
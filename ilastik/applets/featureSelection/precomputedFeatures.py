@@ -0,0 +1,257 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import threading
+import collections
+import logging
+
+import numpy
+import h5py
+
+from ilastik.applets.base.applet import DatasetConstraintError
+
+logger = logging.getLogger(__name__)
+
+def readFeatureListFile( featureListFilename ):
+    """
+    Return the list of feature file paths in the given text file (one per line).
+    """
+    paths = []
+    with open( featureListFilename, 'r' ) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                paths.append( line )
+    return paths
+
+class _PooledFile(object):
+    """
+    An open, read-only hdf5 file.  All users of the same file (with the same mtime) share one instance.
+    """
+    def __init__(self, key, h5file):
+        self.key = key
+        self.file = h5file
+        self.lock = threading.Lock()
+        self.refcount = 0
+
+# Describes where one feature file's channels are placed in the combined feature image.
+_FeatureFileInfo = collections.namedtuple( '_FeatureFileInfo', 'path pooled_file axiskeys channel_start num_channels dtype chunks' )
+
+class PrecomputedFeatureFiles(object):
+    """
+    Reads features from a list of precomputed hdf5 files (each with a dataset named 'data'),
+    and presents them as one feature image with the same axes as the raw input image.
+
+    Each file must have the raw image's axes, in the same order, except that:
+
+    - the channel axis may be omitted (for single-channel features), and
+    - non-channel axes of size 1 may be omitted (e.g. 'xyz' features for 'txyzc' data with a single time slice).
+
+    The channels of all files are concatenated in the order of the list.
+    Files with different dtypes are allowed; the combined image uses their common dtype.
+
+    Open file handles are pooled: each file is opened once per process and stays open until
+    the last PrecomputedFeatureFiles instance using it is closed.  (If a file is modified on disk,
+    subsequent instances open a fresh handle.)
+    """
+
+    _pool = {}
+    _pool_lock = threading.Lock()
+
+    def __init__(self, paths, raw_axiskeys, raw_shape):
+        """
+        :param paths: The feature files to read.
+        :param raw_axiskeys: The axis keys of the raw image, e.g. 'txyzc'.  Must include 'c'.
+        :param raw_shape: The shape of the raw image.
+        """
+        assert 'c' in raw_axiskeys, "Raw image must have a channel axis"
+        self._raw_axiskeys = raw_axiskeys
+        self._raw_shape = tuple(raw_shape)
+        self._files = []
+        try:
+            channel_start = 0
+            for path in paths:
+                info = self._openFeatureFile( path, channel_start )
+                self._files.append( info )
+                channel_start += info.num_channels
+        except:
+            self.close()
+            raise
+        self.num_channels = channel_start
+
+    @property
+    def paths(self):
+        return [info.path for info in self._files]
+
+    @property
+    def dtype(self):
+        return numpy.result_type( *[info.dtype for info in self._files] ).type
+
+    @property
+    def shape(self):
+        """The shape of the combined feature image."""
+        return self._outputShape( self.num_channels )
+
+    def _outputShape(self, num_channels):
+        return tuple( num_channels if k == 'c' else s for k,s in zip(self._raw_axiskeys, self._raw_shape) )
+
+    def layerShape(self, index):
+        """The shape of the feature image from a single file."""
+        return self._outputShape( self._files[index].num_channels )
+
+    def layerDtype(self, index):
+        return self._files[index].dtype
+
+    def ideal_blockshape(self):
+        """
+        A block shape (in raw axis order) that aligns with the hdf5 chunks of the feature files.
+        Non-chunked axes (and all channels) are 0, which means 'no preference'.
+        """
+        blockshape = [0] * len(self._raw_axiskeys)
+        for info in self._files:
+            if info.chunks is None:
+                continue
+            for key, chunk_size in zip( info.axiskeys, info.chunks ):
+                if key != 'c':
+                    i = self._raw_axiskeys.index(key)
+                    blockshape[i] = max( blockshape[i], chunk_size )
+        return tuple(blockshape)
+
+    def _openFeatureFile(self, path, channel_start):
+        pooled_file = self._acquire( path )
+        try:
+            with pooled_file.lock:
+                if 'data' not in pooled_file.file:
+                    raise DatasetConstraintError( "Feature Selection",
+                                                  "Feature file has no dataset named 'data': {}".format( path ) )
+                dataset = pooled_file.file['data']
+                axiskeys = self._matchAxes( path, dataset.shape )
+                if 'c' in axiskeys:
+                    num_channels = dataset.shape[ axiskeys.index('c') ]
+                else:
+                    num_channels = 1
+                return _FeatureFileInfo( path, pooled_file, axiskeys, channel_start, num_channels,
+                                         dataset.dtype.type, dataset.chunks )
+        except:
+            self._release( pooled_file )
+            raise
+
+    def _matchAxes(self, path, file_shape):
+        """
+        Determine which of the raw image's axes are present in a feature file of the given shape.
+        """
+        raw_tagged_shape = collections.OrderedDict( zip(self._raw_axiskeys, self._raw_shape) )
+        all_keys = self._raw_axiskeys
+        squeezed_keys = "".join( k for k in all_keys if k == 'c' or raw_tagged_shape[k] > 1 )
+        candidates = [ all_keys.replace('c', ''), all_keys, squeezed_keys.replace('c', ''), squeezed_keys ]
+        for axiskeys in candidates:
+            if len(axiskeys) != len(file_shape):
+                continue
+            if all( k == 'c' or raw_tagged_shape[k] == s for k,s in zip(axiskeys, file_shape) ):
+                return axiskeys
+        msg = "Feature file {} has shape {}, which doesn't match the raw data (axes '{}', shape {})."\
+              "".format( path, tuple(file_shape), self._raw_axiskeys, self._raw_shape )
+        raise DatasetConstraintError( "Feature Selection", msg )
+
+    @classmethod
+    def _acquire(cls, path):
+        key = ( os.path.abspath(path), os.path.getmtime(path) )
+        with cls._pool_lock:
+            pooled_file = cls._pool.get( key )
+            if pooled_file is None:
+                logger.debug( "Opening feature file: {}".format( path ) )
+                pooled_file = _PooledFile( key, h5py.File( path, 'r' ) )
+                cls._pool[key] = pooled_file
+            pooled_file.refcount += 1
+        return pooled_file
+
+    @classmethod
+    def _release(cls, pooled_file):
+        with cls._pool_lock:
+            pooled_file.refcount -= 1
+            if pooled_file.refcount == 0:
+                del cls._pool[pooled_file.key]
+                with pooled_file.lock:
+                    pooled_file.file.close()
+
+    def close(self):
+        files = self._files
+        self._files = []
+        for info in files:
+            self._release( info.pooled_file )
+
+    def readFeatures(self, start, stop, result):
+        """
+        Read the given roi of the combined feature image (in raw axis order) into ``result``.
+        Each file that overlaps the requested channels is read with a single hdf5 selection.
+        """
+        c_index = self._raw_axiskeys.index('c')
+        c_start, c_stop = start[c_index], stop[c_index]
+        for info in self._files:
+            file_c_start = max( c_start, info.channel_start )
+            file_c_stop = min( c_stop, info.channel_start + info.num_channels )
+            if file_c_start >= file_c_stop:
+                continue
+            self._readFile( info, start, stop,
+                            file_c_start - info.channel_start,
+                            file_c_stop - info.channel_start,
+                            file_c_start - c_start,
+                            result )
+        return result
+
+    def readLayer(self, index, start, stop, result):
+        """
+        Read the given roi of the features from a single file into ``result``.
+        """
+        c_index = self._raw_axiskeys.index('c')
+        self._readFile( self._files[index], start, stop, start[c_index], stop[c_index], 0, result )
+        return result
+
+    def _readFile(self, info, start, stop, file_c_start, file_c_stop, result_c_start, result):
+        tagged_start = dict( zip(self._raw_axiskeys, start) )
+        tagged_stop = dict( zip(self._raw_axiskeys, stop) )
+
+        # The hdf5 selection, in the file's own axis order
+        file_key = []
+        for k in info.axiskeys:
+            if k == 'c':
+                file_key.append( slice(file_c_start, file_c_stop) )
+            else:
+                file_key.append( slice(tagged_start[k], tagged_stop[k]) )
+        file_key = tuple(file_key)
+
+        # The destination within the result (which is always in raw axis order)
+        result_key = [slice(None)] * result.ndim
+        c_index = self._raw_axiskeys.index('c')
+        result_key[c_index] = slice( result_c_start, result_c_start + file_c_stop - file_c_start )
+        dest = result[tuple(result_key)]
+
+        # Since the file axes are a subsequence of the raw axes,
+        #  the file data can be copied into dest by inserting singleton axes.
+        with info.pooled_file.lock:
+            dataset = info.pooled_file.file['data']
+            if dest.flags.c_contiguous and dest.dtype == dataset.dtype:
+                # Fast path: let hdf5 write directly into the result buffer
+                file_shape = tuple( s.stop - s.start for s in file_key )
+                dataset.read_direct( dest.reshape( file_shape ), file_key )
+            else:
+                data = dataset[file_key]
+                dest[...] = data.reshape( dest.shape )
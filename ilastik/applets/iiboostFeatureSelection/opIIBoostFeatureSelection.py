@@ -53,6 +53,9 @@ class OpIIBoostFeatureSelection(Operator):
     FeatureIds = InputSlot(value=FeatureIds)
     SelectionMatrix = InputSlot(value=default_feature_matrix)
     FeatureListFilename = InputSlot(stype="str", optional=True)
+    FeatureCacheDirectory = InputSlot(stype='filestring', optional=True)
+    FeatureCacheSizeMB = InputSlot(value=0)
+    DatasetIdentity = InputSlot(optional=True)
 
     # This output is only for the GUI.  It's taken directly from OpFeatureSelection.
     # Unlike the OutputImage slot, it provides the raw features, NOT the integral images.
@@ -71,6 +74,9 @@ class OpIIBoostFeatureSelection(Operator):
         self.opFeatureSelection.FeatureIds.connect( self.FeatureIds )
         self.opFeatureSelection.SelectionMatrix.connect( self.SelectionMatrix )
         self.opFeatureSelection.FeatureListFilename.connect( self.FeatureListFilename )        
+        self.opFeatureSelection.FeatureCacheDirectory.connect( self.FeatureCacheDirectory )
+        self.opFeatureSelection.FeatureCacheSizeMB.connect( self.FeatureCacheSizeMB )
+        self.opFeatureSelection.DatasetIdentity.connect( self.DatasetIdentity )
         self.FeatureLayers.connect( self.opFeatureSelection.FeatureLayers )
 
         self.WINDOW_SIZE = self.opFeatureSelection.WINDOW_SIZE
@@ -0,0 +1,252 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import threading
+import functools
+import logging
+
+import numpy as np
+import vigra
+
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds
+from lazyflow.request import Request, RequestPool
+
+logger = logging.getLogger(__name__)
+
+STANDARD_PLUGIN_NAME = "Standard Object Features"
+
+# Features of the standard (vigra) plugin that can be accumulated block by block.
+# Each is computed from a few per-object sums, minima and maxima, which are merged across blocks.
+BLOCKWISE_FEATURES = frozenset( [ 'Count', 'Sum', 'Mean', 'Variance', 'Minimum', 'Maximum',
+                                  'Coord<Minimum>', 'Coord<Maximum>', 'RegionCenter' ] )
+
+def canComputeBlockwise( feature_names ):
+    """
+    Return True if all features in the given nested feature dict
+    (``feature_names[plugin_name][feature_name] = params``) can be computed by RegionFeatureAccumulator.
+    """
+    for plugin_name, feature_dict in feature_names.iteritems():
+        if plugin_name != STANDARD_PLUGIN_NAME:
+            return False
+        if not set( feature_dict.keys() ) <= BLOCKWISE_FEATURES:
+            return False
+    return True
+
+class RegionFeatureAccumulator(object):
+    """
+    Computes simple region features (see BLOCKWISE_FEATURES) of a labeled volume one block at a time.
+
+    The statistics of each block are reduced into per-object totals, so the memory needed is
+    proportional to the block size plus the number of objects, not the volume size.
+    Blocks may be added in any order, from several threads.
+
+    Objects are identified by their label, so the labels must be global
+    (e.g. from a connected component labeling of the whole volume).
+    An object that spans several blocks is merged by label; no halo is needed.
+
+    The results match vigra.analysis.extractRegionFeatures (as used by the "Standard Object Features" plugin).
+    """
+
+    def __init__(self, num_channels, coord_axes):
+        """
+        :param num_channels: The number of channels of the raw data
+        :param coord_axes: The indexes of the spatial axes (of the blocks passed to addBlock)
+                           for which coordinate features are computed, in output column order.
+        """
+        self._num_channels = num_channels
+        self._coord_axes = list(coord_axes)
+        self._lock = threading.Lock()
+
+        ndim = len(self._coord_axes)
+        self._count = np.zeros( (1,), dtype=np.float64 )
+        self._sum = np.zeros( (1, num_channels), dtype=np.float64 )
+        self._sumsq = np.zeros( (1, num_channels), dtype=np.float64 )
+        self._min = np.full( (1, num_channels), np.inf )
+        self._max = np.full( (1, num_channels), -np.inf )
+        self._coord_sum = np.zeros( (1, ndim), dtype=np.float64 )
+        self._coord_min = np.full( (1, ndim), np.inf )
+        self._coord_max = np.full( (1, ndim), -np.inf )
+
+    def addBlock(self, raw, labels, offset):
+        """
+        Add the statistics of one block.
+
+        :param raw: The raw data of the block, with the channel axis last.
+        :param labels: The labels of the block (same spatial shape as raw, no channel axis).
+        :param offset: The position of the block in the volume (one entry per spatial axis).
+        """
+        assert raw.shape[:-1] == labels.shape
+        assert raw.shape[-1] == self._num_channels
+        labels = np.asarray(labels)
+        foreground = np.nonzero( labels )
+        if len(foreground[0]) == 0:
+            return
+
+        label_values = labels[foreground]
+        order = np.argsort( label_values, kind='mergesort' )
+        sorted_labels = label_values[order]
+        del label_values
+        starts = np.flatnonzero( np.concatenate( ([True], sorted_labels[1:] != sorted_labels[:-1]) ) )
+        ids = sorted_labels[starts].astype(np.intp)
+        count = np.diff( np.append( starts, len(sorted_labels) ) )
+        del sorted_labels
+
+        values = np.asarray(raw)[foreground].astype(np.float64)[order]
+        sums = np.add.reduceat( values, starts, axis=0 )
+        sumsq = np.add.reduceat( values * values, starts, axis=0 )
+        mins = np.minimum.reduceat( values, starts, axis=0 )
+        maxs = np.maximum.reduceat( values, starts, axis=0 )
+        del values
+
+        ncoords = len(self._coord_axes)
+        coord_sums = np.empty( (len(ids), ncoords), dtype=np.float64 )
+        coord_mins = np.empty( (len(ids), ncoords), dtype=np.float64 )
+        coord_maxs = np.empty( (len(ids), ncoords), dtype=np.float64 )
+        for i, axis in enumerate(self._coord_axes):
+            coords = foreground[axis][order] + offset[axis]
+            coord_sums[:, i] = np.add.reduceat( coords.astype(np.float64), starts )
+            coord_mins[:, i] = np.minimum.reduceat( coords, starts )
+            coord_maxs[:, i] = np.maximum.reduceat( coords, starts )
+
+        with self._lock:
+            self._grow( ids[-1] + 1 )
+            # ids are unique within a block, so fancy indexing is safe here.
+            self._count[ids] += count
+            self._sum[ids] += sums
+            self._sumsq[ids] += sumsq
+            self._min[ids] = np.minimum( self._min[ids], mins )
+            self._max[ids] = np.maximum( self._max[ids], maxs )
+            self._coord_sum[ids] += coord_sums
+            self._coord_min[ids] = np.minimum( self._coord_min[ids], coord_mins )
+            self._coord_max[ids] = np.maximum( self._coord_max[ids], coord_maxs )
+
+    def _grow(self, size):
+        """
+        Make room for labels up to size-1.  Must be called with the lock held.
+        """
+        old_size = len(self._count)
+        if size <= old_size:
+            return
+        size = max( size, 2*old_size )
+        def grown(a, fill):
+            result = np.full( (size,) + a.shape[1:], fill, dtype=a.dtype )
+            result[:old_size] = a
+            return result
+        self._count = grown( self._count, 0 )
+        self._sum = grown( self._sum, 0 )
+        self._sumsq = grown( self._sumsq, 0 )
+        self._min = grown( self._min, np.inf )
+        self._max = grown( self._max, -np.inf )
+        self._coord_sum = grown( self._coord_sum, 0 )
+        self._coord_min = grown( self._coord_min, np.inf )
+        self._coord_max = grown( self._coord_max, -np.inf )
+
+    def features(self, feature_names):
+        """
+        Return the requested features as a dict of feature_name -> array of shape (nobj, k),
+        without the background object.  nobj is the largest label seen so far.
+        Objects that were not seen in any block get zeros.
+        """
+        with self._lock:
+            nobj = np.flatnonzero( self._count ).max() if self._count.any() else 0
+            sl = slice(1, nobj+1)
+            count = self._count[sl].reshape(-1, 1)
+            present = count > 0
+            safe_count = np.where( present, count, 1 )
+
+            def finite(a):
+                return np.where( present, a, 0 )
+
+            mean = self._sum[sl] / safe_count
+            computed = {
+                'Count' : lambda: count.copy(),
+                'Sum' : lambda: self._sum[sl].copy(),
+                'Mean' : lambda: mean,
+                'Variance' : lambda: np.maximum( self._sumsq[sl] / safe_count - mean*mean, 0 ),
+                'Minimum' : lambda: finite( self._min[sl] ),
+                'Maximum' : lambda: finite( self._max[sl] ),
+                'Coord<Minimum>' : lambda: finite( self._coord_min[sl] ),
+                'Coord<Maximum>' : lambda: finite( self._coord_max[sl] ),
+                'RegionCenter' : lambda: self._coord_sum[sl] / safe_count,
+            }
+            return dict( (name, computed[name]()) for name in feature_names )
+
+def computeRegionFeaturesBlockwise( rawSlot, labelSlot, t, blockShape3d, feature_names ):
+    """
+    Compute region features for time slice t by requesting rawSlot and labelSlot one block at a time
+    (in parallel, on the lazyflow request pool), and reducing the blocks with a RegionFeatureAccumulator.
+
+    :param blockShape3d: A dict of spatial block sizes, e.g. ``{'x' : 512, 'y' : 512, 'z' : 512}``
+    :param feature_names: The features to compute (e.g. the keys of the "Standard Object Features" dict)
+    :returns: A dict of feature_name -> array of shape (nobj, k), without the background object
+    """
+    tagged_shape = rawSlot.meta.getTaggedShape()
+    axiskeys = tagged_shape.keys()
+    spatial_keys = [ k for k in axiskeys if k in 'xyz' ]
+
+    # The standard plugin squeezes 2D data (z == 1), so its coordinates have one column less.
+    coord_keys = list(spatial_keys)
+    if tagged_shape.get('z', 1) == 1 and 'z' in coord_keys:
+        coord_keys.remove('z')
+    coord_axes = [ spatial_keys.index(k) for k in coord_keys ]
+    num_channels = tagged_shape.get('c', 1)
+
+    # Blocks cover one time slice and all channels
+    volume_shape = list( rawSlot.meta.shape )
+    block_shape = list( volume_shape )
+    volume_start = [0] * len(volume_shape)
+    for i, k in enumerate(axiskeys):
+        if k == 't':
+            volume_start[i] = t
+            volume_shape[i] = t+1
+            block_shape[i] = 1
+        elif k in spatial_keys:
+            block_shape[i] = min( blockShape3d.get(k, volume_shape[i]), volume_shape[i] )
+    block_starts = getIntersectingBlocks( block_shape, (volume_start, volume_shape) )
+    logger.debug( "Computing region features for t={} in {} blocks of shape {}"
+                  .format( t, len(block_starts), block_shape ) )
+
+    accumulator = RegionFeatureAccumulator( num_channels, coord_axes )
+
+    def processBlock( block_start ):
+        start, stop = getBlockBounds( volume_shape, block_shape, block_start )
+        label_start, label_stop = list(start), list(stop)
+        if 'c' in axiskeys:
+            c_index = axiskeys.index('c')
+            label_start[c_index], label_stop[c_index] = 0, 1
+
+        raw_req = rawSlot( start, stop )
+        label_req = labelSlot( label_start, label_stop )
+        raw_req.submit()
+        label_req.submit()
+        raw = vigra.taggedView( raw_req.wait(), axistags=rawSlot.meta.axistags )
+        labels = vigra.taggedView( label_req.wait(), axistags=labelSlot.meta.axistags )
+
+        raw = raw.withAxes( *(spatial_keys + ['c']) ).view(np.ndarray)
+        labels = labels.withAxes( *spatial_keys ).view(np.ndarray)
+        offset = [ start[axiskeys.index(k)] for k in spatial_keys ]
+        accumulator.addBlock( raw, labels, offset )
+
+    pool = RequestPool()
+    for block_start in block_starts:
+        pool.add( Request( functools.partial( processBlock, block_start ) ) )
+    pool.wait()
+
+    return accumulator.features( feature_names )
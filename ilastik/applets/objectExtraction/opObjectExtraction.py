@@ -21,6 +21,7 @@
 #Python
 from copy import copy, deepcopy
 import collections
+import threading
 from functools import partial
 
 # SciPy
@@ -44,7 +45,10 @@ try:
 except:
     logger.warn('could not import pluginManager')
 
+import ilastik.config
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.utility.slicedBlockShapes import parseBlockDims
+from blockwiseRegionFeatures import canComputeBlockwise, computeRegionFeaturesBlockwise, STANDARD_PLUGIN_NAME
 
 # These features are always calculated, but not used for prediction.
 # They are needed by our gui, or by downstream applets.
@@ -119,6 +123,7 @@ class OpCachedRegionFeatures(Operator):
     LabelImage = InputSlot()
     CacheInput = InputSlot(optional=True)
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape3dDict = InputSlot(optional=True)
 
     Output = OutputSlot()
     CleanBlocks = OutputSlot()
@@ -139,6 +144,7 @@ class OpCachedRegionFeatures(Operator):
         self._opRegionFeatures.RawVolume.connect(self.RawImage)
         self._opRegionFeatures.LabelVolume.connect(self.LabelImage)
         self._opRegionFeatures.Features.connect(self.Features)
+        self._opRegionFeatures.BlockShape3dDict.connect(self.BlockShape3dDict)
 
         # Hook up the cache.
         self._opCache = OpArrayCache(parent=self)
@@ -334,6 +340,10 @@ class OpObjectExtraction(Operator):
     RegionFeaturesCacheInput = InputSlot(optional=True)
     RegionFeaturesCleanBlocks = OutputSlot()
 
+    # If set, region features are computed block by block (see OpRegionFeatures.BlockShape3dDict).
+    # Defaults to the 'feature_block_dims' setting in the [object extraction] section of the ilastik config file.
+    RegionFeaturesBlockShape3dDict = InputSlot(optional=True)
+
     # Schematic:
     #
     # BackgroundLabels              LabelImage
@@ -366,6 +376,7 @@ class OpObjectExtraction(Operator):
         self.RegionFeaturesCleanBlocks.connect(self._opRegFeats.CleanBlocks)
 
         self._opRegFeats.CacheInput.connect(self.RegionFeaturesCacheInput)
+        self._opRegFeats.BlockShape3dDict.connect(self.RegionFeaturesBlockShape3dDict)
 
         self._opRegFeatsAdaptOutput.Input.connect(self._opRegFeats.Output)
 
@@ -385,6 +396,10 @@ class OpObjectExtraction(Operator):
         self.CleanLabelBlocks.connect(self._opLabelVolume.CleanBlocks)
         self.ComputedFeatureNames.connect(self.Features)
 
+        blockDims = parseBlockDims( ilastik.config.cfg.get('object extraction', 'feature_block_dims') )
+        if blockDims:
+            self.RegionFeaturesBlockShape3dDict.setValue( blockDims )
+
         # As soon as input data is available, check its constraints
         self.RawImage.notifyReady( self._checkConstraints )
         self.BinaryImage.notifyReady( self._checkConstraints )
@@ -512,6 +527,11 @@ class OpRegionFeatures(Operator):
     * Features : a nested dictionary of features to compute.
       Features[plugin name][feature name][parameter name] = parameter value
 
+    * BlockShape3dDict : (optional) a dict of spatial block sizes, e.g. {'x' : 512, 'y' : 512, 'z' : 512}.
+      If set, and all selected features can be accumulated blockwise (see blockwiseRegionFeatures),
+      each time slice is processed block by block instead of requesting the whole volume at once.
+      Otherwise, this setting is ignored.
+
     Outputs:
 
     * Output : a nested dictionary of features.
@@ -521,9 +541,13 @@ class OpRegionFeatures(Operator):
     RawVolume = InputSlot()
     LabelVolume = InputSlot()
     Features = InputSlot(rtype=List, stype=Opaque)
+    BlockShape3dDict = InputSlot(optional=True)
 
     Output = OutputSlot()
 
+    # Number of objects per request when computing local (per-object) features
+    LOCAL_FEATURES_BATCH_SIZE = 100
+
     def setupOutputs(self):
         if self.LabelVolume.meta.axistags != self.RawVolume.meta.axistags:
             raise Exception('raw and label axis tags do not match')
@@ -550,7 +574,19 @@ class OpRegionFeatures(Operator):
         t_ind = self.RawVolume.meta.axistags.index('t')
         assert t_ind < len(self.RawVolume.meta.shape)
 
+        blockShape3d = None
+        if self.BlockShape3dDict.ready():
+            if canComputeBlockwise( self.Features([]).wait() ):
+                blockShape3d = self.BlockShape3dDict.value
+            else:
+                logger.warn("Some of the selected features can't be computed blockwise. "
+                            "Requesting the entire volume of each time slice instead.")
+
         def compute_features_for_time_slice(res_t_ind, t):
+            if blockShape3d is not None:
+                result[res_t_ind] = self._extract_blockwise(t, blockShape3d)
+                return
+
             # Process entire spatial volume
             s = [slice(None) for i in range(len(self.RawVolume.meta.shape))]
             s[t_ind] = slice(t, t+1)
@@ -620,6 +656,64 @@ class OpRegionFeatures(Operator):
         key.insert(axes.c, slice(None))
         return image[tuple(key)]
 
+    def _compute_local_features(self, image, labels, mincoords, maxcoords, axes, margin, local_plugins):
+        """
+        Compute the local features of every object with each of the given plugins.
+
+        The objects are processed in batches of LOCAL_FEATURES_BATCH_SIZE, in parallel on the lazyflow request pool.
+        Plugins that are not declared ``thread_safe`` are only called from one thread at a time
+        (but cropping the objects, and the other plugins, still run in parallel).
+
+        :param local_plugins: A list of (plugin_name, feature_dict, plugin_object)
+        :returns: A dict of plugin_name -> (dict of feature_name -> list of per-object values, in object order)
+        """
+        nobj = mincoords.shape[0]
+        plugin_locks = {}
+        for plugin_name, feature_dict, plugin in local_plugins:
+            if not plugin.thread_safe:
+                plugin_locks[plugin_name] = threading.Lock()
+
+        def compute_batch(batch_start, batch_stop):
+            batch_features = []
+            #starting from 0, we stripped 0th background object in global computation
+            for i in range(batch_start, batch_stop):
+                extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
+                rawbbox = self.compute_rawbbox(image, extent, axes)
+                #it's i+1 here, because the background has label 0
+                binary_bbox = np.where(labels[tuple(extent)] == i+1, 1, 0).astype(np.bool)
+                object_features = []
+                for plugin_name, feature_dict, plugin in local_plugins:
+                    if plugin_name in plugin_locks:
+                        with plugin_locks[plugin_name]:
+                            feats = plugin.compute_local(rawbbox, binary_bbox, feature_dict, axes)
+                    else:
+                        feats = plugin.compute_local(rawbbox, binary_bbox, feature_dict, axes)
+                    object_features.append(feats)
+                batch_features.append(object_features)
+            return batch_features
+
+        batch_size = self.LOCAL_FEATURES_BATCH_SIZE
+        batch_starts = range(0, nobj, batch_size)
+        batch_results = [None] * len(batch_starts)
+        def compute_batch_into(batch_index, batch_start):
+            batch_results[batch_index] = compute_batch(batch_start, min(batch_start + batch_size, nobj))
+
+        logger.debug("computing local features for {} objects in {} batches".format(nobj, len(batch_starts)))
+        pool = RequestPool()
+        for batch_index, batch_start in enumerate(batch_starts):
+            pool.add( Request( partial(compute_batch_into, batch_index, batch_start) ) )
+        pool.wait()
+
+        # Merge the results in object order
+        local_features = collections.defaultdict(lambda: collections.defaultdict(list))
+        for batch_features in batch_results:
+            for object_features in batch_features:
+                for (plugin_name, _, _), feats in zip(local_plugins, object_features):
+                    plugin_features = local_features[plugin_name]
+                    for key in feats:
+                        plugin_features[key].append(feats[key])
+        return local_features
+
     def _extract(self, image, labels):
         if not (image.ndim == labels.ndim == 4):
             raise Exception("both images must be 4D. raw image shape: {}"
@@ -687,37 +781,19 @@ class OpRegionFeatures(Operator):
         nobj = mincoords.shape[0]
         
         # local features: loop over all objects
-        def dictextend(a, b):
-            for key in b:
-                a[key].append(b[key])
-            return a
-        
-
         local_features = collections.defaultdict(lambda: collections.defaultdict(list))
         margin = max_margin(feature_names)
-        has_local_features = {}
+        local_plugins = []
         for plugin_name, feature_dict in feature_names.iteritems():
-            has_local_features[plugin_name] = False
             for features in feature_dict.itervalues():
                 if 'margin' in features:
-                    has_local_features[plugin_name] = True
+                    plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
+                    local_plugins.append( (plugin_name, feature_dict, plugin.plugin_object) )
                     break
             
                             
         if np.any(margin) > 0:
-            #starting from 0, we stripped 0th background object in global computation
-            for i in range(0, nobj):
-                logger.debug("processing object {}".format(i))
-                extent = self.compute_extent(i, image, mincoords, maxcoords, axes, margin)
-                rawbbox = self.compute_rawbbox(image, extent, axes)
-                #it's i+1 here, because the background has label 0
-                binary_bbox = np.where(labels[tuple(extent)] == i+1, 1, 0).astype(np.bool)
-                for plugin_name, feature_dict in feature_names.iteritems():
-                    if not has_local_features[plugin_name]:
-                        continue
-                    plugin = pluginManager.getPluginByName(plugin_name, "ObjectFeatures")
-                    feats = plugin.plugin_object.compute_local(rawbbox, binary_bbox, feature_dict, axes)
-                    local_features[plugin_name] = dictextend(local_features[plugin_name], feats)
+            local_features = self._compute_local_features(image, labels, mincoords, maxcoords, axes, margin, local_plugins)
 
         logger.debug("computing done, removing failures")
         # remove local features that failed
@@ -740,6 +816,26 @@ class OpRegionFeatures(Operator):
             all_features[name] = dict(d1.items() + d2.items())
         all_features[default_features_key]=extrafeats
 
+        return self._reshape_features(all_features, nobj)
+
+    def _extract_blockwise(self, t, blockShape3d):
+        """
+        Compute the features of time slice t block by block.
+        Only supports the features listed in blockwiseRegionFeatures.BLOCKWISE_FEATURES.
+        The result has the same format as _extract().
+        """
+        feature_names = self.Features([]).wait()
+        selected_features = feature_names.get(STANDARD_PLUGIN_NAME, {}).keys()
+        computed = computeRegionFeaturesBlockwise(self.RawVolume, self.LabelVolume, t, blockShape3d,
+                                                  set(selected_features) | set(default_features.keys()))
+
+        all_features = {}
+        if STANDARD_PLUGIN_NAME in feature_names:
+            all_features[STANDARD_PLUGIN_NAME] = dict((k, computed[k]) for k in selected_features)
+        all_features[default_features_key] = dict((k, computed[k]) for k in default_features)
+        return self._reshape_features(all_features, computed['Count'].shape[0])
+
+    def _reshape_features(self, all_features, nobj):
         # reshape all features
         for pfeats in all_features.itervalues():
             for key, value in pfeats.iteritems():
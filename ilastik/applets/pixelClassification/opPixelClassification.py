@@ -20,6 +20,8 @@
 ###############################################################################
 #Python
 import copy
+import threading
+import collections
 from functools import partial
 
 #SciPy
@@ -27,11 +29,13 @@ import numpy
 import vigra
 
 #lazyflow
+import lazyflow
 from lazyflow.roi import determineBlockShape
+from lazyflow.request import Request
 from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators import OpValueCache, OpTrainClassifierBlocked, OpClassifierPredict,\
                                OpSlicedBlockedArrayCache, OpMultiArraySlicer2, \
-                               OpPixelOperator, OpMaxChannelIndicatorOperator, OpCompressedUserLabelArray
+                               OpMaxChannelIndicatorOperator, OpCompressedUserLabelArray
 
 from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
 
@@ -39,6 +43,9 @@ from lazyflow.classifiers import ParallelVigraRfLazyflowClassifierFactory
 from ilastik.applets.base.applet import DatasetConstraintError
 from ilastik.utility.operatorSubView import OperatorSubView
 from ilastik.utility import OpMultiLaneWrapper
+from ilastik.utility.slicedBlockShapes import configuredSlicedBlockShapes
+
+from opSpillCache import OpSpillCache
 
 class OpPixelClassification( Operator ):
     """
@@ -63,6 +70,10 @@ class OpPixelClassification( Operator ):
 
     PredictionsFromDisk = InputSlot(optional=True, level=1)
 
+    # Optional second tier for the GUI prediction cache (see OpSpillCache)
+    PredictionSpillDirectory = InputSlot(optional=True) # If not provided (or empty), predictions are only cached in RAM
+    PredictionSpillSizeMB = InputSlot(value=0) # Size limit of the spilled predictions (0 means unlimited)
+
     PredictionProbabilities = OutputSlot(level=1) # Classification predictions (via feature cache for interactive speed)
 
     PredictionProbabilityChannels = OutputSlot(level=2) # Classification predictions, enumerated by channel
@@ -145,6 +156,8 @@ class OpPixelClassification( Operator ):
         self.opPredictionPipeline.FreezePredictions.connect( self.FreezePredictions )
         self.opPredictionPipeline.PredictionsFromDisk.connect( self.PredictionsFromDisk )
         self.opPredictionPipeline.PredictionMask.connect( self.PredictionMasks )
+        self.opPredictionPipeline.PredictionSpillDirectory.connect( self.PredictionSpillDirectory )
+        self.opPredictionPipeline.PredictionSpillSizeMB.connect( self.PredictionSpillSizeMB )
         
         def _updateNumClasses(*args):
             """
@@ -412,23 +425,15 @@ class OpPredictionPipelineNoCache(Operator):
         self.cacheless_predict.Image.connect(self.FeatureImages) # <--- Not from cache
         self.cacheless_predict.LabelsCount.connect(self.NumClasses)
         self.cacheless_predict.PredictionMask.connect(self.PredictionMask)
-        self.HeadlessPredictionProbabilities.connect(self.cacheless_predict.PMaps)
-
-        # Alternate headless output: uint8 instead of float.
-        # Note that drange is automatically updated.        
-        self.opConvertToUint8 = OpPixelOperator( parent=self )
-        self.opConvertToUint8.Input.connect( self.cacheless_predict.PMaps )
-        self.opConvertToUint8.Function.setValue( lambda a: (255*a).astype(numpy.uint8) )
-        self.HeadlessUint8PredictionProbabilities.connect( self.opConvertToUint8.Output )
-
-        self.opArgmaxChannel = OpArgmaxChannel( parent=self )
-        self.opArgmaxChannel.Input.connect( self.cacheless_predict.PMaps )
-        self.SimpleSegmentation.connect( self.opArgmaxChannel.Output )
-        
-        # Create a layer for uncertainty estimate
-        self.opUncertaintyEstimator = OpEnsembleMargin( parent=self )
-        self.opUncertaintyEstimator.Input.connect( self.cacheless_predict.PMaps )
-        self.HeadlessUncertaintyEstimate.connect( self.opUncertaintyEstimator.Output )
+
+        # All headless products are derived from a single probability computation per block,
+        #  so exporting several of them doesn't run the classifier more than once.
+        self.opPredictionProducts = OpFusedPredictionProducts( parent=self )
+        self.opPredictionProducts.Input.connect( self.cacheless_predict.PMaps )
+        self.HeadlessPredictionProbabilities.connect( self.opPredictionProducts.Probabilities )
+        self.HeadlessUint8PredictionProbabilities.connect( self.opPredictionProducts.Uint8Probabilities )
+        self.SimpleSegmentation.connect( self.opPredictionProducts.SimpleSegmentation )
+        self.HeadlessUncertaintyEstimate.connect( self.opPredictionProducts.UncertaintyEstimate )
 
     def setupOutputs(self):
         pass
@@ -478,6 +483,8 @@ class OpPredictionPipeline(OpPredictionPipelineNoCache):
     """        
     FreezePredictions = InputSlot()
     CachedFeatureImages = InputSlot()
+    PredictionSpillDirectory = InputSlot(optional=True) # If provided, predictions evicted from RAM are kept on disk
+    PredictionSpillSizeMB = InputSlot(value=0)
 
     PredictionProbabilities = OutputSlot()
     CachedPredictionProbabilities = OutputSlot()
@@ -497,6 +504,14 @@ class OpPredictionPipeline(OpPredictionPipelineNoCache):
         self.predict.LabelsCount.connect( self.NumClasses )
         self.PredictionProbabilities.connect( self.predict.PMaps )
 
+        # Second cache tier: Blocks that were evicted from the GUI cache are read back from disk
+        #  instead of being recomputed.  (Only used if a PredictionSpillDirectory is provided.)
+        self.opPredictionSpillCache = OpSpillCache( parent=self )
+        self.opPredictionSpillCache.name = "opPredictionSpillCache"
+        self.opPredictionSpillCache.Input.connect( self.predict.PMaps )
+        self.opPredictionSpillCache.ScratchDirectory.connect( self.PredictionSpillDirectory )
+        self.opPredictionSpillCache.MaxSizeMB.connect( self.PredictionSpillSizeMB )
+
         # Prediction cache for the GUI
         self.prediction_cache_gui = OpSlicedBlockedArrayCache( parent=self )
         self.prediction_cache_gui.name = "prediction_cache_gui"
@@ -532,42 +547,72 @@ class OpPredictionPipeline(OpPredictionPipelineNoCache):
         self.UncertaintyEstimate.connect( self.opUncertaintyCache.Output )
 
     def setupOutputs(self):
-        # Set the blockshapes for each input image separately, depending on which axistags it has.
-        axisOrder = [ tag.key for tag in self.FeatureImages.meta.axistags ]
-
-        blockDimsX = { 't' : (1,1),
-                       'z' : (256,256),
-                       'y' : (256,256),
-                       'x' : (1,1),
-                       'c' : (100, 100) }
-
-        blockDimsY = { 't' : (1,1),
-                       'z' : (256,256),
-                       'y' : (1,1),
-                       'x' : (256,256),
-                       'c' : (100,100) }
-
-        blockDimsZ = { 't' : (1,1),
-                       'z' : (1,1),
-                       'y' : (256,256),
-                       'x' : (256,256),
-                       'c' : (100,100) }
-
-        innerBlockShapeX = tuple( blockDimsX[k][0] for k in axisOrder )
-        outerBlockShapeX = tuple( blockDimsX[k][1] for k in axisOrder )
+        # Set the blockshapes for each input image separately, depending on its shape and axistags.
+        # The blocks are sized for the prediction image (one float32 channel per class), not the feature image.
+        predictionMeta = self.FeatureImages.meta.copy()
+        predictionMeta.dtype = numpy.float32
+        predictionShape = list( self.FeatureImages.meta.shape )
+        predictionShape[ self.FeatureImages.meta.getAxisKeys().index('c') ] = max( 1, self.NumClasses.value )
+        predictionMeta.shape = tuple( predictionShape )
+        blockShapes = configuredSlicedBlockShapes( predictionMeta, 'prediction' )
+
+        self.prediction_cache_gui.inputs["innerBlockShape"].setValue( blockShapes )
+        self.prediction_cache_gui.inputs["outerBlockShape"].setValue( blockShapes )
+
+        self.opUncertaintyCache.inputs["innerBlockShape"].setValue( blockShapes )
+        self.opUncertaintyCache.inputs["outerBlockShape"].setValue( blockShapes )
+
+        # Insert the spill cache between the classifier and the GUI cache, if requested.
+        # (The uncertainty cache is fed by the GUI cache, so it benefits from the spilled predictions, too.)
+        if self.PredictionSpillDirectory.ready() and self.PredictionSpillDirectory.value:
+            predictions = self.opPredictionSpillCache.Output
+        else:
+            predictions = self.predict.PMaps
+        if self.prediction_cache_gui.Input.partner != predictions:
+            self.prediction_cache_gui.Input.connect( predictions )
+
+    def getSpillStatistics(self):
+        """
+        Return the hit/miss/spill statistics of the prediction spill cache (see OpSpillCache.getStatistics()).
+        """
+        return self.opPredictionSpillCache.getStatistics()
 
-        innerBlockShapeY = tuple( blockDimsY[k][0] for k in axisOrder )
-        outerBlockShapeY = tuple( blockDimsY[k][1] for k in axisOrder )
 
-        innerBlockShapeZ = tuple( blockDimsZ[k][0] for k in axisOrder )
-        outerBlockShapeZ = tuple( blockDimsZ[k][1] for k in axisOrder )
+def argmaxSegmentation( pmap, chanAxis ):
+    """
+    Return the (1-based) index of the channel with the highest value at each pixel.
+    The result has a singleton channel axis.
+    """
+    return ( numpy.argmax( pmap, axis=chanAxis ) + 1 ).astype( numpy.uint8 )[ _expandIndex( pmap.ndim, chanAxis ) ]
 
-        self.prediction_cache_gui.inputs["innerBlockShape"].setValue( (innerBlockShapeX, innerBlockShapeY, innerBlockShapeZ) )
-        self.prediction_cache_gui.inputs["outerBlockShape"].setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
+def ensembleMargin( pmap, chanAxis ):
+    """
+    Return 1 minus the difference between the highest two channels at each pixel.
+    The result has a singleton channel axis.
+    
+    e.g. predictions of .99 and .01 -> low uncertainty (0.02)
+    e.g. predictions of .51 and .49 -> high uncertainty (0.98)
+    """
+    num_channels = pmap.shape[chanAxis]
+    if num_channels <= 1:
+        # If there's only 1 channel, there's zero uncertainty
+        shape = list(pmap.shape)
+        shape[chanAxis] = 1
+        return numpy.zeros( shape, dtype=pmap.dtype )
 
-        self.opUncertaintyCache.inputs["innerBlockShape"].setValue( (innerBlockShapeX, innerBlockShapeY, innerBlockShapeZ) )
-        self.opUncertaintyCache.inputs["outerBlockShape"].setValue( (outerBlockShapeX, outerBlockShapeY, outerBlockShapeZ) )
+    # A partial selection is enough to find the top two channels (no need to sort all of them).
+    top2 = numpy.partition( numpy.asarray(pmap), num_channels-2, axis=chanAxis )
+    highest = top2.take( [num_channels-1], axis=chanAxis )
+    second = top2.take( [num_channels-2], axis=chanAxis )
+    return 1 - (highest - second)
 
+def _expandIndex( ndim, axis ):
+    """
+    Return an index that re-inserts a singleton axis at the given position (after a reduction over it).
+    """
+    index = [slice(None)] * (ndim-1)
+    index.insert( axis, numpy.newaxis )
+    return tuple(index)
 
 class OpEnsembleMargin(Operator):
     """
@@ -598,19 +643,7 @@ class OpEnsembleMargin(Operator):
         roi.stop[chanAxis] = taggedShape['c']
         pmap = self.Input.get(roi).wait()
 
-        # Sort along channel axis so the every pixel's channels are sorted lowest to highest.
-        pmap.sort(axis=self.Input.meta.axistags.index('c'))
-        pmap = pmap.view(vigra.VigraArray)
-        pmap.axistags = self.Input.meta.axistags
-
-        # Subtract the highest channel from the second-highest channel.
-        res = pmap.bindAxis('c', -1) - pmap.bindAxis('c', -2)
-        res = res.withAxes( *taggedShape.keys() ).view(numpy.ndarray)
-        
-        # Subtract from 1 to make this an "uncertainty" measure, not a "certainty" measure
-        # e.g. predictions of .99 and .01 -> low uncertainty (0.98)
-        # e.g. predictions of .51 and .49 -> high uncertainty (0.02)
-        result[...] = (1-res)
+        result[...] = ensembleMargin( pmap, chanAxis )
         return result 
 
     def propagateDirty(self, inputSlot, subindex, roi):
@@ -619,3 +652,136 @@ class OpEnsembleMargin(Operator):
         roi.start[chanAxis] = 0
         roi.stop[chanAxis] = 1
         self.Output.setDirty( roi )
+
+class OpFusedPredictionProducts(Operator):
+    """
+    Derives several products from the prediction probabilities:
+    the probabilities themselves, their uint8 conversion, the simple segmentation (argmax)
+    and the uncertainty estimate.
+
+    Without this operator, each product requests the probabilities separately,
+    so exporting several products recomputes the (expensive) prediction for every block.
+    Here, the full-channel probabilities for each requested region are computed once and kept
+    in a small LRU buffer, from which all products for the same region (or a subregion of it) are derived.
+    Concurrent requests for the same region wait for a single computation.
+    """
+    Input = InputSlot() # Prediction probabilities (one channel per class)
+
+    Probabilities = OutputSlot() # drange is 0.0 to 1.0
+    Uint8Probabilities = OutputSlot() # drange 0 to 255
+    SimpleSegmentation = OutputSlot()
+    UncertaintyEstimate = OutputSlot()
+
+    # The buffer of recently computed probabilities may use this fraction of the lazyflow RAM budget.
+    BUFFER_RAM_FRACTION = 0.1
+    # Buffer size if no RAM budget is configured.
+    DEFAULT_BUFFER_MB = 500
+
+    def __init__(self, *args, **kwargs):
+        super( OpFusedPredictionProducts, self ).__init__( *args, **kwargs )
+        self._lock = threading.Lock()
+        self._blocks = collections.OrderedDict() # (start, stop) -> (Request, nbytes), least recently used first
+        self._buffered_bytes = 0
+
+    def setupOutputs(self):
+        self._clearBuffer()
+        assert self.Input.meta.getAxisKeys()[-1] == 'c', "Channel axis must be last"
+        num_channels = self.Input.meta.shape[-1]
+        assert num_channels <= 255, "Too many classes for a uint8 segmentation"
+        ram_per_pixel = self.Input.meta.ram_usage_per_requested_pixel
+
+        self.Probabilities.meta.assignFrom( self.Input.meta )
+
+        self.Uint8Probabilities.meta.assignFrom( self.Input.meta )
+        self.Uint8Probabilities.meta.dtype = numpy.uint8
+        self.Uint8Probabilities.meta.drange = (0,255)
+
+        for slot in [self.SimpleSegmentation, self.UncertaintyEstimate]:
+            slot.meta.assignFrom( self.Input.meta )
+            slot.meta.shape = self.Input.meta.shape[:-1] + (1,)
+            if ram_per_pixel:
+                # Each output pixel requires all probability channels
+                slot.meta.ram_usage_per_requested_pixel = ram_per_pixel * num_channels
+        self.SimpleSegmentation.meta.dtype = numpy.uint8 # Assumes no more than 255 channels
+
+    def _maxBufferBytes(self):
+        ram_mb = getattr( lazyflow, 'AVAILABLE_RAM_MB', 0 )
+        if ram_mb:
+            return ram_mb * self.BUFFER_RAM_FRACTION * 1e6
+        return self.DEFAULT_BUFFER_MB * 1e6
+
+    def _clearBuffer(self):
+        with self._lock:
+            self._blocks.clear()
+            self._buffered_bytes = 0
+
+    def _getProbabilities(self, start, stop):
+        """
+        Return the full-channel probabilities for the given region (start/stop include the channel axis).
+        """
+        start, stop = tuple(start), tuple(stop)
+        new_request = None
+        with self._lock:
+            # Look for a buffered block that contains the requested region
+            for (block_start, block_stop), (req, nbytes) in self._blocks.items():
+                if all( bs <= s and e <= be for bs, be, s, e in zip(block_start, block_stop, start, stop) ):
+                    # Mark as recently used
+                    self._blocks[(block_start, block_stop)] = self._blocks.pop( (block_start, block_stop) )
+                    break
+            else:
+                block_start, block_stop = start, stop
+                req = new_request = Request( partial( self._computeProbabilities, start, stop ) )
+                nbytes = numpy.prod( numpy.subtract( stop, start ) ) * numpy.dtype(self.Input.meta.dtype).itemsize
+                self._blocks[(start, stop)] = (req, nbytes)
+                self._buffered_bytes += nbytes
+                
+                # Drop the least recently used blocks (but never the new one)
+                max_bytes = self._maxBufferBytes()
+                while self._buffered_bytes > max_bytes and len(self._blocks) > 1:
+                    _, (_, dropped_bytes) = self._blocks.popitem( last=False )
+                    self._buffered_bytes -= dropped_bytes
+
+        if new_request is not None:
+            new_request.submit()
+
+        try:
+            pmap = req.wait()
+        except:
+            # Don't keep failed blocks around
+            with self._lock:
+                if self._blocks.get( (block_start, block_stop), (None,) )[0] is req:
+                    _, nbytes = self._blocks.pop( (block_start, block_stop) )
+                    self._buffered_bytes -= nbytes
+            raise
+        return pmap[ tuple( slice(s-bs, e-bs) for bs, s, e in zip(block_start, start, stop) ) ]
+
+    def _computeProbabilities(self, start, stop):
+        return self.Input( start, stop ).wait()
+
+    def execute(self, slot, subindex, roi, result):
+        # Request all input channels
+        start = tuple(roi.start[:-1]) + (0,)
+        stop = tuple(roi.stop[:-1]) + (self.Input.meta.shape[-1],)
+        pmap = self._getProbabilities( start, stop )
+        chanAxis = pmap.ndim-1
+
+        if slot == self.Probabilities:
+            result[:] = pmap[..., roi.start[-1]:roi.stop[-1]]
+        elif slot == self.Uint8Probabilities:
+            result[:] = (255*pmap[..., roi.start[-1]:roi.stop[-1]]).astype(numpy.uint8)
+        elif slot == self.SimpleSegmentation:
+            result[:] = argmaxSegmentation( pmap, chanAxis )
+        elif slot == self.UncertaintyEstimate:
+            result[:] = ensembleMargin( pmap, chanAxis )
+        else:
+            assert False, "Unknown output slot: {}".format( slot.name )
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        self._clearBuffer()
+        self.Probabilities.setDirty( roi.start, roi.stop )
+        self.Uint8Probabilities.setDirty( roi.start, roi.stop )
+        start = tuple(roi.start[:-1]) + (0,)
+        stop = tuple(roi.stop[:-1]) + (1,)
+        self.SimpleSegmentation.setDirty( start, stop )
+        self.UncertaintyEstimate.setDirty( start, stop )
@@ -0,0 +1,280 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import shutil
+import tempfile
+import threading
+import collections
+import Queue
+import logging
+
+import numpy
+
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+
+logger = logging.getLogger(__name__)
+
+class OpSpillCache(Operator):
+    """
+    A second cache tier for an expensive image (e.g. pixel predictions), to be placed upstream of an in-memory cache.
+
+    Every block that is computed through this operator is compressed and written to a scratch directory
+    (by a background thread, so requests don't wait for the disk).  When the in-memory cache downstream
+    evicts a block and requests it again, the block is read back from the scratch store instead of being recomputed.
+
+    Blocks are identified by their exact roi, so this works best with a downstream cache that always requests
+    the same blocks (e.g. OpSlicedBlockedArrayCache).
+
+    Stored blocks are only discarded when:
+
+    - the corresponding region of the Input becomes dirty (e.g. the classifier changed),
+    - the Input metadata or the ScratchDirectory changes, or
+    - the store exceeds MaxSizeMB (least recently used blocks first).
+
+    If the ScratchDirectory is empty, spilling is disabled, and requests are forwarded to the Input.
+
+    Hit, miss and spill counts are available via getStatistics().
+    """
+    Input = InputSlot()
+    ScratchDirectory = InputSlot() # Blocks are stored in a temporary subdirectory of this directory.  Empty means disabled.
+    MaxSizeMB = InputSlot(value=0) # 0 means unlimited
+
+    Output = OutputSlot()
+
+    # Maximum number of blocks waiting to be written.  If the writer falls behind, new blocks are not spilled.
+    MAX_PENDING_BLOCKS = 16
+
+    def __init__(self, *args, **kwargs):
+        super( OpSpillCache, self ).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # (start, stop) -> (path, nbytes), least recently used first
+        self._pending = {} # (start, stop) -> data that is queued for writing
+        self._stored_bytes = 0
+        self._generation = 0 # Incremented whenever stored data becomes invalid
+        self._file_counter = 0
+        self._store_dir = None
+        self._store_key = None
+        self._stats = collections.Counter()
+
+        self._queue = Queue.Queue( maxsize=self.MAX_PENDING_BLOCKS )
+        self._writer = None
+
+    def setupOutputs(self):
+        self.Output.meta.assignFrom( self.Input.meta )
+
+        if not self.ScratchDirectory.value:
+            # Disabled
+            self._removeStore()
+            return
+
+        scratch_dir = os.path.expanduser( self.ScratchDirectory.value )
+        store_key = ( scratch_dir, self.Input.meta.shape, self.Input.meta.dtype )
+        if store_key != self._store_key:
+            # Everything stored so far is obsolete
+            self._removeStore()
+            if not os.path.exists( scratch_dir ):
+                os.makedirs( scratch_dir )
+            self._store_dir = tempfile.mkdtemp( prefix='ilastik-spill-', dir=scratch_dir )
+            self._store_key = store_key
+            logger.debug( "Spilling blocks to {}".format( self._store_dir ) )
+
+        with self._lock:
+            self._evict()
+
+        if self._writer is None:
+            self._writer = threading.Thread( target=self._writeSpilledBlocks, name="OpSpillCache writer" )
+            self._writer.daemon = True
+            self._writer.start()
+
+    def getStatistics(self):
+        """
+        Return a dict with the number of 'hits', 'misses', 'spills' (blocks written), 'spilled_bytes',
+        'skipped_spills' (blocks not written because the writer was busy), 'evictions', and the current 'stored_bytes'.
+        """
+        with self._lock:
+            stats = dict( self._stats )
+            stats['stored_bytes'] = self._stored_bytes
+        for key in ['hits', 'misses', 'spills', 'spilled_bytes', 'skipped_spills', 'evictions']:
+            stats.setdefault( key, 0 )
+        return stats
+
+    def execute(self, slot, subindex, roi, result):
+        if self._store_dir is None:
+            # Disabled
+            self.Input( roi.start, roi.stop ).writeInto( result ).wait()
+            return result
+
+        key = ( tuple(roi.start), tuple(roi.stop) )
+        with self._lock:
+            data = self._pending.get( key )
+            entry = self._entries.get( key )
+            if entry is not None:
+                # Mark as recently used
+                self._entries[key] = self._entries.pop( key )
+
+        if data is None and entry is not None:
+            try:
+                npz = numpy.load( entry[0] )
+                try:
+                    data = npz['data']
+                finally:
+                    npz.close()
+            except (IOError, KeyError):
+                # The block was evicted (or invalidated) in the meantime
+                data = None
+
+        if data is not None:
+            result[:] = data
+            with self._lock:
+                self._stats['hits'] += 1
+            return result
+
+        with self._lock:
+            self._stats['misses'] += 1
+            generation = self._generation
+        self.Input( roi.start, roi.stop ).writeInto( result ).wait()
+        self._spill( generation, key, result.copy() )
+        return result
+
+    def _spill(self, generation, key, data):
+        with self._lock:
+            if generation != self._generation:
+                return
+            try:
+                self._queue.put_nowait( (key, data) )
+            except Queue.Full:
+                self._stats['skipped_spills'] += 1
+            else:
+                self._pending[key] = data
+
+    def _writeSpilledBlocks(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            key, data = item
+            with self._lock:
+                # Blocks that were invalidated in the meantime are no longer pending
+                if self._pending.get( key ) is not data:
+                    continue
+                self._file_counter += 1
+                path = os.path.join( self._store_dir, "block_{}.npz".format( self._file_counter ) )
+
+            try:
+                with open( path, 'wb' ) as f:
+                    numpy.savez_compressed( f, data=data )
+                nbytes = os.path.getsize( path )
+            except Exception as ex:
+                with self._lock:
+                    if self._pending.get( key ) is data:
+                        # (Otherwise, the store was probably removed while we were writing.)
+                        logger.warn( "Failed to spill block {} to disk: {}".format( key, ex ) )
+                        del self._pending[key]
+                continue
+
+            with self._lock:
+                if self._pending.get( key ) is not data:
+                    # Invalidated while we were writing
+                    self._deleteFile( path )
+                    continue
+                del self._pending[key]
+                old_entry = self._entries.pop( key, None )
+                if old_entry is not None:
+                    self._deleteFile( old_entry[0] )
+                    self._stored_bytes -= old_entry[1]
+                self._entries[key] = (path, nbytes)
+                self._stored_bytes += nbytes
+                self._stats['spills'] += 1
+                self._stats['spilled_bytes'] += nbytes
+                self._evict()
+
+    def _evict(self):
+        """
+        Delete the least recently used blocks until the store fits within MaxSizeMB.
+        Must be called with the lock held.
+        """
+        max_size_mb = self.MaxSizeMB.value if self.MaxSizeMB.ready() else 0
+        if not max_size_mb:
+            return
+        while self._entries and self._stored_bytes > max_size_mb * 1e6:
+            _, (path, nbytes) = self._entries.popitem( last=False )
+            self._deleteFile( path )
+            self._stored_bytes -= nbytes
+            self._stats['evictions'] += 1
+
+    def _deleteFile(self, path):
+        try:
+            os.remove( path )
+        except OSError:
+            pass
+
+    def _invalidate(self, start, stop):
+        """
+        Forget all blocks that intersect the given region.
+        (Blocks that are currently being computed won't be spilled.)
+        """
+        with self._lock:
+            self._generation += 1
+            for key in self._pending.keys():
+                if self._intersects( key, start, stop ):
+                    del self._pending[key]
+            for key in self._entries.keys():
+                if self._intersects( key, start, stop ):
+                    path, nbytes = self._entries.pop( key )
+                    self._deleteFile( path )
+                    self._stored_bytes -= nbytes
+
+    @classmethod
+    def _intersects(cls, key, start, stop):
+        block_start, block_stop = key
+        return all( bs < e and s < be for bs, be, s, e in zip( block_start, block_stop, start, stop ) )
+
+    def _removeStore(self):
+        with self._lock:
+            self._generation += 1
+            self._pending.clear()
+            self._entries.clear()
+            self._stored_bytes = 0
+            store_dir = self._store_dir
+            self._store_dir = None
+            self._store_key = None
+        if store_dir is not None:
+            shutil.rmtree( store_dir, ignore_errors=True )
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.Input:
+            self._invalidate( roi.start, roi.stop )
+            self.Output.setDirty( roi.start, roi.stop )
+        elif slot == self.MaxSizeMB:
+            # Takes effect in setupOutputs()
+            pass
+        else:
+            # A new scratch directory doesn't change the data
+            pass
+
+    def cleanUp(self):
+        logger.debug( "Spill cache statistics: {}".format( self.getStatistics() ) )
+        # Removing the store first invalidates all queued blocks, so the writer finishes quickly.
+        self._removeStore()
+        if self._writer is not None:
+            self._queue.put( None )
+            self._writer = None
+        super( OpSpillCache, self ).cleanUp()
@@ -23,6 +23,7 @@
 # basic python modules
 import functools
 import logging
+import time
 logger = logging.getLogger(__name__)
 from threading import Lock as ThreadLock
 
@@ -32,7 +33,9 @@ import vigra
 import opengm
 
 # basic lazyflow types
+import lazyflow
 from lazyflow.operator import Operator
+from lazyflow.graph import OrderedSignal
 from lazyflow.slot import InputSlot, OutputSlot
 from lazyflow.rtype import SubRegion
 from lazyflow.stype import Opaque
@@ -45,6 +48,12 @@ from lazyflow.operators.opReorderAxes import OpReorderAxes
 
 from _OpGraphCut import segmentGC, OpGraphCut
 
+# Rough estimate of the peak memory segmentGC() needs per voxel of the box:
+# the unaries (float64), the factor index arrays (uint32, including the
+# temporaries of the concatenation), the OpenGM model (one unary and three
+# Potts factors per voxel) and the max-flow graph.
+GRAPHCUT_BYTES_PER_VOXEL = 600
+
 
 ## segment predictions with pre-thresholding
 #
@@ -94,8 +103,19 @@ class OpObjectsSegment(OpGraphCut):
     #Output = OutputSlot()
     #CachedOutput = OutputSlot()
 
+    # Objects are processed in parallel, as long as the estimated memory of
+    # their graph cuts fits into this fraction of the lazyflow RAM budget
+    # (lazyflow.AVAILABLE_RAM_MB) ...
+    RAM_FRACTION = 0.5
+    # ... or into this budget, if lazyflow has no RAM budget configured.
+    DEFAULT_RAM_MB = 2000
+    # If not None, overrides the budgets above (0: no limit)
+    RAM_BUDGET_MB = None
+
     def __init__(self, *args, **kwargs):
         super(OpObjectsSegment, self).__init__(*args, **kwargs)
+        # Signature: emit(percentComplete), for each processed object
+        self.progressSignal = OrderedSignal()
 
     def setupOutputs(self):
         super(OpObjectsSegment, self).setupOutputs()
@@ -185,8 +205,7 @@ class OpObjectsSegment(OpGraphCut):
         resultXYZ = vigra.taggedView(np.zeros(cc.shape, dtype=np.uint8),
                                      axistags='xyz')
 
-        def processSingleObject(i):
-            logger.debug("processing object {}".format(i))
+        def getBox(i):
             # maxs are inclusive, so we need to add 1
             xmin = max(mins[i][0]-margin[0], 0)
             ymin = max(mins[i][1]-margin[1], 0)
@@ -194,6 +213,11 @@ class OpObjectsSegment(OpGraphCut):
             xmax = min(maxs[i][0]+margin[0]+1, cc.shape[0])
             ymax = min(maxs[i][1]+margin[1]+1, cc.shape[1])
             zmax = min(maxs[i][2]+margin[2]+1, cc.shape[2])
+            return xmin, xmax, ymin, ymax, zmin, zmax
+
+        def processSingleObject(i):
+            logger.debug("processing object {}".format(i))
+            xmin, xmax, ymin, ymax, zmin, zmax = getBox(i)
             ccbox = cc[xmin:xmax, ymin:ymax, zmin:zmax]
             resbox = resultXYZ[xmin:xmax, ymin:ymax, zmin:zmax]
 
@@ -231,18 +255,32 @@ class OpObjectsSegment(OpGraphCut):
                 label = passed[1]  # 0 is background
                 resbox[ccsegm == label] = 1
 
-        pool = RequestPool()
-        #FIXME make sure that the parallel computations fit into memory
+        # Estimate the memory of each object (objects that are too large for
+        # graph cut just copy their seed, which needs about a byte per voxel)
+        jobs = []
         for i in range(1, nobj):
-            req = Request(functools.partial(processSingleObject, i))
-            pool.add(req)
+            xmin, xmax, ymin, ymax, zmin, zmax = getBox(i)
+            nVoxels = (xmax-xmin) * (ymax-ymin) * (zmax-zmin)
+            if nVoxels > MAXBOXSIZE:
+                cost = nVoxels
+            else:
+                cost = nVoxels * GRAPHCUT_BYTES_PER_VOXEL
+            jobs.append((cost, functools.partial(processSingleObject, i)))
 
-        logger.info("Processing {} objects ...".format(nobj-1))
+        budget = self._ramBudgetBytes()
+        logger.info("Processing {} objects (memory budget: {})...".format(
+            nobj-1, "{:.0f} MB".format(budget/1e6) if budget else "unlimited"))
 
-        pool.wait()
-        pool.clean()
+        def reportProgress(numDone):
+            self.progressSignal(100.0 * numDone / len(jobs))
 
-        logger.info("object loop done")
+        startTime = time.time()
+        self.progressSignal(0)
+        _ObjectScheduler(budget, reportProgress).run(jobs)
+        self.progressSignal(100)
+
+        logger.info("object loop done in {:.1f} seconds".format(
+            time.time() - startTime))
 
         # prepare result
         resView = vigra.taggedView(result, axistags=self.Output.meta.axistags)
@@ -251,6 +289,14 @@ class OpObjectsSegment(OpGraphCut):
         # some labels could have been removed => relabel
         vigra.analysis.labelVolumeWithBackground(resultXYZ, out=resView)
 
+    def _ramBudgetBytes(self):
+        if self.RAM_BUDGET_MB is not None:
+            return self.RAM_BUDGET_MB * 1e6
+        ram_mb = getattr(lazyflow, 'AVAILABLE_RAM_MB', 0)
+        if ram_mb:
+            return ram_mb * self.RAM_FRACTION * 1e6
+        return self.DEFAULT_RAM_MB * 1e6
+
     def propagateDirty(self, slot, subindex, roi):
         super(OpObjectsSegment, self).propagateDirty(slot, subindex, roi)
 
@@ -271,3 +317,90 @@ class OpObjectsSegment(OpGraphCut):
         elif slot == self.Margin:
             # margin affects the whole volume
             self.Output.setDirty(slice(None))
+
+
+## run one request per object within a memory budget
+#
+# Each job has an estimated cost (in bytes). Jobs are started largest first,
+# and a job is only started if the costs of all running jobs fit into the
+# budget. (A job that exceeds the budget on its own runs alone.) The order in
+# which jobs run does not change the result of OpObjectsSegment, since all
+# objects write the same value into the output.
+class _ObjectScheduler(object):
+
+    def __init__(self, budget_bytes, progress=None):
+        """
+        :param budget_bytes: the memory budget (0: no limit, run all jobs at once)
+        :param progress: called with the number of finished jobs after each job
+        """
+        self._budget = budget_bytes
+        self._progress = progress or (lambda numDone: None)
+        self._lock = ThreadLock()
+
+    def run(self, jobs):
+        """
+        Run all jobs and wait for them to finish.
+
+        :param jobs: a list of (cost_bytes, function) tuples
+        """
+        # largest last, so we can pop() them
+        self._pending = sorted(jobs, key=lambda job: job[0])
+        self._runningBytes = 0
+        self._numRunning = 0
+        self._numDone = 0
+        self._failed = False
+        self._requests = []
+
+        with self._lock:
+            toSubmit = self._admit()
+        for req in toSubmit:
+            req.submit()
+
+        # Finished jobs start new jobs before their request finishes,
+        # so all requests are in the list once we got to its end.
+        i = 0
+        while True:
+            with self._lock:
+                if i == len(self._requests):
+                    break
+                req = self._requests[i]
+            req.wait()
+            i += 1
+        assert not self._pending
+
+    def _admit(self):
+        """
+        Create requests for the pending jobs that fit into the budget.
+        Must be called with the lock held.
+        """
+        toSubmit = []
+        while self._pending and not self._failed:
+            cost = self._pending[-1][0]
+            if self._numRunning > 0 and self._budget and\
+                    self._runningBytes + cost > self._budget:
+                break
+            cost, function = self._pending.pop()
+            self._numRunning += 1
+            self._runningBytes += cost
+            req = Request(functools.partial(self._runJob, cost, function))
+            self._requests.append(req)
+            toSubmit.append(req)
+        return toSubmit
+
+    def _runJob(self, cost, function):
+        try:
+            function()
+        except:
+            with self._lock:
+                self._failed = True
+            raise
+        finally:
+            with self._lock:
+                self._numRunning -= 1
+                self._runningBytes -= cost
+                self._numDone += 1
+                # report under the lock, so the reports are in order
+                self._progress(self._numDone)
+                toSubmit = self._admit()
+            for req in toSubmit:
+                req.submit()
@@ -0,0 +1,441 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Two-level (hysteresis) thresholding, computed one block at a time.
+
+Both threshold levels are labeled per block.  Components that cross a block face are
+stitched by a union-find pass over the two face planes (no halo is needed, since the
+labeling uses the 6-neighborhood), and the size filters are applied to the global sizes.
+
+Blocks are labeled lazily: requesting one block labels that block, plus the blocks that are
+reachable through the components it contains (and nothing else), so the total sizes of
+these components are known.  For a volume with many small objects, the first displayed
+block is about as cheap as labeling one block.
+"""
+import threading
+import logging
+from functools import partial
+
+import numpy
+import vigra
+
+from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiToSlice
+from lazyflow.request import Request, RequestPool
+
+logger = logging.getLogger(__name__)
+
+LOW = 0
+HIGH = 1
+
+class OpBlockwiseThresholdTwoLevels(Operator):
+    """
+    Blockwise equivalent of _OpThresholdTwoLevels (output without caching).
+
+    The output keeps the objects of the low threshold that contain an object of the high threshold
+    with a size in [MinSize, MaxSize], and whose own size is in [MinSize, MaxSize].
+    Each kept object gets a unique (but not consecutive) label.
+    The input must be 5D (txyzc) with a single channel.
+    """
+    name = "OpBlockwiseThresholdTwoLevels"
+
+    InputImage = InputSlot()
+    MinSize = InputSlot(stype='int', value=0)
+    MaxSize = InputSlot(stype='int', value=1000000)
+    HighThreshold = InputSlot(stype='float', value=0.5)
+    LowThreshold = InputSlot(stype='float', value=0.2)
+    BlockShape3dDict = InputSlot() # e.g. {'x' : 256, 'y' : 256, 'z' : 256}
+
+    Output = OutputSlot()
+
+    def __init__(self, *args, **kwargs):
+        super(OpBlockwiseThresholdTwoLevels, self).__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+        self._timeSlices = {}
+        self._store_key = None
+
+    def setupOutputs(self):
+        assert self.InputImage.meta.getAxisKeys() == list('txyzc'),\
+            "Input must be 5D (txyzc), not {}".format( self.InputImage.meta.getAxisKeys() )
+        assert self.InputImage.meta.shape[-1] == 1, "Input must have a single channel"
+
+        self.Output.meta.assignFrom(self.InputImage.meta)
+        self.Output.meta.dtype = numpy.uint32
+        self.Output.meta.drange = (0, 1)
+
+        blockShape3d = self.BlockShape3dDict.value
+        shape = self.InputImage.meta.shape[1:4]
+        self._blockShape = tuple( min( blockShape3d.get(k, s), s ) for k, s in zip('xyz', shape) )
+
+        # The labels depend on everything except the size filters
+        store_key = ( tuple(self.InputImage.meta.shape), self._blockShape, self.InputImage.meta.drange,
+                      self.LowThreshold.value, self.HighThreshold.value )
+        if store_key != self._store_key:
+            with self._lock:
+                self._timeSlices = {}
+            self._store_key = store_key
+
+    def execute(self, slot, subindex, roi, result):
+        assert slot == self.Output
+        shape = self.InputImage.meta.shape[1:4]
+        spatial_roi = ( roi.start[1:4], roi.stop[1:4] )
+        block_starts = getIntersectingBlocks( self._blockShape, spatial_roi )
+        minSize = self.MinSize.value
+        maxSize = self.MaxSize.value
+
+        def processBlock( t, timeSlice, block_start ):
+            labels = timeSlice.selectedLabels( block_start, minSize, maxSize )
+            start, stop = getBlockBounds( shape, self._blockShape, block_start )
+            start = numpy.maximum( start, spatial_roi[0] )
+            stop = numpy.minimum( stop, spatial_roi[1] )
+            source = roiToSlice( start - block_start, stop - block_start )
+            dest = roiToSlice( start - spatial_roi[0], stop - spatial_roi[0] )
+            result[ (t - roi.start[0],) + dest + (0,) ] = labels[source]
+
+        pool = RequestPool()
+        for t in range( roi.start[0], roi.stop[0] ):
+            timeSlice = self._timeSlice( t )
+            for block_start in block_starts:
+                pool.add( Request( partial( processBlock, t, timeSlice, tuple(block_start) ) ) )
+        pool.wait()
+        return result
+
+    def propagateDirty(self, slot, subindex, roi):
+        if slot == self.InputImage:
+            # Components can cross any number of blocks, so the whole time slice must be relabeled.
+            with self._lock:
+                for t in range( roi.start[0], roi.stop[0] ):
+                    self._timeSlices.pop( t, None )
+            start = (roi.start[0], 0, 0, 0, 0)
+            stop = (roi.stop[0],) + tuple(self.Output.meta.shape[1:])
+            self.Output.setDirty( start, stop )
+        else:
+            # Size and threshold changes affect everything
+            #  (for threshold changes, setupOutputs() has already discarded the labels).
+            self.Output.setDirty( slice(None) )
+
+    def _timeSlice(self, t):
+        with self._lock:
+            if t not in self._timeSlices:
+                shape = self.InputImage.meta.shape[1:4]
+                self._timeSlices[t] = _TimeSliceLabels( shape, self._blockShape, partial( self._labelBlock, t ) )
+            return self._timeSlices[t]
+
+    def _labelBlock(self, t, start, stop):
+        """
+        Threshold and label one block of time slice t with both thresholds.
+        Returns the (local) low and high labels.
+        """
+        data = self.InputImage( (t,) + tuple(start) + (0,), (t+1,) + tuple(stop) + (1,) ).wait()
+        data = data[0, ..., 0]
+
+        lowThreshold = self.LowThreshold.value
+        highThreshold = self.HighThreshold.value
+        drange = self.InputImage.meta.drange
+        if drange is not None:
+            assert drange[0] == 0,\
+                "Don't know how to threshold data with this drange."
+            lowThreshold *= drange[1]
+            highThreshold *= drange[1]
+
+        low = vigra.analysis.labelVolumeWithBackground( (data > lowThreshold).astype(numpy.uint8) )
+        high = vigra.analysis.labelVolumeWithBackground( (data > highThreshold).astype(numpy.uint8) )
+        return low.view(numpy.ndarray), high.view(numpy.ndarray)
+
+
+class _Components(object):
+    """
+    Union-find over the global ids of the components of one threshold level,
+    with the total size of each set.  Not thread-safe: the caller holds the lock.
+    """
+
+    def __init__(self):
+        # id 0 is the background
+        self.parent = numpy.zeros( (1,), dtype=numpy.uint32 )
+        self.sizes = numpy.zeros( (1,), dtype=numpy.int64 )
+        self.count = 1
+
+    def add(self, sizes):
+        """
+        Add components with the given sizes.
+        Returns the offset of their ids: local label i (starting at 1) becomes offset + i.
+        """
+        offset = self.count - 1
+        new_count = self.count + len(sizes)
+        if new_count > len(self.parent):
+            capacity = max( new_count, 2*len(self.parent) )
+            parent = numpy.zeros( (capacity,), dtype=numpy.uint32 )
+            parent[:self.count] = self.parent[:self.count]
+            self.parent = parent
+            total_sizes = numpy.zeros( (capacity,), dtype=numpy.int64 )
+            total_sizes[:self.count] = self.sizes[:self.count]
+            self.sizes = total_sizes
+        self.parent[self.count:new_count] = numpy.arange( self.count, new_count, dtype=numpy.uint32 )
+        self.sizes[self.count:new_count] = sizes
+        self.count = new_count
+        return offset
+
+    def roots(self, ids):
+        """
+        Return the root of each id (vectorized), compressing the paths of the given ids.
+        """
+        ids = numpy.asarray( ids, dtype=numpy.uint32 )
+        roots = self.parent[ids]
+        while True:
+            grand_parents = self.parent[roots]
+            if (grand_parents == roots).all():
+                break
+            roots = grand_parents
+        self.parent[ids] = roots
+        return roots
+
+    def union(self, a, b):
+        """
+        Merge the sets of each pair (a[i], b[i]).  The smaller root becomes the root of the merged set.
+        """
+        for x, y in zip( a, b ):
+            x = self._find( x )
+            y = self._find( y )
+            if x == y:
+                continue
+            if y < x:
+                x, y = y, x
+            self.parent[y] = x
+            self.sizes[x] += self.sizes[y]
+
+    def _find(self, x):
+        parent = self.parent
+        while parent[x] != x:
+            # path halving
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+
+class _TimeSliceLabels(object):
+    """
+    The stitched labels of both threshold levels for one time slice.
+
+    For each labeled block, we keep its label offsets and the face planes towards neighbouring blocks
+    that are not labeled yet (these are dropped as soon as the neighbour has been stitched).
+    The labels themselves are recomputed if a block is requested again (the output is cached downstream).
+    """
+
+    def __init__(self, shape, blockShape, labelBlock):
+        """
+        :param shape: The spatial shape of the volume (xyz)
+        :param blockShape: The spatial block shape
+        :param labelBlock: A function (start, stop) -> (low labels, high labels) that labels one block
+        """
+        self._shape = tuple(shape)
+        self._blockShape = tuple(blockShape)
+        self._labelBlock = labelBlock
+        self._lock = threading.Lock()
+        self._components = ( _Components(), _Components() )
+
+        self._offsets = {}   # block start -> (low offset, high offset)
+        self._faces = {}     # block start -> { direction -> (low plane, high plane) } (global ids)
+        self._faceIds = {}   # block start -> { direction -> (low ids, high ids) } (the unique ids of the planes)
+        self._links = []     # [ (low ids, high ids) ], the overlapping components of both levels
+        self._requests = {}  # block start -> Request, for blocks that are being labeled
+
+    def selectedLabels(self, block_start, minSize, maxSize):
+        """
+        Return the output of one block: the low labels (as the ids of the stitched components) of the
+        components that pass the two-level threshold and the size filters, and 0 everywhere else.
+        """
+        low, high, offsets = self._labelAndIntegrate( block_start )
+        num_low = int( low.max() ) if low.size else 0
+        low_ids = offsets[LOW] + numpy.arange( 1, num_low+1, dtype=numpy.uint32 )
+
+        # All blocks of the low components must be labeled to know their size.
+        self._complete( LOW, low_ids )
+        # The high components inside them are then complete, too (unless the high threshold is lower).
+        with self._lock:
+            high_ids = self._linkedHighIds( self._components[LOW].roots( low_ids ) )
+        self._complete( HIGH, high_ids )
+
+        with self._lock:
+            lowComponents = self._components[LOW]
+            highComponents = self._components[HIGH]
+            roots = lowComponents.roots( low_ids )
+
+            link_low, link_high = self._allLinks()
+            link_roots = lowComponents.roots( link_low )
+            relevant = numpy.in1d( link_roots, roots )
+            high_sizes = highComponents.sizes[ highComponents.roots( link_high[relevant] ) ]
+            good_high = (high_sizes >= minSize) & (high_sizes <= maxSize)
+            kept_roots = link_roots[relevant][good_high]
+
+            low_sizes = lowComponents.sizes[roots]
+            keep = numpy.in1d( roots, kept_roots ) & (low_sizes >= minSize) & (low_sizes <= maxSize)
+
+        lut = numpy.zeros( (num_low+1,), dtype=numpy.uint32 )
+        lut[1:] = numpy.where( keep, roots, 0 )
+        return lut[low]
+
+    def _blockStop(self, block_start):
+        return tuple( min( s + b, n ) for s, b, n in zip( block_start, self._blockShape, self._shape ) )
+
+    def _neighbours(self, block_start):
+        """
+        Yield (direction, neighbour start) for each existing neighbour of a block.
+        direction is (axis, side), with side 0 for the lower face and 1 for the upper face.
+        """
+        for axis in range(3):
+            for side, step in ((0, -self._blockShape[axis]), (1, self._blockShape[axis])):
+                neighbour = list(block_start)
+                neighbour[axis] += step
+                if 0 <= neighbour[axis] < self._shape[axis]:
+                    yield (axis, side), tuple(neighbour)
+
+    def _labelAndIntegrate(self, block_start):
+        """
+        Label a block and stitch it to its labeled neighbours (unless that was done already).
+        Returns the local low and high labels and the offsets of their global ids.
+        """
+        low, high = self._labelBlock( block_start, self._blockStop( block_start ) )
+        with self._lock:
+            if block_start in self._offsets:
+                return low, high, self._offsets[block_start]
+
+        # Gather everything we need from the labels before taking the lock
+        sizes = []
+        for labels in (low, high):
+            num_labels = int( labels.max() ) if labels.size else 0
+            sizes.append( numpy.bincount( labels.ravel(), minlength=num_labels+1 )[1:] )
+        overlap = (low != 0) & (high != 0)
+        link_low, link_high = _uniquePairs( low[overlap], high[overlap] )
+        del overlap
+
+        planes = {}
+        for direction, neighbour in self._neighbours( block_start ):
+            axis, side = direction
+            index = [slice(None)]*3
+            index[axis] = -side
+            planes[direction] = ( low[index], high[index] )
+
+        with self._lock:
+            if block_start in self._offsets:
+                return low, high, self._offsets[block_start]
+
+            offsets = tuple( self._components[level].add( sizes[level] ) for level in (LOW, HIGH) )
+            self._links.append( (link_low + offsets[LOW], link_high + offsets[HIGH]) )
+
+            faces = {}
+            faceIds = {}
+            for direction, neighbour in self._neighbours( block_start ):
+                global_planes = tuple( _globalLabels( plane, offset ) for plane, offset in zip( planes[direction], offsets ) )
+                opposite = ( direction[0], 1 - direction[1] )
+                if neighbour in self._offsets:
+                    # Stitch with the neighbour, and drop its face towards us.
+                    neighbour_planes = self._faces[neighbour].pop( opposite )
+                    del self._faceIds[neighbour][opposite]
+                    for level in (LOW, HIGH):
+                        a, b = global_planes[level], neighbour_planes[level]
+                        both = (a != 0) & (b != 0)
+                        self._components[level].union( *_uniquePairs( a[both], b[both] ) )
+                else:
+                    faces[direction] = global_planes
+                    faceIds[direction] = tuple( _nonzeroUnique( plane ) for plane in global_planes )
+
+            self._offsets[block_start] = offsets
+            self._faces[block_start] = faces
+            self._faceIds[block_start] = faceIds
+            self._requests.pop( block_start, None )
+        return low, high, offsets
+
+    def _complete(self, level, ids):
+        """
+        Label all blocks that the components with the given ids extend into.
+        Blocks are labeled in parallel, one ring of neighbours at a time.
+        """
+        ids = numpy.unique( ids )
+        ids = ids[ids != 0]
+        if len(ids) == 0:
+            return
+        while True:
+            with self._lock:
+                components = self._components[level]
+                seed_roots = numpy.unique( components.roots( ids ) )
+                needed = set()
+                for block_start, faceIds in self._faceIds.iteritems():
+                    for direction, neighbour in self._neighbours( block_start ):
+                        if direction not in faceIds or neighbour in needed:
+                            continue
+                        face_roots = components.roots( faceIds[direction][level] )
+                        if numpy.in1d( face_roots, seed_roots ).any():
+                            needed.add( neighbour )
+                requests = [ self._request( block_start ) for block_start in needed ]
+            if not requests:
+                return
+            for request in requests:
+                request.submit()
+            for request in requests:
+                request.wait()
+
+    def _request(self, block_start):
+        """
+        Return the request that labels and integrates the given block.  Must be called with the lock held.
+        Several threads may need the same block, so they share the request.
+        """
+        if block_start not in self._requests:
+            def labelAndIntegrate():
+                self._labelAndIntegrate( block_start )
+            self._requests[block_start] = Request( labelAndIntegrate )
+        return self._requests[block_start]
+
+    def _allLinks(self):
+        """
+        Return all (low id, high id) overlaps, as two arrays.  Must be called with the lock held.
+        """
+        if len(self._links) != 1:
+            self._links = [ ( numpy.concatenate( [ l for l, h in self._links ] ),
+                              numpy.concatenate( [ h for l, h in self._links ] ) ) ]
+        return self._links[0]
+
+    def _linkedHighIds(self, low_roots):
+        """
+        Return the high ids that overlap the low components with the given roots.
+        Must be called with the lock held.
+        """
+        link_low, link_high = self._allLinks()
+        relevant = numpy.in1d( self._components[LOW].roots( link_low ), low_roots )
+        return link_high[relevant]
+
+
+def _globalLabels( labels, offset ):
+    """
+    Add offset to the nonzero labels.
+    """
+    return numpy.where( labels != 0, labels + numpy.uint32(offset), 0 ).astype( numpy.uint32 )
+
+def _nonzeroUnique( labels ):
+    ids = numpy.unique( labels )
+    return ids[ids != 0]
+
+def _uniquePairs( a, b ):
+    """
+    Return the unique pairs (a[i], b[i]) of two uint32 arrays, as two arrays.
+    """
+    keys = numpy.unique( (a.astype(numpy.uint64) << numpy.uint64(32)) | b.astype(numpy.uint64) )
+    return ( (keys >> numpy.uint64(32)).astype(numpy.uint32),
+             (keys & numpy.uint64(0xFFFFFFFF)).astype(numpy.uint32) )
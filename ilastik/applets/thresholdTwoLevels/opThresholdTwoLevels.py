@@ -30,10 +30,11 @@ import vigra
 
 # ilastik
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.utility.slicedBlockShapes import parseBlockDims
 import ilastik.config
 
 # Lazyflow
-from lazyflow.graph import Operator, InputSlot, OutputSlot
+from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal
 from lazyflow.operators import OpPixelOperator, OpLabelVolume,\
     OpCompressedCache, OpColorizeLabels,\
     OpSingleChannelSelector, OperatorWrapper,\
@@ -47,6 +48,8 @@ from thresholdingTools import OpAnisotropicGaussianSmoothing5d
 
 from thresholdingTools import OpSelectLabels
 
+from opBlockwiseThresholdTwoLevels import OpBlockwiseThresholdTwoLevels
+
 from opGraphcutSegment import haveGraphCut
 
 if haveGraphCut():
@@ -93,6 +96,9 @@ class OpThresholdTwoLevels(Operator):
     # margin around single object (only graph-cut)
     Margin = InputSlot(value=numpy.asarray((20,20,20)))
 
+    # If set, the two-level threshold is computed block by block
+    BlockShape3dDict = InputSlot(optional=True)
+
     ## Output slots ##
 
     Output = OutputSlot()
@@ -136,6 +142,9 @@ class OpThresholdTwoLevels(Operator):
         # debug output
         self.Smoothed.connect(self._opSmoother.Output)
 
+        # Signature: emit(percentComplete), while the graph cut segments the objects
+        self.progressSignal = OrderedSignal()
+
         # single threshold operator
         self.opThreshold1 = _OpThresholdOneLevel(parent=self)
         self.opThreshold1.Threshold.connect(self.SingleThreshold)
@@ -148,6 +157,7 @@ class OpThresholdTwoLevels(Operator):
         self.opThreshold2.MaxSize.connect(self.MaxSize)
         self.opThreshold2.LowThreshold.connect(self.LowThreshold)
         self.opThreshold2.HighThreshold.connect(self.HighThreshold)
+        self.opThreshold2.BlockShape3dDict.connect(self.BlockShape3dDict)
 
         if haveGraphCut():
             self.opThreshold1GC = _OpThresholdOneLevel(parent=self)
@@ -160,6 +170,7 @@ class OpThresholdTwoLevels(Operator):
             self.opObjectsGraphCut.LabelImage.connect(self.opThreshold1GC.Output)
             self.opObjectsGraphCut.Beta.connect(self.Beta)
             self.opObjectsGraphCut.Margin.connect(self.Margin)
+            self.opObjectsGraphCut.progressSignal.subscribe(self.progressSignal)
 
             self.opGraphCut = OpGraphCut(parent=self)
             self.opGraphCut.Prediction.connect(self.Smoothed)
@@ -184,6 +195,11 @@ class OpThresholdTwoLevels(Operator):
         #Debug outputs
         self.InputChannel.connect(self._opChannelSelector.Output)
 
+        blockDims = parseBlockDims(
+            ilastik.config.cfg.get('thresholding', 'two_level_block_dims'))
+        if blockDims:
+            self.BlockShape3dDict.setValue(blockDims)
+
     def setupOutputs(self):
 
         self._opReorder2.AxisOrder.setValue(self.InputImage.meta.getAxisKeys())
@@ -209,6 +225,13 @@ class OpThresholdTwoLevels(Operator):
                 "Unknown index {} for current tab.".format(curIndex))
 
         self._opReorder2.Input.connect(outputSlot)
+
+        # the two-level output is consistent for any block shape
+        if curIndex == 1:
+            self._cache.BlockShape3dDict.connect(self.BlockShape3dDict)
+        else:
+            self._cache.BlockShape3dDict.disconnect()
+
         # force the cache to emit a dirty signal
         self._cache.Input.setDirty(slice(None))
 
@@ -357,6 +380,8 @@ class _OpThresholdOneLevel(Operator):
 # make sure that the ROI for slot 'Output' matches the input shape at least in
 # the spatial dimensions, or you will get inconsistent results. All requests to
 # slot 'CachedOutput' are guaranteed to be consistent though.
+# If BlockShape3dDict is set, the output is computed block by block instead
+# (see OpBlockwiseThresholdTwoLevels), and any ROI is consistent.
 class _OpThresholdTwoLevels(Operator):
     name = "_OpThresholdTwoLevels"
 
@@ -365,6 +390,7 @@ class _OpThresholdTwoLevels(Operator):
     MaxSize = InputSlot(stype='int', value=1000000)
     HighThreshold = InputSlot(stype='float', value=0.5)
     LowThreshold = InputSlot(stype='float', value=0.2)
+    BlockShape3dDict = InputSlot(optional=True)
 
     Output = OutputSlot()
     CachedOutput = OutputSlot()  # For the GUI (blockwise-access)
@@ -429,6 +455,15 @@ class _OpThresholdTwoLevels(Operator):
         self._opFinalLabelSizeFilter.MaxLabelSize.connect( self.MaxSize )
         self._opFinalLabelSizeFilter.BinaryOut.setValue(False)
 
+        # Alternative to all of the above, used if BlockShape3dDict is set
+        self._opBlockwise = OpBlockwiseThresholdTwoLevels( parent=self )
+        self._opBlockwise.InputImage.connect( self.InputImage )
+        self._opBlockwise.MinSize.connect( self.MinSize )
+        self._opBlockwise.MaxSize.connect( self.MaxSize )
+        self._opBlockwise.HighThreshold.connect( self.HighThreshold )
+        self._opBlockwise.LowThreshold.connect( self.LowThreshold )
+        self._opBlockwise.BlockShape3dDict.connect( self.BlockShape3dDict )
+
         self._opCache = OpCompressedCache( parent=self )
         self._opCache.name = "_OpThresholdTwoLevels._opCache"
         self._opCache.InputHdf5.connect( self.InputHdf5 )
@@ -481,22 +516,33 @@ class _OpThresholdTwoLevels(Operator):
         self._opHighThresholder.Function.setValue(
             partial(thresholdToUint8, self.HighThreshold.value))
 
-        # Output is already connected internally -- don't reassign new metadata
+        # Output is connected internally -- don't reassign new metadata
         # self.Output.meta.assignFrom(self.InputImage.meta)
+        if self.BlockShape3dDict.ready():
+            outputSlot = self._opBlockwise.Output
+        else:
+            outputSlot = self._opFinalLabelSizeFilter.Output
+        if self.Output.partner is not outputSlot:
+            self.Output.connect( outputSlot )
+            self._opCache.Input.connect( outputSlot )
 
         # Blockshape is the entire spatial volume (hysteresis thresholding is
-        # a global operation)
-        tagged_shape = self.Output.meta.getTaggedShape()
+        # a global operation), unless we threshold blockwise
+        tagged_shape = self.InputImage.meta.getTaggedShape()
         tagged_shape['c'] = 1
         tagged_shape['t'] = 1
-        self._opCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
-        self._opBigRegionCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
-        self._opSmallRegionCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
-        self._opFilteredSmallLabelsCache.BlockShape.setValue(
-            tuple(tagged_shape.values()))
+        full_shape = tuple(tagged_shape.values())
+        block_shape = full_shape
+        if self.BlockShape3dDict.ready():
+            block_dims = self.BlockShape3dDict.value
+            for k in 'xyz':
+                tagged_shape[k] = min(block_dims.get(k, tagged_shape[k]), tagged_shape[k])
+            block_shape = tuple(tagged_shape.values())
+        self._opCache.BlockShape.setValue(block_shape)
+        self._opBigRegionCache.BlockShape.setValue(block_shape)
+        self._opSmallRegionCache.BlockShape.setValue(block_shape)
+        # These labels come from the global labeling
+        self._opFilteredSmallLabelsCache.BlockShape.setValue(full_shape)
 
     def execute(self, slot, subindex, roi, result):
         assert False, "Shouldn't get here..."
@@ -517,6 +563,7 @@ class _OpThresholdTwoLevels(Operator):
 class _OpCacheWrapper(Operator):
     name = "OpCacheWrapper"
     Input = InputSlot()
+    BlockShape3dDict = InputSlot(optional=True) # If set, the input can be cached in blocks of this size
 
     Output = OutputSlot()
 
@@ -562,7 +609,11 @@ class _OpCacheWrapper(Operator):
         tagged_shape['t'] = 1
         tagged_shape['c'] = 1
         cacheshape = map(lambda k: tagged_shape[k], 'xyzct')
-        if _labeling_impl == "lazy":
+        if self.BlockShape3dDict.ready():
+            block_dims = self.BlockShape3dDict.value
+            blockshape = [min(block_dims.get(k, s), s)
+                          for k, s in zip('xyzct', cacheshape)]
+        elif _labeling_impl == "lazy":
             #HACK hardcoded block shape
             blockshape = numpy.minimum(cacheshape, 256)
         else:
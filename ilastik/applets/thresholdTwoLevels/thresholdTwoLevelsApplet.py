@@ -30,6 +30,11 @@ class ThresholdTwoLevelsApplet( StandardApplet ):
     def __init__( self, workflow, guiName, projectFileGroupName ):
         super(self.__class__, self).__init__( guiName, workflow )
         self._serializableItems = [ ThresholdTwoLevelsSerializer(self.topLevelOperator, projectFileGroupName) ]
+
+        # Report the progress of each lane's object segmentation (graph cut)
+        def subscribeLaneProgress(slot, index, *args):
+            self.topLevelOperator.innerOperators[index].progressSignal.subscribe(self.progressSignal.emit)
+        self.topLevelOperator.InputImage.notifyInserted(subscribeLaneProgress)
         
     @property
     def singleLaneOperatorClass(self):
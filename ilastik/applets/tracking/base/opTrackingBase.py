@@ -19,7 +19,9 @@
 # http://ilastik.org/license.html
 # ##############################################################################
 from functools import partial
+import collections
 import logging
+import time
 
 import numpy as np
 
@@ -28,7 +30,7 @@ from ilastik.utility.exportingOperator import ExportingOperator
 from lazyflow.rtype import List
 from lazyflow.stype import Opaque
 import pgmlink
-from ilastik.applets.tracking.base.trackingUtilities import relabel, \
+from ilastik.applets.tracking.base.trackingUtilities import relabelTable, applyRelabelTable, \
     get_dict_value
 from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
 from ilastik.applets.objectExtraction import config
@@ -68,11 +70,18 @@ class OpTrackingBase(Operator, ExportingOperator):
         super(OpTrackingBase, self).__init__(parent=parent, graph=graph)
         self.label2color = []
         self.mergers = []
+        # Per-frame lookup tables built from label2color and mergers (see relabelTable),
+        # rebuilt whenever label2color changes.
+        self._label2colorTables = {}
+        self._mergerTables = {}
 
         self.track_id = None
         self.extra_track_ids = None
         self.divisions = None
 
+        # Seconds spent in each stage of the last _generate_traxelstore() call
+        self.traxelstore_timings = None
+
         self._opCache = OpCompressedCache(parent=self)
         self._opCache.InputHdf5.connect(self.InputHdf5)
         self._opCache.Input.connect(self.Output)
@@ -144,7 +153,7 @@ class OpTrackingBase(Operator, ExportingOperator):
             for t in range(t_start, t_end):
                 if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][
                     0]) and len(self.label2color) > t:
-                    result[t - t_start, ..., 0] = relabel(result[t - t_start, ..., 0], self.label2color[t])
+                    result[t - t_start, ..., 0] = applyRelabelTable(result[t - t_start, ..., 0], self._getLabel2ColorTable(t))
                 else:
                     result[t - t_start, ...] = 0
             return result
@@ -166,6 +175,18 @@ class OpTrackingBase(Operator, ExportingOperator):
             return result
 
 
+    def _getLabel2ColorTable(self, t):
+        table = self._label2colorTables.get(t)
+        if table is None:
+            table = self._label2colorTables[t] = relabelTable(self.label2color[t], default=1)
+        return table
+
+    def _getMergerTable(self, t):
+        table = self._mergerTables.get(t)
+        if table is None:
+            table = self._mergerTables[t] = relabelTable(self.mergers[t], default=1)
+        return table
+
     def propagateDirty(self, inputSlot, subindex, roi):
         if inputSlot is self.LabelImage:
             self.Output.setDirty(roi)
@@ -331,6 +352,8 @@ class OpTrackingBase(Operator, ExportingOperator):
 
         self.label2color = label2color
         self.mergers = mergers
+        self._label2colorTables = {}
+        self._mergerTables = {}
 
         self.Output._value = None
         self.Output.setDirty(slice(None))
@@ -392,8 +415,12 @@ class OpTrackingBase(Operator, ExportingOperator):
         parameters['z_range'] = z_range
         parameters['size_range'] = size_range
 
+        # Seconds spent in each stage (see traxelstore_timings)
+        timings = collections.OrderedDict((stage, 0.0) for stage in ['fetch features', 'filter', 'build traxels', 'coordinate lists'])
+
         logger.info("generating traxels")
         logger.info("fetching region features and division probabilities")
+        stage_start = time.time()
         feats = self.ObjectFeatures(time_range).wait()
 
         if with_div:
@@ -408,6 +435,7 @@ class OpTrackingBase(Operator, ExportingOperator):
             if not self.DetectionProbabilities.ready() or len(self.DetectionProbabilities([0]).wait()[0]) == 0:
                 raise Exception, "Classifier not yet ready. Did you forget to train the Object Count Classifier?"
             detProbs = self.DetectionProbabilities(time_range).wait()
+        timings['fetch features'] += time.time() - stage_start
 
         logger.info("filling traxelstore")
         ts = pgmlink.TraxelStore()
@@ -418,6 +446,7 @@ class OpTrackingBase(Operator, ExportingOperator):
         total_count = 0
         empty_frame = False
         for t in feats.keys():
+            stage_start = time.time()
             rc = feats[t][default_features_key]['RegionCenter']
             lower = feats[t][default_features_key]['Coord<Minimum>']
             upper = feats[t][default_features_key]['Coord<Maximum>']
@@ -425,6 +454,8 @@ class OpTrackingBase(Operator, ExportingOperator):
                 rc = rc[1:, ...]
                 lower = lower[1:, ...]
                 upper = upper[1:, ...]
+            else:
+                rc = rc.reshape((0, 3))
 
             if with_opt_correction:
                 try:
@@ -437,62 +468,72 @@ class OpTrackingBase(Operator, ExportingOperator):
             ct = feats[t][default_features_key]['Count']
             if ct.size:
                 ct = ct[1:, ...]
-
-            logger.info("at timestep {}, {} traxels found".format(t, rc.shape[0]))
-            count = 0
-            filtered_labels_at = []
-            for idx in range(rc.shape[0]):
-                # for 2d data, set z-coordinate to 0:
-                if len(rc[idx]) == 2:
-                    x, y = rc[idx]
-                    z = 0
-                elif len(rc[idx]) == 3:
-                    x, y, z = rc[idx]
-                else:
-                    raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
-                size = ct[idx]
-                if (x < x_range[0] or x >= x_range[1] or
-                            y < y_range[0] or y >= y_range[1] or
-                            z < z_range[0] or z >= z_range[1] or
-                            size < size_range[0] or size >= size_range[1]):
-                    filtered_labels_at.append(int(idx + 1))
-                    continue
-                else:
-                    count += 1
+            sizes = np.asarray(ct, dtype=np.float64).reshape(-1)
+
+            num_objects = rc.shape[0]
+            logger.info("at timestep {}, {} traxels found".format(t, num_objects))
+            if rc.shape[1] not in (2, 3):
+                raise Exception, "The RegionCenter feature must have dimensionality 2 or 3."
+
+            # pgmlink expects always 3 coordinates, z=0 for 2d data
+            com = np.zeros((num_objects, 3), dtype=np.float64)
+            com[:, :rc.shape[1]] = rc
+
+            # Apply the roi and size filters to all objects at once
+            x, y, z = com.T
+            passed = ((x >= x_range[0]) & (x < x_range[1]) &
+                      (y >= y_range[0]) & (y < y_range[1]) &
+                      (z >= z_range[0]) & (z < z_range[1]) &
+                      (sizes >= size_range[0]) & (sizes < size_range[1]))
+            filtered_labels_at = (np.flatnonzero(~passed) + 1).tolist()
+            indexes = np.flatnonzero(passed)
+            count = len(indexes)
+
+            # Gather the features of the remaining objects into contiguous arrays,
+            # and convert them to Python floats once per time step (instead of once per value).
+            ids = (indexes + 1).tolist()
+            com_values = com[indexes].tolist()
+            size_values = sizes[indexes].tolist()
+            if with_opt_correction:
+                com_corrected = np.zeros((num_objects, 3), dtype=np.float64)
+                com_corrected[:, :rc_corr.shape[1]] = rc_corr
+                com_corrected_values = com_corrected[indexes].tolist()
+            if with_div:
+                # idx+1 because rc and ct start from 1, divProbs starts from 0
+                div_values = np.asarray(divProbs[t], dtype=np.float64)[indexes + 1, 1].tolist()
+            if with_classifier_prior:
+                det_values = np.asarray(detProbs[t], dtype=np.float64)[indexes + 1].tolist()
+            if median_object_size is not None:
+                obj_sizes.extend(size_values)
+            timings['filter'] += time.time() - stage_start
+
+            stage_start = time.time()
+            coordinate_list_seconds = 0.0
+            for n, idx in enumerate(indexes):
                 tr = pgmlink.Traxel()
                 tr.set_x_scale(x_scale)
                 tr.set_y_scale(y_scale)
                 tr.set_z_scale(z_scale)
-                tr.Id = int(idx + 1)
+                tr.Id = ids[n]
                 tr.Timestep = t
 
-                # pgmlink expects always 3 coordinates, z=0 for 2d data
                 tr.add_feature_array("com", 3)
-                for i, v in enumerate([x, y, z]):
-                    tr.set_feature_value('com', i, float(v))
+                for i, v in enumerate(com_values[n]):
+                    tr.set_feature_value('com', i, v)
 
                 if with_opt_correction:
                     tr.add_feature_array("com_corrected", 3)
-                    for i, v in enumerate(rc_corr[idx]):
-                        tr.set_feature_value("com_corrected", i, float(v))
-                    if len(rc_corr[idx]) == 2:
-                        tr.set_feature_value("com_corrected", 2, 0.)
+                    for i, v in enumerate(com_corrected_values[n]):
+                        tr.set_feature_value("com_corrected", i, v)
 
                 if with_div:
                     tr.add_feature_array("divProb", 1)
-                    # idx+1 because rc and ct start from 1, divProbs starts from 0
-                    tr.set_feature_value("divProb", 0, float(divProbs[t][idx + 1][1]))
+                    tr.set_feature_value("divProb", 0, div_values[n])
 
                 if with_classifier_prior:
-                    tr.add_feature_array("detProb", len(detProbs[t][idx + 1]))
-                    for i, v in enumerate(detProbs[t][idx + 1]):
-                        val = float(v)
-                        if val < 0.0000001:
-                            val = 0.0000001
-                        if val > 0.99999999:
-                            val = 0.99999999
-                        tr.set_feature_value("detProb", i, float(v))
-
+                    tr.add_feature_array("detProb", len(det_values[n]))
+                    for i, v in enumerate(det_values[n]):
+                        tr.set_feature_value("detProb", i, v)
 
                 # FIXME: check whether it is 2d or 3d data!
                 if with_local_centers:
@@ -505,15 +546,14 @@ class OpTrackingBase(Operator, ExportingOperator):
                         tr.set_feature_value("localCentersZ", i, float(v[2]))
 
                 tr.add_feature_array("count", 1)
-                tr.set_feature_value("count", 0, float(size))
-                if median_object_size is not None:
-                    obj_sizes.append(float(size))
+                tr.set_feature_value("count", 0, size_values[n])
 
                 ts.add(tr)
 
                 # add coordinate lists
 
                 if with_coordinate_list and coordinate_map is not None:  # store coordinates in arma::mat
+                    coordinate_list_start = time.time()
                     # generate roi: assume the following order: txyzc
                     n_dim = len(rc[idx])
                     roi = [0] * 5
@@ -533,11 +573,14 @@ class OpTrackingBase(Operator, ExportingOperator):
                         raise Exception, "n_dim = %s instead of 2 or 3"
 
                     pgmlink.extract_coordinates(coordinate_map, image_excerpt, lower[idx].astype(np.int64), tr)
+                    coordinate_list_seconds += time.time() - coordinate_list_start
+            timings['coordinate lists'] += coordinate_list_seconds
+            timings['build traxels'] += time.time() - stage_start - coordinate_list_seconds
 
             if len(filtered_labels_at) > 0:
                 filtered_labels[str(int(t) - time_range[0])] = filtered_labels_at
             logger.info("at timestep {}, {} traxels passed filter".format(t, count))
-            max_traxel_id_at.append(int(rc.shape[0]))
+            max_traxel_id_at.append(int(num_objects))
             if count == 0:
                 empty_frame = True
 
@@ -547,6 +590,10 @@ class OpTrackingBase(Operator, ExportingOperator):
             median_object_size[0] = np.median(np.array(obj_sizes), overwrite_input=True)
             logger.info('median object size = ' + str(median_object_size[0]))
 
+        self.traxelstore_timings = timings
+        logger.info("traxelstore with {} traxels generated. Seconds per stage: {}".format(
+            total_count, ", ".join("{}: {:.2f}".format(stage, seconds) for stage, seconds in timings.items())))
+
         self.FilteredLabels.setValue(filtered_labels, check_changed=False)
 
         return ts, empty_frame
@@ -33,7 +33,7 @@ import numpy as np
 import vigra
 import h5py
 from ilastik.applets.labeling.labelingGui import LabelingGui
-from ilastik.applets.tracking.base.trackingUtilities import relabel,write_events
+from ilastik.applets.tracking.base.trackingUtilities import relabel,write_events,SingleFileEventWriter
 from volumina.layer import GrayscaleLayer
 from volumina.utility import encode_from_qstring
 from ilastik.applets.layerViewer.layerViewerGui import LayerViewerGui
@@ -267,15 +267,39 @@ class TrackingBaseGui( LayerViewerGui ):
         if ilastik_config.getboolean("ilastik", "debug"):
             options |= QFileDialog.DontUseNativeDialog
 
-        directory = encode_from_qstring(QFileDialog.getExistingDirectory(self, 'Select Directory',os.path.expanduser("~"), options=options))
-
-        if directory is None or len(str(directory)) == 0:
+        reply = QMessageBox.question(self, "Export Tracking Results",
+                                     "Export all frames into a single HDF5 file?\n"
+                                     "(Choose 'No' to write one file per frame.)",
+                                     QMessageBox.Yes | QMessageBox.No | QMessageBox.Cancel, QMessageBox.Yes)
+        if reply == QMessageBox.Cancel:
             logger.info( "cancelled." )
             return
+        single_file = (reply == QMessageBox.Yes)
+
+        if single_file:
+            filename = encode_from_qstring(QFileDialog.getSaveFileName(self, 'Export Tracking Results',
+                                                                       os.path.expanduser("~") + "/tracking.h5",
+                                                                       "HDF5 files (*.h5)", options=options))
+            if filename is None or len(str(filename)) == 0:
+                logger.info( "cancelled." )
+                return
+        else:
+            directory = encode_from_qstring(QFileDialog.getExistingDirectory(self, 'Select Directory',os.path.expanduser("~"), options=options))
+
+            if directory is None or len(str(directory)) == 0:
+                logger.info( "cancelled." )
+                return
 
         def _handle_progress(x):
             self.applet.progressSignal.emit(x)
 
+        def _getLabelImage(key, t):
+            key = list(key)
+            key[0] = slice(t,t+1)
+            roi = SubRegion(self.mainOperator.LabelImage, key)
+            labelImage = self.mainOperator.LabelImage.get(roi).wait()
+            return labelImage[0,...,0]
+
         def _export():
             self.applet.busy = True
             self.applet.appletStateUpdateRequested.emit()
@@ -309,6 +333,14 @@ class TrackingBaseGui( LayerViewerGui ):
             labelImage = self.mainOperator.LabelImage.get(roi).wait()
             labelImage = labelImage[0,...,0]
 
+            if single_file:
+                events = self.mainOperator.EventsVector.value
+                logger.info( "Saving {} frames to {}...".format( len(events), filename ) )
+                num_frames = max( int(i) for i in events.keys() ) + 1 if len(events) else 0
+                writer = SingleFileEventWriter( str(filename), labelImage.shape, t_from, num_frames )
+                writer.run( events, partial(_getLabelImage, key), _handle_progress )
+                return
+
             try:
                 # write_events([], str(directory), t_from, labelImage)
 
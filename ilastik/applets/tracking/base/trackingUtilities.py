@@ -18,40 +18,45 @@
 # on the ilastik web site at:
 #		   http://ilastik.org/license.html
 ###############################################################################
+import functools
+
 import h5py
 import numpy as np
 import os.path as path
 import pgmlink
 
+from lazyflow.request import Request
+
 import logging
 logger = logging.getLogger(__name__)
 
+def relabelTable(replace, default=1):
+    """
+    Build a lookup table for applyRelabelTable() from a dict of label -> new label.
+    Labels that are not in the dict are mapped to 'default', the background (0) stays 0.
+
+    The table has one extra entry (the default) at the end, which is used for all labels
+    larger than the largest key.
+    """
+    items = [(k, v) for k, v in replace.iteritems() if k > 0]
+    keys = np.fromiter((k for k, v in items), dtype=np.int64, count=len(items))
+    values = np.fromiter((v for k, v in items), dtype=np.int64, count=len(items))
+    table = np.empty(keys.max() + 2 if len(keys) else 2, dtype=np.int64)
+    table[:] = default
+    table[0] = 0
+    table[keys] = values
+    return table
+
+def applyRelabelTable(volume, table):
+    """Relabel the volume with a table from relabelTable(), in a single gather."""
+    return np.take(table, volume, mode='clip').astype(volume.dtype, copy=False)
+
 def relabel(volume, replace):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
-    mp[1:] = 1
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            try:
-                r = replace[label]
-                mp[label] = r
-            except:                
-                pass
-#    mp[replace.keys()] = replace.values()
-    return mp[volume]
+    return applyRelabelTable(volume, relabelTable(replace, default=1))
     
     
 def relabelMergers(volume, merger):
-    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)    
-    mp[:] = 0
-    labels = np.unique(volume)
-    for label in labels:
-        if label > 0:
-            if label in merger:
-                mp[label] = merger[label]
-            else:
-                mp[label] = 1
-    return mp[volume]
+    return applyRelabelTable(volume, relabelTable(merger, default=1))
 
 def get_dict_value(dic, key, default=[]):
     if key not in dic:
@@ -180,6 +185,124 @@ def write_events(events_at, directory, t, labelImage, mergers=None):
 
     
 
+# Event tables of the tracking export: events_at key -> (dataset name, format description, dtype)
+EVENT_TABLES = [ ("app", "Appearances", "cell label appeared in current file", np.uint32),
+                 ("dis", "Disappearances", "cell label disappeared in current file", np.uint32),
+                 ("mov", "Moves", "from (previous file), to (current file)", np.uint32),
+                 ("div", "Splits", "ancestor (previous file), descendant (current file), descendant (current file)", np.uint32),
+                 ("merger", "Mergers", "descendant (current file), number of objects", np.uint32),
+                 ("multiMove", "MultiFrameMoves", "from (given by timestep), to (current file), timestep", np.int32) ]
+
+class SingleFileEventWriter(object):
+    """
+    Writes the tracking results of all frames into one chunked HDF5 file,
+    instead of one file per frame (see write_events()):
+
+    - /segmentation/labels: a 4D dataset (t, x, y, z), chunked per frame.
+      Its 'time_offset' attribute holds the time step of the first frame.
+    - /tracking/<Event>, /tracking/<Event>-Energy and /tracking/<Event>-Time for each event type
+      (e.g. Moves), with the same columns as in the per-frame files, plus the time step of each row.
+      Rows are sorted by time step, and the tables are resizable, so more rows can be appended later.
+
+    Label images are requested in parallel (on the lazyflow request pool), a window of frames at a time,
+    and written by the calling thread (HDF5 doesn't allow concurrent writes).
+
+    Usage:
+
+    >>> writer = SingleFileEventWriter( filename, label_shape, t_from, num_frames )
+    >>> writer.run( events, getLabelImage )
+    """
+
+    # Number of label images requested at once
+    MAX_PENDING_FRAMES = 8
+
+    def __init__(self, filename, label_shape, time_offset, num_frames):
+        """
+        :param label_shape: The (x, y, z) shape of each frame's label image.
+        :param time_offset: The time step of the first frame.
+        """
+        self.filename = filename
+        self.label_shape = tuple(label_shape)
+        self.time_offset = time_offset
+        self.num_frames = num_frames
+
+    def run(self, events, getLabelImage, progressCallback=None):
+        """
+        Export all frames.
+
+        :param events: A dict of frame index (relative to time_offset, int or str) -> events_at (see get_events_at())
+        :param getLabelImage: A function that returns the (x, y, z) label image of a time step.
+                              It is called from several threads at once.
+        :param progressCallback: Called with the overall progress (0-100), if provided.
+        """
+        progressCallback = progressCallback or (lambda progress: None)
+        frames = sorted( int(i) for i in events.keys() )
+        events_by_frame = dict( (int(i), events_at) for i, events_at in events.iteritems() )
+
+        with h5py.File( self.filename, 'w' ) as f:
+            chunks = (1,) + tuple( min(s, 64) for s in self.label_shape )
+            labels_ds = f.create_dataset( "segmentation/labels",
+                                          shape=(self.num_frames,) + self.label_shape,
+                                          dtype=np.uint32,
+                                          chunks=chunks,
+                                          compression=1 )
+            labels_ds.attrs["time_offset"] = self.time_offset
+
+            # Request the label images in windows of MAX_PENDING_FRAMES frames.
+            # While one window is being written, the next one is computed.
+            # (No request ever blocks on the writer, so the lazyflow workers stay free.)
+            written = 0
+            previous_window = window = []
+            try:
+                for window_start in range( 0, len(frames), self.MAX_PENDING_FRAMES ):
+                    window = [ (i, Request( functools.partial( getLabelImage, self.time_offset + i ) ))
+                               for i in frames[window_start:window_start+self.MAX_PENDING_FRAMES] ]
+                    for _, req in window:
+                        req.submit()
+                    written = self._writeFrames( labels_ds, previous_window, written, len(frames), progressCallback )
+                    previous_window = window
+                self._writeFrames( labels_ds, previous_window, written, len(frames), progressCallback )
+            except:
+                for _, req in previous_window + window:
+                    req.cancel()
+                raise
+
+            self._writeEventTables( f, frames, events_by_frame )
+
+    def _writeFrames(self, labels_ds, window, written, num_frames, progressCallback):
+        """
+        Wait for the label images of a window of frames and write them.
+        Returns the number of frames written so far.
+        """
+        for i, req in window:
+            labels_ds[i] = req.wait()
+            written += 1
+            progressCallback( 100.0 * written / max(1, num_frames) )
+        return written
+
+    def _writeEventTables(self, f, frames, events_by_frame):
+        tg = f.create_group("tracking")
+        for key, name, description, dtype in EVENT_TABLES:
+            rows = []
+            times = []
+            for i in frames:
+                table = get_dict_value( events_by_frame[i], key, [] )
+                if len(table):
+                    rows.append( table )
+                    times.append( np.repeat( self.time_offset + i, len(table) ) )
+            if not rows:
+                continue
+            rows = np.concatenate( rows )
+            ds = tg.create_dataset(name, data=rows[:, :-1], dtype=dtype,
+                                   maxshape=(None, rows.shape[1]-1), chunks=True, compression=1)
+            ds.attrs["Format"] = description
+            ds = tg.create_dataset(name + "-Energy", data=rows[:, -1], dtype=np.double,
+                                   maxshape=(None,), chunks=True, compression=1)
+            ds.attrs["Format"] = "lower energy -> higher confidence"
+            ds = tg.create_dataset(name + "-Time", data=np.concatenate( times ), dtype=np.uint32,
+                                   maxshape=(None,), chunks=True, compression=1)
+            ds.attrs["Format"] = "time step of each row in " + name
+
 class LineageTrees():
 
     def createLineageTrees(self, fn=None, width=None, height=None, circular=False, withAppearing=True, from_t=0, to_t=0):
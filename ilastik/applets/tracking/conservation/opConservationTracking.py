@@ -3,7 +3,7 @@ from lazyflow.rtype import List
 from lazyflow.stype import Opaque
 import pgmlink
 from ilastik.applets.tracking.base.opTrackingBase import OpTrackingBase
-from ilastik.applets.tracking.base.trackingUtilities import relabelMergers
+from ilastik.applets.tracking.base.trackingUtilities import applyRelabelTable
 from ilastik.applets.tracking.base.trackingUtilities import get_events
 from lazyflow.operators.opCompressedCache import OpCompressedCache
 from lazyflow.roi import sliceToRoi
@@ -50,7 +50,7 @@ class OpConservationTracking(OpTrackingBase):
             trange = range(roi.start[0], roi.stop[0])
             for t in trange:
                 if ('time_range' in parameters and t <= parameters['time_range'][-1] and t >= parameters['time_range'][0] and len(self.mergers) > t and len(self.mergers[t])):
-                    result[t-roi.start[0],...,0] = relabelMergers(result[t-roi.start[0],...,0], self.mergers[t])
+                    result[t-roi.start[0],...,0] = applyRelabelTable(result[t-roi.start[0],...,0], self._getMergerTable(t))
                 else:
                     result[t-roi.start[0],...][:] = 0
             
@@ -34,12 +34,17 @@ ClusterConfigFields = \
     "task_threadpool_size" : AutoEval(int),
     "task_total_ram_mb" : AutoEval(int),
     "task_timeout_secs" : AutoEval(int),
+    "task_blocks_per_task" : AutoEval(int),
     "use_node_local_scratch" : bool,
     "use_master_local_scratch" : bool,
     "node_output_compression_cmd" :   FormattedField( requiredFields=["compressed_file", "uncompressed_file"]),
     "node_output_decompression_cmd" : FormattedField( requiredFields=["compressed_file", "uncompressed_file"]),
     "task_progress_update_command" : FormattedField( requiredFields=["progress"] ),
-    "task_launch_server" : str,
+    "task_launch_server" : str,         # A host name, "localhost", or "local_process_pool"
+    "local_pool_size" : AutoEval(int),  # Number of concurrent local tasks ("local_process_pool": defaults to the number of cores, "localhost": 1)
+    "monitor_task_progress" : bool,
+    "task_max_retries" : AutoEval(int),
+    "task_monitor_interval_secs" : AutoEval(int),
     "output_log_directory" : str,
     "server_working_directory" : str,
     "command_format" : FormattedField( requiredFields=["task_args"], optionalFields=["task_name"] ),
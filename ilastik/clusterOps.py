@@ -20,7 +20,11 @@
 ###############################################################################
 import os
 import copy
+import time
+import Queue
+import threading
 import subprocess
+import multiprocessing
 import collections
 import hashlib
 import functools
@@ -31,6 +35,7 @@ from lazyflow.rtype import Roi, SubRegion
 from lazyflow.graph import Operator, InputSlot, OutputSlot, OrderedSignal
 from lazyflow.utility import BigRequestStreamer
 from lazyflow.utility.io.blockwiseFileset import BlockwiseFileset
+from lazyflow.utility.fileLock import FileLock
 from lazyflow.utility.timer import Timer
 from lazyflow.utility.pathHelpers import getPathVariants
 
@@ -82,31 +87,46 @@ class OpTaskWorker(Operator):
         assert set(inputAxes) == set(outputAxes), \
             "Output dataset has the wrong set of axes.  Input axes: {}, Output axes: {}".format( "".join(inputAxes), "".join(outputAxes) )
         
-        roiString = self.RoiString.value
-        roi = Roi.loads(roiString)
-        if len( roi.start ) != len( self.Input.meta.shape ):
-            assert False, "Task roi: {} is not valid for this input.  Did the master launch this task correctly?".format( roiString )
-
-        logger.info( "Executing for roi: {}".format(roi) )
+        # A task may have been assigned several blocks (see OpClusterize.ROI_SEPARATOR)
+        roiStrings = self.RoiString.value.split( OpClusterize.ROI_SEPARATOR )
+        rois = map( Roi.loads, roiStrings )
+        for roiString, roi in zip( roiStrings, rois ):
+            if len( roi.start ) != len( self.Input.meta.shape ):
+                assert False, "Task roi: {} is not valid for this input.  Did the master launch this task correctly?".format( roiString )
 
         if config.use_node_local_scratch:
             assert False, "FIXME."
 
-        assert (blockwiseFileset.getEntireBlockRoi( roi.start )[1] == roi.stop).all(), "Each task must execute exactly one full block.  ({},{}) is not a valid block roi.".format( roi.start, roi.stop )
+        for roi in rois:
+            assert (blockwiseFileset.getEntireBlockRoi( roi.start )[1] == roi.stop).all(), "Each task roi must be exactly one full block.  ({},{}) is not a valid block roi.".format( roi.start, roi.stop )
         assert self.Input.ready()
 
-        with Timer() as computeTimer:
-            # Stream the data out to disk.
-            request_blockshape = self._primaryBlockwiseFileset.description.sub_block_shape # Could be None.  That's okay.
-            streamer = BigRequestStreamer(self.Input, (roi.start, roi.stop), request_blockshape )
-            streamer.progressSignal.subscribe( self.progressSignal )
-            streamer.resultSignal.subscribe( self._handlePrimaryResultBlock )
-            streamer.execute()
+        # Stream through our blocks in one process, so the project, classifier, etc. are only loaded once.
+        with Timer() as taskTimer:
+            for blockIndex, roi in enumerate(rois):
+                if blockwiseFileset.getBlockStatus( roi.start ) == BlockwiseFileset.BLOCK_AVAILABLE:
+                    # This block was already finished by a previous attempt of this task.
+                    logger.info( "Skipping completed block: {}".format(roi) )
+                    continue
+
+                logger.info( "Executing for roi: {} (block {}/{})".format(roi, blockIndex+1, len(rois)) )
+                def forwardProgress( progress, blockIndex=blockIndex ):
+                    self.progressSignal( (100.0*blockIndex + progress) / len(rois) )
+
+                with Timer() as computeTimer:
+                    # Stream the data out to disk.
+                    request_blockshape = self._primaryBlockwiseFileset.description.sub_block_shape # Could be None.  That's okay.
+                    streamer = BigRequestStreamer(self.Input, (roi.start, roi.stop), request_blockshape )
+                    streamer.progressSignal.subscribe( forwardProgress )
+                    streamer.resultSignal.subscribe( self._handlePrimaryResultBlock )
+                    streamer.execute()
+        
+                    # Now the block is ready.  Update the status.
+                    blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
 
-            # Now the block is ready.  Update the status.
-            blockwiseFileset.setBlockStatus( roi.start, BlockwiseFileset.BLOCK_AVAILABLE )
+                logger.info( "Finished block in {} seconds".format( computeTimer.seconds() ) )
 
-        logger.info( "Finished task in {} seconds".format( computeTimer.seconds() ) )
+        logger.info( "Finished task in {} seconds".format( taskTimer.seconds() ) )
         result[0] = True
         return result
 
@@ -134,10 +154,20 @@ class OpClusterize(Operator):
     
     ReturnCode = OutputSlot()
 
+    # Separates the block rois in a task's --_node_work_ argument
+    ROI_SEPARATOR = ';'
+
+    # Special value for the task_launch_server config setting:
+    # Run the tasks in a bounded pool of local processes (see LocalTaskPool).
+    LOCAL_PROCESS_POOL = "local_process_pool"
+
     class TaskInfo():
         taskName = None
         command = None
-        subregion = None
+        blockRois = None    # List of (start, stop) block rois computed by this task
+        attempts = 0        # Number of times this task has been launched
+        launchTime = None   # Time of the most recent launch
+        handle = None       # Launch handle with a poll() method (e.g. a Popen), or None if the task can't be polled
         
     def setupOutputs(self):
         self.ReturnCode.meta.dtype = bool
@@ -153,29 +183,36 @@ class OpClusterize(Operator):
         self._config = parseClusterConfigFile( configFilePath )
 
         # Create the destination file if necessary
-        blockwiseFileset, taskInfos = self._prepareDestination()
+        blockwiseFileset, blockRois = self._prepareDestination()
 
         try:
             # Figure out which work doesn't need to be recomputed (if any)
-            unneeded_rois = []
-            for roi in taskInfos.keys():
+            neededRois = []
+            for roi in blockRois:
                 if blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE \
                 or blockwiseFileset.isBlockLocked(roi[0]): # We don't attempt to process currently locked blocks.
-                    unneeded_rois.append( roi )
-    
-            # Remove any tasks that we don't need to compute (they were finished in a previous run)
-            for roi in unneeded_rois:
-                logger.info( "No need to run task: {} for roi: {}".format( taskInfos[roi].taskName, roi ) )
-                del taskInfos[roi]
+                    # No need to compute this block (it was finished in a previous run)
+                    logger.info( "No need to compute block: {}".format( roi ) )
+                else:
+                    neededRois.append( roi )
+
+            taskInfos = self._prepareTaskInfos( neededRois, blockwiseFileset.description.block_shape )
 
             absWorkDir, _ = getPathVariants(self._config.server_working_directory, os.path.split( configFilePath )[0] )
-            if self._config.task_launch_server == "localhost":
-                def localCommand( cmd ):
-                    cwd = os.getcwd()
-                    os.chdir( absWorkDir )
-                    subprocess.call( cmd, shell=True )
-                    os.chdir( cwd )
-                launchFunc = localCommand
+            localPool = None
+            if self._config.task_launch_server == OpClusterize.LOCAL_PROCESS_POOL:
+                localPool = LocalTaskPool( absWorkDir,
+                                           self._config.local_pool_size,
+                                           self._config.task_threadpool_size,
+                                           self._config.task_total_ram_mb )
+                launchFunc = localPool.launch
+            elif self._config.task_launch_server == "localhost":
+                # Each task loads the whole project, so by default they run one at a time.
+                localPool = LocalTaskPool( absWorkDir,
+                                           self._config.local_pool_size or 1,
+                                           self._config.task_threadpool_size,
+                                           self._config.task_total_ram_mb )
+                launchFunc = localPool.launch
             else:
                 # We use fabric for executing remote tasks
                 # Import it here because it isn't required that the nodes can use it.
@@ -184,35 +221,67 @@ class OpClusterize(Operator):
                 def remoteCommand( cmd ):
                     with fab.cd( absWorkDir ):
                         fab.run( cmd )
-                launchFunc = functools.partial( fab.execute, remoteCommand )
-    
-            # Spawn each task
-            for taskInfo in taskInfos.values():
-                logger.info("Launching node task: " + taskInfo.command )
-                launchFunc( taskInfo.command )
-        
-            # Return immediately.  We do not attempt to monitor the task progress.
-            result[0] = True
+                def remoteLaunch( cmd ):
+                    fab.execute( remoteCommand, cmd )
+                    return None # The remote task can't be polled directly.
+                launchFunc = remoteLaunch
+
+            if not self._config.monitor_task_progress:
+                # Spawn each task
+                for taskInfo in taskInfos.values():
+                    logger.info("Launching node task: " + taskInfo.command )
+                    launchFunc( taskInfo.command )
+
+                if localPool is not None:
+                    # Our tasks die with us, so we must wait for them.
+                    localPool.wait()
+
+                # Return immediately.  We do not attempt to monitor the task progress.
+                result[0] = True
+                return result
+
+            monitor = ClusterTaskMonitor( blockwiseFileset,
+                                          taskInfos,
+                                          launchFunc,
+                                          max_retries=self._config.task_max_retries or 0,
+                                          poll_interval_secs=self._config.task_monitor_interval_secs or 10,
+                                          task_timeout_secs=self._config.task_timeout_secs )
+            result[0] = monitor.run()
             return result
         finally:
+            if localPool is not None:
+                localPool.shutdown()
             blockwiseFileset.close()
 
-    def _prepareTaskInfos(self, roiList):
+    def _prepareTaskInfos(self, roiList, blockShape):
+        """
+        Divide the given block rois into tasks.
+        If the config specifies ``task_blocks_per_task``, several blocks are packed into each task,
+        so that each task only pays once for process startup, project loading, etc.
+        Blocks are ordered along a Z-order curve before they are packed, so each task works on
+        a compact group of neighboring blocks and their halos overlap.
+        """
+        blocksPerTask = self._config.task_blocks_per_task or 1
+        roiList = [ ( tuple(roi[0]), tuple(roi[1]) ) for roi in roiList ]
+        if blocksPerTask > 1:
+            roiList = sorted( roiList, key=lambda roi: _mortonKey( numpy.array(roi[0]) / blockShape ) )
+        roiGroups = [ roiList[i:i+blocksPerTask] for i in range(0, len(roiList), blocksPerTask) ]
+
         # Divide up the workload into large pieces
-        logger.info( "Dividing into {} node jobs.".format( len(roiList) ) )
+        logger.info( "Dividing {} blocks into {} node jobs.".format( len(roiList), len(roiGroups) ) )
 
         taskInfos = collections.OrderedDict()
-        for roiIndex, roi in enumerate(roiList):
-            roi = ( tuple(roi[0]), tuple(roi[1]) )
+        for roiIndex, roiGroup in enumerate(roiGroups):
             taskInfo = OpClusterize.TaskInfo()
-            taskInfo.subregion = SubRegion( None, start=roi[0], stop=roi[1] )
+            taskInfo.blockRois = roiGroup
+            subregions = [ SubRegion( None, start=roi[0], stop=roi[1] ) for roi in roiGroup ]
             
             taskName = "J{:02}".format(roiIndex)
 
             commandArgs = []
             commandArgs.append( "--option_config_file=" + self.ConfigFilePath.value )
             commandArgs.append( "--project=" + self.ProjectFilePath.value )
-            commandArgs.append( "--_node_work_=\"" + Roi.dumps( taskInfo.subregion ) + "\"" )
+            commandArgs.append( "--_node_work_=\"" + OpClusterize.ROI_SEPARATOR.join( map( Roi.dumps, subregions ) ) + "\"" )
             commandArgs.append( "--process_name={}".format(taskName)  )
             commandArgs.append( "--output_description_file={}".format( self.OutputDatasetDescription.value )  )
 
@@ -230,7 +299,7 @@ class OpClusterize(Operator):
             allArgs = " " + " ".join(commandArgs) + " "
             taskInfo.taskName = taskName
             taskInfo.command = commandFormat.format( task_args=allArgs, task_name=taskName, task_output_file=taskOutputLogPath )
-            taskInfos[roi] = taskInfo
+            taskInfos[taskName] = taskInfo
 
         return taskInfos
 
@@ -288,22 +357,23 @@ class OpClusterize(Operator):
         # Now open the dataset
         blockwiseFileset = BlockwiseFileset( self.OutputDatasetDescription.value )
         
-        taskInfos = self._prepareTaskInfos( blockwiseFileset.getAllBlockRois() )
+        blockRois = blockwiseFileset.getAllBlockRois()
         
         if blockwiseFileset.description.hash_id != originalDescription.hash_id:
             # Something about our blocking scheme changed.
             # Make sure all blocks are marked as NOT available.
             # (Just in case some were left over from a previous run.)
-            for roi in taskInfos.keys():
+            for roi in blockRois:
                 blockwiseFileset.setBlockStatus( roi[0], BlockwiseFileset.BLOCK_NOT_AVAILABLE )
 
-        return blockwiseFileset, taskInfos
+        return blockwiseFileset, blockRois
 
     def _determineCompletedBlocks(self, blockwiseFileset, taskInfos):
         finished_rois = []
-        for roi in taskInfos.keys():
-            if blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE:
-                finished_rois.append( roi )
+        for taskInfo in taskInfos.values():
+            for roi in taskInfo.blockRois:
+                if blockwiseFileset.getBlockStatus(roi[0]) == BlockwiseFileset.BLOCK_AVAILABLE:
+                    finished_rois.append( roi )
         return finished_rois
 
     def propagateDirty(self, slot, subindex, roi):
@@ -323,29 +393,315 @@ class OpClusterize(Operator):
         return dtype().nbytes
 
 
+class ClusterTaskMonitor(object):
+    """
+    Master-side monitoring loop for clusterized tasks.
 
+    Launches every task, then polls the ``BlockwiseFileset`` block status (and the task exit code,
+    if the launch function provides one) until every block is available or has failed too often.
 
+    A task is considered failed if:
+    
+    - its process exited with a nonzero exit code, or exited without marking all of its blocks available
+    - one of its blocks is still locked, but the lock is older than ``task_timeout_secs`` (e.g. the node died)
+    - its blocks have not become available within ``task_timeout_secs`` (per block) of its launch
+
+    Failed tasks are relaunched (after purging any stale lock) up to ``max_retries`` times.
+    (Relaunched tasks skip the blocks they already completed.)
+    A task that is still running (e.g. it timed out) is terminated first, if its handle has a ``terminate()`` method.
+
+    Tasks that can't be polled (e.g. remote tasks) are given ``DEFAULT_TASK_TIMEOUT_SECS`` if no
+    ``task_timeout_secs`` is configured, so a task that dies on its node can't stall the monitor forever.
+
+    :param taskInfos: A dict of ``OpClusterize.TaskInfo`` objects
+    :param launchFunc: Called with a command string.  Returns an object with a ``poll()`` method
+                       (e.g. ``subprocess.Popen``) that returns ``None`` while the task is running
+                       and its exit code afterwards, or ``None`` if the task can't be polled.
+                       If the object has a ``startTime`` attribute, task timeouts are measured from 
+                       that time instead of the launch time (``None`` means the task is still queued).
+    """
+    # Timeout (per block) for tasks that can't be polled, if task_timeout_secs isn't given.
+    DEFAULT_TASK_TIMEOUT_SECS = 60*60
+
+    def __init__(self, blockwiseFileset, taskInfos, launchFunc, max_retries=0, poll_interval_secs=10, task_timeout_secs=None):
+        self._blockwiseFileset = blockwiseFileset
+        self._taskInfos = taskInfos
+        self._launchFunc = launchFunc
+        self._max_retries = max_retries
+        self._poll_interval_secs = poll_interval_secs
+        self._task_timeout_secs = task_timeout_secs
+
+        self.completed_tasks = []
+        self.failed_tasks = []
+        self.relaunch_count = 0
+
+    def run(self):
+        """
+        Launch all tasks and wait for them to finish.
+        Returns True if every block was completed.
+        """
+        self._startTime = time.time()
+        self._initialBlockCount = self._countCompletedBlocks()
+        pending = collections.OrderedDict( self._taskInfos )
+        for taskInfo in pending.values():
+            self._launch( taskInfo )
+
+        while pending:
+            for taskKey, taskInfo in pending.items():
+                if self._isTaskComplete( taskInfo ):
+                    del pending[taskKey]
+                    self.completed_tasks.append( taskKey )
+                    continue
+                failure = self._checkFailure( taskInfo )
+                if failure is None:
+                    continue
+                self._terminate( taskInfo )
+                if taskInfo.attempts <= self._max_retries:
+                    logger.warn( "Task {} failed ({}).  Relaunching (attempt {} of {}).".format(
+                                 taskInfo.taskName, failure, taskInfo.attempts+1, self._max_retries+1 ) )
+                    self.relaunch_count += 1
+                    self._launch( taskInfo )
+                else:
+                    logger.error( "Task {} failed ({}).  Giving up after {} attempts.".format(
+                                  taskInfo.taskName, failure, taskInfo.attempts ) )
+                    del pending[taskKey]
+                    self.failed_tasks.append( taskKey )
+
+            self._reportProgress()
+            if pending:
+                time.sleep( self._poll_interval_secs )
+
+        if self.failed_tasks:
+            logger.error( "{} of {} tasks could not be completed: {}".format( len(self.failed_tasks), len(self._taskInfos), self.failed_tasks ) )
+        return not self.failed_tasks
+
+    def _launch(self, taskInfo):
+        logger.info("Launching node task: " + taskInfo.command )
+        taskInfo.attempts += 1
+        taskInfo.launchTime = time.time()
+        try:
+            taskInfo.handle = self._launchFunc( taskInfo.command )
+        except Exception as ex:
+            # Treat a failed launch like a task that failed immediately.
+            logger.error( "Failed to launch task {}: {}".format( taskInfo.taskName, ex ) )
+            taskInfo.handle = _FinishedTask( -1 )
 
+    def _terminate(self, taskInfo):
+        """
+        Stop a failed task that is still running (or queued), so it can't compete with its relaunch.
+        """
+        handle = taskInfo.handle
+        if handle is not None and handle.poll() is None and hasattr( handle, 'terminate' ):
+            logger.info( "Terminating task {}".format( taskInfo.taskName ) )
+            handle.terminate()
 
+    def _isBlockComplete(self, roi):
+        return self._blockwiseFileset.getBlockStatus( roi[0] ) == BlockwiseFileset.BLOCK_AVAILABLE
 
+    def _isTaskComplete(self, taskInfo):
+        return all( map( self._isBlockComplete, taskInfo.blockRois ) )
 
+    def _countCompletedBlocks(self):
+        return sum( len( filter( self._isBlockComplete, taskInfo.blockRois ) ) for taskInfo in self._taskInfos.values() )
 
+    def _checkFailure(self, taskInfo):
+        """
+        For a task whose blocks are not complete yet, return None if the task is still running,
+        or otherwise a description of why the task is considered failed.
+        """
+        exit_code = None
+        if taskInfo.handle is not None:
+            exit_code = taskInfo.handle.poll()
+        lockedStarts = [ roi[0] for roi in taskInfo.blockRois if self._blockwiseFileset.isBlockLocked( roi[0] ) ]
+        if exit_code is not None and not lockedStarts:
+            # The task may have finished its blocks after we last checked.
+            if self._isTaskComplete( taskInfo ):
+                return None
+            if exit_code != 0:
+                return "exit code {}".format( exit_code )
+            return "exited without completing its blocks"
+
+        timeout = self._task_timeout_secs
+        if timeout is None:
+            if taskInfo.handle is not None:
+                # We'll notice when the process exits.
+                return None
+            timeout = self.DEFAULT_TASK_TIMEOUT_SECS
+        now = time.time()
+        for block_start in lockedStarts:
+            lock = self._getBlockLock( block_start )
+            try:
+                lock_age = now - os.path.getmtime( lock.lockfile )
+            except OSError:
+                # The lock was released in the meantime.
+                continue
+            if lock_age > timeout:
+                logger.warn( "Purging stale lock for block {} ({} seconds old)".format( block_start, int(lock_age) ) )
+                lock.purge()
+                return "stale lock"
+        # Tasks that are queued (not started yet) can't time out.
+        startTime = getattr( taskInfo.handle, 'startTime', taskInfo.launchTime )
+        if not lockedStarts and startTime is not None and now - startTime > timeout * len(taskInfo.blockRois):
+            return "timed out after {} seconds".format( timeout * len(taskInfo.blockRois) )
+        return None
+
+    def _getBlockLock(self, block_start):
+        pathComponents = self._blockwiseFileset.getDatasetPathComponents( block_start )
+        return FileLock( pathComponents.externalPath )
+
+    def _reportProgress(self):
+        num_total = sum( len(taskInfo.blockRois) for taskInfo in self._taskInfos.values() )
+        num_finished = self._countCompletedBlocks()
+        num_remaining = num_total - num_finished
+        elapsed_minutes = (time.time() - self._startTime) / 60.0
+        new_blocks = num_finished - self._initialBlockCount
+        if elapsed_minutes > 0 and new_blocks > 0:
+            blocks_per_minute = new_blocks / elapsed_minutes
+            eta = "{:.1f} minutes".format( num_remaining / blocks_per_minute )
+        else:
+            blocks_per_minute = 0.0
+            eta = "unknown"
+        logger.info( "Cluster progress: {}/{} blocks finished ({} failed tasks, {} relaunches), {:.2f} blocks/minute, ETA: {}"
+                     .format( num_finished, num_total, len(self.failed_tasks), self.relaunch_count, blocks_per_minute, eta ) )
+
+class LocalTaskPool(object):
+    """
+    Runs task commands as subprocesses on the local machine, with at most ``pool_size`` running at once.
+    
+    Each process is told (via the ``LAZYFLOW_THREADS`` and ``LAZYFLOW_TOTAL_RAM_MB`` environment variables)
+    to use its share of the machine's cores and RAM, so the concurrent tasks don't oversubscribe the node.
+    
+    ``launch()`` returns immediately with a handle that can be polled (and terminated) like a ``subprocess.Popen``.
+    """
+    class TaskHandle(object):
+        def __init__(self, command):
+            self.command = command
+            self.startTime = None   # None until the task actually starts
+            self.returncode = None
+            self.finished = threading.Event()
+            self._process = None
+            self._terminated = False
+            self._lock = threading.Lock()
+
+        def poll(self):
+            return self.returncode
+
+        def terminate(self):
+            """
+            Terminate the task's process, or drop the task if it hasn't started yet.
+            """
+            with self._lock:
+                self._terminated = True
+                if self._process is not None and self._process.poll() is None:
+                    self._process.terminate()
+    
+    def __init__(self, working_directory, pool_size=None, threads_per_task=None, ram_mb_per_task=None):
+        """
+        :param pool_size: Number of concurrent tasks.  Defaults to the number of cores.
+        :param threads_per_task: Lazyflow threads for each task.  Defaults to an equal share of the cores.
+        :param ram_mb_per_task: Lazyflow RAM limit for each task.  Defaults to an equal share of the total RAM.
+        """
+        num_cores = multiprocessing.cpu_count()
+        pool_size = pool_size or num_cores
+        if threads_per_task is None:
+            threads_per_task = max(1, num_cores // pool_size)
+        if ram_mb_per_task is None:
+            import psutil
+            ram_mb_per_task = int( psutil.virtual_memory().total / 1e6 / pool_size )
+
+        logger.info( "Running tasks in a local pool of {} processes, each with {} threads and {} MB RAM"
+                     .format( pool_size, threads_per_task, ram_mb_per_task ) )
+
+        self._working_directory = working_directory
+        self._env = dict( os.environ )
+        self._env["LAZYFLOW_THREADS"] = str(threads_per_task)
+        self._env["LAZYFLOW_TOTAL_RAM_MB"] = str(ram_mb_per_task)
+
+        self._queue = Queue.Queue()
+        self._processes = set()
+        self._processes_lock = threading.Lock()
+        self._handles = []
+        self._threads = []
+        for i in range(pool_size):
+            th = threading.Thread( target=self._run_tasks, name="LocalTaskPool-{}".format(i) )
+            th.daemon = True
+            th.start()
+            self._threads.append( th )
+
+    def launch(self, command):
+        handle = LocalTaskPool.TaskHandle( command )
+        self._handles.append( handle )
+        self._queue.put( handle )
+        return handle
+
+    def wait(self):
+        """
+        Block until all launched tasks have finished.
+        """
+        for handle in list(self._handles):
+            handle.finished.wait()
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    def shutdown(self):
+        """
+        Stop the pool.  Queued tasks are dropped and running tasks are terminated.
+        """
+        while True:
+            try:
+                handle = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if handle is not None:
+                handle.returncode = -1
+                handle.finished.set()
+        for th in self._threads:
+            self._queue.put( None )
+        with self._processes_lock:
+            for process in self._processes:
+                if process.poll() is None:
+                    process.terminate()
+
+    def _run_tasks(self):
+        while True:
+            handle = self._queue.get()
+            if handle is None:
+                return
+            try:
+                with handle._lock:
+                    if handle._terminated:
+                        handle.returncode = -1
+                        continue
+                    handle.startTime = time.time()
+                    process = subprocess.Popen( handle.command, shell=True, cwd=self._working_directory, env=self._env )
+                    handle._process = process
+                with self._processes_lock:
+                    self._processes.add( process )
+                handle.returncode = process.wait()
+                with self._processes_lock:
+                    self._processes.remove( process )
+            except Exception as ex:
+                logger.error( "Failed to run local task: {}\n{}".format( handle.command, ex ) )
+                handle.returncode = -1
+            finally:
+                handle.finished.set()
+
+class _FinishedTask(object):
+    """
+    A stand-in launch handle for tasks whose exit code is already known.
+    """
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+def _mortonKey(blockIndex):
+    """
+    Return a sort key that orders the given N-d block index along a Z-order (Morton) curve.
+    Consecutive blocks in that order are spatially close to each other.
+    """
+    key = 0
+    numBits = max( 1, int(max(blockIndex)).bit_length() )
+    for bit in range(numBits):
+        for axis, index in enumerate(blockIndex):
+            key |= ((int(index) >> bit) & 1) << (bit*len(blockIndex) + axis)
+    return key
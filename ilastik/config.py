@@ -31,6 +31,43 @@ Example:
 debug: false
 plugin_directories: ~/.ilastik/plugins,
 logging_config: ~/custom_ilastik_logging_config.json
+
+[feature cache]
+directory: ~/.ilastik/feature_cache
+size_mb: 20000
+
+[prediction cache]
+spill_directory: /tmp/ilastik_prediction_spill
+spill_size_mb: 10000
+
+[cache block shapes]
+feature_block_mb: 200
+feature_slab_thickness: 16
+feature_block_dims: z=8
+prediction_block_mb: 2
+prediction_slab_thickness: 1
+prediction_block_dims:
+
+[autosave]
+interval_minutes: 10
+max_overhead: 0.1
+
+[object extraction]
+feature_block_dims: x=1024, y=1024, z=256
+
+[blockwise object classification]
+max_block_pipelines: 64
+evicted_prediction_directory: /tmp/ilastik_blockwise_predictions
+
+[carving]
+preprocessing_block_dims: x=256, y=256, z=256
+
+[thresholding]
+two_level_block_dims: x=256, y=256, z=256
+
+[raw data cache]
+size_mb: 500
+read_ahead_blocks: 8
 """
 
 default_config = """
@@ -42,6 +79,43 @@ plugin_directories: ~/.ilastik/plugins,
 threads: -1
 total_ram_mb: 0
 
+[feature cache]
+directory:
+size_mb: 0
+
+[prediction cache]
+spill_directory:
+spill_size_mb: 0
+
+[cache block shapes]
+feature_block_mb: 100
+feature_slab_thickness: 32
+feature_block_dims:
+prediction_block_mb: 1
+prediction_slab_thickness: 1
+prediction_block_dims:
+
+[autosave]
+interval_minutes: 0
+max_overhead: 0.1
+
+[object extraction]
+feature_block_dims:
+
+[blockwise object classification]
+max_block_pipelines: 0
+evicted_prediction_directory:
+
+[carving]
+preprocessing_block_dims:
+
+[thresholding]
+two_level_block_dims:
+
+[raw data cache]
+size_mb: 0
+read_ahead_blocks: 0
+
 [ipc raw tcp]
 autostart: false
 autoaccept: true
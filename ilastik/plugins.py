@@ -43,6 +43,10 @@ class ObjectFeaturesPlugin(IPlugin):
 
     name = "Base object features plugin"
 
+    # If True, compute_local() may be called for several objects at the same time (from different threads).
+    # Plugins that keep per-object state on self, or use libraries that aren't thread-safe, must leave this False.
+    thread_safe = False
+
     # TODO for now, only one margin will be set in the dialog. however, it
     # should be repeated for each feature, because in the future it
     # might be different, or each feature might take other parameters.
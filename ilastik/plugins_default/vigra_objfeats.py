@@ -63,6 +63,9 @@ class VigraObjFeats(ObjectFeaturesPlugin):
     local_out_suffixes = [local_suffix, " in object and neighborhood"]
 
     ndim = None
+
+    # compute_local() only calls vigra, so several objects can be processed in parallel.
+    thread_safe = True
     
     def availableFeatures(self, image, labels):
         names = vigra.analysis.supportedRegionFeatures(image, labels)
@@ -1474,10 +1474,27 @@ class IlastikShell(QMainWindow):
 
         snapshotPath = self.getProjectPathToCreate(defaultSnapshot, caption="Create Project Snapshot")
         if snapshotPath is not None:
+            # Capture the unsaved state here (in the GUI thread), so it isn't edited while it is serialized.
             try:
-                self.projectManager.saveProjectSnapshot(snapshotPath)
+                state = self.projectManager.captureProjectSnapshot(snapshotPath)
             except ProjectManager.SaveError, err:
                 QMessageBox.warning(self, "Error Attempting Save Snapshot", str(err))
+                return
+
+            # The snapshot doesn't modify the current project, so the user can keep working while it is written.
+            def saveSnapshot():
+                try:
+                    if not self.projectManager.writeProjectSnapshot(state, snapshotPath):
+                        self.thunkEventHandler.post(partial(QMessageBox.warning, self, "Error Attempting Save Snapshot",
+                                                            "The project was saved while the snapshot was written.  Please try again."))
+                except Exception, err:
+                    log_exception( logger, "Project Save Snapshot Action failed due to the exception printed above." )
+                    self.thunkEventHandler.post(partial(QMessageBox.warning, self, "Error Attempting Save Snapshot", str(err)))
+
+            snapshotThread = threading.Thread(target=saveSnapshot)
+            snapshotThread.start()
+
+            return snapshotThread  # Return the thread so non-gui users (e.g. unit tests) can join it if they want to.
 
     def closeEvent(self, closeEvent):
         """
@@ -0,0 +1,154 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import threading
+import logging
+
+from lazyflow.utility.timer import Timer
+from ilastik.utility import log_exception
+
+logger = logging.getLogger(__name__)
+
+class ProjectAutosaver(object):
+    """
+    Periodically saves a snapshot of the current project in a background thread,
+    if the project has unsaved changes.
+
+    The snapshot is written next to the project file (e.g. MyProject.autosave.ilp for MyProject.ilp).
+    The project file itself is not modified, and the project remains dirty until the user saves it.
+    The unsaved state is captured in the GUI thread (if postToGuiThread is given), so it can't be
+    edited while it is serialized.  Only writing the snapshot file happens in the background.
+    If nothing changed since the last autosave, no new snapshot is written.
+    (That is checked in the background, too.)
+
+    To bound the overhead for large projects, the time between two autosaves is at least
+    ``duration / max_overhead``, where ``duration`` is the time the last autosave took.
+    (With the default max_overhead of 0.1, no more than 10% of the time is spent autosaving.)
+    An autosave is skipped if the user is saving the project at the same time.
+    """
+
+    def __init__(self, projectManager, interval_seconds, max_overhead=0.1, postToGuiThread=None):
+        """
+        :param postToGuiThread: A function that asynchronously calls the given function in the GUI thread,
+                                e.g. ThunkEventHandler.post.  If None, the project state is captured in
+                                the autosave thread.
+        """
+        assert interval_seconds > 0
+        assert 0 < max_overhead <= 1
+        self._projectManager = projectManager
+        self._interval_seconds = interval_seconds
+        self._max_overhead = max_overhead
+        self._postToGuiThread = postToGuiThread
+        self._stopped = threading.Event()
+        self._thread = None
+        self._lastMarker = None # Identifies the project state of the last autosave
+        self.last_duration = None
+
+    @property
+    def autosavePath(self):
+        base, ext = os.path.splitext( self._projectManager.currentProjectPath )
+        return base + ".autosave" + ext
+
+    def start(self):
+        assert self._thread is None, "Autosaver was already started"
+        self._thread = threading.Thread( target=self._run, name="ProjectAutosaver" )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop autosaving.  If an autosave is in progress, wait for it to finish.
+        """
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        wait_seconds = self._interval_seconds
+        while not self._stopped.wait( wait_seconds ):
+            wait_seconds = self._interval_seconds
+            if not self._projectManager.getDirtyAppletNames():
+                continue
+
+            timer = Timer()
+            timer.start()
+            try:
+                saved = self._autosave()
+            except Exception:
+                log_exception( logger, "Autosave failed." )
+                continue
+            timer.stop()
+            if not saved:
+                continue
+
+            self.last_duration = timer.seconds()
+            wait_seconds = max( self._interval_seconds, self.last_duration / self._max_overhead )
+            logger.info( "Autosaved project to {} in {:.1f} seconds.  Next autosave in {:.0f} seconds."
+                         .format( self.autosavePath, self.last_duration, wait_seconds ) )
+
+    def _autosave(self):
+        """
+        Save a snapshot, unless the user is saving or nothing changed since the last autosave.
+        Returns True if a snapshot was written.
+        """
+        state = self._captureState()
+        if state is None:
+            return False
+        if state.marker == self._lastMarker:
+            state.close()
+            logger.debug( "Not autosaving: nothing changed since the last autosave." )
+            return False
+        if not self._projectManager.writeProjectSnapshot( state, self.autosavePath ):
+            return False
+        self._lastMarker = state.marker
+        return True
+
+    def _captureState(self):
+        """
+        Capture the unsaved project state (in the GUI thread, if possible).
+        Returns None if the project is being saved, or if the autosaver was stopped in the meantime.
+        """
+        if self._postToGuiThread is None:
+            return self._projectManager.captureProjectSnapshot( self.autosavePath, wait=False )
+
+        done = threading.Event()
+        result = []
+        def capture():
+            try:
+                # The GUI thread may stop us (e.g. when the project is closed) before it gets here.
+                if not self._stopped.is_set():
+                    result.append( self._projectManager.captureProjectSnapshot( self.autosavePath, wait=False ) )
+            except Exception, ex:
+                result.append( ex )
+            finally:
+                done.set()
+        self._postToGuiThread( capture )
+
+        # Don't block stop() (which is called from the GUI thread) while waiting for the GUI thread.
+        while not done.wait( 0.1 ):
+            if self._stopped.is_set():
+                return None
+        if not result:
+            return None
+        if isinstance( result[0], Exception ):
+            raise result[0]
+        return result[0]
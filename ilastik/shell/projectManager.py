@@ -21,7 +21,12 @@
 import os
 import gc
 import copy
+import shutil
+import tempfile
 import platform
+import threading
+import uuid
+import hashlib
 import h5py
 import logging
 import time
@@ -29,11 +34,62 @@ logger = logging.getLogger(__name__)
 
 import traceback
 
+import numpy
+
 import ilastik
 from ilastik import isVersionCompatible
+from ilastik.config import cfg as ilastik_config
 from ilastik.utility import log_exception
 from ilastik.workflow import getWorkflowFromName
 from lazyflow.utility.timer import Timer, timeLogged
+from projectAutosaver import ProjectAutosaver
+
+class CapturedProjectState(object):
+    """
+    The unsaved state of a project, as captured by ProjectManager.captureProjectSnapshot():
+    The top-level groups of the serialized applets, in an in-memory hdf5 file.
+    """
+    def __init__(self, stateFile, saveGeneration):
+        self.stateFile = stateFile
+        # The project file that the state applies to (see ProjectManager.writeProjectSnapshot())
+        self.saveGeneration = saveGeneration
+        self._marker = None
+
+    @property
+    def marker(self):
+        """
+        Identifies the project state: equal markers mean that the snapshots would be the same.
+        Hashing the captured data can take a while, so it is only done when the marker is first needed
+        (e.g. in the autosave thread), not in captureProjectSnapshot().
+        """
+        if self._marker is None:
+            self._marker = ( self.saveGeneration, _hdf5Digest(self.stateFile) )
+        return self._marker
+
+    def close(self):
+        if self.stateFile is not None:
+            self.stateFile.close()
+            self.stateFile = None
+
+def _hdf5Digest(h5File):
+    """
+    A checksum of the names, attributes and contents of all groups and datasets in the given file.
+    """
+    digest = hashlib.md5()
+    def update(name, obj):
+        digest.update(name)
+        for key, value in sorted(obj.attrs.items()):
+            digest.update(key)
+            digest.update(repr(value))
+        if isinstance(obj, h5py.Dataset):
+            value = obj[()]
+            if isinstance(value, numpy.ndarray) and value.dtype != object:
+                digest.update("{}{}".format(value.dtype, value.shape))
+                digest.update(numpy.ascontiguousarray(value).data)
+            else:
+                digest.update(repr(value))
+    h5File.visititems(update)
+    return digest.hexdigest()
 
 class ProjectManager(object):
     """
@@ -171,6 +227,13 @@ class ProjectManager(object):
         self.currentProjectPath = None
         self.currentProjectIsReadOnly = False
 
+        # Saves and snapshots may be triggered from different threads (e.g. the autosaver).
+        # They must not run at the same time.
+        self._saveLock = threading.RLock()
+        self._autosaver = None
+        # Incremented whenever the project file changes (see CapturedProjectState)
+        self._saveGeneration = 0
+
         # Instantiate the workflow.
         self._workflowClass = workflowClass
         self._workflow_cmdline_args = workflow_cmdline_args or []
@@ -214,6 +277,10 @@ class ProjectManager(object):
         Update the project file with the state of the current workflow settings.
         Must not be called if the project file was opened in read-only mode.
         """
+        with self._saveLock:
+            self._saveProject(force_all_save)
+
+    def _saveProject(self, force_all_save):
         logger.debug("Save Project triggered")
         assert self.currentProjectFile != None
         assert self.currentProjectPath != None
@@ -248,16 +315,53 @@ class ProjectManager(object):
             self.currentProjectFile.create_dataset("time", data = time.ctime())
             # Flush any changes we made to disk, but don't close the file.
             self.currentProjectFile.flush()
+            self._saveGeneration += 1
             
             for applet in self._applets:
                 applet.progressSignal.emit(100)
 
-    def saveProjectSnapshot(self, snapshotPath):
+    def saveProjectSnapshot(self, snapshotPath, wait=True):
         """
         Copy the project file as it is, then serialize any dirty state into the copy.
         Original serializers and project file should not be touched.
+
+        This is captureProjectSnapshot() followed by writeProjectSnapshot(), in the calling thread.
+        To keep working while the snapshot is written, call those two functions separately.
+
+        :param wait: If False and another save is in progress, return immediately without saving.
+        :returns: True if the snapshot was saved.
         """
-        with h5py.File(snapshotPath, 'w') as snapshotFile:
+        state = self.captureProjectSnapshot(snapshotPath, wait)
+        if state is None:
+            return False
+        return self.writeProjectSnapshot(state, snapshotPath)
+
+    def captureProjectSnapshot(self, snapshotPath, wait=True):
+        """
+        Serialize the unsaved state of the project into memory, so that it can be written to a
+        snapshot file with writeProjectSnapshot() (e.g. in a background thread).
+
+        The serializers read the workflow's current state, so this must be called while the project can't
+        be edited at the same time, i.e. in the GUI thread (or while the applets are disabled).
+        Only the top-level groups of the applets that need to be serialized are held in memory.
+
+        :param snapshotPath: The path of the snapshot file that will be written.
+        :param wait: If False and another save is in progress, return None immediately.
+        :returns: A CapturedProjectState, or None if nothing was captured.
+        """
+        if not self._saveLock.acquire(wait):
+            logger.debug("Not capturing snapshot: another save is in progress.")
+            return None
+        try:
+            return self._captureProjectState(os.path.abspath(snapshotPath))
+        finally:
+            self._saveLock.release()
+
+    @timeLogged(logger, logging.DEBUG)
+    def _captureProjectState(self, snapshotPath):
+        stateFile = h5py.File('ilastik-snapshot-{}.h5'.format(uuid.uuid4().hex), 'w',
+                              driver='core', backing_store=False)
+        try:
             # Minor GUI nicety: Pre-activate the progress signals for dirty applets so
             #  the progress manager treats these tasks as a group instead of several sequential jobs.
             for aplt in self._applets:
@@ -265,36 +369,147 @@ class ProjectManager(object):
                     if ser.isDirty():
                         aplt.progressSignal.emit(0)
 
-            # Start by copying the current project state into the file
-            # This should be faster than serializing everything from scratch
-            for key in self.currentProjectFile.keys():
-                snapshotFile.copy(self.currentProjectFile[key], key)
-
             try:
-                # Applet serializable items are given the whole file (root group) for now
                 for aplt in self._applets:
                     for item in aplt.dataSerializers:
                         assert item.base_initialized, "AppletSerializer subclasses must call AppletSerializer.__init__ upon construction."
 
                         if item.isDirty() or item.shouldSerialize(self.currentProjectFile):
+                            # Start from the saved contents of the applet's group,
+                            #  so serializers that only update their group (e.g. label blocks) can do so.
+                            groupName = item.topGroupName
+                            if groupName and groupName in self.currentProjectFile and groupName not in stateFile:
+                                stateFile.copy(self.currentProjectFile[groupName], groupName)
+
                             # Use a COPY of the serializer, so the original serializer doesn't forget it's dirty state
-                            itemCopy = copy.copy(item)
-                            itemCopy.serializeToHdf5(snapshotFile, snapshotPath)
+                            itemCopy = self._copySerializer(item)
+                            itemCopy.serializeToHdf5(stateFile, snapshotPath)
             except Exception, err:
                 log_exception( logger, "Project Save Snapshot Action failed due to the exception printed above." )
                 raise ProjectManager.SaveError(str(err))
             finally:
+                for applet in self._applets:
+                    applet.progressSignal.emit(100)
+
+            return CapturedProjectState(stateFile, self._saveGeneration)
+        except:
+            stateFile.close()
+            raise
+
+    def writeProjectSnapshot(self, state, snapshotPath):
+        """
+        Write a snapshot file: a copy of the project file, updated with the state from captureProjectSnapshot().
+        The workflow isn't accessed, so this is safe to call from a background thread.  Closes ``state``.
+
+        The snapshot is written to a temporary file first, which replaces ``snapshotPath`` when it is complete.
+        That way, an existing file at ``snapshotPath`` (e.g. a previous autosave) is never left half-written.
+
+        :returns: False if the project was saved (or another project was opened) since the state was captured,
+                  in which case the captured state is outdated and no snapshot is written.  True otherwise.
+        """
+        try:
+            with self._saveLock:
+                if state.saveGeneration != self._saveGeneration:
+                    logger.debug("Not writing snapshot: the project was saved after the snapshot was captured.")
+                    return False
+                self._writeProjectSnapshot(state, os.path.abspath(snapshotPath))
+                return True
+        finally:
+            state.close()
+
+    @timeLogged(logger, logging.DEBUG)
+    def _writeProjectSnapshot(self, state, snapshotPath):
+        fd, tmpPath = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(snapshotPath) + '-',
+                                       dir=os.path.dirname(snapshotPath))
+        os.close(fd)
+        try:
+            # Start by copying the current project state into the file
+            # This should be faster than serializing everything from scratch
+            self._copyProjectFile(tmpPath)
+
+            with h5py.File(tmpPath, 'r+') as snapshotFile:
+                # Replace the groups of the serialized applets
+                for key in state.stateFile.keys():
+                    if key in snapshotFile:
+                        del snapshotFile[key]
+                    snapshotFile.copy(state.stateFile[key], key)
+
                 # save current time
                 if "time" in snapshotFile:
                     del snapshotFile["time"]
                 snapshotFile.create_dataset("time", data = time.ctime())
 
-                # Flush any changes we made to disk, but don't close the file.
-                snapshotFile.flush()
-                
-                for applet in self._applets:
-                    applet.progressSignal.emit(100)
-                    
+            self._replaceFile(tmpPath, snapshotPath)
+        except:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+            raise
+
+    def _copyProjectFile(self, destinationPath):
+        """
+        Copy the current project file to the given (existing, empty) path.
+        """
+        if not self.currentProjectIsReadOnly:
+            self.currentProjectFile.flush()
+        if self.currentProjectFile.driver == 'sec2' and os.path.exists(self.currentProjectPath):
+            # Copying the file as a whole is much faster than copying it group by group,
+            #  especially for projects that contain many small datasets (e.g. label blocks).
+            shutil.copyfile(self.currentProjectPath, destinationPath)
+        else:
+            # The project file isn't (only) on disk, e.g. it was created with driver='core'.
+            with h5py.File(destinationPath, 'w') as destinationFile:
+                for key in self.currentProjectFile.keys():
+                    destinationFile.copy(self.currentProjectFile[key], key)
+
+    @staticmethod
+    def _copySerializer(item):
+        """
+        Make a copy of the given applet serializer that can be used to write a snapshot.
+        The serial slots are copied, too, so the original serial slots keep their dirty state.
+        """
+        itemCopy = copy.copy(item)
+        itemCopy.serialSlots = [ copy.copy(ss) for ss in item.serialSlots ]
+        return itemCopy
+
+    @staticmethod
+    def _replaceFile(sourcePath, destinationPath):
+        if platform.system() == 'Windows' and os.path.exists(destinationPath):
+            # On Windows, rename() doesn't overwrite existing files.
+            os.remove(destinationPath)
+        os.rename(sourcePath, destinationPath)
+
+    def startAutosave(self, interval_seconds, max_overhead=0.1, postToGuiThread=None):
+        """
+        Periodically save a snapshot of the project (if it has unsaved changes) in the background.
+        See ProjectAutosaver.
+        """
+        self.stopAutosave()
+        self._autosaver = ProjectAutosaver(self, interval_seconds, max_overhead, postToGuiThread)
+        self._autosaver.start()
+
+    def stopAutosave(self):
+        """
+        Stop the autosaver, if it's running.  Waits for an ongoing autosave to finish.
+        """
+        if self._autosaver is not None:
+            self._autosaver.stop()
+            self._autosaver = None
+
+    def _startConfiguredAutosave(self):
+        """
+        Start the autosaver if it is enabled in the [autosave] section of the ilastik config file.
+        """
+        interval_minutes = ilastik_config.getfloat('autosave', 'interval_minutes')
+        if interval_minutes <= 0 or self.currentProjectIsReadOnly:
+            return
+        if self.currentProjectFile.driver != 'sec2':
+            # In-memory project files are not autosaved.
+            return
+        # In the GUI, the project state must be captured in the GUI thread (see captureProjectSnapshot())
+        thunkEventHandler = getattr(self._shell, 'thunkEventHandler', None)
+        postToGuiThread = thunkEventHandler.post if thunkEventHandler is not None else None
+        self.startAutosave( interval_minutes * 60, ilastik_config.getfloat('autosave', 'max_overhead'), postToGuiThread )
+
     def saveProjectAs(self, newPath):
         """
         Implement "Save As"
@@ -315,32 +530,33 @@ class ProjectManager(object):
             self._takeSnapshotAndLoadIt(newPath)
             return
 
-        oldPath = self.currentProjectPath
-        try:
-            os.rename( oldPath, newPath )
-        except OSError, err:
-            msg = 'Could not rename your project file to:\n'
-            msg += newPath + '\n'
-            msg += 'One common cause for this is that the new location is on a different disk.\n'
-            msg += 'Please try "Save Copy As" instead.'
-            msg += '(Error was: ' + str(err) + ')'
-            logger.error(msg)
-            raise ProjectManager.SaveError(msg)
-
-        # The file has been renamed
-        self.currentProjectPath = newPath
-        
-        # Copy the contents of the current project file to a newly-created file (with the old name)
-        with h5py.File(oldPath, 'a') as oldFile:
-            for key in self.currentProjectFile.keys():
-                oldFile.copy(self.currentProjectFile[key], key)
-        
-        for aplt in self._applets:
-            for item in aplt.dataSerializers:
-                item.updateWorkingDirectory(newPath,oldPath)
-        
-        # Save the current project state
-        self.saveProject()
+        with self._saveLock:
+            oldPath = self.currentProjectPath
+            try:
+                os.rename( oldPath, newPath )
+            except OSError, err:
+                msg = 'Could not rename your project file to:\n'
+                msg += newPath + '\n'
+                msg += 'One common cause for this is that the new location is on a different disk.\n'
+                msg += 'Please try "Save Copy As" instead.'
+                msg += '(Error was: ' + str(err) + ')'
+                logger.error(msg)
+                raise ProjectManager.SaveError(msg)
+    
+            # The file has been renamed
+            self.currentProjectPath = newPath
+            
+            # Copy the contents of the current project file to a newly-created file (with the old name)
+            with h5py.File(oldPath, 'a') as oldFile:
+                for key in self.currentProjectFile.keys():
+                    oldFile.copy(self.currentProjectFile[key], key)
+            
+            for aplt in self._applets:
+                for item in aplt.dataSerializers:
+                    item.updateWorkingDirectory(newPath,oldPath)
+            
+            # Save the current project state
+            self.saveProject()
         
     #########################
     ## Private methods
@@ -374,6 +590,7 @@ class ProjectManager(object):
             aplt.progressSignal.emit(0)
 
         # Save this as the current project
+        self._saveGeneration += 1
         self.currentProjectFile = hdf5File
         self.currentProjectPath = projectFilePath
         self.currentProjectIsReadOnly = readOnly
@@ -399,6 +616,7 @@ class ProjectManager(object):
             self.workflow.onProjectLoaded( self )
 
             self.workflow.handleAppletStateUpdateRequested()            
+            self._startConfiguredAutosave()
         except:
             msg = "Project could not be loaded due to the exception shown above.\n"
             msg += "Aborting Project Open Action"
@@ -421,6 +639,7 @@ class ProjectManager(object):
         
         # Close the old project *file*, but don't destroy the workflow.
         assert self.currentProjectFile is not None
+        self.stopAutosave()
         self.currentProjectFile.close()
         self.currentProjectFile = None
         
@@ -470,8 +689,11 @@ class ProjectManager(object):
     def _closeCurrentProject(self):
         if self.closed:
             return
+        self.stopAutosave()
         self.closed = True
         if self.workflow is not None:
             self.workflow.cleanUp()
         if self.currentProjectFile is not None:
-            self.currentProjectFile.close()
+            # Don't close the file while a snapshot is being copied from it.
+            with self._saveLock:
+                self.currentProjectFile.close()
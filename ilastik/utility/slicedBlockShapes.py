@@ -0,0 +1,169 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+import ilastik.config
+
+VIEW_AXES = 'xyz'
+
+def parseBlockDims( s ):
+    """
+    Parse a string like 'x=64, y=64, z=16' into a dict of axis sizes.
+    An empty string gives an empty dict.
+    """
+    dims = {}
+    for item in s.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        try:
+            key, size = item.split('=')
+            key = key.strip().lower()
+            size = int(size)
+        except ValueError:
+            raise ValueError( "Can't parse block dimensions: '{}' (expected e.g. 'x=64, y=64, z=16')".format( s ) )
+        if key not in 'txyzc' or len(key) != 1 or size < 1:
+            raise ValueError( "Invalid block dimension: '{}'".format( item ) )
+        dims[key] = size
+    return dims
+
+def configuredSlicedBlockShapes( meta, config_prefix ):
+    """
+    Compute the block shapes for a sliced cache, using the settings in the [cache block shapes]
+    section of the ilastik config file (e.g. 'feature_block_mb', 'feature_slab_thickness' and
+    'feature_block_dims' for the config_prefix 'feature').
+    See computeSlicedBlockShapes().
+    """
+    cfg = ilastik.config.cfg
+    section = 'cache block shapes'
+    block_mb = cfg.getfloat( section, config_prefix + '_block_mb' )
+    slab_thickness = cfg.getint( section, config_prefix + '_slab_thickness' )
+    fixed_dims = parseBlockDims( cfg.get( section, config_prefix + '_block_dims' ) )
+    return computeSlicedBlockShapes( meta, slab_thickness, block_mb * 1e6, fixed_dims )
+
+def computeSlicedBlockShapes( meta, slab_thickness, target_block_bytes, fixed_dims=None ):
+    """
+    Choose the block shapes for a cache that serves 2D slice views of an image (e.g. OpSlicedBlockedArrayCache).
+
+    One block shape is returned for each of the 'x', 'y' and 'z' view axes (in that order, in the axis order of meta).
+    Each block is a slab that is ``slab_thickness`` pixels thick along its view axis.
+    The in-plane sizes are chosen such that:
+
+    - a block (with all channels) holds about ``target_block_bytes``,
+    - blocks are roughly isotropic in physical units, if the axistags specify a resolution for each axis,
+    - blocks don't extend past the image (the unused budget goes to the other in-plane axis), and
+    - block sizes are multiples of the upstream chunk shape (``meta.ideal_blockshape``), if there is one.
+
+    Time slices are always cached separately, and each block includes all channels.
+
+    :param meta: The metadata of the image to cache (shape, dtype, axistags, ideal_blockshape)
+    :param slab_thickness: Block size along the view axis
+    :param target_block_bytes: Approximate size of each block
+    :param fixed_dims: A dict of block sizes (e.g. ``{'z' : 16}``) that override the automatic choice for all views
+    """
+    fixed_dims = fixed_dims or {}
+    tagged_shape = meta.getTaggedShape()
+    axiskeys = tagged_shape.keys()
+    itemsize = numpy.dtype( meta.dtype ).itemsize
+    num_channels = tagged_shape.get( 'c', 1 )
+    chunks = _chunkSizes( meta )
+    resolutions = _resolutions( meta )
+
+    block_shapes = []
+    for view_axis in VIEW_AXES:
+        dims = { 't' : 1, 'c' : num_channels }
+        thickness = 1
+        if view_axis in tagged_shape:
+            thickness = min( _alignToChunk( slab_thickness, chunks.get( view_axis, 1 ) ),
+                             tagged_shape[view_axis] )
+            dims[view_axis] = thickness
+
+        in_plane_axes = [ k for k in VIEW_AXES if k in tagged_shape and k != view_axis ]
+        pixel_budget = max( 1.0, float(target_block_bytes) / ( itemsize * num_channels * thickness ) )
+        dims.update( _fillPlane( in_plane_axes, tagged_shape, pixel_budget, resolutions, chunks ) )
+
+        dims.update( fixed_dims )
+        block_shapes.append( tuple( max( 1, min( dims[k], tagged_shape[k] ) ) for k in axiskeys ) )
+    return tuple( block_shapes )
+
+def _fillPlane( axes, tagged_shape, pixel_budget, resolutions, chunks ):
+    """
+    Choose sizes for the given axes whose product is about pixel_budget.
+    """
+    # Relative side lengths: equal in physical units (if known), otherwise equal in pixels.
+    weights = {}
+    for k in axes:
+        weights[k] = 1.0 / resolutions[k] if resolutions else 1.0
+
+    sizes = {}
+    remaining_axes = list(axes)
+    while remaining_axes:
+        # Scale the weights so the product of the remaining sizes matches the remaining budget.
+        weight_product = numpy.prod( [ weights[k] for k in remaining_axes ] )
+        scale = ( pixel_budget / weight_product ) ** ( 1.0 / len(remaining_axes) )
+
+        # Axes that are smaller than their share of the budget are clipped to the image extent,
+        #  and their unused budget goes to the other axes.
+        clipped = [ k for k in remaining_axes if scale * weights[k] >= tagged_shape[k] ]
+        if not clipped:
+            for k in remaining_axes:
+                sizes[k] = scale * weights[k]
+            break
+        for k in clipped:
+            sizes[k] = tagged_shape[k]
+            pixel_budget /= tagged_shape[k]
+            remaining_axes.remove( k )
+
+    aligned_sizes = {}
+    for k, size in sizes.items():
+        aligned_sizes[k] = min( _alignToChunk( int(round(size)), chunks.get(k, 1) ), tagged_shape[k] )
+    return aligned_sizes
+
+def _alignToChunk( size, chunk_size ):
+    """
+    Round size to the nearest (nonzero) multiple of chunk_size.
+    """
+    size = max( 1, size )
+    if chunk_size <= 1:
+        return size
+    return max( 1, int(round( float(size) / chunk_size )) ) * chunk_size
+
+def _chunkSizes( meta ):
+    """
+    Return the upstream chunk size for each axis (from meta.ideal_blockshape), as a dict.
+    Axes without a preference are omitted.
+    """
+    ideal_blockshape = meta.ideal_blockshape
+    if ideal_blockshape is None or len(ideal_blockshape) != len(meta.shape):
+        return {}
+    return dict( (k, s) for k, s in zip( meta.getAxisKeys(), ideal_blockshape ) if s and k in VIEW_AXES )
+
+def _resolutions( meta ):
+    """
+    Return the physical resolution of each spatial axis as a dict, or an empty dict if not all of them are known.
+    """
+    resolutions = {}
+    for tag in meta.axistags:
+        if tag.key in VIEW_AXES:
+            if not tag.resolution > 0:
+                return {}
+            resolutions[tag.key] = tag.resolution
+    return resolutions
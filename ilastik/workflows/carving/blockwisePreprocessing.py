@@ -0,0 +1,131 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+"""
+Blockwise version of the carving preprocessing filters.
+
+The volume is processed one block at a time (in parallel, on the lazyflow request pool),
+so the temporaries of the vigra filters are proportional to the block size, not to the volume size.
+Only the (already cached) input and the result are held for the whole volume.
+
+The blockwise filters are exact.  The watershed is always computed on the whole volume,
+so the supervoxels (and hence the carving graph) don't depend on the block layout.
+"""
+import functools
+import logging
+
+import numpy
+import vigra
+
+from lazyflow.roi import getIntersectingBlocks, getBlockBounds, roiFromShape, roiToSlice
+from lazyflow.request import Request, RequestPool
+
+logger = logging.getLogger(__name__)
+
+# Filter ids (the same as OpFilter.HESSIAN_BRIGHT etc.)
+HESSIAN_BRIGHT = 0
+HESSIAN_DARK = 1
+STEP_EDGES = 2
+RAW = 3
+RAW_INVERTED = 4
+
+# The highest derivative order that each filter computes
+FILTER_ORDERS = { HESSIAN_BRIGHT : 2,
+                  HESSIAN_DARK : 2,
+                  STEP_EDGES : 1,
+                  RAW : 0,
+                  RAW_INVERTED : 0 }
+
+def filterHalo( sigma, order ):
+    """
+    The halo needed to compute a filter of the given derivative order exactly within a block:
+    the radius of vigra's Gaussian derivative kernels, which is int( (3 + 0.5*order)*sigma + 0.5 ).
+    """
+    return int( numpy.ceil( (3 + 0.5*order)*sigma + 0.5 ) )
+
+def applyFilter( volume, volume_filter, sigma ):
+    """
+    Apply one of the carving filters to a 2D or 3D float32 array.
+
+    Unlike OpFilter, the result of HESSIAN_BRIGHT is NOT inverted (max - value),
+    since that depends on the maximum of the whole volume.
+    """
+    if volume_filter == HESSIAN_BRIGHT:
+        # vigra sorts the eigenvalues in descending order
+        return vigra.filters.hessianOfGaussianEigenvalues( volume, sigma )[..., -1]
+    elif volume_filter == HESSIAN_DARK:
+        return vigra.filters.hessianOfGaussianEigenvalues( volume, sigma )[..., 0]
+    elif volume_filter == STEP_EDGES:
+        return vigra.filters.gaussianGradientMagnitude( volume, sigma )
+    elif volume_filter == RAW:
+        return vigra.filters.gaussianSmoothing( volume, sigma )
+    elif volume_filter == RAW_INVERTED:
+        return vigra.filters.gaussianSmoothing( -volume, sigma )
+    assert False, "Unknown filter: {}".format( volume_filter )
+
+def _blockStarts( shape, blockShape3d ):
+    """
+    Return the 5D (txyzc) block shape and the starts of all blocks of a (1,x,y,z,1) volume.
+    """
+    block_shape = [1] + [ min( blockShape3d.get(k, s), s ) for k, s in zip( 'xyz', shape[1:4] ) ] + [1]
+    return block_shape, getIntersectingBlocks( block_shape, roiFromShape( shape ) )
+
+def _haloBounds( shape, start, stop, halo ):
+    halo_start = [ start[0] ] + [ max( 0, s - halo ) for s in start[1:4] ] + [ start[4] ]
+    halo_stop = [ stop[0] ] + [ min( n, s + halo ) for n, s in zip( shape[1:4], stop[1:4] ) ] + [ stop[4] ]
+    return halo_start, halo_stop
+
+def filterBlockwise( inputSlot, volume_filter, sigma, blockShape3d, result ):
+    """
+    Compute a carving filter for a 5D (txyzc) single-channel volume, one block at a time.
+    Each block is requested from inputSlot with a halo (see filterHalo()), so the result matches
+    the filter computed on the whole volume.
+
+    :param blockShape3d: A dict of spatial block sizes, e.g. ``{'x' : 256, 'y' : 256, 'z' : 256}``
+    :param result: A float32 array of the full volume shape, which receives the filtered volume.
+    """
+    shape = inputSlot.meta.shape
+    is_3d = shape[3] > 1
+    halo = filterHalo( sigma, FILTER_ORDERS[volume_filter] )
+    block_shape, block_starts = _blockStarts( shape, blockShape3d )
+    logger.debug( "Filtering in {} blocks of shape {} (halo: {})".format( len(block_starts), block_shape, halo ) )
+
+    def processBlock( block_start ):
+        start, stop = getBlockBounds( shape, block_shape, block_start )
+        halo_start, halo_stop = _haloBounds( shape, start, stop, halo )
+        data = inputSlot( halo_start, halo_stop ).wait()
+        fvol = numpy.asarray( data[0,:,:,:,0], numpy.float32 )
+        if not is_3d:
+            fvol = fvol[:,:,0]
+        filtered = applyFilter( fvol, volume_filter, sigma )
+        if not is_3d:
+            filtered = filtered[:,:,numpy.newaxis]
+
+        inner = roiToSlice( numpy.subtract( start, halo_start )[1:4], numpy.subtract( stop, halo_start )[1:4] )
+        result[ roiToSlice( start, stop ) ][0,:,:,:,0] = filtered[inner]
+
+    pool = RequestPool()
+    for block_start in block_starts:
+        pool.add( Request( functools.partial( processBlock, block_start ) ) )
+    pool.wait()
+
+    if volume_filter == HESSIAN_BRIGHT:
+        result[:] = numpy.max( result ) - result
+    return result
@@ -31,10 +31,13 @@ from lazyflow.graph import Operator, InputSlot, OutputSlot
 from lazyflow.operators import OpArrayCache
 
 from lazyflow.utility.timer import Timer
+import ilastik.config
 from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.utility.slicedBlockShapes import parseBlockDims
 
 #carving Cython module
 from watershed_segmentor import WatershedSegmentor
+from blockwisePreprocessing import filterBlockwise
 
 import logging
 logger = logging.getLogger(__name__)
@@ -49,6 +52,7 @@ class OpFilter(Operator):
     Input = InputSlot()
     Filter = InputSlot(value=HESSIAN_BRIGHT)
     Sigma = InputSlot(value=1.6)
+    BlockShape3dDict = InputSlot(optional=True) # If set, the filter is computed block by block (with halos)
     
     Output = OutputSlot()
 
@@ -65,6 +69,15 @@ class OpFilter(Operator):
         for i in range(1,4):
             assert ax[i].isSpatial()
         assert ax[4].key == "c" and sh[4] == 1
+
+        if self.BlockShape3dDict.ready():
+            # The blockwise filter requests its own halos, but (like the whole-volume filter below)
+            #  it always computes the entire volume.  (Our outputs are consumed through full-volume caches.)
+            assert tuple( roi.stop - roi.start ) == tuple( self.Output.meta.shape ), "Filter must be run on the entire volume."
+            with Timer() as filterTimer:
+                filterBlockwise( self.Input, self.Filter.value, self.Sigma.value, self.BlockShape3dDict.value, result )
+            logger.info( "Blockwise filter took {} seconds".format( filterTimer.seconds() ) )
+            return result
         
         volume5d = self.Input.value
         sigma = self.Sigma.value
@@ -256,6 +269,11 @@ class OpPreprocessing(Operator):
     Filter = InputSlot(value = 0)
     WatershedSource = InputSlot(value="filtered") # Choices: "raw", "input", "filtered"
     InvertWatershedSource = InputSlot(value=False)
+
+    # If set, the filters are computed block by block, to bound the memory needed for large volumes.
+    # (The watershed always runs on the whole volume, so the supervoxels don't depend on the blocks.)
+    # Defaults to the 'preprocessing_block_dims' setting in the [carving] section of the ilastik config file (empty by default).
+    BlockShape3dDict = InputSlot(optional=True)
     
     #Image after preprocess 
     PreprocessedData = OutputSlot()
@@ -291,6 +309,7 @@ class OpPreprocessing(Operator):
         self._opFilter.Input.connect( self.InputData )
         self._opFilter.Sigma.connect( self.Sigma )
         self._opFilter.Filter.connect( self.Filter )
+        self._opFilter.BlockShape3dDict.connect( self.BlockShape3dDict )
 
         self._opFilterNormalize = OpNormalize255( parent=self )
         self._opFilterNormalize.Input.connect( self._opFilter.Output )
@@ -304,6 +323,7 @@ class OpPreprocessing(Operator):
         self._opRawFilter = OpFilter( parent=self )
         self._opRawFilter.Input.connect( self.RawData )
         self._opRawFilter.Sigma.connect( self.Sigma )
+        self._opRawFilter.BlockShape3dDict.connect( self.BlockShape3dDict )
         
         self._opRawNormalize = OpNormalize255( parent=self )
         self._opRawNormalize.Input.connect( self._opRawFilter.Output )
@@ -311,6 +331,7 @@ class OpPreprocessing(Operator):
         self._opInputFilter = OpFilter( parent=self )
         self._opInputFilter.Input.connect( self.InputData )
         self._opInputFilter.Sigma.connect( self.Sigma )
+        self._opInputFilter.BlockShape3dDict.connect( self.BlockShape3dDict )
 
         self._opInputNormalize = OpNormalize255( parent=self )
         self._opInputNormalize.Input.connect( self._opInputFilter.Output )
@@ -326,6 +347,10 @@ class OpPreprocessing(Operator):
         # Display slots
         self.FilteredImage.connect( self._opFilterCache.Output )
         self.WatershedImage.connect( self._opWatershedCache.Output )
+
+        blockDims = parseBlockDims( ilastik.config.cfg.get('carving', 'preprocessing_block_dims') )
+        if blockDims:
+            self.BlockShape3dDict.setValue( blockDims )
         
         self.InputData.notifyReady( self._checkConstraints )
         
@@ -373,18 +398,21 @@ class OpPreprocessing(Operator):
         ws_source = self.WatershedSource.value
         if ws_source == 'raw':
             if self.RawData.ready():
-                self._opWatershed.Input.connect( self._opRawNormalize.Output )
+                sourceSlot = self._opRawNormalize.Output
             else:
-                self._opWatershed.Input.connect( self._opInputNormalize.Output )
+                sourceSlot = self._opInputNormalize.Output
         elif ws_source == 'input':
-            self._opWatershed.Input.connect( self._opInputNormalize.Output )
+            sourceSlot = self._opInputNormalize.Output
         elif ws_source == 'filtered':
-            self._opWatershed.Input.connect( self._opFilterCache.Output )
+            sourceSlot = self._opFilterCache.Output
         else:
             assert False, "Unknown Watershed source option: {}".format( ws_source )
 
+        # The watershed always reads its source through a full-volume cache:
+        #  OpNormalize255 must see the entire volume to normalize it with one min/max.
         self._opWatershedSourceCache.blockShape.setValue( self.InputData.meta.shape )
-        self._opWatershedSourceCache.Input.connect( self._opWatershed.Input )
+        self._opWatershedSourceCache.Input.connect( sourceSlot )
+        self._opWatershed.Input.connect( self._opWatershedSourceCache.Output )
 
         self.WatershedSourceImage.connect( self._opWatershedSourceCache.Output )
 
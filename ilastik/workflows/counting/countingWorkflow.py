@@ -271,23 +271,7 @@ class CountingWorkflow(Workflow):
                 sys.stdout.flush()
             else:
                 # Now run the batch export and report progress....
-                opBatchDataExport = self.batchResultsApplet.topLevelOperator
-                for i, opExportDataLaneView in enumerate(opBatchDataExport):
-                    logger.info( "Exporting object density image {} to {}".format(i, opExportDataLaneView.ExportPath.value) )
-        
-                    sys.stdout.write( "Result {}/{} Progress: ".format( i, len( opBatchDataExport ) ) )
-                    sys.stdout.flush()
-                    def print_progress( progress ):
-                        sys.stdout.write( "{:.1f} ".format( progress ) )
-                        sys.stdout.flush()
-        
-                    # If the operator provides a progress signal, use it.
-                    slotProgressSignal = opExportDataLaneView.progressSignal
-                    slotProgressSignal.subscribe( print_progress )
-                    opExportDataLaneView.run_export()
-                    
-                    # Finished.
-                    sys.stdout.write("\n")
+                self.batchResultsApplet.run_headless_export( result_description="Object density image" )
 
     def handleAppletStateUpdateRequested(self):
         """
@@ -109,21 +109,7 @@ class DataConversionWorkflow(Workflow):
 
         if self._headless and self._data_input_args and self._data_export_args:
             # Now run the export and report progress....
-            opDataExport = self.dataExportApplet.topLevelOperator
-            for i, opExportDataLaneView in enumerate(opDataExport):
-                logger.info( "Exporting file #{} to {}".format(i, opExportDataLaneView.ExportPath.value) )
-    
-                sys.stdout.write( "Result #{}/{} Progress: ".format( i, len( opDataExport ) ) )
-                def print_progress( progress ):
-                    sys.stdout.write( "{} ".format( progress ) )
-    
-                # If the operator provides a progress signal, use it.
-                slotProgressSignal = opExportDataLaneView.progressSignal
-                slotProgressSignal.subscribe( print_progress )
-                opExportDataLaneView.run_export()
-                
-                # Finished.
-                sys.stdout.write("\n")
+            self.dataExportApplet.run_headless_export( result_description="File" )
 
     def connectLane(self, laneIndex):
         opDataSelectionView = self.dataSelectionApplet.topLevelOperator.getLane(laneIndex)
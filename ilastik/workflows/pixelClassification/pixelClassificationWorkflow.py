@@ -18,6 +18,7 @@
 # on the ilastik web site at:
 #		   http://ilastik.org/license.html
 ###############################################################################
+import os
 import sys
 import copy
 import argparse
@@ -108,9 +109,22 @@ class PixelClassificationWorkflow(Workflow):
 
         self.featureSelectionApplet = self.createFeatureSelectionApplet()
 
+        # Optionally, store computed features on disk so they can be reused between sessions and batch runs.
+        feature_cache_dir = ilastik_config.get('feature cache', 'directory')
+        if feature_cache_dir:
+            opFeatureSelection = self.featureSelectionApplet.topLevelOperator
+            opFeatureSelection.FeatureCacheDirectory.setValue( os.path.expanduser(feature_cache_dir) )
+            opFeatureSelection.FeatureCacheSizeMB.setValue( ilastik_config.getint('feature cache', 'size_mb') )
+
         self.pcApplet = self.createPixelClassificationApplet()
         opClassify = self.pcApplet.topLevelOperator
 
+        # Optionally, keep predictions that were evicted from RAM on disk (instead of recomputing them).
+        prediction_spill_dir = ilastik_config.get('prediction cache', 'spill_directory')
+        if prediction_spill_dir:
+            opClassify.PredictionSpillDirectory.setValue( os.path.expanduser(prediction_spill_dir) )
+            opClassify.PredictionSpillSizeMB.setValue( ilastik_config.getint('prediction cache', 'spill_size_mb') )
+
         self.dataExportApplet = PixelClassificationDataExportApplet(self, "Prediction Export")
         opDataExport = self.dataExportApplet.topLevelOperator
         opDataExport.PmapColors.connect( opClassify.PmapColors )
@@ -193,6 +207,7 @@ class PixelClassificationWorkflow(Workflow):
         # Input Image -> Feature Op
         #         and -> Classification Op (for display)
         opTrainingFeatures.InputImage.connect( opData.Image )
+        opTrainingFeatures.DatasetIdentity.connect( opData.DatasetGroup[self.DATA_ROLE_RAW] )
         opClassify.InputImages.connect( opData.Image )
         
         if ilastik_config.getboolean('ilastik', 'debug'):
@@ -244,7 +259,7 @@ class PixelClassificationWorkflow(Workflow):
         
         ## Create additional batch workflow operators
         feature_operator_class = self.featureSelectionApplet.singleLaneOperatorClass
-        opBatchFeatures = OperatorWrapper( feature_operator_class, operator_kwargs={'filter_implementation': self.filter_implementation}, parent=self, promotedSlotNames=['InputImage'] )
+        opBatchFeatures = OperatorWrapper( feature_operator_class, operator_kwargs={'filter_implementation': self.filter_implementation}, parent=self, promotedSlotNames=['InputImage', 'DatasetIdentity'] )
         opBatchPredictionPipeline = OperatorWrapper( OpPredictionPipelineNoCache, parent=self )
         
         ## Connect Operators ##
@@ -262,6 +277,9 @@ class PixelClassificationWorkflow(Workflow):
         opBatchFeatures.Scales.connect( opTrainingFeatures.Scales )
         opBatchFeatures.FeatureIds.connect( opTrainingFeatures.FeatureIds )
         opBatchFeatures.SelectionMatrix.connect( opTrainingFeatures.SelectionMatrix )
+        opBatchFeatures.FeatureCacheDirectory.connect( opTrainingFeatures.FeatureCacheDirectory )
+        opBatchFeatures.FeatureCacheSizeMB.connect( opTrainingFeatures.FeatureCacheSizeMB )
+        opBatchFeatures.DatasetIdentity.connect( opTranspose.Outputs[self.DATA_ROLE_RAW] )
         
         # Classifier and NumClasses are provided by the interactive workflow
         opBatchPredictionPipeline.Classifier.connect( opClassify.Classifier )
@@ -421,23 +439,8 @@ class PixelClassificationWorkflow(Workflow):
             self.pcApplet.topLevelOperator.FreezePredictions.setValue(False)
         
             # Now run the batch export and report progress....
-            opBatchDataExport = self.batchResultsApplet.topLevelOperator
-            for i, opExportDataLaneView in enumerate(opBatchDataExport):
-                logger.info( "Exporting result {} to {}".format(i, opExportDataLaneView.ExportPath.value) )
-    
-                sys.stdout.write( "Result {}/{} Progress: ".format( i, len( opBatchDataExport ) ) )
-                sys.stdout.flush()
-                def print_progress( progress ):
-                    sys.stdout.write( "{} ".format( progress ) )
-                    sys.stdout.flush()
-    
-                # If the operator provides a progress signal, use it.
-                slotProgressSignal = opExportDataLaneView.progressSignal
-                slotProgressSignal.subscribe( print_progress )
-                opExportDataLaneView.run_export()
-                
-                # Finished.
-                sys.stdout.write("\n")
+            # (Several lanes may be exported at once, see --export_lane_concurrency)
+            self.batchResultsApplet.run_headless_export()
 
 
     def _print_labels_by_slice(self, search_value):
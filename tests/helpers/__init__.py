@@ -20,3 +20,4 @@
 ###############################################################################
 from shellGuiTestCaseBase import ShellGuiTestCaseBase
 import mainThreadHelpers
+from opCountingPiper import OpCountingPiper
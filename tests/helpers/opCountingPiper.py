@@ -0,0 +1,34 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+
+from lazyflow.operators import OpArrayPiper
+
+class OpCountingPiper(OpArrayPiper):
+    """
+    Counts the number of pixels that were requested from it (in all instances).
+    Tests reset ``OpCountingPiper.requested_pixels`` before they start counting.
+    """
+    requested_pixels = 0
+
+    def execute(self, slot, subindex, roi, result):
+        OpCountingPiper.requested_pixels += numpy.prod( roi.stop - roi.start )
+        return super( OpCountingPiper, self ).execute( slot, subindex, roi, result )
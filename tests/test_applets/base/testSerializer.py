@@ -489,6 +489,56 @@ class TestSerialBlockSlot(unittest.TestCase):
         shutil.rmtree(tmp_dir)
 
 
+    def testIncrementalSave(self):
+        tmp_dir = tempfile.mkdtemp()
+        h5_filepath = os.path.join(tmp_dir , 'serial_blockslot_test.h5' )
+
+        # Create an operator and a serializer to write the data.
+        opLabelArrays, slotSerializer = self._init_objects()
+
+        # Give it some data in three separate blocks.
+        opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][30:31, 30:40, 30:40, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+        opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 1*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+
+        with h5py.File(h5_filepath, 'w') as f:
+            label_group = f.create_group('label_data')
+            slotSerializer.serialize( label_group )
+            assert not slotSerializer.shouldSerialize( label_group )
+
+            # Mark the stored blocks, so we can tell which ones are rewritten.
+            lane_group = label_group['Output']['0']
+            for block in lane_group.values():
+                block.attrs['marker'] = True
+
+            # Change one block and erase another.
+            opLabelArrays.Input[0][10:11, 10:20, 10:20, 0:1] = 2*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            opLabelArrays.Input[0][50:51, 50:60, 50:60, 0:1] = 255*numpy.ones((1,10,10,1), dtype=numpy.uint8)
+            assert slotSerializer.shouldSerialize( label_group )
+            slotSerializer.serialize( label_group )
+            assert not slotSerializer.shouldSerialize( label_group )
+
+            # Only the block that was changed was rewritten.
+            marked = { block.attrs['blockSlice'] for block in lane_group.values() if 'marker' in block.attrs }
+            assert marked == { '[30:31,30:40,30:40,0:1]' }, marked
+
+        # Now start again with fresh objects.
+        # This time we'll read the data.
+        opLabelArrays, slotSerializer = self._init_objects()
+
+        with h5py.File(h5_filepath, 'r') as f:
+            label_group = f['label_data']
+            slotSerializer.deserialize( label_group )
+
+        # Verify that we get the updated data back.
+        assert ( opLabelArrays.Output[0][10:11, 10:20, 10:20, 0:1].wait() == 2 ).all()
+        assert ( opLabelArrays.Output[0][30:31, 30:40, 30:40, 0:1].wait() == 2 ).all()
+        assert ( opLabelArrays.Output[0][50:51, 50:60, 50:60, 0:1].wait() == 0 ).all()
+
+        os.remove(h5_filepath)
+        shutil.rmtree(tmp_dir)
+
+
 class TestSerialBlockSlot2(unittest.TestCase):
 
     def _init_objects(self):
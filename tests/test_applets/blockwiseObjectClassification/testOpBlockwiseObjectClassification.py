@@ -19,6 +19,8 @@
 #		   http://ilastik.org/license.html
 ###############################################################################
 import sys
+import time
+import shutil
 import warnings
 import tempfile
 
@@ -120,6 +122,82 @@ class TestOpBlockwiseObjectClassification(object):
             "as the non-blockwise prediction operator, despite having a pathological block/halo combination!"
              
                  
+    def testPipelineLimit(self):
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op.MaxBlockPipelines.setValue( 2 )
+
+        for _ in range(2):
+            pred = self.op.PredictionImage[:].wait()
+            assert (pred == self.prediction_volume).all(), \
+                "Evicting block pipelines changed the prediction image!"
+            stats = self.op.getStatistics()
+            assert stats['live_pipelines'] <= 2, stats
+
+        # The second pass had to rebuild the evicted pipelines.
+        assert stats['evictions'] > 0, stats
+        assert stats['recomputes'] > 0, stats
+        assert stats['stored_predictions'] == 0, stats
+
+    def testStoredPredictions(self):
+        store_dir = tempfile.mkdtemp()
+        try:
+            self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+            self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+            self.op.MaxBlockPipelines.setValue( 2 )
+            self.op.EvictedPredictionDirectory.setValue( store_dir )
+
+            for _ in range(2):
+                pred = self.op.PredictionImage[:].wait()
+                assert (pred == self.prediction_volume).all(), \
+                    "Stored predictions of evicted blocks don't match the prediction image!"
+
+            # The second pass read the evicted blocks from disk instead of recomputing them.
+            stats = self.op.getStatistics()
+            assert stats['evictions'] > 0, stats
+            assert stats['stored_predictions'] == stats['evictions'], stats
+            assert stats['stored_prediction_reads'] > 0, stats
+            assert stats['recomputes'] == 0, stats
+
+            # A new classifier invalidates the stored predictions
+            self.op.Classifier.setDirty()
+            assert self.op.PredictionImage[:].wait().shape == self.prediction_volume.shape
+            assert self.op.getStatistics()['stored_prediction_reads'] == stats['stored_prediction_reads']
+        finally:
+            self.op.cleanUp()
+            shutil.rmtree( store_dir, ignore_errors=True )
+
+    def testPrefetch(self):
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op.PrefetchBlocks.setValue( 2 )
+
+        # Request the first block.  The next two blocks (in raster order) are prefetched in the background.
+        pred = self.op.PredictionImage[:, 0:40, 0:40, 0:40, :].wait()
+        assert (pred == self.prediction_volume[:, 0:40, 0:40, 0:40, :]).all()
+        for _ in range(600):
+            if self.op.getStatistics()['prefetched_blocks'] == 2:
+                break
+            time.sleep(0.1)
+        stats = self.op.getStatistics()
+        assert stats['prefetched_blocks'] == 2, stats
+
+        # The prefetched block is used as-is
+        self.op.PrefetchBlocks.setValue( 0 )
+        pred = self.op.PredictionImage[:, 0:40, 0:40, 40:80, :].wait()
+        assert (pred == self.prediction_volume[:, 0:40, 0:40, 40:80, :]).all()
+        assert self.op.getStatistics()['created_pipelines'] == stats['created_pipelines']
+
+    def testParallelRegionFeatures(self):
+        self.op.BlockShape3dDict.setValue( {'x' : 40, 'y' : 40, 'z' : 40} )
+        self.op.HaloPadding3dDict.setValue( {'x' : 10, 'y' : 10, 'z' : 10} )
+        self.op.PredictionImage[:].wait()
+
+        features = self.op.BlockwiseRegionFeatures[:].wait()
+        assert features.shape == (1, 3, 3, 3, 1)
+        for block_features in features.flat:
+            assert 'Default features' in block_features
+
     def setUpSources(self):
         """
         Create big cubes with starting corners at multiples of 20, and small cubes offset 10 from that.
@@ -0,0 +1,73 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
+
+from ilastik.workflows.carving.blockwisePreprocessing import filterBlockwise, applyFilter, filterHalo, \
+                                                          HESSIAN_BRIGHT, HESSIAN_DARK, STEP_EDGES, RAW, RAW_INVERTED
+
+BLOCK_SHAPE = { 'x' : 25, 'y' : 20, 'z' : 16 }
+
+def _inputSlot( data ):
+    op = OpArrayPiper( graph=Graph() )
+    op.Input.setValue( vigra.taggedView( data, 'txyzc' ) )
+    return op.Output
+
+class TestBlockwisePreprocessing(object):
+
+    def testFilter(self):
+        data = numpy.random.random( (1, 60, 50, 40, 1) ).astype( numpy.float32 ) * 255
+        inputSlot = _inputSlot( data )
+        # (At sigma 5, the Hessian kernels are larger than the blocks.)
+        for sigma in [ 1.0, 1.6, 3.5, 5.0 ]:
+            for volume_filter in [ HESSIAN_BRIGHT, HESSIAN_DARK, STEP_EDGES, RAW, RAW_INVERTED ]:
+                expected = applyFilter( data[0,:,:,:,0], volume_filter, sigma )
+                if volume_filter == HESSIAN_BRIGHT:
+                    expected = expected.max() - expected
+
+                result = numpy.zeros( data.shape, dtype=numpy.float32 )
+                filterBlockwise( inputSlot, volume_filter, sigma, BLOCK_SHAPE, result )
+                assert numpy.allclose( result[0,:,:,:,0], expected, rtol=1e-5, atol=1e-4 ), \
+                    "Blockwise filter {} (sigma {}) differs from the whole-volume result".format( volume_filter, sigma )
+
+    def testFilterHalo(self):
+        # At least the radius of vigra's kernels
+        for sigma in [ 0.7, 1.0, 1.6, 3.5, 5.0, 10.0 ]:
+            for order in [0, 1, 2]:
+                assert filterHalo( sigma, order ) >= int( (3 + 0.5*order)*sigma + 0.5 )
+        assert filterHalo( 5.0, 2 ) == 21
+
+    def testFilter2D(self):
+        data = numpy.random.random( (1, 60, 50, 1, 1) ).astype( numpy.float32 ) * 255
+        result = numpy.zeros( data.shape, dtype=numpy.float32 )
+        filterBlockwise( _inputSlot( data ), STEP_EDGES, 2.0, BLOCK_SHAPE, result )
+        expected = vigra.filters.gaussianGradientMagnitude( data[0,:,:,0,0], 2.0 )
+        assert numpy.allclose( result[0,:,:,0,0], expected, rtol=1e-5, atol=1e-4 )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,95 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph, Operator, OrderedSignal
+
+from ilastik.workflows.carving.opPreprocessing import OpPreprocessing
+
+BLOCK_SHAPE = { 'x' : 25, 'y' : 20, 'z' : 16 }
+
+class _PreprocessingAppletStub(object):
+    def __init__(self):
+        self.progress = 0
+        self.progressSignal = OrderedSignal()
+
+class _OpParent(Operator):
+    """
+    OpPreprocessing finds its applet via parent.parent.preprocessingApplet
+    """
+    pass
+
+class TestOpPreprocessingBlockwise(object):
+
+    def setUp(self):
+        # A few large cone-shaped basins, which cross several block faces
+        shape = (1, 64, 60, 48, 1)
+        seeds = numpy.array( [ [10, 10, 10], [50, 15, 30], [20, 45, 40], [55, 50, 8] ] )
+        coords = numpy.indices( shape[1:4] ).reshape(3, -1).T
+        distances = numpy.sqrt( ( ( coords[:, numpy.newaxis, :] - seeds[numpy.newaxis] )**2 ).sum(axis=2) ).min(axis=1)
+        # Not in [0,255], so the watershed sources must be normalized
+        self.data = vigra.taggedView( ( 100 + distances * 3.0 ).reshape( shape ).astype( numpy.float32 ), 'txyzc' )
+
+        self.graph = Graph()
+        self.opWorkflow = _OpParent( graph=self.graph )
+        self.opWorkflow.preprocessingApplet = _PreprocessingAppletStub()
+        self.opLane = _OpParent( parent=self.opWorkflow )
+
+    def _createOp(self, blockShape3dDict):
+        op = OpPreprocessing( parent=self.opLane )
+        if blockShape3dDict is None:
+            op.BlockShape3dDict.disconnect()
+        else:
+            op.BlockShape3dDict.setValue( blockShape3dDict )
+        op.Sigma.setValue( 1.0 )
+        op.RawData.setValue( self.data )
+        op.InputData.setValue( self.data )
+        return op
+
+    def testWatershedSources(self):
+        opBlockwise = self._createOp( BLOCK_SHAPE )
+        opWhole = self._createOp( None )
+        for source in ['raw', 'input', 'filtered']:
+            opBlockwise.WatershedSource.setValue( source )
+            opWhole.WatershedSource.setValue( source )
+
+            # The watershed source is normalized over the whole volume, in both modes
+            sourceImage = opBlockwise.WatershedSourceImage[:].wait()
+            assert sourceImage.shape == self.data.shape
+            assert numpy.allclose( sourceImage, opWhole.WatershedSourceImage[:].wait() )
+            assert abs( sourceImage.min() ) < 1e-3 and abs( sourceImage.max() - 255 ) < 1e-3, \
+                "Watershed source '{}' was not normalized over the whole volume".format( source )
+
+            labels = opBlockwise.WatershedImage[:].wait()
+            assert labels.shape == self.data.shape, \
+                "Wrong watershed shape for source '{}': {}".format( source, labels.shape )
+
+            # The supervoxels (and hence the carving graph) don't depend on the block layout
+            assert ( labels == opWhole.WatershedImage[:].wait() ).all(), \
+                "Watershed source '{}': the supervoxels differ from the whole-volume mode".format( source )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,111 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import tempfile
+import shutil
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.operators.ioOperators import OpInputDataReader
+
+from ilastik.utility import OpMultiLaneWrapper
+from ilastik.applets.dataExport.opDataExport import OpDataExport
+from ilastik.applets.dataExport.laneExportScheduler import LaneExportScheduler
+
+class TestLaneExportScheduler(object):
+    
+    @classmethod
+    def setupClass(cls):
+        cls._tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardownClass(cls):
+        shutil.rmtree(cls._tmpdir) 
+
+    def _createExportOperator(self, graph, num_lanes):
+        opExport = OpMultiLaneWrapper( OpDataExport, graph=graph )
+        opExport.TransactionSlot.setValue(True)
+        opExport.WorkingDirectory.setValue( self._tmpdir )
+        opExport.SelectionNames.setValue(['Mock Export Data'])
+        opExport.OutputFormat.setValue( 'hdf5' )
+        opExport.OutputFilenameFormat.setValue( '{dataset_dir}/{nickname}_export' )
+        opExport.OutputInternalPath.setValue('volume/data')
+
+        # Simulate the important fields of a DatasetInfo object
+        class MockDatasetInfo(object): pass
+
+        all_data = []
+        for lane_index in range(num_lanes):
+            opExport.addLane(lane_index)
+            opLane = opExport.getLane(lane_index)
+
+            rawInfo = MockDatasetInfo()
+            rawInfo.nickname = 'lane_{}'.format( lane_index )
+            rawInfo.filePath = './somefile.h5'
+            opLane.RawDatasetInfo.setValue( rawInfo )
+
+            data = numpy.random.random( (50,60) ).astype( numpy.float32 ) * 100
+            data = vigra.taggedView( data, vigra.defaultAxistags('xy') )
+            opLane.Inputs.resize(1)
+            opLane.Inputs[0].setValue(data)
+            all_data.append( data )
+        return opExport, all_data
+
+    def testConcurrentExport(self):
+        graph = Graph()
+        opExport, all_data = self._createExportOperator( graph, 5 )
+
+        results = LaneExportScheduler( opExport, lane_concurrency=3 ).run()
+        assert [r.lane_index for r in results] == range(5)
+        assert all( r.exception is None for r in results )
+
+        for data, result in zip(all_data, results):
+            opRead = OpInputDataReader( graph=graph )
+            opRead.FilePath.setValue( result.export_path )
+            read_data = opRead.Output[:].wait()
+            assert (read_data == data.view(numpy.ndarray)).all(), "Read data didn't match exported data!"
+            opRead.cleanUp()
+
+    def testRamBudgetLimitsConcurrency(self):
+        graph = Graph()
+        opExport, _ = self._createExportOperator( graph, 3 )
+
+        # Every lane needs more than half of the budget, so they must run one at a time.
+        class FixedRamScheduler(LaneExportScheduler):
+            max_running = 0
+            @classmethod
+            def estimate_lane_ram_mb(cls, opLane):
+                return 1.0
+            def _release(self, ram_mb, result):
+                FixedRamScheduler.max_running = max( FixedRamScheduler.max_running, self._running_count )
+                super( FixedRamScheduler, self )._release( ram_mb, result )
+
+        FixedRamScheduler( opExport, lane_concurrency=3, ram_budget_mb=1.5 ).run()
+        assert FixedRamScheduler.max_running == 1
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -90,6 +90,50 @@ class TestOpDataExport(object):
         
         opRead.cleanUp()
 
+    def testMultipleSelections(self):
+        """
+        Export two selections in the same pass, into separate datasets of the same file.
+        """
+        graph = Graph()
+        opExport = OpDataExport(graph=graph)
+        opExport.TransactionSlot.setValue(True)        
+        opExport.WorkingDirectory.setValue( self._tmpdir )
+        
+        class MockDatasetInfo(object): pass
+        rawInfo = MockDatasetInfo()
+        rawInfo.nickname = 'multi_nickname'
+        rawInfo.filePath = './somefile.h5'
+        opExport.RawDatasetInfo.setValue( rawInfo )
+
+        opExport.SelectionNames.setValue(['Probabilities', 'Segmentation', 'Uncertainty'])
+
+        probabilities = numpy.random.random( (100,90,3) ).astype( numpy.float32 )
+        segmentation = numpy.random.randint( 0, 3, (100,90,1) ).astype( numpy.uint8 )
+        uncertainty = numpy.random.random( (100,90,1) ).astype( numpy.float32 )
+        all_data = [probabilities, segmentation, uncertainty]
+
+        opExport.Inputs.resize(3)
+        for slot, data in zip( opExport.Inputs, all_data ):
+            slot.setValue( vigra.taggedView( data, 'xyc' ) )
+
+        opExport.InputSelection.setValue( 1 )
+        opExport.AdditionalInputSelections.setValue( [0, 2] )
+        opExport.OutputFormat.setValue( 'hdf5' )
+        opExport.OutputFilenameFormat.setValue( '{dataset_dir}/{nickname}_results' )
+        opExport.OutputInternalPath.setValue('{result_type}')
+
+        assert opExport.ExportPath.value == self._tmpdir + '/multi_nickname_results.h5/Segmentation'
+        opExport.run_export()
+
+        opRead = OpInputDataReader( graph=graph )
+        try:
+            for name, data in zip( ['Probabilities', 'Segmentation', 'Uncertainty'], all_data ):
+                opRead.FilePath.setValue( self._tmpdir + '/multi_nickname_results.h5/' + name )
+                read_data = opRead.Output[:].wait()
+                assert (read_data == data).all(), "Read data didn't match exported data for {}".format( name )
+        finally:
+            opRead.cleanUp()
+
 if __name__ == "__main__":
     import sys
     import nose
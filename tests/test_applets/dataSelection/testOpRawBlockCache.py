@@ -0,0 +1,115 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.metaDict import MetaDict
+from ilastik.applets.dataSelection.opRawBlockCache import OpRawBlockCache, rawCacheBlockShape
+from tests.helpers import OpCountingPiper
+
+class TestRawCacheBlockShape(object):
+
+    def testChunkAlignment(self):
+        meta = MetaDict( shape=(1000, 1000, 100, 1), dtype=numpy.uint8, axistags=vigra.defaultAxistags('xyzc'),
+                         ideal_blockshape=(64, 64, 64, 0) )
+        # z is filled first (64 -> 100, the full extent), then y grows by whole chunks
+        assert rawCacheBlockShape( meta, 64*256*100 ) == (64, 256, 100, 1)
+
+    def testNoChunks(self):
+        meta = MetaDict( shape=(100, 200, 3), dtype=numpy.float32, axistags=vigra.defaultAxistags('xyc') )
+        assert rawCacheBlockShape( meta, 10*200*3*4 ) == (10, 200, 3)
+
+class TestOpRawBlockCache(object):
+
+    def setUp(self):
+        self.data = vigra.taggedView( numpy.random.random( (100,100,3) ).astype( numpy.float32 ), 'xyc' )
+        OpCountingPiper.requested_pixels = 0
+
+        graph = Graph()
+        self.opData = OpCountingPiper( graph=graph )
+        self.opData.Input.setValue( self.data )
+        self.opCache = OpRawBlockCache( graph=graph )
+        # Blocks of 10 x-columns
+        self.opCache.TARGET_BLOCK_BYTES = 10*100*3*4
+        self.opCache.Input.connect( self.opData.Output )
+
+    def tearDown(self):
+        self.opCache.cleanUp()
+
+    def testOverlappingRequests(self):
+        # Requests with a halo, as from a filter
+        for x in range(0, 100, 20):
+            start, stop = max(0, x-5), min(100, x+25)
+            result = self.opCache.Output[start:stop, :, :].wait()
+            assert (result == self.data[start:stop]).all()
+
+        stats = self.opCache.getStatistics()
+        assert OpCountingPiper.requested_pixels == self.data.size, "Raw data was read more than once"
+        assert stats['bytes_read'] == self.data.nbytes
+        assert stats['bytes_served'] > stats['bytes_read']
+        assert stats['misses'] == 10
+        assert stats['hits'] > 0
+
+    def testDirtyInvalidatesBlocks(self):
+        self.opCache.Output[:].wait()
+        self.opData.Input.setDirty( (0,0,0), (5,5,3) )
+        self.opCache.Output[:].wait()
+        assert OpCountingPiper.requested_pixels == self.data.size + 10*100*3, "Only the dirty block should be read again"
+
+    def testEviction(self):
+        # Room for two blocks
+        self.opCache.MaxSizeMB.setValue( 2.5*10*100*3*4 / 1e6 )
+        for x in range(0, 100, 10):
+            self.opCache.Output[x:x+10].wait()
+        stats = self.opCache.getStatistics()
+        assert stats['evictions'] == 8
+        assert stats['cached_bytes'] == 2*10*100*3*4
+
+        # The most recently used blocks are still cached
+        self.opCache.Output[90:100].wait()
+        assert OpCountingPiper.requested_pixels == self.data.size
+
+    def testReadAhead(self):
+        self.opCache.ReadAheadBlocks.setValue( 3 )
+        self.opCache.Output[0:10].wait()
+        # The second sequential request triggers the read-ahead of blocks 2-4
+        self.opCache.Output[10:20].wait()
+
+        start = time.time()
+        while self.opCache.getStatistics()['bytes_read'] < 5*10*100*3*4:
+            assert time.time() - start < 10.0, "Blocks were not read ahead"
+            time.sleep( 0.01 )
+
+        result = self.opCache.Output[20:40].wait()
+        assert (result == self.data[20:40]).all()
+        stats = self.opCache.getStatistics()
+        assert stats['read_ahead'] >= 3
+        assert stats['misses'] == 2
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,174 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import glob
+import shutil
+import tempfile
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from ilastik.applets.featureSelection.opFeatureDiskCache import OpFeatureDiskCache
+from tests.helpers import OpCountingPiper
+
+class TestOpFeatureDiskCache(object):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.data = numpy.random.random( (100,90,5) ).astype( numpy.float32 )
+        self.data = vigra.taggedView( self.data, 'xyc' )
+        OpCountingPiper.requested_pixels = 0
+
+    def tearDown(self):
+        shutil.rmtree( self.cache_dir )
+
+    def _createCache(self, graph, settings="settings A", dataset="dataset 1", data=None):
+        opData = OpCountingPiper( graph=graph )
+        opData.Input.setValue( self.data if data is None else data )
+
+        opCache = OpFeatureDiskCache( graph=graph )
+        opCache.Input.connect( opData.Output )
+        opCache.CacheDirectory.setValue( self.cache_dir )
+        opCache.DatasetIdentity.setValue( dataset )
+        opCache.FeatureSettings.setValue( settings )
+        return opCache
+
+    def testBasic(self):
+        graph = Graph()
+        opCache = self._createCache( graph )
+        result = opCache.Output[10:70, 20:30, 1:3].wait()
+        assert (result == self.data[10:70, 20:30, 1:3]).all()
+        requested = OpCountingPiper.requested_pixels
+        assert requested > 0
+
+        # Requesting it again doesn't touch the input
+        result = opCache.Output[10:70, 20:30, 1:3].wait()
+        assert (result == self.data[10:70, 20:30, 1:3]).all()
+        assert OpCountingPiper.requested_pixels == requested
+        opCache.cleanUp()
+
+    def testPersistence(self):
+        opCache = self._createCache( Graph() )
+        opCache.Output[:].wait()
+        opCache.cleanUp()
+
+        # A new cache with the same identity and settings re-uses the stored features
+        OpCountingPiper.requested_pixels = 0
+        opCache = self._createCache( Graph() )
+        result = opCache.Output[:].wait()
+        assert (result == self.data).all()
+        assert OpCountingPiper.requested_pixels == 0
+        opCache.cleanUp()
+
+    def testSettingsChangeInvalidates(self):
+        opCache = self._createCache( Graph() )
+        opCache.Output[:].wait()
+        assert len( glob.glob( self.cache_dir + '/*.h5' ) ) == 1
+
+        opCache.FeatureSettings.setValue( "settings B" )
+        OpCountingPiper.requested_pixels = 0
+        opCache.Output[:].wait()
+        assert OpCountingPiper.requested_pixels == numpy.prod( self.data.shape )
+
+        # The entry for the old settings was deleted.
+        assert len( glob.glob( self.cache_dir + '/*.h5' ) ) == 1
+        opCache.cleanUp()
+
+    def testDirtyInvalidates(self):
+        graph = Graph()
+        opCache = self._createCache( graph )
+        opCache.Output[:].wait()
+        
+        new_data = self.data.copy()
+        new_data[:] = 0
+        opCache.Input.partner.getRealOperator().Input.setValue( new_data )
+        assert (opCache.Output[:].wait() == 0).all()
+        opCache.cleanUp()
+
+    def testLruEviction(self):
+        entry_mb = self.data.nbytes / 1e6
+        for i in range(3):
+            opCache = self._createCache( Graph(), dataset="dataset {}".format(i) )
+            opCache.Output[:].wait()
+            opCache.cleanUp()
+
+        # Make dataset 1 the least recently used entry
+        paths = glob.glob( self.cache_dir + '/*.h5' )
+        assert len( paths ) == 3
+        for path in paths:
+            os.utime( path, (2000, 2000) )
+        dataset1_path = glob.glob( self.cache_dir + '/features_{}_*.h5'.format( OpFeatureDiskCache._hash("dataset 1") ) )[0]
+        os.utime( dataset1_path, (1000, 1000) )
+
+        # Limit the cache to (roughly) two full entries
+        opCache = self._createCache( Graph(), dataset="dataset 3" )
+        opCache.MaxSizeMB.setValue( 2.5*entry_mb )
+        opCache.cleanUp()
+
+        assert not os.path.exists( dataset1_path )
+        assert len( glob.glob( self.cache_dir + '/*.h5' ) ) == 3
+
+    def testEvictionAfterWrites(self):
+        entry_mb = self.data.nbytes / 1e6
+        for i in range(2):
+            opCache = self._createCache( Graph(), dataset="dataset {}".format(i) )
+            opCache.Output[:].wait()
+            opCache.cleanUp()
+        dataset0_path = glob.glob( self.cache_dir + '/features_{}_*.h5'.format( OpFeatureDiskCache._hash("dataset 0") ) )[0]
+        os.utime( dataset0_path, (1000, 1000) )
+
+        # The new entry is still empty, so everything fits...
+        opCache = self._createCache( Graph(), dataset="dataset 2" )
+        opCache.MaxSizeMB.setValue( 2.5*entry_mb )
+        assert len( glob.glob( self.cache_dir + '/*.h5' ) ) == 3
+
+        # ...until its features are stored.
+        opCache.Output[:].wait()
+        assert not os.path.exists( dataset0_path )
+        assert len( glob.glob( self.cache_dir + '/*.h5' ) ) == 2
+        opCache.cleanUp()
+
+    def testDisabled(self):
+        graph = Graph()
+        opData = OpCountingPiper( graph=graph )
+        opData.Input.setValue( self.data )
+        opCache = OpFeatureDiskCache( graph=graph )
+        opCache.Input.connect( opData.Output )
+        opCache.CacheDirectory.setValue( '' )
+        opCache.DatasetIdentity.setValue( "dataset 1" )
+        opCache.FeatureSettings.setValue( "settings A" )
+
+        result = opCache.Output[10:70, 20:30, 1:3].wait()
+        assert (result == self.data[10:70, 20:30, 1:3]).all()
+
+        # Nothing is stored, so every request goes to the input
+        opCache.Output[10:70, 20:30, 1:3].wait()
+        assert OpCountingPiper.requested_pixels == 2 * 60*10*2
+        assert glob.glob( self.cache_dir + '/*.h5' ) == []
+        opCache.cleanUp()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,239 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import sys
+import shutil
+import tempfile
+import logging
+
+import numpy
+import vigra
+import h5py
+import nose
+
+from lazyflow.graph import Graph
+from lazyflow.utility.timer import Timer
+from ilastik.applets.base.applet import DatasetConstraintError
+from ilastik.applets.featureSelection.opFeatureSelection import OpFeatureSelection
+from ilastik.applets.featureSelection.precomputedFeatures import PrecomputedFeatureFiles
+
+logger = logging.getLogger(__name__)
+logger.addHandler( logging.StreamHandler(sys.stdout) )
+
+class TestPrecomputedFeatures(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # Raw data: 'txyzc' with a single time slice
+        self.raw_shape = (1, 30, 40, 20, 1)
+        self.f1 = numpy.random.random( (30, 40, 20) ).astype( numpy.float32 )        # 'xyz'
+        self.f2 = numpy.random.random( (1, 30, 40, 20, 3) ).astype( numpy.float64 )  # 'txyzc'
+        self.f3 = numpy.random.randint( 0, 255, (30, 40, 20, 2) ).astype( numpy.uint8 ) # 'xyzc'
+        self.paths = [ self._writeFile( 'f1.h5', self.f1, chunks=(10,10,10) ),
+                       self._writeFile( 'f2.h5', self.f2 ),
+                       self._writeFile( 'f3.h5', self.f3, chunks=(15,20,5,2) ) ]
+
+        # The combined features, in raw axis order
+        self.expected = numpy.concatenate( [ self.f1[None,...,None], self.f2, self.f3[None] ], axis=-1 )
+
+    def tearDown(self):
+        shutil.rmtree( self.tmpdir )
+
+    def _writeFile(self, name, data, chunks=None):
+        path = os.path.join( self.tmpdir, name )
+        with h5py.File( path, 'w' ) as f:
+            f.create_dataset( 'data', data=data, chunks=chunks )
+        return path
+
+    def testChannelsAndDtypes(self):
+        features = PrecomputedFeatureFiles( self.paths, 'txyzc', self.raw_shape )
+        try:
+            assert features.num_channels == 6
+            assert features.shape == (1, 30, 40, 20, 6)
+            assert features.dtype == numpy.float64
+            assert features.layerShape(1) == (1, 30, 40, 20, 3)
+            assert features.layerDtype(2) == numpy.uint8
+            assert features.ideal_blockshape() == (0, 15, 20, 10, 0)
+
+            # Full read
+            result = numpy.zeros( features.shape, dtype=features.dtype )
+            features.readFeatures( (0,0,0,0,0), features.shape, result )
+            assert (result == self.expected).all()
+
+            # Subregion that spans part of each file's channels
+            start, stop = (0, 5, 10, 2, 2), (1, 25, 33, 19, 5)
+            result = numpy.zeros( numpy.subtract(stop, start), dtype=features.dtype )
+            features.readFeatures( start, stop, result )
+            assert (result == self.expected[0:1, 5:25, 10:33, 2:19, 2:5]).all()
+
+            # Single layer
+            result = numpy.zeros( (1, 10, 10, 10, 2), dtype=numpy.uint8 )
+            features.readLayer( 2, (0, 0, 0, 0, 0), (1, 10, 10, 10, 2), result )
+            assert (result == self.f3[None, 0:10, 0:10, 0:10]).all()
+        finally:
+            features.close()
+
+    def testHandlePool(self):
+        features1 = PrecomputedFeatureFiles( self.paths, 'txyzc', self.raw_shape )
+        features2 = PrecomputedFeatureFiles( self.paths[:1], 'txyzc', self.raw_shape )
+        assert len( PrecomputedFeatureFiles._pool ) == 3
+
+        features1.close()
+        # f1.h5 is still in use by features2
+        assert len( PrecomputedFeatureFiles._pool ) == 1
+        result = numpy.zeros( (1, 30, 40, 20, 1), dtype=numpy.float32 )
+        features2.readFeatures( (0,0,0,0,0), (1,30,40,20,1), result )
+        assert (result[0,...,0] == self.f1).all()
+
+        features2.close()
+        assert len( PrecomputedFeatureFiles._pool ) == 0
+
+    def testShapeMismatch(self):
+        bad_path = self._writeFile( 'bad.h5', numpy.zeros( (30, 40, 21), dtype=numpy.float32 ) )
+        try:
+            PrecomputedFeatureFiles( self.paths + [bad_path], 'txyzc', self.raw_shape )
+        except DatasetConstraintError:
+            pass
+        else:
+            assert False, "Expected a DatasetConstraintError"
+        # The files that were opened before the error were released again.
+        assert len( PrecomputedFeatureFiles._pool ) == 0
+
+    def testOperator(self):
+        listfile = os.path.join( self.tmpdir, 'features.txt' )
+        with open( listfile, 'w' ) as f:
+            f.write( "\n".join( self.paths ) + "\n" )
+
+        raw = vigra.taggedView( numpy.zeros( self.raw_shape, dtype=numpy.uint8 ), 'txyzc' )
+        opFeatures = OpFeatureSelection( filter_implementation='Original', graph=Graph() )
+        opFeatures.InputImage.setValue( raw )
+        # The feature selection inputs must be set (as the GUI does), but they are ignored in favor of the files.
+        opFeatures.Scales.setValue( [1.0] )
+        opFeatures.FeatureIds.setValue( ['GaussianSmoothing'] )
+        opFeatures.SelectionMatrix.setValue( numpy.ones( (1,1), dtype=bool ) )
+        opFeatures.FeatureListFilename.setValue( listfile )
+
+        assert opFeatures.OutputImage.meta.shape == (1, 30, 40, 20, 6)
+        assert opFeatures.OutputImage.meta.dtype == numpy.float64
+        assert len( opFeatures.FeatureLayers ) == 3
+
+        result = opFeatures.OutputImage[:, 10:20, 0:40, 5:6, 1:6].wait()
+        assert (result == self.expected[:, 10:20, 0:40, 5:6, 1:6]).all()
+
+        result = opFeatures.CachedOutputImage[:].wait()
+        assert (result == self.expected).all()
+
+        result = opFeatures.FeatureLayers[1][:].wait()
+        assert (result == self.f2).all()
+
+        opFeatures.cleanUp()
+        assert len( PrecomputedFeatureFiles._pool ) == 0
+
+class TestPrecomputedFeaturesBenchmark(object):
+    """
+    Compares reading precomputed features against computing the same number of feature channels.
+    """
+
+    SHAPE = (1, 256, 256, 64, 1)
+    SCALES = [0.3, 0.7, 1, 1.6, 3.5, 5.0, 10.0]
+    FEATURE_IDS = [ 'GaussianSmoothing',
+                    'LaplacianOfGaussian',
+                    'StructureTensorEigenvalues',
+                    'HessianOfGaussianEigenvalues',
+                    'GaussianGradientMagnitude',
+                    'DifferenceOfGaussians' ]
+    BLOCK_SIDE = 64
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+        cls.tmpdir = tempfile.mkdtemp()
+        data = numpy.random.random( cls.SHAPE )
+        data *= 256
+        cls.raw = vigra.taggedView( data.astype( numpy.uint8 ), 'txyzc' )
+
+    @classmethod
+    def teardownClass(cls):
+        shutil.rmtree( cls.tmpdir )
+
+    def _requestBlockwise(self, slot):
+        """
+        Request the slot in blocks, the way tiled GUI views and batch prediction do.
+        """
+        shape = slot.meta.shape
+        timer = Timer()
+        timer.start()
+        for x in range(0, shape[1], self.BLOCK_SIDE):
+            for y in range(0, shape[2], self.BLOCK_SIDE):
+                for z in range(0, shape[3], self.BLOCK_SIDE):
+                    slot[ :, x:x+self.BLOCK_SIDE, y:y+self.BLOCK_SIDE, z:z+self.BLOCK_SIDE, : ].wait()
+        timer.stop()
+        return timer.seconds()
+
+    def testBenchmark(self):
+        selections = numpy.zeros( (len(self.FEATURE_IDS), len(self.SCALES)), dtype=bool )
+        selections[:, 1:4] = True
+        selections[0, 0] = True
+
+        # Compute the features
+        opCompute = OpFeatureSelection( filter_implementation='Original', graph=Graph() )
+        opCompute.InputImage.setValue( self.raw )
+        opCompute.Scales.setValue( self.SCALES )
+        opCompute.FeatureIds.setValue( self.FEATURE_IDS )
+        opCompute.SelectionMatrix.setValue( selections )
+        compute_seconds = self._requestBlockwise( opCompute.OutputImage )
+
+        # Store them in one file per channel (chunked like the requests)
+        features = opCompute.OutputImage[:].wait()
+        paths = []
+        for c in range( features.shape[-1] ):
+            path = os.path.join( self.tmpdir, 'feature_{}.h5'.format(c) )
+            with h5py.File( path, 'w' ) as f:
+                f.create_dataset( 'data', data=features[0,...,c], chunks=(self.BLOCK_SIDE,)*3 )
+            paths.append( path )
+        listfile = os.path.join( self.tmpdir, 'features.txt' )
+        with open( listfile, 'w' ) as f:
+            f.write( "\n".join( paths ) + "\n" )
+
+        # Read them back
+        opRead = OpFeatureSelection( filter_implementation='Original', graph=Graph() )
+        opRead.InputImage.setValue( self.raw )
+        opRead.Scales.setValue( self.SCALES )
+        opRead.FeatureIds.setValue( self.FEATURE_IDS )
+        opRead.SelectionMatrix.setValue( selections )
+        opRead.FeatureListFilename.setValue( listfile )
+        read_seconds = self._requestBlockwise( opRead.OutputImage )
+
+        assert ( opRead.OutputImage[:].wait() == features ).all()
+        logger.info( "{} feature channels: computed in {:.2f} seconds, read from files in {:.2f} seconds"
+                     .format( len(paths), compute_seconds, read_seconds ) )
+        opRead.cleanUp()
+        opCompute.cleanUp()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
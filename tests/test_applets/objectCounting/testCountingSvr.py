@@ -0,0 +1,119 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import sys
+import logging
+import resource
+
+import numpy as np
+import nose
+
+from lazyflow.utility.timer import Timer
+
+from ilastik.applets.counting.countingsvr import SVR, RegressorC
+
+logger = logging.getLogger(__name__)
+logger.addHandler( logging.StreamHandler(sys.stdout) )
+
+def _linearSVR( numFeatures, numRegressors ):
+    """
+    An SVR with linear regressors with random weights (no training, so no solver is needed).
+    """
+    minmax = ( np.zeros( (numFeatures,) ), np.random.rand( numFeatures ) + 0.5 )
+    svr = SVR( method="BoxedRegressionCplex", minmax=minmax )
+    svr._regressor = []
+    for i in range(numRegressors):
+        regressor = RegressorC()
+        regressor.w = np.random.rand( numFeatures+1, 1 ) - 0.5
+        svr._regressor.append( regressor )
+    svr._numRegressors = numRegressors
+    return svr
+
+def _predictWholeImage( svr, oldImage ):
+    """
+    The previous implementation of SVR.predict(), which normalizes and predicts the whole image at once.
+    """
+    oldShape = oldImage.shape
+    image = np.copy(oldImage.reshape((-1, oldImage.shape[-1])))
+    image = svr.normalize(image)
+    reslist = [ r.predict(image) for r in svr._regressor ]
+    res = np.dstack(reslist).view(np.ndarray)
+    res[res < 0] = 0
+    return res.reshape(oldShape[:-1] + (len(svr._regressor),))
+
+class TestSVRPredict(object):
+
+    def testBatches(self):
+        svr = _linearSVR( 5, 3 )
+        svr.PREDICTION_BATCH_SIZE = 100
+        image = np.random.rand( 4, 30, 25, 5 ).astype( np.float32 )
+
+        expected = _predictWholeImage( svr, image )
+        result = svr.predict( image )
+        assert result.shape == (4, 30, 25, 3)
+        assert ( result >= 0 ).all()
+        np.testing.assert_allclose( result, expected, rtol=1e-5 )
+
+    def testUntrainedRegressor(self):
+        svr = _linearSVR( 5, 2 )
+        svr._regressor[1] = None
+        result = svr.predict( np.random.rand( 10, 10, 5 ) )
+        assert result.shape == (10, 10, 2)
+        assert ( result[..., 1] == 0 ).all()
+
+class TestSVRPredictBenchmark(object):
+    """
+    Compares the time and memory of the streaming prediction with the previous whole-image prediction
+    for a large 2D+t feature image.
+    """
+    SHAPE = (20, 1024, 1024, 12) # t, x, y, features
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def _measure(self, predict, image):
+        rss_before = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+        timer = Timer()
+        timer.start()
+        predict( image )
+        timer.stop()
+        peak_mb = ( resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss - rss_before ) / 1024.0
+        return timer.seconds(), peak_mb
+
+    def testBenchmark(self):
+        svr = _linearSVR( self.SHAPE[-1], 4 )
+        image = np.random.rand( *self.SHAPE ).astype( np.float32 )
+
+        # The streaming path runs first, because the peak memory (maxrss) only grows.
+        streaming = self._measure( svr.predict, image )
+        whole = self._measure( lambda img: _predictWholeImage( svr, img ), image )
+        logger.info( "Feature image: {:.0f} MB".format( image.nbytes / 1e6 ) )
+        logger.info( "Streaming prediction: {:.2f} seconds, peak memory increase {:.0f} MB".format( *streaming ) )
+        logger.info( "Whole-image prediction: {:.2f} seconds, peak memory increase {:.0f} MB".format( *whole ) )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -29,13 +29,14 @@ import unittest
 import numpy as np
 import vigra
 from lazyflow.graph import Graph
+from lazyflow.operators import OpArrayPiper
 from ilastik.applets.objectClassification.opObjectClassification import \
     OpRelabelSegmentation, OpObjectTrain, OpObjectPredict, OpObjectClassification, \
     OpBadObjectsToWarningMessage, OpMaxLabel
     
 from ilastik.applets.counting.opCounting import \
     OpCounting, OpMean, OpVolumeOperator,OpLabelPipeline, \
-    OpPredictionPipelineNoCache,OpPredictionPipeline
+    OpPredictionPipelineNoCache,OpPredictionPipeline, OpBoxStatistics
 
 from ilastik.applets.counting.countingOperators import OpTrainCounter, OpPredictCounter, OpLabelPreviewer
 
@@ -89,6 +90,80 @@ class TestOpMean(object):
         #FIXME: why is it this the region ?
         np.testing.assert_allclose(np.mean(rimg.view(np.ndarray),axis=2),mean.view(np.ndarray)[...,0:1,0])
 
+class TestOpBoxStatistics(object):
+    def setUp(self):
+        g = Graph()
+        self.piper = OpArrayPiper(graph=g)
+        self.op = OpBoxStatistics(graph=g)
+        self.op.BlockShape.setValue(16)
+        self.op.Input.connect(self.piper.Output)
+
+    def _density(self):
+        img = np.random.rand(1, 70, 50, 1, 1)
+        return vigra.taggedView(img, 'txyzc')
+
+    def _check(self, density, rois):
+        counts, means, stds = self.op.getBoxStatistics(rois)
+        for (start, stop), count, mean, std in zip(rois, counts, means, stds):
+            region = density.view(np.ndarray)[0, start[1]:stop[1], start[2]:stop[2], 0, 0]
+            if region.size == 0:
+                assert count == mean == std == 0
+                continue
+            np.testing.assert_allclose(count, np.sum(region))
+            np.testing.assert_allclose(mean, np.mean(region))
+            np.testing.assert_allclose(std, np.std(region), atol=1e-7)
+
+    def test(self):
+        density = self._density()
+        self.piper.Input.setValue(density)
+        rois = [ [(0, 0, 0, 0, 0), (1, 70, 50, 1, 1)],    # whole image
+                 [(0, 3, 5, 0, 0), (1, 10, 12, 1, 1)],    # within one block
+                 [(0, 10, 7, 0, 0), (1, 45, 33, 1, 1)],   # several blocks
+                 [(0, 60, 40, 0, 0), (1, 70, 50, 1, 1)],  # partial blocks at the border
+                 [(0, 20, 20, 0, 0), (1, 20, 30, 1, 1)] ] # empty
+        self._check(density, rois)
+
+        # New data invalidates the tables
+        density = self._density()
+        self.piper.Input.setValue(density)
+        self._check(density, rois)
+
+    def testUnorderedAndClipped(self):
+        density = self._density()
+        self.piper.Input.setValue(density)
+        counts, _, _ = self.op.getBoxStatistics([ [(1, 45, 33, 1, 1), (0, 10, 7, 0, 0)],
+                                                  [(0, -5, -5, 0, 0), (1, 100, 100, 1, 1)] ])
+        np.testing.assert_allclose(counts[0], np.sum(density.view(np.ndarray)[0, 10:45, 7:33]))
+        np.testing.assert_allclose(counts[1], np.sum(density.view(np.ndarray)))
+
+    def testCoarseTables(self):
+        density = self._density()
+        self.piper.Input.setValue(density)
+        # The first query computes all block tables, so the coarse tables can be built
+        self._check(density, [ [(0, 0, 0, 0, 0), (1, 70, 50, 1, 1)] ])
+        assert self.op._coarseTables is not None
+
+        # Boxes that cover whole blocks (including the smaller blocks at the image border) and parts of blocks
+        rois = [ [(0, 16, 16, 0, 0), (1, 48, 48, 1, 1)],
+                 [(0, 5, 3, 0, 0), (1, 70, 50, 1, 1)],
+                 [(0, 17, 1, 0, 0), (1, 63, 49, 1, 1)],
+                 [(0, 0, 0, 0, 0), (1, 16, 50, 1, 1)],
+                 [(0, 30, 10, 0, 0), (1, 33, 45, 1, 1)] ]
+        for _ in range(20):
+            x0, x1 = sorted(np.random.randint(0, 71, 2))
+            y0, y1 = sorted(np.random.randint(0, 51, 2))
+            rois.append( [(0, x0, y0, 0, 0), (1, x1, y1, 1, 1)] )
+        self._check(density, rois)
+
+        # Only the blocks on the border of a box are needed
+        assert sorted(self.op._borderBlocksOfBox( (5, 70, 3, 50) )) == \
+               sorted( [(0, by) for by in range(4)] + [(bx, 0) for bx in range(1, 5)] )
+        assert self.op._interiorBlocksOfBox( (5, 70, 3, 50) ) == (1, 5, 1, 4)
+
+        # Dirty input invalidates the coarse tables
+        self.piper.Input.setDirty(slice(None))
+        assert self.op._coarseTables is None
+
         
 # class TestOpObjectTrain(unittest.TestCase):
 #     
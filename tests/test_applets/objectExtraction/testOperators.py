@@ -185,6 +185,156 @@ class testOpRegionFeaturesAgainstNumpy(object):
                     assert abs(coord-center_good)<0.01
 
 
+class testOpRegionFeaturesLocalBatches(object):
+    """
+    Local features must not depend on how the objects are split into parallel batches.
+    """
+    def setUp(self):
+        self.features = {
+            NAME : {
+                "Count" : {},
+                "Coord<Minimum>" : {},
+                "Coord<Maximum>" : {},
+                "Mean in neighborhood" : {"margin" : (5, 5, 1)},
+                "Sum in neighborhood" : {"margin" : (5, 5, 1)}
+            }
+        }
+
+    def _computeFeatures(self, batch_size):
+        g = Graph()
+        labelop = OpLabelVolume(graph=g)
+        op = OpRegionFeatures(graph=g)
+        op.LOCAL_FEATURES_BATCH_SIZE = batch_size
+        op.LabelVolume.connect(labelop.Output)
+        op.RawVolume.setValue(rawImage())
+        op.Features.setValue(self.features)
+        labelop.Input.setValue(binaryImage())
+
+        opAdapt = OpAdaptTimeListRoi(graph=g)
+        opAdapt.Input.connect(op.Output)
+        return opAdapt.Output([0, 1]).wait()
+
+    def test(self):
+        serial_feats = self._computeFeatures(1000)
+        batched_feats = self._computeFeatures(1)
+        for t in [0, 1]:
+            assert set(serial_feats[t][NAME].keys()) == set(batched_feats[t][NAME].keys())
+            assert "Sum in object and neighborhood" in batched_feats[t][NAME]
+            for key, value in serial_feats[t][NAME].items():
+                assert (value == batched_feats[t][NAME][key]).all(), key
+
+
+class testOpRegionFeaturesBlockwise(object):
+    """
+    Features computed block by block must match the features of the whole volume,
+    also for objects that span several blocks.
+    """
+    def _computeFeatures(self, features, blockShape3d):
+        g = Graph()
+        labelop = OpLabelVolume(graph=g)
+        op = OpRegionFeatures(graph=g)
+        op.LabelVolume.connect(labelop.Output)
+        op.RawVolume.setValue(rawImage())
+        op.Features.setValue(features)
+        if blockShape3d is not None:
+            op.BlockShape3dDict.setValue(blockShape3d)
+        labelop.Input.setValue(binaryImage())
+
+        opAdapt = OpAdaptTimeListRoi(graph=g)
+        opAdapt.Input.connect(op.Output)
+        return opAdapt.Output([0, 1]).wait()
+
+    def _compare(self, features, blockShape3d):
+        whole_feats = self._computeFeatures(features, None)
+        blockwise_feats = self._computeFeatures(features, blockShape3d)
+        for t in [0, 1]:
+            assert set(whole_feats[t].keys()) == set(blockwise_feats[t].keys())
+            for plugin_name, plugin_feats in whole_feats[t].items():
+                assert set(plugin_feats.keys()) == set(blockwise_feats[t][plugin_name].keys())
+                for key, value in plugin_feats.items():
+                    blockwise_value = blockwise_feats[t][plugin_name][key]
+                    assert value.shape == blockwise_value.shape, key
+                    assert blockwise_value.dtype == np.float32
+                    assert np.allclose(value, blockwise_value, rtol=1e-4), key
+
+    def test(self):
+        features = {
+            NAME : {
+                "Count" : {},
+                "Sum" : {},
+                "Mean" : {},
+                "Variance" : {},
+                "Minimum" : {},
+                "Maximum" : {},
+                "RegionCenter" : {},
+                "Coord<Minimum>" : {}
+            }
+        }
+        # Block boundaries cut through all objects
+        self._compare(features, {'x' : 7, 'y' : 11, 'z' : 13})
+
+    def testDefaultFeaturesOnly(self):
+        self._compare({}, {'x' : 16, 'y' : 16, 'z' : 16})
+
+    def testFallback(self):
+        # Local features can't be computed blockwise, so the whole volume is used.
+        features = {
+            NAME : {
+                "Count" : {},
+                "Mean in neighborhood" : {"margin" : (5, 5, 1)}
+            }
+        }
+        self._compare(features, {'x' : 16, 'y' : 16, 'z' : 16})
+
+
+class testOpRegionFeaturesLocalBenchmark(object):
+    """
+    Measures how local feature computation scales with the number of threads,
+    for a single time slice with many objects.
+    """
+    NUM_THREADS = [1, 2, 4, 8]
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        import nose
+        raise nose.SkipTest
+
+    def test(self):
+        import time
+        from lazyflow.request import Request
+
+        # A grid of ~10000 small objects
+        binimage = np.zeros((1, 400, 400, 10, 1), dtype=np.float32)
+        binimage[0, 1::4, 1::4, 2:8, 0] = 1
+        binimage[0, 2::4, 2::4, 2:8, 0] = 1
+        binimage = vigra.taggedView(binimage, 'txyzc')
+        rawimage = vigra.taggedView(np.random.random(binimage.shape).astype(np.float32), 'txyzc')
+        features = { NAME : { "Count" : {},
+                              "Mean in neighborhood" : {"margin" : (3, 3, 1)},
+                              "Variance in neighborhood" : {"margin" : (3, 3, 1)} } }
+
+        try:
+            for num_threads in self.NUM_THREADS:
+                Request.reset_thread_pool(num_threads)
+                g = Graph()
+                labelop = OpLabelVolume(graph=g)
+                op = OpRegionFeatures(graph=g)
+                op.LabelVolume.connect(labelop.Output)
+                op.RawVolume.setValue(rawimage)
+                op.Features.setValue(features)
+                labelop.Input.setValue(binimage)
+                labelop.Output[:].wait()
+
+                start = time.time()
+                feats = op.Output([0], [1]).wait()
+                nobj = feats[0][NAME]["Count"].shape[0] - 1
+                print "{} threads: local features of {} objects in {:.2f} seconds".format(num_threads, nobj, time.time() - start)
+        finally:
+            Request.reset_thread_pool()
+
+
 if __name__ == '__main__':
     import sys
     import nose
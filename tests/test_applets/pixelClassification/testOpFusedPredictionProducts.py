@@ -0,0 +1,99 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from ilastik.applets.pixelClassification.opPixelClassification import OpFusedPredictionProducts, OpEnsembleMargin
+from tests.helpers import OpCountingPiper
+
+class TestOpFusedPredictionProducts(object):
+
+    def setUp(self):
+        pmap = numpy.random.random( (50, 60, 4) ).astype( numpy.float32 )
+        pmap /= pmap.sum( axis=-1 )[..., None]
+        self.pmap = vigra.taggedView( pmap, 'xyc' )
+        OpCountingPiper.requested_pixels = 0
+
+        graph = Graph()
+        self.opInput = OpCountingPiper( graph=graph )
+        self.opInput.Input.setValue( self.pmap )
+        self.opProducts = OpFusedPredictionProducts( graph=graph )
+        self.opProducts.Input.connect( self.opInput.Output )
+
+    def testProducts(self):
+        pmap = self.pmap.view( numpy.ndarray )
+        op = self.opProducts
+
+        assert op.SimpleSegmentation.meta.shape == (50, 60, 1)
+        assert op.SimpleSegmentation.meta.dtype == numpy.uint8
+        assert op.Uint8Probabilities.meta.dtype == numpy.uint8
+
+        probabilities = op.Probabilities[10:20, 5:50, 1:3].wait()
+        assert (probabilities == pmap[10:20, 5:50, 1:3]).all()
+
+        uint8 = op.Uint8Probabilities[:].wait()
+        assert (uint8 == (255*pmap).astype(numpy.uint8)).all()
+
+        segmentation = op.SimpleSegmentation[:].wait()
+        assert (segmentation[..., 0] == numpy.argmax( pmap, axis=-1 ) + 1).all()
+
+        sorted_pmap = numpy.sort( pmap, axis=-1 )
+        expected_uncertainty = 1 - (sorted_pmap[..., -1] - sorted_pmap[..., -2])
+        uncertainty = op.UncertaintyEstimate[:].wait()
+        assert numpy.allclose( uncertainty[..., 0], expected_uncertainty )
+
+    def testSingleComputation(self):
+        """
+        All products of the same region are derived from a single request for the probabilities.
+        """
+        op = self.opProducts
+        op.SimpleSegmentation[0:25, 0:30, :].wait()
+        requested = OpCountingPiper.requested_pixels
+        assert requested == 25*30*4
+
+        op.UncertaintyEstimate[0:25, 0:30, :].wait()
+        op.Uint8Probabilities[0:25, 0:30, :].wait()
+        op.Probabilities[5:20, 10:30, 2:3].wait() # Subregion
+        assert OpCountingPiper.requested_pixels == requested
+
+        # A different region must be computed
+        op.Probabilities[25:50, 0:30, :].wait()
+        assert OpCountingPiper.requested_pixels == 2*requested
+
+        # Dirty input invalidates the buffer
+        self.opInput.Input.setDirty( slice(None) )
+        op.Probabilities[0:25, 0:30, :].wait()
+        assert OpCountingPiper.requested_pixels == 3*requested
+
+    def testEnsembleMargin(self):
+        opMargin = OpEnsembleMargin( graph=Graph() )
+        opMargin.Input.setValue( self.pmap )
+        sorted_pmap = numpy.sort( self.pmap.view( numpy.ndarray ), axis=-1 )
+        expected = 1 - (sorted_pmap[..., -1:] - sorted_pmap[..., -2:-1])
+        assert numpy.allclose( opMargin.Output[:].wait(), expected )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
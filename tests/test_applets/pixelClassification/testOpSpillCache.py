@@ -0,0 +1,107 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import shutil
+import tempfile
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from ilastik.applets.pixelClassification.opSpillCache import OpSpillCache
+from tests.helpers import OpCountingPiper
+
+class TestOpSpillCache(object):
+
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        self.data = vigra.taggedView( numpy.random.random( (100,100,3) ).astype( numpy.float32 ), 'xyc' )
+        OpCountingPiper.requested_pixels = 0
+
+        graph = Graph()
+        self.opData = OpCountingPiper( graph=graph )
+        self.opData.Input.setValue( self.data )
+        self.opSpill = OpSpillCache( graph=graph )
+        self.opSpill.Input.connect( self.opData.Output )
+        self.opSpill.ScratchDirectory.setValue( self.scratch_dir )
+
+    def tearDown(self):
+        self.opSpill.cleanUp()
+        shutil.rmtree( self.scratch_dir )
+
+    def _waitForSpills(self, num_spills, timeout=10.0):
+        start = time.time()
+        while self.opSpill.getStatistics()['spills'] < num_spills:
+            assert time.time() - start < timeout, "Blocks were not spilled to disk"
+            time.sleep( 0.01 )
+
+    def testSpilledBlocksAreReused(self):
+        result = self.opSpill.Output[0:50, 0:50, :].wait()
+        assert (result == self.data[0:50, 0:50, :]).all()
+        assert OpCountingPiper.requested_pixels == 50*50*3
+        self._waitForSpills( 1 )
+
+        result = self.opSpill.Output[0:50, 0:50, :].wait()
+        assert (result == self.data[0:50, 0:50, :]).all()
+        assert OpCountingPiper.requested_pixels == 50*50*3, "Spilled block was recomputed"
+
+        stats = self.opSpill.getStatistics()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['stored_bytes'] > 0
+
+    def testDirtyInvalidatesBlocks(self):
+        self.opSpill.Output[0:50, 0:50, :].wait()
+        self.opSpill.Output[50:100, 0:50, :].wait()
+        self._waitForSpills( 2 )
+
+        self.opData.Input.setDirty( (0,0,0), (10,10,3) )
+        self.opSpill.Output[0:50, 0:50, :].wait()
+        self.opSpill.Output[50:100, 0:50, :].wait()
+        assert OpCountingPiper.requested_pixels == 3*50*50*3, "Only the dirty block should be recomputed"
+
+    def testSizeLimit(self):
+        # Too small for even a single block
+        self.opSpill.MaxSizeMB.setValue( 1e-6 )
+        self.opSpill.Output[0:50, 0:50, :].wait()
+        self._waitForSpills( 1 )
+        assert self.opSpill.getStatistics()['evictions'] == 1
+        assert self.opSpill.getStatistics()['stored_bytes'] == 0
+
+        self.opSpill.Output[0:50, 0:50, :].wait()
+        assert OpCountingPiper.requested_pixels == 2*50*50*3
+
+    def testDisabled(self):
+        self.opSpill.ScratchDirectory.setValue( '' )
+        for i in range(2):
+            result = self.opSpill.Output[0:50, 0:50, :].wait()
+            assert (result == self.data[0:50, 0:50, :]).all()
+        assert OpCountingPiper.requested_pixels == 2*50*50*3
+        assert self.opSpill.getStatistics()['spills'] == 0
+        assert os.listdir( self.scratch_dir ) == []
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
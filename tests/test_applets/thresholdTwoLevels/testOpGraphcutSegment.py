@@ -34,9 +34,14 @@ from nose import SkipTest
 from lazyflow.graph import Graph
 from lazyflow.operators.opArrayPiper import OpArrayPiper
 
+import time
+import threading
+
 if have_opengm:
     from ilastik.applets.thresholdTwoLevels.opGraphcutSegment\
         import OpObjectsSegment, OpGraphCut
+    from ilastik.applets.thresholdTwoLevels._OpObjectsSegment\
+        import _ObjectScheduler
 
 def getTestVolume():
     t, c = 3, 2
@@ -174,3 +179,162 @@ class TestOpObjectsSegment(unittest.TestCase):
             op.LabelImage.connect(piper.Output)
 
     #TODO test dirty propagation
+
+
+def getManyObjectsVolume(shape, nobj, seed=0):
+    """
+    Prediction and label volumes (5d, txyzc) with nobj boxes of various sizes.
+    """
+    np.random.seed(seed)
+    vol = np.random.rand(*shape).astype(np.float32)*.1
+    labels = np.zeros(shape, dtype=np.uint32)
+    for i in range(1, nobj+1):
+        size = np.random.randint(3, 20, size=3)
+        start = [np.random.randint(0, s - d) for s, d in zip(shape[1:4], size)]
+        box = (0,) + tuple(slice(b, b + d) for b, d in zip(start, size)) + (0,)
+        vol[box] = np.random.rand(*size)*.39 + .6
+        labels[box] = i
+    return (vigra.taggedView(vol, axistags='txyzc'),
+            vigra.taggedView(labels, axistags='txyzc'))
+
+
+def runObjectsSegment(vol, labels, budget_mb):
+    graph = Graph()
+    op = OpObjectsSegment(graph=graph)
+    op.RAM_BUDGET_MB = budget_mb
+    piper = OpArrayPiper(graph=graph)
+    piper.Input.setValue(vol)
+    op.Prediction.connect(piper.Output)
+    op.LabelImage.setValue(labels)
+    op.Margin.setValue(np.asarray((5, 5, 5)))
+
+    progress = []
+    op.progressSignal.subscribe(progress.append)
+    out = op.Output[...].wait()
+    return out, progress
+
+
+@unittest.skipIf(not have_opengm, "OpenGM not available")
+class TestOpObjectsSegmentScheduling(unittest.TestCase):
+
+    def testAgainstUnscheduled(self):
+        vol, labels = getManyObjectsVolume((1, 100, 100, 60, 1), 20)
+        expected, _ = runObjectsSegment(vol, labels, 0)
+        # a budget that is smaller than most objects: run (almost) sequentially
+        out, progress = runObjectsSegment(vol, labels, 1)
+        assert_array_equal(out, expected)
+
+        # one report per object, plus start and end
+        nobj = len(np.unique(labels)) - 1
+        assert len(progress) == nobj + 2
+        assert progress[0] == 0
+        assert progress[-1] == 100
+        assert all(a <= b for a, b in zip(progress[:-1], progress[1:]))
+
+
+class _FakeJobs(object):
+    """
+    Jobs that only record their start order and the bytes that are running concurrently.
+    """
+    def __init__(self, costs, seconds=0.02):
+        self._lock = threading.Lock()
+        self._seconds = seconds
+        self.jobs = [(cost, self._job(cost)) for cost in costs]
+        self.started = []
+        self.runningBytes = 0
+        self.maxRunningBytes = 0
+        self.maxRunningJobs = 0
+        self._numRunning = 0
+
+    def _job(self, cost):
+        def job():
+            with self._lock:
+                self.started.append(cost)
+                self.runningBytes += cost
+                self._numRunning += 1
+                self.maxRunningBytes = max(self.maxRunningBytes, self.runningBytes)
+                self.maxRunningJobs = max(self.maxRunningJobs, self._numRunning)
+            time.sleep(self._seconds)
+            with self._lock:
+                self.runningBytes -= cost
+                self._numRunning -= 1
+        return job
+
+
+@unittest.skipIf(not have_opengm, "OpenGM not available")
+class TestObjectScheduler(unittest.TestCase):
+
+    def testLargestFirst(self):
+        # every job takes more than half the budget: one job at a time, largest first
+        costs = [6, 9, 7, 8, 10, 6]
+        fake = _FakeJobs(costs)
+        progress = []
+        _ObjectScheduler(11, progress.append).run(fake.jobs)
+        assert fake.started == sorted(costs, reverse=True)
+        assert fake.maxRunningJobs == 1
+        assert progress == list(range(1, len(costs) + 1))
+
+    def testBudget(self):
+        costs = [1, 2, 3, 4, 5, 6, 7, 8] * 4
+        fake = _FakeJobs(costs)
+        _ObjectScheduler(10, None).run(fake.jobs)
+        assert sorted(fake.started) == sorted(costs)
+        assert fake.maxRunningBytes <= 10
+        # the largest jobs are admitted first
+        assert fake.started[:4] == [8, 8, 8, 8]
+
+    def testOversizedJob(self):
+        # a job that exceeds the budget runs alone
+        fake = _FakeJobs([3, 20, 3])
+        _ObjectScheduler(10, None).run(fake.jobs)
+        assert fake.started[0] == 20
+        assert fake.maxRunningBytes == 20
+        assert sorted(fake.started) == [3, 3, 20]
+
+    def testNoBudget(self):
+        fake = _FakeJobs([5] * 4, seconds=0.1)
+        _ObjectScheduler(0, None).run(fake.jobs)
+        assert len(fake.started) == 4
+        assert fake.maxRunningBytes <= 20
+
+    def testFailure(self):
+        def fail():
+            raise ValueError("job failed")
+        fake = _FakeJobs([1, 1])
+        try:
+            _ObjectScheduler(1, None).run([(2, fail)] + fake.jobs)
+        except ValueError:
+            pass
+        else:
+            assert False, "Expected the job's exception"
+        # no more jobs were started after the failure
+        assert fake.started == []
+
+
+class TestOpObjectsSegmentSchedulingBenchmark(object):
+    """
+    Compares the scheduled object loop (with a memory budget) to the
+    unscheduled one, for a volume with many objects.
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise SkipTest
+
+    def testBenchmark(self):
+        import time
+        vol, labels = getManyObjectsVolume((1, 500, 500, 200, 1), 500)
+
+        start = time.time()
+        expected, _ = runObjectsSegment(vol, labels, 0)
+        unscheduled = time.time() - start
+
+        start = time.time()
+        out, _ = runObjectsSegment(vol, labels, 500)
+        scheduled = time.time() - start
+
+        assert_array_equal(out, expected)
+        print("unscheduled: {:.1f}s, scheduled (500 MB): {:.1f}s".format(
+            unscheduled, scheduled))
@@ -31,6 +31,8 @@ from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels\
     import _OpThresholdOneLevel as OpThresholdOneLevel
 from ilastik.applets.thresholdTwoLevels.opThresholdTwoLevels\
     import _OpThresholdTwoLevels as OpThresholdTwoLevels5d
+from ilastik.applets.thresholdTwoLevels.opBlockwiseThresholdTwoLevels\
+    import OpBlockwiseThresholdTwoLevels
 from ilastik.applets.thresholdTwoLevels.opGraphcutSegment import haveGraphCut
 
 import ilastik.ilastik_logging
@@ -386,6 +388,76 @@ class TestThresholdTwoLevelsInternal(Generator2):
             "{}% elements <= 0".format((out5d <= 0).sum()/float(out5d.size)*100)
 
 
+class TestBlockwiseThresholdTwoLevels(Generator2):
+
+    def _globalOutput(self, data, blockShape3d=None):
+        oper5d = OpThresholdTwoLevels5d(graph=Graph())
+        oper5d.InputImage.setValue(data)
+        oper5d.MinSize.setValue(self.minSize)
+        oper5d.MaxSize.setValue(self.maxSize)
+        oper5d.HighThreshold.setValue(self.highThreshold)
+        oper5d.LowThreshold.setValue(self.lowThreshold)
+        if blockShape3d is not None:
+            oper5d.BlockShape3dDict.setValue(blockShape3d)
+        return oper5d.CachedOutput[:].wait()
+
+    def _blockwiseOp(self, data, blockShape3d):
+        op = OpBlockwiseThresholdTwoLevels(graph=Graph())
+        op.InputImage.setValue(data)
+        op.MinSize.setValue(self.minSize)
+        op.MaxSize.setValue(self.maxSize)
+        op.HighThreshold.setValue(self.highThreshold)
+        op.LowThreshold.setValue(self.lowThreshold)
+        op.BlockShape3dDict.setValue(blockShape3d)
+        return op
+
+    def assertSameObjects(self, a, b):
+        # The label values differ, but the objects must be the same
+        numpy.testing.assert_array_equal(a > 0, b > 0)
+        pairs = set(zip(a[a > 0], b[b > 0]))
+        assert len(pairs) == len(numpy.unique(a[a > 0])) == len(numpy.unique(b[b > 0]))
+
+    def testAgainstGlobal(self):
+        # Small blocks, so the clusters cross block faces
+        blockShape3d = {'x': 6, 'y': 7, 'z': 6}
+        op = self._blockwiseOp(self.data5d[0:1, ..., 0:1], blockShape3d)
+        out = op.Output[:].wait()
+        self.checkResult(vigra.taggedView(out, axistags='txyzc')[0])
+        self.assertSameObjects(out, self._globalOutput(self.data5d[0:1, ..., 0:1]))
+
+        # Through _OpThresholdTwoLevels
+        cached = self._globalOutput(self.data5d[0:1, ..., 0:1], blockShape3d)
+        self.assertSameObjects(out, cached)
+
+    def testRandomData(self):
+        numpy.random.seed(0)
+        data = vigra.filters.gaussianSmoothing(
+            numpy.random.random((40, 41, 42)).astype(numpy.float32), 1.5)
+        data = (data - data.min()) / (data.max() - data.min())
+        data = vigra.taggedView(data[numpy.newaxis, ..., numpy.newaxis], axistags='txyzc')
+        self.minSize = 10
+        self.maxSize = 2000
+        self.highThreshold = 0.6
+        self.lowThreshold = 0.45
+
+        op = self._blockwiseOp(data, {'x': 8, 'y': 8, 'z': 8})
+        expected = self._globalOutput(data)
+        assert (expected > 0).any()
+        self.assertSameObjects(op.Output[:].wait(), expected)
+
+        # Requesting a single block first (so only part of the volume is labeled)
+        op = self._blockwiseOp(data, {'x': 8, 'y': 8, 'z': 8})
+        block = op.Output[:, 16:24, 8:16, 0:8, :].wait()
+        out = op.Output[:].wait()
+        numpy.testing.assert_array_equal(block, out[:, 16:24, 8:16, 0:8, :])
+        self.assertSameObjects(out, expected)
+
+        # Changing the size filters keeps the labels
+        op.MaxSize.setValue(100)
+        self.maxSize = 100
+        self.assertSameObjects(op.Output[:].wait(), self._globalOutput(data))
+
+
 class TestThresholdTwoLevels(Generator2):
 
     def testOpSelectLabels(self):
@@ -0,0 +1,184 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import numpy as np
+import nose
+
+from ilastik.applets.tracking.base import opTrackingBase
+from ilastik.applets.tracking.base.opTrackingBase import OpTrackingBase
+from ilastik.applets.objectExtraction.opObjectExtraction import default_features_key
+
+class FakeTraxel(object):
+    """Records the values that _generate_traxelstore() sets on a pgmlink.Traxel."""
+    def __init__(self):
+        self.Id = None
+        self.Timestep = None
+        self.features = {}
+
+    def set_x_scale(self, scale):
+        pass
+
+    set_y_scale = set_z_scale = set_x_scale
+
+    def add_feature_array(self, name, size):
+        self.features[name] = [None] * size
+
+    def set_feature_value(self, name, index, value):
+        self.features[name][index] = value
+
+class FakeTraxelStore(list):
+    add = list.append
+
+class FakePgmlink(object):
+    Traxel = FakeTraxel
+    TraxelStore = FakeTraxelStore
+    VectorOfInt = list
+
+class FakeSlot(object):
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def __call__(self, roi):
+        return self
+
+    def wait(self):
+        return self.value
+
+    def setValue(self, value, check_changed=True):
+        self.value = value
+
+class FakeOpTrackingBase(object):
+    """Provides the slots that _generate_traxelstore() reads, without a graph."""
+    def __init__(self, feats, divProbs):
+        self.Parameters = FakeSlot({})
+        self.ObjectFeatures = FakeSlot(feats)
+        self.DivisionProbabilities = FakeSlot(divProbs)
+        self.FilteredLabels = FakeSlot({})
+        self.traxelstore_timings = None
+
+def loopTraxels(feats, divProbs, time_range, x_range, y_range, z_range, size_range):
+    """
+    The original (per-object) filter loop of _generate_traxelstore(), for comparison.
+    Returns the filtered labels and a list of (timestep, id, com, count, divProb) for the traxels that passed.
+    """
+    filtered_labels = {}
+    traxels = []
+    for t in feats.keys():
+        rc = feats[t][default_features_key]['RegionCenter']
+        if rc.size:
+            rc = rc[1:, ...]
+        ct = feats[t][default_features_key]['Count']
+        if ct.size:
+            ct = ct[1:, ...]
+
+        filtered_labels_at = []
+        for idx in range(rc.shape[0]):
+            if len(rc[idx]) == 2:
+                x, y = rc[idx]
+                z = 0
+            else:
+                x, y, z = rc[idx]
+            size = ct[idx]
+            if (x < x_range[0] or x >= x_range[1] or
+                        y < y_range[0] or y >= y_range[1] or
+                        z < z_range[0] or z >= z_range[1] or
+                        size < size_range[0] or size >= size_range[1]):
+                filtered_labels_at.append(int(idx + 1))
+                continue
+            com = [float(v) for v in [x, y, z]]
+            traxels.append((t, int(idx + 1), com, [float(size)], [float(divProbs[t][idx + 1][1])]))
+
+        if len(filtered_labels_at) > 0:
+            filtered_labels[str(int(t) - time_range[0])] = filtered_labels_at
+    return filtered_labels, traxels
+
+def randomFeatures(time_range, num_objects, ndim, seed=0):
+    """Region centers in [0,100) and counts in [1,200), with the background object at index 0."""
+    rng = np.random.RandomState(seed)
+    feats = {}
+    divProbs = {}
+    n = num_objects + 1
+    for t in time_range:
+        feats[t] = { default_features_key : {
+                        'RegionCenter' : rng.uniform(0, 100, size=(n, ndim)),
+                        'Coord<Minimum>' : np.zeros((n, ndim)),
+                        'Coord<Maximum>' : np.zeros((n, ndim)),
+                        'Count' : rng.randint(1, 200, size=(n, 1)).astype(np.float32) } }
+    # The division classifier predicts every time step (_generate_traxelstore() checks time step 0)
+    for t in range(max(time_range) + 1):
+        div = rng.uniform(0, 1, size=(n, 1))
+        divProbs[t] = np.concatenate((1 - div, div), axis=1)
+    return feats, divProbs
+
+class TestGenerateTraxelstore(object):
+    def setUp(self):
+        self._pgmlink = opTrackingBase.pgmlink
+        opTrackingBase.pgmlink = FakePgmlink
+
+    def tearDown(self):
+        opTrackingBase.pgmlink = self._pgmlink
+
+    def _check(self, feats, divProbs, time_range, x_range, y_range, z_range, size_range):
+        op = FakeOpTrackingBase(feats, divProbs)
+        ts, empty_frame = OpTrackingBase._generate_traxelstore.im_func(
+            op, time_range, x_range, y_range, z_range, size_range, with_div=True)
+
+        expected_filtered, expected_traxels = loopTraxels(feats, divProbs, time_range,
+                                                          x_range, y_range, z_range, size_range)
+        traxels = [(tr.Timestep, tr.Id, tr.features['com'], tr.features['count'], tr.features['divProb'])
+                   for tr in ts]
+        assert op.FilteredLabels.value == expected_filtered
+        assert traxels == expected_traxels
+        assert all(type(v) is float for traxel in traxels for feature in traxel[2:] for v in feature)
+        return traxels
+
+    def test2D(self):
+        time_range = range(3, 7)
+        feats, divProbs = randomFeatures(time_range, 200, 2)
+        traxels = self._check(feats, divProbs, time_range, [10, 90], [20, 70], [0, 1], [5, 150])
+        assert 0 < len(traxels) < 4 * 200, "Some objects must pass the filter, and some must be filtered out."
+        assert all(traxel[2][2] == 0.0 for traxel in traxels)
+
+    def test3D(self):
+        time_range = range(0, 3)
+        feats, divProbs = randomFeatures(time_range, 300, 3, seed=1)
+        traxels = self._check(feats, divProbs, time_range, [10, 90], [0, 100], [25, 75], [0, 180])
+        assert 0 < len(traxels) < 3 * 300, "Some objects must pass the filter, and some must be filtered out."
+
+    def testEmptyFrame(self):
+        time_range = range(0, 2)
+        feats, divProbs = randomFeatures(time_range, 20, 3, seed=2)
+        for key in ['RegionCenter', 'Coord<Minimum>', 'Coord<Maximum>', 'Count']:
+            feats[1][default_features_key][key] = np.zeros((0,))
+        op = FakeOpTrackingBase(feats, divProbs)
+        ts, empty_frame = OpTrackingBase._generate_traxelstore.im_func(
+            op, time_range, [0, 100], [0, 100], [0, 100], [0, 1000], with_div=True)
+        assert empty_frame
+        assert len(ts) == 20
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,175 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import shutil
+import tempfile
+
+import numpy as np
+import h5py
+import nose
+
+from ilastik.applets.tracking.base.trackingUtilities import relabel, relabelMergers, relabelTable, applyRelabelTable, \
+    SingleFileEventWriter
+
+def loopRelabel(volume, replace, default):
+    """The original (per-label) implementation, for comparison."""
+    mp = np.arange(0, np.amax(volume) + 1, dtype=volume.dtype)
+    mp[1:] = default
+    for label in np.unique(volume):
+        if label > 0 and label in replace:
+            mp[label] = replace[label]
+    return mp[volume]
+
+def randomFrame(shape, num_labels, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randint(0, num_labels+1, size=shape).astype(np.uint32)
+
+class TestRelabel(object):
+    def setUp(self):
+        self.volume = randomFrame((50, 60, 7), 500)
+        # Some labels are mapped, some are missing, and some keys don't occur in the volume
+        self.replace = dict((label, 1000 + label) for label in range(1, 700, 3))
+
+    def testRelabel(self):
+        expected = loopRelabel(self.volume, self.replace, 1)
+        result = relabel(self.volume, self.replace)
+        assert result.dtype == self.volume.dtype
+        assert (result == expected).all()
+
+    def testRelabelMergers(self):
+        mergers = dict((label, 2 + label % 3) for label in range(1, 500, 7))
+        assert (relabelMergers(self.volume, mergers) == loopRelabel(self.volume, mergers, 1)).all()
+
+    def testLabelsAboveTable(self):
+        # Labels larger than all keys get the default
+        table = relabelTable({1 : 5, 3 : 7}, default=1)
+        volume = np.array([[0, 1, 2], [3, 4, 100]], dtype=np.uint16)
+        assert (applyRelabelTable(volume, table) == [[0, 5, 1], [7, 1, 1]]).all()
+
+    def testEmpty(self):
+        assert (relabel(self.volume, {}) == np.where(self.volume > 0, 1, 0)).all()
+
+class TestSingleFileEventWriter(object):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test(self):
+        time_offset = 2
+        label_shape = (20, 30, 1)
+        frames = dict((t, randomFrame(label_shape, 10, seed=t)) for t in range(time_offset, time_offset+5))
+        events = {
+            "0" : { "app" : np.asarray([(1, 0.5), (2, 0.25)]) },
+            "1" : { "mov" : np.asarray([(1, 3, 0.1)]) },
+            "2" : {},
+            "3" : { "mov" : np.asarray([(3, 4, 0.2), (2, 5, 0.3)]),
+                    "div" : np.asarray([(1, 6, 7, 0.4)]) },
+            "4" : { "dis" : np.asarray([(4, 0.6)]) },
+        }
+
+        filename = os.path.join(self.tmpdir, "tracking.h5")
+        progress = []
+        writer = SingleFileEventWriter(filename, label_shape, time_offset, 5)
+        writer.run(events, lambda t: frames[t], progress.append)
+        assert progress[-1] == 100
+
+        with h5py.File(filename, 'r') as f:
+            labels = f["segmentation/labels"]
+            assert labels.attrs["time_offset"] == time_offset
+            assert labels.chunks[0] == 1
+            for i in range(5):
+                assert (labels[i] == frames[time_offset + i]).all()
+
+            assert (f["tracking/Appearances"][:] == [[1], [2]]).all()
+            assert (f["tracking/Moves"][:] == [[1, 3], [3, 4], [2, 5]]).all()
+            assert (f["tracking/Moves-Energy"][:] == [0.1, 0.2, 0.3]).all()
+            assert (f["tracking/Moves-Time"][:] == [3, 5, 5]).all()
+            assert (f["tracking/Splits"][:] == [[1, 6, 7]]).all()
+            assert (f["tracking/Disappearances-Time"][:] == [6]).all()
+            assert "Mergers" not in f["tracking"]
+
+            # Tables can be extended
+            assert f["tracking/Moves"].maxshape == (None, 2)
+
+    def testPendingFrames(self):
+        # At most two windows of frames are requested before they are written
+        num_frames = 20
+        label_shape = (10, 10, 1)
+        requested = []
+        progress = []
+        def getLabelImage(t):
+            requested.append(t)
+            assert len(requested) - len(progress) <= 2 * SingleFileEventWriter.MAX_PENDING_FRAMES
+            return randomFrame(label_shape, 10, seed=t)
+
+        filename = os.path.join(self.tmpdir, "tracking.h5")
+        writer = SingleFileEventWriter(filename, label_shape, 0, num_frames)
+        writer.run(dict((str(i), {}) for i in range(num_frames)), getLabelImage, progress.append)
+        assert sorted(requested) == range(num_frames)
+        assert len(progress) == num_frames
+
+        with h5py.File(filename, 'r') as f:
+            for i in range(num_frames):
+                assert (f["segmentation/labels"][i] == randomFrame(label_shape, 10, seed=i)).all()
+
+class TestRelabelBenchmark(object):
+    """
+    Compares the vectorized relabeling with the original per-label loop
+    for a frame with tens of thousands of cells (e.g. when scrolling through a tracked movie).
+    """
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+    def test(self):
+        num_labels = 50000
+        volume = randomFrame((1000, 1000, 1), num_labels)
+        replace = dict((label, np.random.randint(2, 1000)) for label in range(1, num_labels+1))
+
+        start = time.time()
+        expected = loopRelabel(volume, replace, 1)
+        loop_seconds = time.time() - start
+
+        # The table is built once per frame (and cached by the tracking operator)
+        start = time.time()
+        table = relabelTable(replace)
+        table_seconds = time.time() - start
+
+        start = time.time()
+        result = applyRelabelTable(volume, table)
+        gather_seconds = time.time() - start
+
+        assert (result == expected).all()
+        print "Relabeling {} labels: loop {:.3f}s, table {:.3f}s + gather {:.3f}s".format(
+            num_labels, loop_seconds, table_seconds, gather_seconds)
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
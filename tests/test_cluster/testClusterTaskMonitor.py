@@ -0,0 +1,148 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import time
+import tempfile
+import subprocess
+import collections
+
+from lazyflow.utility.io.blockwiseFileset import BlockwiseFileset
+from ilastik.clusterOps import OpClusterize, ClusterTaskMonitor, LocalTaskPool
+
+class MockBlockwiseFileset(object):
+    """
+    Provides just the block status functions that the monitor uses.
+    """
+    def __init__(self):
+        self.statuses = collections.defaultdict( lambda: BlockwiseFileset.BLOCK_NOT_AVAILABLE )
+
+    def getBlockStatus(self, block_start):
+        return self.statuses[block_start]
+
+    def setBlockStatus(self, block_start, status):
+        self.statuses[block_start] = status
+
+    def isBlockLocked(self, block_start):
+        return False
+
+class TestClusterTaskMonitor(object):
+
+    def _makeTaskInfos(self, num_tasks):
+        taskInfos = collections.OrderedDict()
+        for i in range(num_tasks):
+            roi = ( (i*10,), ((i+1)*10,) )
+            taskInfo = OpClusterize.TaskInfo()
+            taskInfo.taskName = "J{:02}".format(i)
+            taskInfo.command = taskInfo.taskName
+            taskInfo.blockRois = [roi]
+            taskInfos[taskInfo.taskName] = taskInfo
+        return taskInfos
+
+    def _makeLaunchFunc(self, fileset, taskInfos, failures):
+        """
+        Each 'task' is a real subprocess.
+        Task names listed in ``failures`` fail that many times before they succeed.
+        """
+        rois = dict( (t.taskName, t.blockRois[0]) for t in taskInfos.values() )
+        self.launches = collections.Counter()
+        def launchFunc( taskName ):
+            self.launches[taskName] += 1
+            if failures.get( taskName, 0 ) >= self.launches[taskName]:
+                cmd = "exit 1"
+            else:
+                cmd = "exit 0"
+                fileset.setBlockStatus( rois[taskName][0], BlockwiseFileset.BLOCK_AVAILABLE )
+            return subprocess.Popen( cmd, shell=True )
+        return launchFunc
+
+    def testRetry(self):
+        fileset = MockBlockwiseFileset()
+        taskInfos = self._makeTaskInfos(4)
+        launchFunc = self._makeLaunchFunc( fileset, taskInfos, { "J01" : 2 } )
+
+        monitor = ClusterTaskMonitor( fileset, taskInfos, launchFunc, max_retries=2, poll_interval_secs=0.01 )
+        assert monitor.run()
+        assert self.launches["J01"] == 3
+        assert self.launches["J00"] == 1
+        assert monitor.relaunch_count == 2
+        assert len(monitor.completed_tasks) == 4
+        assert not monitor.failed_tasks
+
+    def testGiveUp(self):
+        fileset = MockBlockwiseFileset()
+        taskInfos = self._makeTaskInfos(3)
+        launchFunc = self._makeLaunchFunc( fileset, taskInfos, { "J02" : 5 } )
+
+        monitor = ClusterTaskMonitor( fileset, taskInfos, launchFunc, max_retries=1, poll_interval_secs=0.01 )
+        assert not monitor.run()
+        assert self.launches["J02"] == 2
+        assert monitor.failed_tasks == [ "J02" ]
+        assert len(monitor.completed_tasks) == 2
+
+    def testTerminateTimedOutTasks(self):
+        fileset = MockBlockwiseFileset()
+        taskInfos = self._makeTaskInfos(2)
+        pool = LocalTaskPool( tempfile.gettempdir(), pool_size=2, threads_per_task=1, ram_mb_per_task=1000 )
+        handles = []
+        def launchFunc( taskName ):
+            # These 'tasks' hang, and never complete their block
+            handles.append( pool.launch( "sleep 60" ) )
+            return handles[-1]
+
+        try:
+            monitor = ClusterTaskMonitor( fileset, taskInfos, launchFunc, max_retries=1, poll_interval_secs=0.01, task_timeout_secs=0.5 )
+            assert not monitor.run()
+            assert len(handles) == 4
+            assert sorted( monitor.failed_tasks ) == [ "J00", "J01" ]
+
+            # Each timed-out task was terminated (before it was relaunched), so the pool is idle again.
+            start = time.time()
+            pool.wait()
+            assert time.time() - start < 10.0
+            assert all( h.poll() != 0 for h in handles )
+        finally:
+            pool.shutdown()
+
+    def testUnpollableTaskTimeout(self):
+        # Remote tasks can't be polled.  If one of them dies, the monitor must not wait forever.
+        fileset = MockBlockwiseFileset()
+        taskInfos = self._makeTaskInfos(2)
+        launches = collections.Counter()
+        def launchFunc( taskName ):
+            launches[taskName] += 1
+            if taskName == "J00":
+                fileset.setBlockStatus( taskInfos[taskName].blockRois[0][0], BlockwiseFileset.BLOCK_AVAILABLE )
+            return None
+
+        class Monitor(ClusterTaskMonitor):
+            DEFAULT_TASK_TIMEOUT_SECS = 0.1
+
+        monitor = Monitor( fileset, taskInfos, launchFunc, max_retries=1, poll_interval_secs=0.01 )
+        assert not monitor.run()
+        assert launches["J01"] == 2
+        assert monitor.completed_tasks == [ "J00" ]
+        assert monitor.failed_tasks == [ "J01" ]
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
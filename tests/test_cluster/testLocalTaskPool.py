@@ -0,0 +1,96 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import shutil
+import tempfile
+
+from ilastik.clusterOps import LocalTaskPool
+
+class TestLocalTaskPool(object):
+
+    @classmethod
+    def setupClass(cls):
+        cls._tmpdir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardownClass(cls):
+        shutil.rmtree(cls._tmpdir) 
+
+    def testExitCodes(self):
+        pool = LocalTaskPool( self._tmpdir, pool_size=2, threads_per_task=1, ram_mb_per_task=1000 )
+        try:
+            handles = [ pool.launch( "exit {}".format(i) ) for i in range(4) ]
+            pool.wait()
+            assert [h.poll() for h in handles] == range(4)
+        finally:
+            pool.shutdown()
+
+    def testConcurrencyLimit(self):
+        pool = LocalTaskPool( self._tmpdir, pool_size=2, threads_per_task=1, ram_mb_per_task=1000 )
+        try:
+            handles = [ pool.launch( "sleep 0.5" ) for i in range(4) ]
+            pool.wait()
+            
+            # The last two tasks could only start after the first two finished.
+            start_times = sorted( h.startTime for h in handles )
+            assert start_times[2] - start_times[0] >= 0.4
+            assert all( h.poll() == 0 for h in handles )
+        finally:
+            pool.shutdown()
+
+    def testWorkerSettings(self):
+        pool = LocalTaskPool( self._tmpdir, pool_size=1, threads_per_task=3, ram_mb_per_task=1234 )
+        try:
+            handle = pool.launch( 'test "$LAZYFLOW_THREADS" = 3 && test "$LAZYFLOW_TOTAL_RAM_MB" = 1234 && test "$(pwd -P)" = "{}"'
+                                  .format( os.path.realpath(self._tmpdir) ) )
+            pool.wait()
+            assert handle.poll() == 0
+        finally:
+            pool.shutdown()
+
+    def testTerminate(self):
+        pool = LocalTaskPool( self._tmpdir, pool_size=1, threads_per_task=1, ram_mb_per_task=1000 )
+        try:
+            running = pool.launch( "sleep 60" )
+            queued = pool.launch( "exit 0" )
+            while running.startTime is None:
+                time.sleep(0.01)
+
+            start = time.time()
+            queued.terminate()
+            running.terminate()
+            pool.wait()
+            assert time.time() - start < 10.0
+            assert running.poll() not in (None, 0)
+
+            # The queued task never started
+            assert queued.poll() == -1
+            assert queued.startTime is None
+        finally:
+            pool.shutdown()
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
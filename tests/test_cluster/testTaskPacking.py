@@ -0,0 +1,234 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import re
+import json
+import shutil
+import tempfile
+import itertools
+import collections
+
+import numpy
+import vigra
+
+from lazyflow.graph import Graph
+from lazyflow.rtype import Roi, SubRegion
+from lazyflow.utility.io.blockwiseFileset import BlockwiseFileset
+from ilastik.clusterConfig import parseClusterConfigFile
+from ilastik.clusterOps import OpClusterize, OpTaskWorker, _mortonKey
+
+from tests.helpers import OpCountingPiper
+
+def _writeConfig( path, **fields ):
+    config = { "_schema_name" : "cluster-execution-configuration",
+               "_schema_version" : 1.0,
+               "use_node_local_scratch" : False,
+               "command_format" : "{task_args}" }
+    config.update( fields )
+    with open( path, 'w' ) as f:
+        json.dump( config, f )
+
+def _blockRois( shape, blockShape ):
+    """
+    All block rois of the given shape, in C-order.
+    """
+    ranges = [ range( 0, s, b ) for s, b in zip( shape, blockShape ) ]
+    return [ ( start, tuple( numpy.minimum( numpy.add( start, blockShape ), shape ) ) )
+             for start in itertools.product( *ranges ) ]
+
+def _nodeWorkRois( command ):
+    """
+    Parse the block rois from the --_node_work_ argument of a task command, the way OpTaskWorker does.
+    """
+    roiString = re.search( '--_node_work_="([^"]*)"', command ).group(1)
+    return [ Roi.loads( s ) for s in roiString.split( OpClusterize.ROI_SEPARATOR ) ]
+
+class TestMortonKey(object):
+
+    def testOrder2D(self):
+        indexes = sorted( itertools.product( range(4), range(4) ), key=_mortonKey )
+        assert indexes[:8] == [ (0,0), (1,0), (0,1), (1,1), (2,0), (3,0), (2,1), (3,1) ]
+        # Each group of four consecutive blocks is a 2x2 square
+        for i in range( 0, 16, 4 ):
+            xs, ys = zip( *indexes[i:i+4] )
+            assert max(xs) - min(xs) == 1 and max(ys) - min(ys) == 1
+
+    def testOrder3D(self):
+        indexes = sorted( itertools.product( range(4), range(4), range(4) ), key=_mortonKey )
+        assert len( set( map( _mortonKey, indexes ) ) ) == 64, "Keys must be unique"
+        # Each group of eight consecutive blocks is a 2x2x2 cube
+        for i in range( 0, 64, 8 ):
+            for axis_indexes in zip( *indexes[i:i+8] ):
+                assert max(axis_indexes) - min(axis_indexes) == 1
+
+class TestTaskPacking(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.configPath = os.path.join( self.tmpdir, 'cluster_config.json' )
+
+    def tearDown(self):
+        shutil.rmtree( self.tmpdir )
+
+    def _prepareTaskInfos(self, roiList, blockShape, blocks_per_task):
+        fields = { 'output_log_directory' : os.path.join( self.tmpdir, 'logs' ) }
+        if blocks_per_task is not None:
+            fields['task_blocks_per_task'] = str( blocks_per_task )
+        _writeConfig( self.configPath, **fields )
+        opClusterize = OpClusterize( graph=Graph() )
+        opClusterize.ConfigFilePath.setValue( self.configPath )
+        opClusterize.ProjectFilePath.setValue( os.path.join( self.tmpdir, 'MyProject.ilp' ) )
+        opClusterize.OutputDatasetDescription.setValue( os.path.join( self.tmpdir, 'description.json' ) )
+        opClusterize._config = parseClusterConfigFile( self.configPath )
+        return opClusterize._prepareTaskInfos( roiList, blockShape )
+
+    def testPacking(self):
+        blockShape = (10, 10)
+        roiList = _blockRois( (40, 40), blockShape )
+        taskInfos = self._prepareTaskInfos( roiList, blockShape, 4 )
+        assert len( taskInfos ) == 4
+        for taskInfo in taskInfos.values():
+            # Neighboring blocks are packed together: each task computes a 2x2 square of blocks
+            assert len( taskInfo.blockRois ) == 4
+            blockIndexes = numpy.array( [ roi[0] for roi in taskInfo.blockRois ] ) / blockShape
+            assert ( blockIndexes.max( axis=0 ) - blockIndexes.min( axis=0 ) == 1 ).all()
+            assert ( blockIndexes.min( axis=0 ) % 2 == 0 ).all()
+
+        allRois = sum( ( taskInfo.blockRois for taskInfo in taskInfos.values() ), [] )
+        assert sorted( allRois ) == sorted( roiList )
+
+    def testUnevenPacking(self):
+        blockShape = (10, 10, 10)
+        roiList = _blockRois( (30, 20, 15), blockShape )
+        taskInfos = self._prepareTaskInfos( roiList, blockShape, 5 )
+        assert [ len(t.blockRois) for t in taskInfos.values() ] == [5, 5, 2]
+        allRois = sum( ( taskInfo.blockRois for taskInfo in taskInfos.values() ), [] )
+        assert sorted( allRois ) == sorted( roiList )
+
+    def testSingleBlockTasks(self):
+        blockShape = (10, 10)
+        roiList = _blockRois( (30, 20), blockShape )
+        taskInfos = self._prepareTaskInfos( roiList, blockShape, None )
+        # Without packing, the tasks keep the original block order
+        assert [ t.blockRois for t in taskInfos.values() ] == [ [roi] for roi in roiList ]
+
+    def testRoiStringRoundTrip(self):
+        blockShape = (10, 10, 10)
+        roiList = _blockRois( (30, 20, 15), blockShape )
+        taskInfos = self._prepareTaskInfos( roiList, blockShape, 4 )
+        for taskInfo in taskInfos.values():
+            rois = _nodeWorkRois( taskInfo.command )
+            assert [ ( tuple(roi.start), tuple(roi.stop) ) for roi in rois ] == taskInfo.blockRois
+
+class MockTaskFileset(object):
+    """
+    Provides the parts of BlockwiseFileset that OpTaskWorker uses.
+    """
+    class Description(object):
+        def __init__(self, axes):
+            self.axes = axes
+            self.sub_block_shape = None
+
+    def __init__(self, shape, blockShape, axes):
+        self.description = MockTaskFileset.Description( axes )
+        self._shape = shape
+        self._blockShape = blockShape
+        self.statuses = collections.defaultdict( lambda: BlockwiseFileset.BLOCK_NOT_AVAILABLE )
+        self.written = []
+
+    def getEntireBlockRoi(self, block_start):
+        start = numpy.array( block_start )
+        return start, numpy.minimum( start + self._blockShape, self._shape )
+
+    def getBlockStatus(self, block_start):
+        return self.statuses[ tuple(block_start) ]
+
+    def setBlockStatus(self, block_start, status):
+        self.statuses[ tuple(block_start) ] = status
+
+    def writeData(self, roi, data):
+        self.written.append( ( tuple(roi[0]), tuple(roi[1]) ) )
+
+    def close(self):
+        pass
+
+class _NoPostprocessingWorkflow(object):
+    def postprocessClusterSubResult(self, roi, result, blockwiseFileset):
+        pass
+
+class OpMockTaskWorker(OpTaskWorker):
+    """
+    An OpTaskWorker that writes to a MockTaskFileset, outside of a workflow.
+    """
+    def setupOutputs(self):
+        self.ReturnCode.meta.dtype = bool
+        self.ReturnCode.meta.shape = (1,)
+
+    def get_workflow(self):
+        return _NoPostprocessingWorkflow()
+
+class TestResumePackedTask(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.configPath = os.path.join( self.tmpdir, 'cluster_config.json' )
+        _writeConfig( self.configPath, output_log_directory=os.path.join( self.tmpdir, 'logs' ) )
+
+    def tearDown(self):
+        shutil.rmtree( self.tmpdir )
+
+    def testResume(self):
+        shape, blockShape = (40, 40), (20, 20)
+        blockRois = _blockRois( shape, blockShape )
+        roiString = OpClusterize.ROI_SEPARATOR.join( Roi.dumps( SubRegion( None, start=start, stop=stop ) )
+                                                     for start, stop in blockRois )
+
+        # A previous attempt of this task completed two of its four blocks
+        fileset = MockTaskFileset( shape, blockShape, 'xy' )
+        for start, _ in blockRois[:2]:
+            fileset.setBlockStatus( start, BlockwiseFileset.BLOCK_AVAILABLE )
+
+        OpCountingPiper.requested_pixels = 0
+        graph = Graph()
+        opData = OpCountingPiper( graph=graph )
+        opData.Input.setValue( vigra.taggedView( numpy.random.random( shape ).astype( numpy.float32 ), 'xy' ) )
+
+        opWorker = OpMockTaskWorker( graph=graph )
+        opWorker.Input.connect( opData.Output )
+        opWorker.RoiString.setValue( roiString )
+        opWorker.TaskName.setValue( 'J00' )
+        opWorker.ConfigFilePath.setValue( self.configPath )
+        opWorker.OutputFilesetDescription.setValue( os.path.join( self.tmpdir, 'description.json' ) )
+        opWorker._primaryBlockwiseFileset = fileset
+
+        assert opWorker.ReturnCode.value
+        # Only the remaining blocks were computed
+        assert OpCountingPiper.requested_pixels == 2 * 20 * 20
+        assert set( start for start, _ in fileset.written ) <= set( start for start, _ in blockRois[2:] )
+        for start, _ in blockRois:
+            assert fileset.getBlockStatus( start ) == BlockwiseFileset.BLOCK_AVAILABLE
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
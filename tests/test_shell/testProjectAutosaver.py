@@ -0,0 +1,257 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import os
+import time
+import shutil
+import tempfile
+import threading
+
+import h5py
+
+from ilastik.utility.simpleSignal import SimpleSignal
+from ilastik.applets.base.appletSerializer import AppletSerializer
+from ilastik.shell import projectManager as projectManagerModule
+from ilastik.shell.projectManager import ProjectManager
+from ilastik.shell.projectAutosaver import ProjectAutosaver
+
+class _FakeState(object):
+    def __init__(self, marker):
+        self.marker = marker
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class _FakeProjectManager(object):
+    """
+    Records the snapshots that the autosaver writes.  Each write takes write_seconds.
+    """
+    def __init__(self, write_seconds=0.0):
+        self.currentProjectPath = '/tmp/MyProject.ilp'
+        self.marker = 0
+        self.write_seconds = write_seconds
+        self.write_times = []
+        self.captured = []
+
+    def getDirtyAppletNames(self):
+        return ['Some Applet']
+
+    def captureProjectSnapshot(self, snapshotPath, wait=True):
+        state = _FakeState( self.marker )
+        self.captured.append( state )
+        return state
+
+    def writeProjectSnapshot(self, state, snapshotPath):
+        assert snapshotPath == '/tmp/MyProject.autosave.ilp'
+        self.write_times.append( time.time() )
+        time.sleep( self.write_seconds )
+        state.close()
+        return True
+
+class TestProjectAutosaver(object):
+
+    def testSkipWhenUnchanged(self):
+        projectManager = _FakeProjectManager()
+        autosaver = ProjectAutosaver( projectManager, interval_seconds=1 )
+
+        assert autosaver._autosave()
+        assert len( projectManager.write_times ) == 1
+
+        # Nothing changed: the captured state is discarded
+        assert not autosaver._autosave()
+        assert len( projectManager.write_times ) == 1
+        assert projectManager.captured[-1].closed
+
+        projectManager.marker += 1
+        assert autosaver._autosave()
+        assert len( projectManager.write_times ) == 2
+
+    def testCaptureInGuiThread(self):
+        projectManager = _FakeProjectManager()
+        posted = []
+        def postToGuiThread(func):
+            posted.append( func )
+            thread = threading.Thread( target=func )
+            thread.start()
+        autosaver = ProjectAutosaver( projectManager, interval_seconds=1, postToGuiThread=postToGuiThread )
+        assert autosaver._autosave()
+        assert len( posted ) == 1
+        assert len( projectManager.write_times ) == 1
+
+    def testOverheadBackoff(self):
+        # Each autosave takes 0.2 seconds, so with max_overhead=0.5, the next one starts 0.4 seconds later
+        #  (although the interval is shorter).
+        projectManager = _FakeProjectManager( write_seconds=0.2 )
+        autosaver = ProjectAutosaver( projectManager, interval_seconds=0.05, max_overhead=0.5 )
+
+        def changeProject():
+            while not stopped.is_set():
+                projectManager.marker += 1
+                time.sleep( 0.01 )
+        stopped = threading.Event()
+        changer = threading.Thread( target=changeProject )
+        changer.start()
+        autosaver.start()
+        try:
+            time.sleep( 1.5 )
+        finally:
+            autosaver.stop()
+            stopped.set()
+            changer.join()
+
+        write_times = projectManager.write_times
+        assert 2 <= len( write_times ) <= 4, "Unexpected number of autosaves: {}".format( len(write_times) )
+        assert autosaver.last_duration >= 0.2
+        for t1, t2 in zip( write_times[:-1], write_times[1:] ):
+            # The previous autosave (0.2s) plus the wait (at least 0.2 / 0.5)
+            assert t2 - t1 >= 0.2 + 0.4 - 0.01
+
+class _Serializer(AppletSerializer):
+    def __init__(self):
+        super( _Serializer, self ).__init__( 'MyApplet' )
+        self.value = 0
+
+    def isDirty(self):
+        return True
+
+    def _serializeToHdf5(self, topGroup, hdf5File, projectFilePath):
+        if 'value' in topGroup:
+            del topGroup['value']
+        topGroup.create_dataset( 'value', data=self.value )
+
+class _Applet(object):
+    def __init__(self):
+        self.name = 'MyApplet'
+        self.progressSignal = SimpleSignal()
+        self.serializer = _Serializer()
+        self.dataSerializers = [ self.serializer ]
+
+class _Workflow(object):
+    workflowName = 'MyWorkflow'
+
+    def __init__(self, shell, headless, workflow_cmdline_args, project_creation_args):
+        self.applets = [ _Applet() ]
+
+    def cleanUp(self):
+        pass
+
+class TestProjectSnapshot(object):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        projectPath = os.path.join( self.tmpdir, 'MyProject.ilp' )
+        projectFile = h5py.File( projectPath, 'w' )
+        projectFile.create_group( 'MyApplet' ).create_dataset( 'saved', data=1 )
+        projectFile.create_dataset( 'other', data=2 )
+        projectFile.flush()
+
+        self.projectManager = ProjectManager( None, _Workflow, headless=True )
+        self.projectManager.currentProjectFile = projectFile
+        self.projectManager.currentProjectPath = projectPath
+        self.serializer = self.projectManager.workflow.applets[0].serializer
+        self.snapshotPath = os.path.join( self.tmpdir, 'MyProject.autosave.ilp' )
+
+    def tearDown(self):
+        self.projectManager.currentProjectFile.close()
+        shutil.rmtree( self.tmpdir )
+
+    def _readSnapshot(self):
+        with h5py.File( self.snapshotPath, 'r' ) as f:
+            return f['MyApplet/value'][()], f['MyApplet/saved'][()], f['other'][()]
+
+    def testReplaceSnapshot(self):
+        self.serializer.value = 10
+        assert self.projectManager.saveProjectSnapshot( self.snapshotPath )
+        assert self._readSnapshot() == (10, 1, 2)
+
+        # The state is captured when captureProjectSnapshot() is called, not when the snapshot is written.
+        self.serializer.value = 11
+        state = self.projectManager.captureProjectSnapshot( self.snapshotPath )
+        self.serializer.value = 12
+        assert self.projectManager.writeProjectSnapshot( state, self.snapshotPath )
+        assert self._readSnapshot() == (11, 1, 2)
+
+        # The project file itself is unchanged, and no temporary files are left over.
+        assert 'value' not in self.projectManager.currentProjectFile['MyApplet']
+        assert sorted( os.listdir( self.tmpdir ) ) == ['MyProject.autosave.ilp', 'MyProject.ilp']
+
+    def testFailedWriteKeepsSnapshot(self):
+        self.serializer.value = 10
+        assert self.projectManager.saveProjectSnapshot( self.snapshotPath )
+
+        def failingCopy( destinationPath ):
+            with open( destinationPath, 'w' ) as f:
+                f.write( "half-written" )
+            raise IOError( "Disk full" )
+        self.projectManager._copyProjectFile = failingCopy
+
+        self.serializer.value = 11
+        try:
+            self.projectManager.saveProjectSnapshot( self.snapshotPath )
+        except IOError:
+            pass
+        else:
+            assert False, "Expected an IOError"
+
+        # The previous snapshot is intact, and the temporary file was removed.
+        assert self._readSnapshot() == (10, 1, 2)
+        assert sorted( os.listdir( self.tmpdir ) ) == ['MyProject.autosave.ilp', 'MyProject.ilp']
+
+    def testDigestInAutosaveThread(self):
+        # Only the serialization happens in the GUI thread, not the check for changes.
+        guiThreads = []
+        def postToGuiThread(func):
+            thread = threading.Thread( target=func )
+            guiThreads.append( thread )
+            thread.start()
+
+        digestThreads = []
+        originalDigest = projectManagerModule._hdf5Digest
+        def recordingDigest( h5File ):
+            digestThreads.append( threading.current_thread() )
+            return originalDigest( h5File )
+        projectManagerModule._hdf5Digest = recordingDigest
+        try:
+            autosaver = ProjectAutosaver( self.projectManager, interval_seconds=1, postToGuiThread=postToGuiThread )
+            assert autosaver.autosavePath == self.snapshotPath
+            self.serializer.value = 10
+            assert autosaver._autosave()
+            assert not autosaver._autosave(), "Nothing changed"
+        finally:
+            projectManagerModule._hdf5Digest = originalDigest
+
+        assert len( guiThreads ) == 2
+        assert len( digestThreads ) == 2
+        assert not set( guiThreads ) & set( digestThreads )
+
+    def testOutdatedState(self):
+        # States that were captured before the project was saved are not written.
+        state = self.projectManager.captureProjectSnapshot( self.snapshotPath )
+        self.projectManager.saveProject()
+        assert not self.projectManager.writeProjectSnapshot( state, self.snapshotPath )
+        assert not os.path.exists( self.snapshotPath )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)
@@ -0,0 +1,159 @@
+###############################################################################
+#   ilastik: interactive learning and segmentation toolkit
+#
+#       Copyright (C) 2011-2014, the ilastik developers
+#                                <team@ilastik.org>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# In addition, as a special exception, the copyright holders of
+# ilastik give you permission to combine ilastik with applets,
+# workflows and plugins which are not covered under the GNU
+# General Public License.
+#
+# See the LICENSE file for details. License information is also available
+# on the ilastik web site at:
+#		   http://ilastik.org/license.html
+###############################################################################
+import sys
+import logging
+
+import numpy
+import vigra
+import nose
+
+from lazyflow.graph import Graph
+from lazyflow.metaDict import MetaDict
+from lazyflow.utility.timer import Timer
+
+import ilastik.config
+from ilastik.applets.featureSelection.opFeatureSelection import OpFeatureSelection
+from ilastik.utility.slicedBlockShapes import computeSlicedBlockShapes, parseBlockDims
+
+logger = logging.getLogger(__name__)
+logger.addHandler( logging.StreamHandler(sys.stdout) )
+
+def _meta( shape, dtype=numpy.uint8, ideal_blockshape=None, resolutions=None ):
+    axistags = vigra.defaultAxistags('txyzc')
+    for key, resolution in (resolutions or {}).items():
+        axistags.setResolution( key, resolution )
+    return MetaDict( shape=shape, dtype=dtype, axistags=axistags, ideal_blockshape=ideal_blockshape )
+
+class TestSlicedBlockShapes(object):
+
+    def testClipping(self):
+        # The budget that doesn't fit into the short z axis goes to the other in-plane axis
+        meta = _meta( (1, 500, 400, 100, 1) )
+        blockX, blockY, blockZ = computeSlicedBlockShapes( meta, 1, 256*256 )
+        assert blockX == (1, 1, 400, 100, 1), blockX
+        assert blockY == (1, 500, 1, 100, 1), blockY
+        assert blockZ == (1, 256, 256, 1, 1), blockZ
+
+    def testChannelsAndDtype(self):
+        # All channels are included, so the in-plane area shrinks as the channel count grows.
+        meta = _meta( (1, 1000, 1000, 1000, 4), dtype=numpy.float32 )
+        blockX, blockY, blockZ = computeSlicedBlockShapes( meta, 1, 256*256*16 )
+        assert blockZ == (1, 256, 256, 1, 4), blockZ
+
+    def testChunkAlignment(self):
+        meta = _meta( (1, 1000, 1000, 1000, 1), ideal_blockshape=(0, 64, 64, 64, 0) )
+        blockX, blockY, blockZ = computeSlicedBlockShapes( meta, 32, 64*250*250 )
+        # The slab thickness is rounded up to a whole chunk, and the in-plane sides to multiples of the chunk size.
+        assert blockZ == (1, 256, 256, 64, 1), blockZ
+        assert blockX == (1, 64, 256, 256, 1), blockX
+
+    def testAnisotropy(self):
+        # z is sampled 4x more coarsely, so blocks are 4x shorter in z (in pixels)
+        meta = _meta( (1, 1000, 1000, 1000, 1), resolutions={ 'x' : 1.0, 'y' : 1.0, 'z' : 4.0 } )
+        blockX, blockY, blockZ = computeSlicedBlockShapes( meta, 1, 256*256 )
+        assert blockY == (1, 512, 1, 128, 1), blockY
+        assert blockZ == (1, 256, 256, 1, 1), blockZ
+
+    def testFixedDims(self):
+        meta = _meta( (1, 500, 400, 100, 1) )
+        blockShapes = computeSlicedBlockShapes( meta, 1, 256*256, parseBlockDims('z=10, c=1') )
+        for blockShape in blockShapes:
+            assert blockShape[3] == 10
+            assert blockShape[4] == 1
+
+    def testParseBlockDims(self):
+        assert parseBlockDims('') == {}
+        assert parseBlockDims('x=64, Y=32 ,') == { 'x' : 64, 'y' : 32 }
+        for bad in ['x:64', 'q=3', 'x=0', 'x=abc']:
+            try:
+                parseBlockDims( bad )
+            except ValueError:
+                pass
+            else:
+                assert False, "Expected ValueError for '{}'".format( bad )
+
+class TestSlicedBlockShapesBenchmark(object):
+    """
+    Measures the latency of viewer-like slice requests through the feature cache
+    for an anisotropic volume, with uniform and resolution-aware block shapes.
+    """
+
+    SHAPE = (1, 512, 512, 64, 1)
+    SCALES = [0.3, 0.7, 1, 1.6, 3.5, 5.0, 10.0]
+    FEATURE_IDS = [ 'GaussianSmoothing',
+                    'LaplacianOfGaussian',
+                    'StructureTensorEigenvalues',
+                    'HessianOfGaussianEigenvalues',
+                    'GaussianGradientMagnitude',
+                    'DifferenceOfGaussians' ]
+
+    @classmethod
+    def setupClass(cls):
+        # This test is useful for performance evaluation,
+        #  but it takes too long to be useful as part of the normal test suite.
+        raise nose.SkipTest
+
+        data = numpy.random.random( cls.SHAPE ) * 256
+        cls.raw = vigra.taggedView( data.astype( numpy.uint8 ), 'txyzc' )
+
+    def _viewerLatency(self, resolutions):
+        raw = vigra.taggedView( self.raw.view( numpy.ndarray ), 'txyzc' )
+        for key, resolution in resolutions.items():
+            raw.axistags.setResolution( key, resolution )
+
+        selections = numpy.zeros( (len(self.FEATURE_IDS), len(self.SCALES)), dtype=bool )
+        selections[:, 1:3] = True
+
+        opFeatures = OpFeatureSelection( filter_implementation='Original', graph=Graph() )
+        opFeatures.InputImage.setValue( raw )
+        opFeatures.Scales.setValue( self.SCALES )
+        opFeatures.FeatureIds.setValue( self.FEATURE_IDS )
+        opFeatures.SelectionMatrix.setValue( selections )
+
+        # A user looks at a z-slice, scrolls through a few neighbouring slices, then switches to a y-slice.
+        latencies = []
+        for key in [ numpy.s_[:, :, :, 32:33, :],
+                     numpy.s_[:, :, :, 33:34, :],
+                     numpy.s_[:, :, :, 40:41, :],
+                     numpy.s_[:, :, 256:257, :, :] ]:
+            timer = Timer()
+            timer.start()
+            opFeatures.CachedOutputImage[key].wait()
+            timer.stop()
+            latencies.append( timer.seconds() )
+        opFeatures.cleanUp()
+        return latencies
+
+    def testBenchmark(self):
+        cfg = ilastik.config.cfg
+        for block_mb in ['25', '100']:
+            cfg.set( 'cache block shapes', 'feature_block_mb', block_mb )
+            uniform = self._viewerLatency( {} )
+            anisotropic = self._viewerLatency( { 'x' : 1.0, 'y' : 1.0, 'z' : 8.0 } )
+            logger.info( "{} MB blocks: slice latencies (seconds) with uniform blocks: {}, resolution-aware blocks: {}"
+                         .format( block_mb, numpy.round(uniform, 2), numpy.round(anisotropic, 2) ) )
+
+if __name__ == "__main__":
+    import sys
+    import nose
+    sys.argv.append("--nocapture")    # Don't steal stdout.  Show it on the console as usual.
+    sys.argv.append("--nologcapture") # Don't set the logging level to DEBUG.  Leave it alone.
+    nose.run(defaultTest=__file__)